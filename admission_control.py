@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+并发准入控制模块
+限制同时进行的上游请求数量，超出部分进入有界FIFO队列排队，
+队列已满或排队超时时快速拒绝并返回 Retry-After。
+多租户时每个租户各自排队，按权重加权公平地分配上游容量
+"""
+
+import asyncio
+import time
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+    """准入被拒绝（队列已满或排队超时）"""
+
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """全局准入控制器"""
+
+    def __init__(self, max_inflight: int = 32, max_queue: int = 64, queue_timeout: float = 30.0):
+        """
+        初始化准入控制器
+
+        Args:
+            max_inflight: 同时进行的上游请求数上限
+            max_queue: 等待队列的最大长度
+            queue_timeout: 单个请求在队列中的最长等待时间（秒）
+        """
+        self.max_inflight = max(1, max_inflight)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+
+        self._inflight = 0
+        # 每个租户一个FIFO队列，按虚拟时间选择下一个获得名额的租户
+        self._queues: Dict[str, deque] = {}
+        self._vtime: Dict[str, float] = {}
+        self._shares: Dict[str, float] = {}
+        self._queue_depth = 0
+
+        # 统计信息
+        self._admitted = 0
+        self._queued = 0
+        self._rejected_queue_full = 0
+        self._rejected_timeout = 0
+        self._peak_inflight = 0
+        self._peak_queue_depth = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._recent_waits = deque(maxlen=1000)
+        self._recent_holds = deque(maxlen=200)
+
+    def reconfigure(self, max_inflight: int, max_queue: int, queue_timeout: float):
+        """更新限制参数，已在队列中的请求按新上限重新调度"""
+        self.max_inflight = max(1, max_inflight)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self._wake_waiters()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue_depth
+
+    @property
+    def inflight(self) -> int:
+        return self._inflight
+
+    def _retry_after(self) -> int:
+        """根据最近的占用时长估算客户端应等待的秒数"""
+        if self._recent_holds:
+            avg_hold = sum(self._recent_holds) / len(self._recent_holds)
+        else:
+            avg_hold = 1.0
+        rounds = (self._queue_depth + 1) / self.max_inflight
+        return max(1, int(avg_hold * rounds + 0.999))
+
+    def _charge(self, tenant: str, weight: int):
+        """按租户权重推进其虚拟时间，权重越大推进越慢，获得的份额越多"""
+        self._vtime[tenant] = self._vtime.get(tenant, 0.0) + weight / self._shares.get(tenant, 1.0)
+
+    def _next_tenant(self) -> Optional[str]:
+        """选出虚拟时间最小的排队租户"""
+        backlogged = [tenant for tenant, queue in self._queues.items() if queue]
+        if not backlogged:
+            return None
+        return min(backlogged, key=lambda tenant: self._vtime.get(tenant, 0.0))
+
+    def _grant(self, weight: int, waited: float):
+        self._inflight += weight
+        self._admitted += 1
+        self._peak_inflight = max(self._peak_inflight, self._inflight)
+        self._wait_total += waited
+        self._wait_max = max(self._wait_max, waited)
+        self._recent_waits.append(waited)
+
+    def _wake_waiters(self):
+        """唤醒可以获得名额的等待者：租户之间加权公平，租户内部FIFO"""
+        while True:
+            tenant = self._next_tenant()
+            if tenant is None:
+                break
+            queue = self._queues[tenant]
+            weight, future, enqueued_at = queue[0]
+            if future.done():
+                queue.popleft()
+                self._queue_depth -= 1
+                continue
+            if self._inflight + weight > self.max_inflight:
+                break
+            queue.popleft()
+            self._queue_depth -= 1
+            self._charge(tenant, weight)
+            self._grant(weight, time.monotonic() - enqueued_at)
+            future.set_result(weight)
+
+    def _tenant_queue_limit(self, tenant: str) -> int:
+        """每个租户最多占用与其权重成比例的队列长度，避免单个租户挤满队列"""
+        total_share = sum(self._shares.values()) or 1.0
+        return max(1, int(self.max_queue * self._shares.get(tenant, 1.0) / total_share + 0.5))
+
+    async def acquire(self, weight: int = 1, tenant: str = "default", share: float = 1.0) -> int:
+        """
+        申请上游请求名额
+
+        Args:
+            weight: 本次请求计划发起的上游调用数
+            tenant: 发起请求的租户名称
+            share: 租户的公平份额权重
+
+        Returns:
+            实际获得的名额数（不超过 max_inflight）
+
+        Raises:
+            AdmissionRejected: 队列已满(429)或排队超时(503)
+        """
+        weight = max(1, min(weight, self.max_inflight))
+        self._shares[tenant] = share if share > 0 else 1.0
+        queue = self._queues.setdefault(tenant, deque())
+
+        if not queue:
+            # 租户重新进入排队状态时，虚拟时间不能落后于当前最慢的排队租户，
+            # 否则空闲期间“攒下”的份额会让它长时间独占上游容量
+            active = [self._vtime.get(name, 0.0) for name, q in self._queues.items() if q]
+            floor = min(active) if active else max(self._vtime.values(), default=0.0)
+            self._vtime[tenant] = max(self._vtime.get(tenant, 0.0), floor)
+
+        if self._queue_depth == 0 and self._inflight + weight <= self.max_inflight:
+            self._charge(tenant, weight)
+            self._grant(weight, 0.0)
+            return weight
+
+        if self._queue_depth >= self.max_queue or len(queue) >= self._tenant_queue_limit(tenant):
+            self._rejected_queue_full += 1
+            retry_after = self._retry_after()
+            logger.warning(f"准入队列已满 (深度: {self._queue_depth}, 租户 {tenant}: {len(queue)}), 拒绝请求")
+            raise AdmissionRejected(429, "服务繁忙，请求队列已满，请稍后重试。", retry_after)
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = (weight, future, time.monotonic())
+        queue.append(waiter)
+        self._queue_depth += 1
+        self._queued += 1
+        self._peak_queue_depth = max(self._peak_queue_depth, self._queue_depth)
+
+        try:
+            return await asyncio.wait_for(future, timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._remove_waiter(tenant, waiter)
+            self._rejected_timeout += 1
+            logger.warning(f"请求排队超过 {self.queue_timeout} 秒，拒绝请求")
+            raise AdmissionRejected(503, "请求排队超时，服务暂时不可用。", self._retry_after())
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 名额已经分配但调用方已放弃，立即归还
+                self.release(weight)
+            else:
+                self._remove_waiter(tenant, waiter)
+            raise
+
+    def try_acquire(self, weight: int = 1, headroom: int = 0) -> int:
+        """
+        不排队地申请名额（批处理等低优先级任务使用）：只有没有请求在排队、
+        且占用后仍空出 headroom 个名额留给交互请求时才成功，否则立即返回0
+
+        Returns:
+            获得的名额数，用完后调用 release 归还
+        """
+        weight = max(1, min(weight, self.max_inflight))
+        if self._queue_depth > 0 or self._inflight + weight + headroom > self.max_inflight:
+            return 0
+        self._grant(weight, 0.0)
+        return weight
+
+    def _remove_waiter(self, tenant: str, waiter):
+        try:
+            self._queues[tenant].remove(waiter)
+            self._queue_depth -= 1
+        except ValueError:
+            pass
+        # 队首被移除后，后面的等待者可能已经可以获得名额
+        self._wake_waiters()
+
+    def release(self, weight: int, held_for: float = None):
+        """归还上游请求名额"""
+        self._inflight = max(0, self._inflight - weight)
+        if held_for is not None:
+            self._recent_holds.append(held_for)
+        self._wake_waiters()
+
+    @asynccontextmanager
+    async def admit(self, weight: int = 1, tenant: str = "default", share: float = 1.0):
+        """以上下文管理器形式持有名额，退出时自动归还"""
+        granted = await self.acquire(weight, tenant, share)
+        started = time.monotonic()
+        try:
+            yield granted
+        finally:
+            self.release(granted, time.monotonic() - started)
+
+    @staticmethod
+    def _percentile(values: List[float], pct: float) -> float:
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        index = min(len(ordered) - 1, int(len(ordered) * pct))
+        return ordered[index]
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取准入控制统计信息"""
+        waits = list(self._recent_waits)
+        return {
+            'max_inflight': self.max_inflight,
+            'max_queue': self.max_queue,
+            'queue_timeout': self.queue_timeout,
+            'inflight': self._inflight,
+            'peak_inflight': self._peak_inflight,
+            'queue_depth': self._queue_depth,
+            'tenant_queue_depth': {tenant: len(queue) for tenant, queue in self._queues.items() if queue},
+            'peak_queue_depth': self._peak_queue_depth,
+            'admitted': self._admitted,
+            'queued': self._queued,
+            'rejected_queue_full': self._rejected_queue_full,
+            'rejected_timeout': self._rejected_timeout,
+            'wait_avg_ms': round(self._wait_total / self._admitted * 1000, 2) if self._admitted else 0.0,
+            'wait_max_ms': round(self._wait_max * 1000, 2),
+            'wait_p50_ms': round(self._percentile(waits, 0.50) * 1000, 2),
+            'wait_p95_ms': round(self._percentile(waits, 0.95) * 1000, 2),
+        }
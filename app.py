@@ -5,38 +5,37 @@ LLM代理服务 - Web版
 将GUI改为HTML界面，支持热重载更改配置，为迁移到安卓上的termux做准备
 """
 
-import asyncio
-import httpx
 import os
 import sys
+import hmac
 import json
 import time
 import logging
 import configparser
 import threading
-import signal
-import platform
-import socket
-import subprocess
-import webbrowser
+import importlib.util
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 
-# 尝试导入Flask相关模块
-try:
-    from flask import Flask, render_template, request, jsonify, send_from_directory
-    from flask_cors import CORS
-    from flask_socketio import SocketIO, emit
-    FLASK_AVAILABLE = True
-except ImportError:
-    FLASK_AVAILABLE = False
+# Web界面依赖（Flask、SocketIO）只在Web模式下才导入，这里只检查是否已安装，
+# 命令行模式不必为它们付出导入时间
+FLASK_AVAILABLE = all(
+    importlib.util.find_spec(name) is not None
+    for name in ('flask', 'flask_cors', 'flask_socketio')
+)
 
 # 尝试导入FastAPI和Pydantic（用于API代理服务）
 try:
-    from fastapi import FastAPI, Request, HTTPException
-    from fastapi.responses import JSONResponse, StreamingResponse
+    from fastapi import FastAPI, Request, HTTPException, Depends
+    from fastapi.responses import JSONResponse, StreamingResponse, Response
     from fastapi.middleware.cors import CORSMiddleware
     from pydantic import BaseModel
+    from request_trace import span, trace_store, RequestTraceMiddleware
+    from admission_control import AdmissionRejected
+    from proxy_engine import ProxyEngine, EngineError, to_sse
+    from live_metrics import MetricsAggregator
+    from server_control import ManagedServer
+    from socket_handoff import serve
     FASTAPI_AVAILABLE = True
 except ImportError:
     FASTAPI_AVAILABLE = False
@@ -58,8 +57,15 @@ class ConfigManager:
     
     def __init__(self, config_file: str = "config.ini"):
         self.config_file = get_resource_path(config_file)
-        self.config = configparser.ConfigParser()
-        self.load_config()
+        self._config = None
+    
+    @property
+    def config(self) -> configparser.ConfigParser:
+        """首次访问时才读取配置文件，导入模块时不做任何文件读写"""
+        if self._config is None:
+            self._config = configparser.ConfigParser()
+            self.load_config()
+        return self._config
     
     def load_config(self):
         """加载配置文件"""
@@ -77,7 +83,11 @@ class ConfigManager:
             'min_response_length': '400',
             'request_timeout': '180',
             'web_port': '5001',
-            'web_host': '127.0.0.1'
+            'web_host': '127.0.0.1',
+            'selection': 'longest',
+            'wait_more': '15',
+            'shutdown_timeout': '30',
+            'reuse_port': 'true'
         }
         
         self.config['API_KEYS'] = {
@@ -120,13 +130,19 @@ class ConfigManager:
             'min_response_length': int(self.config['SERVER']['min_response_length']),
             'request_timeout': int(self.config['SERVER']['request_timeout']),
             'web_port': int(self.config['SERVER']['web_port']),
-            'web_host': self.config['SERVER']['web_host']
+            'web_host': self.config['SERVER']['web_host'],
+            'selection': self.config.get('SERVER', 'selection', fallback='longest'),
+            'wait_more': self.config.getfloat('SERVER', 'wait_more', fallback=15.0),
+            'min_response_unit': self.config.get('SERVER', 'min_response_unit', fallback='chars'),
+            'shutdown_timeout': self.config.getfloat('SERVER', 'shutdown_timeout', fallback=30.0),
+            'reuse_port': self.config.getboolean('SERVER', 'reuse_port', fallback=True)
         }
     
     def set_server_config(self, port: int, host: str, api_key: str, 
                          min_response_length: int, request_timeout: int,
-                         web_port: int, web_host: str):
-        """设置服务器配置"""
+                         web_port: int, web_host: str,
+                         selection: Optional[str] = None, wait_more: Optional[float] = None):
+        """设置服务器配置（selection/wait_more 未提供时保持不变）"""
         self.config['SERVER']['port'] = str(port)
         self.config['SERVER']['host'] = host
         self.config['SERVER']['api_key'] = api_key
@@ -134,6 +150,10 @@ class ConfigManager:
         self.config['SERVER']['request_timeout'] = str(request_timeout)
         self.config['SERVER']['web_port'] = str(web_port)
         self.config['SERVER']['web_host'] = web_host
+        if selection is not None:
+            self.config['SERVER']['selection'] = selection
+        if wait_more is not None:
+            self.config['SERVER']['wait_more'] = str(wait_more)
         self.save_config()
     
     def get_api_keys(self) -> Dict[str, List[str]]:
@@ -157,6 +177,10 @@ class ConfigManager:
         """设置基础URL"""
         self.config['API']['base_url'] = base_url
         self.save_config()
+    
+    def get_admin_key(self) -> str:
+        """获取调试接口的管理密钥（[SERVER] admin_key），未配置时调试接口不可用"""
+        return self.config.get('SERVER', 'admin_key', fallback='').strip()
 
 # 配置日志
 logging.basicConfig(
@@ -164,7 +188,7 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[
         logging.StreamHandler(sys.stdout),
-        logging.FileHandler('llm_proxy.log', encoding='utf-8')
+        logging.FileHandler('llm_proxy.log', encoding='utf-8', delay=True)
     ]
 )
 logger = logging.getLogger(__name__)
@@ -181,210 +205,67 @@ if FASTAPI_AVAILABLE:
         max_tokens: int = 4096
         stream: bool = False
 
-    # 轮询计数器
-    current_group_index = 0
+    # 代理引擎：与 llm_proxy.py 共用同一份并发扇出实现。
+    # Web版默认的选择规则是出现有效响应后再等待15秒，返回其中最长的
+    _engine = None
 
-    def get_current_api_keys():
-        """根据轮询机制返回当前应该使用的API密钥组"""
-        global current_group_index
+    def get_engine() -> ProxyEngine:
+        """首次使用时按当前配置创建代理引擎"""
+        global _engine
+        if _engine is None:
+            server_config = config_manager.get_server_config()
+            api_keys = config_manager.get_api_keys()
+            _engine = ProxyEngine(
+                base_url=config_manager.get_base_url(),
+                key_groups=[api_keys['group1'], api_keys['group2']],
+                min_response_length=server_config['min_response_length'],
+                request_timeout=server_config['request_timeout'],
+                selection=server_config['selection'],
+                wait_more=server_config['wait_more'],
+                length_unit=server_config['min_response_unit']
+            )
+        return _engine
+
+    def apply_engine_config():
+        """把保存后的配置同步到代理引擎，下一个请求即生效，不影响已建立的连接"""
+        if _engine is None:
+            return
+        server_config = config_manager.get_server_config()
         api_keys = config_manager.get_api_keys()
-        
-        if current_group_index == 0:
-            keys = api_keys['group1']
-            current_group_index = 1
-        else:
-            keys = api_keys['group2']
-            current_group_index = 0
-        
-        valid_keys = [key for key in keys if key and not key.startswith("YOUR_") and len(key) > 10]
-        return valid_keys
-
-    async def send_single_request(client: httpx.AsyncClient, api_key: str, request_data: dict):
-        """使用单个API密钥发送请求"""
-        cleaned_data = {}
-        supported_params = {
-            'model', 'messages', 'temperature', 'max_tokens',
-            'top_p', 'top_k', 'stop'
-        }
-        
-        for key, value in request_data.items():
-            if key in supported_params:
-                cleaned_data[key] = value
-        
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json",
-        }
-        
-        url = f"{config_manager.get_base_url()}/openai/chat/completions"
-        
-        try:
-            response = await client.post(url, headers=headers, json=cleaned_data,
-                                       timeout=config_manager.get_server_config()['request_timeout'])
-            response.raise_for_status()
-            
-            response_text = response.text
-            
-            if "data:" in response_text:
-                lines = response_text.strip().split('\n')
-                content = ""
-                final_id = ""
-                final_model = ""
-                final_created = int(time.time())
-                
-                for line in lines:
-                    if line.startswith("data: "):
-                        try:
-                            data = json.loads(line[6:])
-                            if data == "[DONE]":
-                                continue
-                                
-                            if "choices" in data and data["choices"]:
-                                delta = data["choices"][0].get("delta", {})
-                                if "content" in delta:
-                                    content += delta["content"]
-                                
-                                if "id" in data:
-                                    final_id = data["id"]
-                                if "model" in data:
-                                    final_model = data["model"]
-                                if "created" in data:
-                                    final_created = data["created"]
-                                    
-                        except json.JSONDecodeError:
-                            continue
-                
-                if content:
-                    return {
-                        "id": final_id or "chatcmpl-" + str(int(time.time())),
-                        "object": "chat.completion",
-                        "created": final_created,
-                        "model": final_model or "gemini-2.5-flash",
-                        "choices": [
-                            {
-                                "index": 0,
-                                "message": {
-                                    "role": "assistant",
-                                    "content": content,
-                                },
-                                "finish_reason": "stop"
-                            }
-                        ],
-                        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
-                    }
-            
-            try:
-                return response.json()
-            except ValueError as e:
-                logger.error(f"JSON解析错误: {e}")
-                return None
-                
-        except httpx.RequestError as e:
-            logger.error(f"请求错误: {e}")
-            return None
-        except Exception as e:
-            logger.error(f"未知错误: {e}")
-            return None
+        _engine.configure(
+            base_url=config_manager.get_base_url(),
+            key_groups=[api_keys['group1'], api_keys['group2']],
+            min_response_length=server_config['min_response_length'],
+            request_timeout=server_config['request_timeout'],
+            selection=server_config['selection'],
+            wait_more=server_config['wait_more'],
+            length_unit=server_config['min_response_unit']
+        )
 
-    async def generate_fake_stream_response(request_data: dict):
-        """获取完整的响应内容，等待15秒后选择token最长的响应，然后以流式方式发送给前端"""
-        try:
-            current_keys = get_current_api_keys()
-            if not current_keys:
-                raise HTTPException(status_code=500, detail="没有可用的API密钥")
-            
-            valid_responses = []
-            
-            async with httpx.AsyncClient() as client:
-                tasks = [
-                    asyncio.create_task(send_single_request(client, key, request_data))
-                    for key in current_keys
-                ]
-                
-                # 收集所有有效的响应
-                for future in asyncio.as_completed(tasks):
-                    try:
-                        result = await future
-                        if result and "choices" in result and result["choices"]:
-                            message_content = result["choices"][0].get("message", {}).get("content", "")
-                            if len(message_content) >= config_manager.get_server_config()['min_response_length']:
-                                valid_responses.append({
-                                    'result': result,
-                                    'content': message_content,
-                                    'token_count': len(message_content)
-                                })
-                    except asyncio.CancelledError:
-                        pass
-                
-                # 等待15秒收集更多响应
-                if valid_responses:
-                    # 已经有有效响应，继续等待其他响应
-                    remaining_tasks = [task for task in tasks if not task.done()]
-                    if remaining_tasks:
-                        try:
-                            done, pending = await asyncio.wait(remaining_tasks, timeout=15)
-                            
-                            # 处理剩余完成的任务
-                            for task in done:
-                                try:
-                                    result = task.result()
-                                    if result and "choices" in result and result["choices"]:
-                                        message_content = result["choices"][0].get("message", {}).get("content", "")
-                                        if len(message_content) >= config_manager.get_server_config()['min_response_length']:
-                                            valid_responses.append({
-                                                'result': result,
-                                                'content': message_content,
-                                                'token_count': len(message_content)
-                                            })
-                                except Exception as e:
-                                    logger.error(f"处理响应时出错: {e}")
-                                    pass
-                            
-                            # 取消仍在进行的任务
-                            for task in pending:
-                                task.cancel()
-                                
-                        except asyncio.TimeoutError:
-                            logger.warning("等待响应超时")
-                            pass
-                
-                # 选择token最长的响应
-                if valid_responses:
-                    best_response = max(valid_responses, key=lambda x: x['token_count'])
-                    return await stream_response_content(best_response['result'], best_response['content'])
-
-            raise HTTPException(status_code=503, detail="所有上游API请求均失败")
-        except HTTPException:
-            raise
-        except Exception as e:
-            logger.error(f"生成流式响应时出错: {e}")
-            raise HTTPException(status_code=500, detail=f"服务器内部错误: {str(e)}")
-
-    async def stream_response_content(result: dict, content: str):
-        """将完整的响应内容以流式方式发送给前端"""
-        response_id = result.get("id", f"chatcmpl-{int(time.time())}")
-        created_time = result.get("created", int(time.time()))
-        model_name = result.get("model", "gemini-2.5-flash")
-        
-        async def generate_stream():
-            chunk_size = max(1, len(content) // 50)
-            for i in range(0, len(content), chunk_size):
-                chunk = content[i:i+chunk_size]
-                chunk_data = {
-                    "id": response_id, "object": "chat.completion.chunk", "created": created_time, "model": model_name,
-                    "choices": [{"index": 0, "delta": {"content": chunk}, "finish_reason": None}]
-                }
-                yield f"data: {json.dumps(chunk_data)}\n\n"
-                await asyncio.sleep(0.01)
-            
-            final_data = {
-                "id": response_id, "object": "chat.completion.chunk", "created": created_time, "model": model_name,
-                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
-            }
-            yield f"data: {json.dumps(final_data)}\n\n"
-            yield "data: [DONE]\n\n"
-        
-        return StreamingResponse(generate_stream(), media_type="text/event-stream")
+    # Web模式下由界面启动/停止的API服务
+    _api_server = None
+
+    def get_api_server() -> ManagedServer:
+        """首次使用时创建受管理的API服务"""
+        global _api_server
+        if _api_server is None:
+            _api_server = ManagedServer(
+                app_fastapi, drain_timeout=config_manager.get_server_config()['shutdown_timeout']
+            )
+        return _api_server
+
+    def is_api_server_running() -> bool:
+        return _api_server is not None and _api_server.is_running
+
+    def engine_gauges() -> Dict[str, Any]:
+        """仪表盘上的瞬时值：排队深度和进行中的上游请求数"""
+        if _engine is None:
+            return {'queue_depth': 0, 'inflight': 0}
+        stats = _engine.admission.get_stats()
+        return {'queue_depth': stats['queue_depth'], 'inflight': stats['inflight']}
+
+    # 实时指标：API服务线程中记录，Web界面的后台任务每秒汇总一次并推送增量
+    dashboard_metrics = MetricsAggregator(gauges=engine_gauges)
 
     # 初始化FastAPI应用
     app_fastapi = FastAPI(title="LLM代理服务", version="2.0.0")
@@ -392,112 +273,94 @@ if FASTAPI_AVAILABLE:
         CORSMiddleware,
         allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"]
     )
+    # 返回 Server-Timing / X-Proxy-Request-Id，并保存最近的请求时间线
+    app_fastapi.add_middleware(RequestTraceMiddleware, store=trace_store,
+                               observers=[dashboard_metrics.observe_trace])
+
+    @app_fastapi.exception_handler(EngineError)
+    async def engine_error_handler(request: Request, exc: EngineError):
+        return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail})
+
+    @app_fastapi.exception_handler(AdmissionRejected)
+    async def admission_rejected_handler(request: Request, exc: AdmissionRejected):
+        return JSONResponse(
+            status_code=exc.status_code,
+            content={"detail": exc.detail},
+            headers={"Retry-After": str(exc.retry_after)}
+        )
+
+    @app_fastapi.on_event("startup")
+    async def start_engine():
+        get_engine().start()
+
+    @app_fastapi.on_event("shutdown")
+    async def close_engine():
+        await get_engine().aclose()
 
     @app_fastapi.post("/v1/chat/completions")
     async def chat_completions_proxy(chat_request: ChatRequest, request: Request):
-        try:
-            api_key_header = request.headers.get("Authorization")
-            if not api_key_header or not api_key_header.startswith("Bearer "):
-                raise HTTPException(status_code=401, detail="缺少API密钥或格式不正确")
-            
-            provided_key = api_key_header.split(" ")[1]
+        api_key_header = request.headers.get("Authorization")
+        if not api_key_header or not api_key_header.startswith("Bearer "):
+            raise HTTPException(status_code=401, detail="缺少API密钥或格式不正确")
+        
+        provided_key = api_key_header.split(" ")[1]
+        with span("auth"):
             server_config = config_manager.get_server_config()
-            if not provided_key or provided_key != server_config['api_key']:
-                raise HTTPException(status_code=401, detail="API密钥无效")
-            
+        if not provided_key or not hmac.compare_digest(provided_key.encode(), server_config['api_key'].encode()):
+            raise HTTPException(status_code=401, detail="API密钥无效")
+        
+        with span("parse"):
             request_data = await request.json()
-            
-            if chat_request.stream:
-                return await generate_fake_stream_response(request_data)
-            
-            current_keys = get_current_api_keys()
-            if not current_keys:
-                raise HTTPException(status_code=500, detail="服务器未配置有效的API密钥")
-            
-            valid_responses = []
-            
-            async with httpx.AsyncClient() as client:
-                tasks = [
-                    asyncio.create_task(send_single_request(client, key, request_data))
-                    for key in current_keys
-                ]
-                
-                # 收集所有有效的响应
-                for future in asyncio.as_completed(tasks):
-                    try:
-                        result = await future
-                        if result and "choices" in result and result["choices"]:
-                            message_content = result["choices"][0].get("message", {}).get("content", "")
-                            if len(message_content) >= server_config['min_response_length']:
-                                valid_responses.append({
-                                    'result': result,
-                                    'content': message_content,
-                                    'token_count': len(message_content)
-                                })
-                    except asyncio.CancelledError:
-                        pass
-                
-                # 等待15秒收集更多响应
-                if valid_responses:
-                    # 已经有有效响应，继续等待其他响应
-                    remaining_tasks = [task for task in tasks if not task.done()]
-                    if remaining_tasks:
-                        try:
-                            done, pending = await asyncio.wait(remaining_tasks, timeout=15)
-                            
-                            # 处理剩余完成的任务
-                            for task in done:
-                                try:
-                                    result = task.result()
-                                    if result and "choices" in result and result["choices"]:
-                                        message_content = result["choices"][0].get("message", {}).get("content", "")
-                                        if len(message_content) >= server_config['min_response_length']:
-                                            valid_responses.append({
-                                                'result': result,
-                                                'content': message_content,
-                                                'token_count': len(message_content)
-                                            })
-                                except Exception as e:
-                                    logger.error(f"处理响应时出错: {e}")
-                                    pass
-                            
-                            # 取消仍在进行的任务
-                            for task in pending:
-                                task.cancel()
-                                
-                        except asyncio.TimeoutError:
-                            logger.warning("等待响应超时")
-                            pass
-                
-                # 选择token最长的响应
-                if valid_responses:
-                    best_response = max(valid_responses, key=lambda x: x['token_count'])
-                    return JSONResponse(content=best_response['result'])
-
-            raise HTTPException(status_code=503, detail="所有上游API请求均失败")
-        except HTTPException:
-            raise
-        except Exception as e:
-            logger.error(f"处理聊天完成请求时出错: {e}")
-            raise HTTPException(status_code=500, detail=f"服务器内部错误: {str(e)}")
+        
+        result = await get_engine().complete(request_data)
+        
+        if chat_request.stream:
+            # 将完整的响应内容以流式方式发送给前端
+            return StreamingResponse(to_sse(get_engine().iter_chunks(result)), media_type="text/event-stream")
+        
+        return Response(content=result.body, media_type="application/json")
 
     @app_fastapi.get("/")
     def read_root():
         return {"status": "ok", "message": "LLM代理服务正在运行"}
 
-# ==================== Flask Web界面 (如果可用) ====================
-if FLASK_AVAILABLE:
+    def require_admin(request: Request):
+        """校验管理密钥，未配置管理密钥时调试接口不存在"""
+        admin_key = config_manager.get_admin_key()
+        if not admin_key:
+            raise HTTPException(status_code=404, detail="Not Found")
+        api_key_header = request.headers.get("Authorization", "")
+        provided_key = api_key_header[7:] if api_key_header.startswith("Bearer ") else ""
+        if not provided_key or not hmac.compare_digest(provided_key.encode(), admin_key.encode()):
+            raise HTTPException(status_code=401, detail="管理密钥无效。")
+
+    # 请求时间线包含密钥末4位和每一路上游请求的细节，需要管理密钥
+    @app_fastapi.get("/debug/requests", dependencies=[Depends(require_admin)])
+    def list_debug_requests(limit: int = 50):
+        """最近请求的时间线摘要（最新的在前）"""
+        return {"requests": trace_store.list(limit)}
+
+    @app_fastapi.get("/debug/requests/{request_id}", dependencies=[Depends(require_admin)])
+    def get_debug_request(request_id: str):
+        """单个请求的完整时间线，包括每一路上游请求的状态、耗时和字节数"""
+        timeline = trace_store.get(request_id)
+        if timeline is None:
+            raise HTTPException(status_code=404, detail="请求记录不存在或已被淘汰")
+        return timeline
+
+# ==================== Flask Web界面 (Web模式下按需创建) ====================
+def create_web_app():
+    """导入Flask相关模块并创建Web界面应用，返回 (app_flask, socketio)"""
+    from flask import Flask, render_template, request, jsonify
+    from flask_cors import CORS
+    from flask_socketio import SocketIO, emit
+
     app_flask = Flask(__name__, 
                      template_folder='templates',
                      static_folder='static')
     CORS(app_flask)
     socketio = SocketIO(app_flask, cors_allowed_origins="*")
     
-    # 全局变量
-    api_server_thread = None
-    is_api_server_running = False
-    api_server_lock = threading.Lock()
-    
     @app_flask.route('/')
     def index():
         """主页"""
@@ -530,9 +393,13 @@ if FLASK_AVAILABLE:
         try:
             data = request.get_json()
             
+            previous_server = config_manager.get_server_config()
+            
             # 保存服务器配置
             if 'server' in data:
                 server = data['server']
+                if server.get('selection') not in (None, 'first', 'longest', 'score'):
+                    return jsonify({'error': "选择规则只能是 first、longest 或 score"}), 400
                 config_manager.set_server_config(
                     port=int(server['port']),
                     host=server['host'],
@@ -540,7 +407,9 @@ if FLASK_AVAILABLE:
                     min_response_length=int(server['min_response_length']),
                     request_timeout=int(server['request_timeout']),
                     web_port=int(server['web_port']),
-                    web_host=server['web_host']
+                    web_host=server['web_host'],
+                    selection=server.get('selection'),
+                    wait_more=float(server['wait_more']) if 'wait_more' in server else None
                 )
             
             # 保存API密钥
@@ -555,148 +424,200 @@ if FLASK_AVAILABLE:
             if 'base_url' in data:
                 config_manager.set_base_url(data['base_url'])
             
-            return jsonify({'success': True})
+            if not FASTAPI_AVAILABLE:
+                return jsonify({'success': True})
+            
+            # 超时、最短长度、密钥和选择规则直接热更新，不断开已建立的连接
+            apply_engine_config()
+            
+            # 监听地址变化只能重启API服务：先处理完进行中的请求再切换到新地址
+            server_config = config_manager.get_server_config()
+            address_changed = (server_config['host'], server_config['port']) != \
+                              (previous_server['host'], previous_server['port'])
+            if address_changed and is_api_server_running():
+                api_server = get_api_server()
+                api_server.restart(server_config['host'], server_config['port'])
+                socketio.emit('server_status', {'status': 'running', 'url': api_server.url})
+                return jsonify({'success': True, 'restarted': True})
+            
+            return jsonify({'success': True, 'restarted': False})
         except Exception as e:
             return jsonify({'error': str(e)}), 500
     
     @app_flask.route('/api/server/start', methods=['POST'])
     def start_api_server():
-        """启动API服务器"""
-        global api_server_thread, is_api_server_running
+        """启动API服务器（端口开始监听后才返回）"""
+        if not FASTAPI_AVAILABLE:
+            return jsonify({'error': 'FastAPI不可用，无法启动API服务器'})
+        
+        api_server = get_api_server()
+        if api_server.is_running:
+            return jsonify({'error': '服务器已在运行中'})
         
-        with api_server_lock:
-            if is_api_server_running:
-                return jsonify({'error': '服务器已在运行中'})
+        try:
+            server_config = config_manager.get_server_config()
+            api_server.start(server_config['host'], server_config['port'])
             
-            if not FASTAPI_AVAILABLE:
-                return jsonify({'error': 'FastAPI不可用，无法启动API服务器'})
+            # 通过SocketIO通知前端
+            socketio.emit('server_status', {
+                'status': 'running',
+                'url': api_server.url
+            })
             
-            try:
-                server_config = config_manager.get_server_config()
-                
-                def run_api_server():
-                    try:
-                        import uvicorn
-                        uvicorn.run(
-                            app_fastapi,
-                            host=server_config['host'],
-                            port=server_config['port'],
-                            log_level="info"
-                        )
-                    except Exception as e:
-                        logger.error(f"API服务器运行错误: {e}")
-                        with api_server_lock:
-                            global is_api_server_running
-                            is_api_server_running = False
-                
-                api_server_thread = threading.Thread(target=run_api_server, daemon=True)
-                api_server_thread.start()
-                is_api_server_running = True
-                
-                # 通过SocketIO通知前端
-                socketio.emit('server_status', {
-                    'status': 'running',
-                    'url': f"http://{server_config['host']}:{server_config['port']}"
-                })
-                
-                return jsonify({'success': True})
-            except Exception as e:
-                logger.error(f"启动API服务器失败: {e}")
-                return jsonify({'error': str(e)}), 500
+            return jsonify({'success': True})
+        except Exception as e:
+            logger.error(f"启动API服务器失败: {e}")
+            return jsonify({'error': str(e)}), 500
     
     @app_flask.route('/api/server/stop', methods=['POST'])
     def stop_api_server():
-        """停止API服务器"""
-        global is_api_server_running
+        """停止API服务器：不再接受新连接，进行中的请求在期限内处理完"""
+        if not is_api_server_running():
+            return jsonify({'error': '服务器未运行'})
         
-        with api_server_lock:
-            if not is_api_server_running:
-                return jsonify({'error': '服务器未运行'})
+        try:
+            drained = get_api_server().stop()
             
-            try:
-                # 注意：这里只是简单标记为停止，实际需要更复杂的进程管理
-                is_api_server_running = False
-                
-                # 通过SocketIO通知前端
-                socketio.emit('server_status', {
-                    'status': 'stopped'
-                })
-                
-                return jsonify({'success': True})
-            except Exception as e:
-                logger.error(f"停止API服务器失败: {e}")
-                return jsonify({'error': str(e)}), 500
+            # 通过SocketIO通知前端
+            socketio.emit('server_status', {
+                'status': 'stopped'
+            })
+            
+            return jsonify({'success': True, 'drained': drained})
+        except Exception as e:
+            logger.error(f"停止API服务器失败: {e}")
+            return jsonify({'error': str(e)}), 500
+    
+    @app_flask.route('/api/server/restart', methods=['POST'])
+    def restart_api_server():
+        """按当前配置重启API服务器"""
+        if not FASTAPI_AVAILABLE:
+            return jsonify({'error': 'FastAPI不可用，无法启动API服务器'})
+        
+        try:
+            server_config = config_manager.get_server_config()
+            api_server = get_api_server()
+            drained = api_server.restart(server_config['host'], server_config['port'])
+            
+            socketio.emit('server_status', {
+                'status': 'running',
+                'url': api_server.url
+            })
+            
+            return jsonify({'success': True, 'drained': drained})
+        except Exception as e:
+            logger.error(f"重启API服务器失败: {e}")
+            return jsonify({'error': str(e)}), 500
     
     @app_flask.route('/api/server/status', methods=['GET'])
     def get_server_status():
         """获取服务器状态"""
-        with api_server_lock:
-            return jsonify({
-                'is_running': is_api_server_running
-            })
+        if not FASTAPI_AVAILABLE:
+            return jsonify({'is_running': False})
+        return jsonify(dict(get_api_server().get_stats(), is_running=is_api_server_running()))
     
     @socketio.on('connect')
     def handle_connect():
         """客户端连接时的处理"""
         emit('server_status', {
-            'status': 'running' if is_api_server_running else 'stopped'
+            'status': 'running' if FASTAPI_AVAILABLE and is_api_server_running() else 'stopped'
         })
+    
+    if FASTAPI_AVAILABLE:
+        @socketio.on('connect', namespace='/dashboard')
+        def handle_dashboard_connect():
+            """仪表盘连接时先发送完整快照，之后只接收增量"""
+            seq, snapshot = dashboard_metrics.current()
+            emit('metrics_snapshot', {'seq': seq, 'snapshot': snapshot})
+        
+        def broadcast_metrics():
+            """每个间隔只汇总一次，增量广播给所有仪表盘，没有变化时不发送"""
+            while True:
+                socketio.sleep(dashboard_metrics.interval)
+                delta = dashboard_metrics.tick()
+                if delta:
+                    socketio.emit('metrics_delta', {'seq': dashboard_metrics.seq, 'delta': delta},
+                                  namespace='/dashboard')
+        
+        socketio.start_background_task(broadcast_metrics)
+    
+    return app_flask, socketio
 
 # ==================== 主程序入口 ====================
+def run_cli(replace: bool = False):
+    """
+    命令行模式：只运行API代理服务，不导入Web界面依赖
+
+    Args:
+        replace: 无缝替换同一端口上正在运行的服务（见 socket_handoff.py）
+    """
+    if not FASTAPI_AVAILABLE:
+        print("错误：缺少运行命令行服务所需的FastAPI依赖。")
+        print("请运行 'pip install fastapi uvicorn httpx pydantic python-multipart'")
+        return
+        
+    print("正在以命令行模式启动API服务...")
+    server_config = config_manager.get_server_config()
+    
+    # serve() 内部才导入uvicorn，缺少依赖时在这里提示
+    try:
+        serve(
+            app_fastapi, server_config['host'], server_config['port'],
+            drain_timeout=server_config['shutdown_timeout'],
+            replace=replace,
+            reuse_port=server_config['reuse_port']
+        )
+    except ImportError:
+        print("错误：缺少uvicorn依赖。请运行 'pip install uvicorn'")
+        return
+
+def run_web():
+    """Web模式：启动配置界面，API代理服务由界面按需启动"""
+    if not FLASK_AVAILABLE:
+        print("错误：缺少运行Web界面所需的Flask依赖。")
+        print("请运行 'pip install flask flask-cors flask-socketio'")
+        if FASTAPI_AVAILABLE:
+            print("你可以使用 'python app.py cli' 来运行命令行版本。")
+        return
+    
+    import webbrowser
+    
+    print("正在启动Web界面...")
+    app_flask, socketio = create_web_app()
+    server_config = config_manager.get_server_config()
+    
+    # 构建Web界面URL
+    web_url = f"http://{server_config['web_host']}:{server_config['web_port']}"
+    
+    # 启动Flask应用前，延迟1秒后自动打开浏览器
+    def open_browser():
+        time.sleep(1.5)  # 等待服务器启动
+        try:
+            webbrowser.open(web_url)
+            print(f"已自动打开浏览器: {web_url}")
+        except Exception as e:
+            print(f"自动打开浏览器失败: {e}")
+            print(f"请手动访问: {web_url}")
+    
+    # 在新线程中打开浏览器，避免阻塞主线程
+    browser_thread = threading.Thread(target=open_browser, daemon=True)
+    browser_thread.start()
+    
+    # 启动Flask应用
+    print(f"Web界面将运行在: {web_url}")
+    socketio.run(
+        app_flask,
+        host=server_config['web_host'],
+        port=server_config['web_port'],
+        debug=True  # 启用调试模式，支持热重载
+    )
+
 def main():
     # 检查命令行参数
     if len(sys.argv) > 1 and sys.argv[1] == 'cli':
-        if not FASTAPI_AVAILABLE:
-            print("错误：缺少运行命令行服务所需的FastAPI依赖。")
-            print("请运行 'pip install fastapi uvicorn httpx pydantic python-multipart'")
-            return
-            
-        print("正在以命令行模式启动API服务...")
-        server_config = config_manager.get_server_config()
-        
-        # 导入uvicorn
-        try:
-            import uvicorn
-            uvicorn.run(app_fastapi, host=server_config['host'], port=server_config['port'])
-        except ImportError:
-            print("错误：缺少uvicorn依赖。请运行 'pip install uvicorn'")
-            return
+        run_cli(replace='--replace' in sys.argv[2:])
     else:
-        if not FLASK_AVAILABLE:
-            print("错误：缺少运行Web界面所需的Flask依赖。")
-            print("请运行 'pip install flask flask-cors flask-socketio'")
-            if FASTAPI_AVAILABLE:
-                print("你可以使用 'python app.py cli' 来运行命令行版本。")
-            return
-        
-        print("正在启动Web界面...")
-        server_config = config_manager.get_server_config()
-        
-        # 构建Web界面URL
-        web_url = f"http://{server_config['web_host']}:{server_config['web_port']}"
-        
-        # 启动Flask应用前，延迟1秒后自动打开浏览器
-        def open_browser():
-            time.sleep(1.5)  # 等待服务器启动
-            try:
-                webbrowser.open(web_url)
-                print(f"已自动打开浏览器: {web_url}")
-            except Exception as e:
-                print(f"自动打开浏览器失败: {e}")
-                print(f"请手动访问: {web_url}")
-        
-        # 在新线程中打开浏览器，避免阻塞主线程
-        browser_thread = threading.Thread(target=open_browser, daemon=True)
-        browser_thread.start()
-        
-        # 启动Flask应用
-        print(f"Web界面将运行在: {web_url}")
-        socketio.run(
-            app_flask,
-            host=server_config['web_host'],
-            port=server_config['web_port'],
-            debug=True  # 启用调试模式，支持热重载
-        )
+        run_web()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+近似重复请求缓存模块
+很多请求只差在空白、系统提示词里的时间戳，或末尾多了一句“继续”，精确匹配的缓存命中不了。
+这里先把消息规范化（合并空白、屏蔽时间戳/日期/UUID、去掉末尾的“继续”），
+规范化后完全相同的直接命中；否则对最后一条用户消息和其余上下文分别计算64位SimHash，
+用LSH分段索引查找候选，两者的相似度都达到阈值才命中。
+只在同一租户、且除消息外所有请求参数都相同的请求之间命中。
+
+只对配置中选择加入的模型或租户生效；条目数、内存和存活时间都有上限，按最近最少使用淘汰
+"""
+
+import re
+import json
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple, Iterable, Set
+
+from raw_completion import RawCompletion
+
+logger = logging.getLogger(__name__)
+
+MASK64 = (1 << 64) - 1
+
+# 上下文中替换为占位符的易变内容：UUID、各种格式的日期时间、Unix时间戳
+# （合并为一个正则只扫描一遍，开头的先行断言让不可能匹配的位置快速跳过）
+_VOLATILE = re.compile(r'(?=[\da-f])(?:' + '|'.join([
+    r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}',
+    r'\d{4}-\d{1,2}-\d{1,2}(?:[ t]\d{1,2}:\d{2}(?::\d{2}(?:\.\d+)?)?(?:z|[+-]\d{2}:?\d{2})?)?',
+    r'\d{4}年\d{1,2}月\d{1,2}日(?:\s*\d{1,2}[:：]\d{2}(?:[:：]\d{2})?)?',
+    r'\d{4}/\d{1,2}/\d{1,2}(?:\s+\d{1,2}:\d{2}(?::\d{2})?)?',
+    r'\b\d{1,2}:\d{2}(?::\d{2})?(?:\s*[ap]m)?\b',
+    r'\b1\d{9}(?:\d{3})?\b',
+]) + ')')
+_TRAILING_CONTINUE = re.compile(r'(?:[\s,，.。!！]+(?:please\s+)?(?:continue|go on|keep going)'
+                                r'|[\s,，.。!！]*(?:请继续|继续))[\s.。!！]*$')
+# ASCII单词或单个非空白字符（中文按字切分）
+_TOKEN = re.compile(r'[a-z0-9_]+|[^\sa-z0-9_<>]|<v>')
+
+# 不影响回答内容的请求字段，其余字段（温度、采样参数、停止词、工具等）都计入缓存键
+_NEUTRAL_FIELDS = frozenset({'messages', 'stream', 'stream_options'})
+
+# 计算SimHash时最多使用的特征数，超长上下文按哈希值均匀抽样
+MAX_FEATURES = 512
+
+
+def collapse(text: str) -> str:
+    """统一大小写，合并空白"""
+    return ' '.join(text.lower().split())
+
+
+def normalize_context(text: str) -> str:
+    """规范化上下文（系统提示词和历史消息），另外屏蔽其中的时间戳、日期和UUID"""
+    return _VOLATILE.sub('<v>', collapse(text))
+
+
+def _message_text(message: Dict[str, Any]) -> str:
+    content = message.get('content')
+    if isinstance(content, list):
+        return ' '.join(part.get('text', '') for part in content if isinstance(part, dict))
+    return str(content or '')
+
+
+def split_messages(messages: List[Dict[str, Any]]) -> Tuple[str, str]:
+    """
+    把对话拆成 (最后一条用户消息, 其余上下文) 两段原始文本；
+    最后一条不是用户消息时整个对话都算上下文
+    """
+    texts = [f"{message.get('role', '')}: {_message_text(message)}" for message in messages]
+    if not messages or messages[-1].get('role') != 'user':
+        return '', '\n'.join(texts)
+    return _message_text(messages[-1]), '\n'.join(texts[:-1])
+
+
+def normalize_query(query: str) -> str:
+    """
+    规范化最后一条用户消息。问题本身里的数字和日期可能改变答案，这里不屏蔽；
+    末尾的“继续”只在去掉后消息仍非空时去掉（只检查结尾部分，避免扫描整条长消息）
+    """
+    query = collapse(query)
+    head, tail = query[:-64], query[-64:]
+    return (head + _TRAILING_CONTINUE.sub('', tail)).rstrip() or query
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN.findall(text)
+
+
+def _features(tokens: List[str]) -> List[int]:
+    """三元组shingle的哈希值；进程内的索引用内置hash即可（C实现，足够快）"""
+    if len(tokens) < 3:
+        hashes = list({hash(token) & MASK64 for token in tokens})
+    else:
+        # 去重：重复出现的片段不重复计数（也避免高度重复的长文本拖慢计算）
+        hashes = list({value & MASK64 for value in map(hash, zip(tokens, tokens[1:], tokens[2:]))})
+    if len(hashes) > MAX_FEATURES:
+        # 按哈希值抽样：两段文本中相同的shingle要么都保留要么都丢弃，相似度估计不变
+        step = len(hashes) // MAX_FEATURES + 1
+        hashes = [value for value in hashes if value % step == 0] or hashes[:MAX_FEATURES]
+    return hashes
+
+
+def simhash(features: List[int]) -> int:
+    """
+    64位SimHash：每一位取所有特征在该位上的多数值。
+    用按位切片的计数器同时累加64个位置（每个特征只需几次整数运算），避免逐位循环
+    """
+    counters = [0] * (len(features).bit_length() + 1)
+    for value in features:
+        carry = value
+        level = 0
+        while carry:
+            current = counters[level]
+            counters[level] = current ^ carry
+            carry &= current
+            level += 1
+    result = 0
+    count = len(features)
+    for bit in range(64):
+        total = 0
+        for level, counter in enumerate(counters):
+            total |= ((counter >> bit) & 1) << level
+        if total * 2 > count:
+            result |= 1 << bit
+    return result
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+class CacheEntry:
+    """一个缓存的响应"""
+
+    __slots__ = ('scope', 'exact', 'query_hash', 'context_hash', 'result', 'size', 'created_at', 'hits')
+
+    def __init__(self, scope: str, exact: bytes, query_hash: Optional[int], context_hash: int,
+                 result: RawCompletion):
+        self.scope = scope
+        self.exact = exact
+        self.query_hash = query_hash
+        self.context_hash = context_hash
+        self.result = result
+        self.size = len(result.body) + 200
+        self.created_at = time.time()
+        self.hits = 0
+
+
+class ApproxResponseCache:
+    """基于规范化 + SimHash/LSH 的近似重复请求响应缓存"""
+
+    def __init__(self, threshold: float = 0.95, ttl: float = 3600.0, max_entries: int = 10000,
+                 max_bytes: int = 64 * 1024 * 1024, min_query_tokens: int = 8,
+                 models: Iterable[str] = (), tenants: Iterable[str] = ()):
+        """
+        Args:
+            threshold: 相似度阈值（SimHash相同位数的比例），如0.95表示64位中最多3位不同
+            ttl: 条目的存活时间（秒）
+            max_entries / max_bytes: 条目数和缓存响应字节数上限，超出时淘汰最近最少使用的条目
+            min_query_tokens: 最后一条用户消息少于这么多词元时只做精确匹配（短文本的SimHash不可靠）
+            models: 选择加入的模型，"*" 表示全部
+            tenants: 选择加入的租户，"*" 表示全部
+        """
+        self.max_distance = max(0, min(15, int((1 - threshold) * 64)))
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max_bytes
+        self.min_query_tokens = min_query_tokens
+        self.models = set(models)
+        self.tenants = set(tenants)
+
+        # 按 max_distance + 1 段切分指纹：相差不超过 max_distance 位的两个指纹至少有一段完全相同
+        bands = self.max_distance + 1
+        self._band_bits = [(64 * i // bands, 64 * (i + 1) // bands) for i in range(bands)]
+
+        self._entries: 'OrderedDict[int, CacheEntry]' = OrderedDict()
+        self._exact: Dict[bytes, int] = {}
+        self._bands: Dict[Tuple[str, int, int], Set[int]] = {}
+        # 上下文（系统提示词+历史）在连续请求间通常不变，缓存其指纹避免重复计算
+        self._context_hashes: 'OrderedDict[bytes, Tuple[bytes, int]]' = OrderedDict()
+        self._next_id = 0
+        self._bytes = 0
+        self.stats = {'lookups': 0, 'exact_hits': 0, 'approx_hits': 0, 'misses': 0, 'stores': 0,
+                      'evictions': 0, 'lookup_ms_total': 0.0, 'lookup_ms_max': 0.0}
+
+    def enabled_for(self, model: Optional[str], tenant: Optional[str]) -> bool:
+        """模型或租户任一选择加入即启用"""
+        return ('*' in self.models or model in self.models or
+                '*' in self.tenants or (tenant is not None and tenant in self.tenants))
+
+    def _bands_of(self, scope: str, value: int) -> List[Tuple[str, int, int]]:
+        return [(scope, index, (value >> start) & ((1 << (end - start)) - 1))
+                for index, (start, end) in enumerate(self._band_bits)]
+
+    def _context_hash(self, context: str) -> Tuple[bytes, int]:
+        """
+        上下文的 (规范化摘要, 指纹)。以原始文本的摘要为键缓存，
+        系统提示词和历史不变时跳过规范化和指纹计算
+        """
+        raw_digest = hashlib.blake2b(context.encode('utf-8'), digest_size=16).digest()
+        cached = self._context_hashes.get(raw_digest)
+        if cached is not None:
+            self._context_hashes.move_to_end(raw_digest)
+            return cached
+        normalized = normalize_context(context)
+        cached = (hashlib.blake2b(normalized.encode('utf-8'), digest_size=16).digest(),
+                  simhash(_features(tokenize(normalized))))
+        self._context_hashes[raw_digest] = cached
+        if len(self._context_hashes) > 1024:
+            self._context_hashes.popitem(last=False)
+        return cached
+
+    @staticmethod
+    def _scope(request_data: Dict[str, Any], tenant: Optional[str]) -> str:
+        """
+        缓存的隔离范围：租户 + 除消息外所有影响输出的请求参数的摘要。
+        只有范围完全相同的请求之间才会精确或近似命中，不同租户的缓存互不可见
+        """
+        params = {key: value for key, value in request_data.items() if key not in _NEUTRAL_FIELDS}
+        encoded = json.dumps([tenant, params], sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.blake2b(encoded.encode('utf-8'), digest_size=16).hexdigest()
+
+    def _fingerprint(self, request_data: Dict[str, Any],
+                     tenant: Optional[str]) -> Optional[Tuple[str, bytes, Optional[int], int]]:
+        """(隔离范围, 精确匹配摘要, 查询指纹, 上下文指纹)；请求格式不支持时返回None"""
+        messages = request_data.get('messages')
+        if not isinstance(messages, list) or not messages:
+            return None
+        query, context = split_messages(messages)
+        query = normalize_query(query)
+        context_digest, context_hash = self._context_hash(context)
+        scope = self._scope(request_data, tenant)
+        exact = hashlib.blake2b(f"{scope}\n{query}".encode('utf-8') + context_digest, digest_size=16).digest()
+        tokens = tokenize(query)
+        query_hash = simhash(_features(tokens)) if len(tokens) >= self.min_query_tokens else None
+        return scope, exact, query_hash, context_hash
+
+    def _alive(self, entry_id: int) -> Optional[CacheEntry]:
+        entry = self._entries.get(entry_id)
+        if entry is not None and time.time() - entry.created_at > self.ttl:
+            self._remove(entry_id)
+            return None
+        return entry
+
+    def lookup(self, request_data: Dict[str, Any], tenant: Optional[str] = None) -> Optional[RawCompletion]:
+        """查找近似重复请求的缓存响应，未启用或未命中时返回None"""
+        if not self.enabled_for(request_data.get('model'), tenant):
+            return None
+        began = time.perf_counter()
+        self.stats['lookups'] += 1
+        try:
+            fingerprint = self._fingerprint(request_data, tenant)
+            if fingerprint is None:
+                return None
+            scope, exact, query_hash, context_hash = fingerprint
+
+            entry_id = self._exact.get(exact)
+            if entry_id is not None and self._alive(entry_id) is not None:
+                return self._hit(entry_id, 'exact_hits')
+
+            if query_hash is not None:
+                best_id, best_distance = None, self.max_distance + 1
+                for band in self._bands_of(scope, query_hash):
+                    for candidate_id in list(self._bands.get(band, ())):
+                        entry = self._alive(candidate_id)
+                        if entry is None or entry.query_hash is None:
+                            continue
+                        if hamming(entry.context_hash, context_hash) > self.max_distance:
+                            continue
+                        distance = hamming(entry.query_hash, query_hash)
+                        if distance < best_distance:
+                            best_id, best_distance = candidate_id, distance
+                if best_id is not None:
+                    return self._hit(best_id, 'approx_hits')
+
+            self.stats['misses'] += 1
+            return None
+        finally:
+            elapsed = (time.perf_counter() - began) * 1000
+            self.stats['lookup_ms_total'] += elapsed
+            self.stats['lookup_ms_max'] = max(self.stats['lookup_ms_max'], elapsed)
+
+    def _hit(self, entry_id: int, kind: str) -> RawCompletion:
+        entry = self._entries[entry_id]
+        self._entries.move_to_end(entry_id)
+        entry.hits += 1
+        self.stats[kind] += 1
+        return entry.result
+
+    def store(self, request_data: Dict[str, Any], result: RawCompletion, tenant: Optional[str] = None):
+        """保存一个成功的响应"""
+        if not self.enabled_for(request_data.get('model'), tenant):
+            return
+        fingerprint = self._fingerprint(request_data, tenant)
+        if fingerprint is None:
+            return
+        scope, exact, query_hash, context_hash = fingerprint
+        old_id = self._exact.get(exact)
+        if old_id is not None:
+            self._remove(old_id)
+
+        entry = CacheEntry(scope, exact, query_hash, context_hash, result)
+        if entry.size > self.max_bytes:
+            return
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = entry
+        self._exact[exact] = entry_id
+        if query_hash is not None:
+            for band in self._bands_of(scope, query_hash):
+                self._bands.setdefault(band, set()).add(entry_id)
+        self._bytes += entry.size
+        self.stats['stores'] += 1
+
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.stats['evictions'] += 1
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        self._bytes -= entry.size
+        if self._exact.get(entry.exact) == entry_id:
+            del self._exact[entry.exact]
+        if entry.query_hash is not None:
+            for band in self._bands_of(entry.scope, entry.query_hash):
+                members = self._bands.get(band)
+                if members is not None:
+                    members.discard(entry_id)
+                    if not members:
+                        del self._bands[band]
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.stats['lookups']
+        hits = self.stats['exact_hits'] + self.stats['approx_hits']
+        return dict(
+            self.stats,
+            entries=len(self._entries),
+            bytes=self._bytes,
+            max_distance=self.max_distance,
+            hit_rate=round(hits / lookups, 3) if lookups else 0.0,
+            lookup_ms_avg=round(self.stats['lookup_ms_total'] / lookups, 3) if lookups else 0.0,
+            models=sorted(self.models),
+            tenants=sorted(self.tenants),
+        )
@@ -0,0 +1,507 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批量请求模块
+离线任务一次上传成千上万条互相独立的请求（JSONL），每条只用一个密钥请求一次，失败才换密钥重试，
+不做交互请求那样的并发扇出。请求按配额余量分散到全部可用密钥上；只在准入控制有空闲名额时才发送，
+交互请求始终优先。任务和每条结果保存在SQLite（WAL模式）中，服务重启后从未完成的条目继续
+
+输入的每一行:
+    {"custom_id": "req-1", "body": {"model": "gemini-2.5-flash", "messages": [...]}}
+    或直接是请求体 {"model": ..., "messages": [...]}（custom_id 默认为行号）
+结果的每一行（与 OpenAI Batch 输出格式一致）:
+    {"custom_id": "req-1", "response": {"status_code": 200, "body": {...}}, "error": null}
+    上游返回错误时 response 为上游的状态码和响应内容；没有上游响应的失败（无法解析、没有可用密钥、
+    网络错误）response 为 null，原因写在 error.message 中
+"""
+
+import json
+import time
+import uuid
+import sqlite3
+import asyncio
+import logging
+import threading
+from collections import deque, Counter
+from typing import Dict, Any, List, Optional, Iterable, Iterator, Set
+
+from admission_control import AdmissionController
+from quota_tracker import QuotaTracker
+from proxy_engine import EngineError, UpstreamError
+
+logger = logging.getLogger(__name__)
+
+# 批量写入条目时每批的行数（每批一个事务，批与批之间释放锁，调度循环的读写不必等整个上传写完）
+INSERT_BATCH_SIZE = 500
+
+# 每次从数据库取出的待处理条目数
+LOAD_BATCH_SIZE = 200
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS batch_jobs (
+    id TEXT PRIMARY KEY,
+    tenant TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    completed_at REAL,
+    total INTEGER NOT NULL DEFAULT 0,
+    succeeded INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS batch_items (
+    job_id TEXT NOT NULL,
+    line INTEGER NOT NULL,
+    custom_id TEXT NOT NULL,
+    request TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    response TEXT,
+    error TEXT,
+    PRIMARY KEY (job_id, line)
+);
+CREATE INDEX IF NOT EXISTS idx_batch_items_status ON batch_items (status, job_id);
+"""
+
+
+class BatchItem:
+    """一条待处理的请求"""
+
+    __slots__ = ('job_id', 'line', 'request', 'attempts', 'tried_keys')
+
+    def __init__(self, job_id: str, line: int, request: Dict[str, Any], attempts: int = 0):
+        self.job_id = job_id
+        self.line = line
+        self.request = request
+        self.attempts = attempts
+        # 本条已经失败过的密钥，重试时优先换用其他密钥
+        self.tried_keys: Set[str] = set()
+
+
+def parse_line(line: str, line_number: int, default_model: str = '') -> Dict[str, Any]:
+    """
+    解析输入的一行
+
+    Returns:
+        {'custom_id': ..., 'request': 请求体} 或 {'custom_id': ..., 'error': 错误原因}
+    """
+    try:
+        data = json.loads(line)
+    except ValueError as e:
+        return {'custom_id': str(line_number), 'error': f"JSON解析失败: {e}"}
+    if not isinstance(data, dict):
+        return {'custom_id': str(line_number), 'error': "每行必须是JSON对象"}
+    custom_id = str(data.get('custom_id', line_number))
+    body = data['body'] if 'body' in data else {k: v for k, v in data.items() if k != 'custom_id'}
+    if not isinstance(body, dict) or not isinstance(body.get('messages'), list):
+        return {'custom_id': custom_id, 'error': "缺少 messages"}
+    body.pop('stream', None)
+    if not body.get('model'):
+        if not default_model:
+            return {'custom_id': custom_id, 'error': "缺少 model"}
+        body['model'] = default_model
+    return {'custom_id': custom_id, 'request': body}
+
+
+def _retryable(error: EngineError) -> bool:
+    """429、5xx 和没有上游响应的失败换密钥重试；其他4xx是请求本身的问题，换密钥也不会成功"""
+    if isinstance(error, UpstreamError):
+        return error.status_code == 429 or error.status_code >= 500
+    return True
+
+
+def _error_body(detail: str) -> Any:
+    """上游的错误响应内容，是JSON时原样保留"""
+    try:
+        return json.loads(detail)
+    except ValueError:
+        return {'error': {'message': detail}}
+
+
+class BatchRunner:
+    """批量任务的存储与调度"""
+
+    def __init__(self, engine, admission: AdmissionController, quota_tracker: Optional[QuotaTracker] = None,
+                 path: str = "batch.db", workers: int = 8, per_key_concurrency: int = 1,
+                 max_attempts: int = 3, headroom: int = 2, poll_interval: float = 0.5):
+        """
+        Args:
+            engine: ProxyEngine，提供可用密钥和单密钥请求
+            admission: 与交互请求共用的准入控制器
+            quota_tracker: 提供时只把请求分配给还有每分钟/每日余量的密钥
+            path: SQLite数据库文件路径
+            workers: 批量请求同时进行的上游调用数上限
+            per_key_concurrency: 每个密钥同时进行的批量调用数上限
+            max_attempts: 每条请求最多尝试的次数（含第一次）
+            headroom: 为交互请求保留的准入名额，名额不足时批量请求暂停
+            poll_interval: 没有名额或密钥时再次尝试的间隔（秒）
+        """
+        self.engine = engine
+        self.admission = admission
+        self.quota_tracker = quota_tracker
+        self.path = path
+        self.workers = max(1, workers)
+        self.per_key_concurrency = max(1, per_key_concurrency)
+        self.max_attempts = max(1, max_attempts)
+        self.headroom = max(0, headroom)
+        self.poll_interval = poll_interval
+
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pending: deque = deque()
+        # 进行中的调用 -> 对应的条目
+        self._inflight: Dict[asyncio.Task, BatchItem] = {}
+        self._key_inflight: Counter = Counter()
+        self._cancelled: Set[str] = set()
+        self._started_jobs: Set[str] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.stats = {'attempts': 0, 'succeeded': 0, 'failed': 0, 'retries': 0, 'waits_for_capacity': 0}
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    # --- 任务管理（可在线程池中调用） ---
+
+    def create_job(self, lines: Iterable[str], tenant: str, default_model: str = '') -> Dict[str, Any]:
+        """
+        保存上传的任务；无法解析的行直接记为失败，结果中仍占一行。
+        条目分批写入，写完之前任务处于 validating 状态，调度循环不会取用
+
+        Raises:
+            ValueError: 没有任何请求行
+        """
+        job_id = f"batch_{uuid.uuid4().hex[:16]}"
+        total = failed = 0
+        rows: List[tuple] = []
+        with self._lock:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT INTO batch_jobs (id, tenant, status, created_at) VALUES (?, ?, 'validating', ?)",
+                    (job_id, tenant, time.time())
+                )
+        try:
+            for line in lines:
+                line = line.strip()
+                if not line:
+                    continue
+                parsed = parse_line(line, total, default_model)
+                if 'error' in parsed:
+                    failed += 1
+                    rows.append((job_id, total, parsed['custom_id'], '', 'failed', parsed['error']))
+                else:
+                    rows.append((job_id, total, parsed['custom_id'],
+                                 json.dumps(parsed['request'], ensure_ascii=False), 'pending', None))
+                total += 1
+                if len(rows) >= INSERT_BATCH_SIZE:
+                    self._insert_items(rows)
+                    rows = []
+            if rows:
+                self._insert_items(rows)
+            if total == 0:
+                raise ValueError("上传的内容中没有请求")
+        except BaseException:
+            # 上传失败（包括客户端断开导致的取消）时删除已写入的部分
+            with self._lock:
+                with self.conn:
+                    self.conn.execute("DELETE FROM batch_items WHERE job_id = ?", (job_id,))
+                    self.conn.execute("DELETE FROM batch_jobs WHERE id = ?", (job_id,))
+            raise
+        status = 'completed' if failed == total else 'queued'
+        with self._lock:
+            with self.conn:
+                self.conn.execute(
+                    "UPDATE batch_jobs SET total = ?, failed = ?, status = ?, completed_at = ? WHERE id = ?",
+                    (total, failed, status, time.time() if status == 'completed' else None, job_id)
+                )
+        logger.info(f"已创建批量任务 {job_id}: {total} 条请求（{failed} 条无法解析），租户 {tenant}")
+        if self._loop is not None:
+            # 通常在线程池中调用，需通过事件循环唤醒调度循环
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        return self.get_job(job_id, tenant)
+
+    def _insert_items(self, rows: List[tuple]):
+        with self._lock:
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT INTO batch_items (job_id, line, custom_id, request, status, error) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+
+    @staticmethod
+    def _job_dict(row) -> Dict[str, Any]:
+        job_id, status, created_at, completed_at, total, succeeded, failed = row
+        return {
+            'id': job_id,
+            'object': 'batch',
+            'status': status,
+            'created_at': int(created_at),
+            'completed_at': int(completed_at) if completed_at else None,
+            'request_counts': {'total': total, 'completed': succeeded, 'failed': failed,
+                               'pending': total - succeeded - failed},
+        }
+
+    def get_job(self, job_id: str, tenant: str) -> Optional[Dict[str, Any]]:
+        """任务进度；任务不存在或不属于该租户时返回None"""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT id, status, created_at, completed_at, total, succeeded, failed FROM batch_jobs "
+                "WHERE id = ? AND tenant = ?", (job_id, tenant)
+            ).fetchone()
+        return self._job_dict(row) if row else None
+
+    def list_jobs(self, tenant: str, limit: int = 20) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT id, status, created_at, completed_at, total, succeeded, failed FROM batch_jobs "
+                "WHERE tenant = ? ORDER BY created_at DESC LIMIT ?", (tenant, limit)
+            ).fetchall()
+        return [self._job_dict(row) for row in rows]
+
+    def cancel_job(self, job_id: str, tenant: str) -> Optional[Dict[str, Any]]:
+        """取消任务：未开始的条目不再发送，已完成的结果仍可下载"""
+        with self._lock:
+            with self.conn:
+                self.conn.execute(
+                    "UPDATE batch_jobs SET status = 'cancelled', completed_at = ? "
+                    "WHERE id = ? AND tenant = ? AND status IN ('queued', 'running')",
+                    (time.time(), job_id, tenant)
+                )
+        self._cancelled.add(job_id)
+        return self.get_job(job_id, tenant)
+
+    def iter_results(self, job_id: str) -> Iterator[str]:
+        """按输入顺序逐行导出已完成条目的结果，成功的响应体原样拼接，不重新编码"""
+        last_line = -1
+        while True:
+            with self._lock:
+                rows = self.conn.execute(
+                    "SELECT line, custom_id, status, response, error FROM batch_items "
+                    "WHERE job_id = ? AND line > ? AND status != 'pending' ORDER BY line LIMIT ?",
+                    (job_id, last_line, LOAD_BATCH_SIZE)
+                ).fetchall()
+            if not rows:
+                return
+            for line, custom_id, status, response, error in rows:
+                last_line = line
+                custom_id = json.dumps(custom_id, ensure_ascii=False)
+                if status == 'succeeded':
+                    yield f'{{"custom_id":{custom_id},"response":{{"status_code":200,"body":{response}}},"error":null}}\n'
+                elif response is not None:
+                    # 上游的错误响应（状态码和响应内容）
+                    yield f'{{"custom_id":{custom_id},"response":{response},"error":null}}\n'
+                else:
+                    error = json.dumps({'message': error}, ensure_ascii=False, separators=(',', ':'))
+                    yield f'{{"custom_id":{custom_id},"response":null,"error":{error}}}\n'
+
+    # --- 调度 ---
+    # 调度循环运行在事件循环中，数据库读写都放到线程池执行：
+    # 等待锁（如正在写入上传的任务）或提交事务时不会阻塞交互请求
+
+    def _load_pending(self, busy: Set[tuple]) -> List[BatchItem]:
+        """
+        按任务创建顺序取出一批待处理的条目（在线程池中调用）
+
+        Args:
+            busy: 进行中的 (任务, 行号)，这些条目在数据库中仍是 pending，需要跳过
+        """
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT i.job_id, i.line, i.request, i.attempts FROM batch_items i "
+                "JOIN batch_jobs j ON j.id = i.job_id "
+                "WHERE i.status = 'pending' AND j.status IN ('queued', 'running') "
+                "ORDER BY j.created_at, i.line LIMIT ?", (LOAD_BATCH_SIZE + len(busy),)
+            ).fetchall()
+        return [
+            BatchItem(job_id, line, json.loads(request), attempts)
+            for job_id, line, request, attempts in rows
+            if (job_id, line) not in busy
+        ][:LOAD_BATCH_SIZE]
+
+    def _pick_key(self, item: BatchItem, keys: List[str]) -> Optional[str]:
+        """
+        为一条请求从 keys（可用于其模型的密钥）中选择密钥：只考虑未达到单密钥并发上限的密钥，
+        有配额统计时还要求有每分钟和每日余量；优先选进行中调用最少、当天余量最多的密钥
+        """
+        model = item.request.get('model')
+        candidates = []
+        for key in keys:
+            if self._key_inflight[key] >= self.per_key_concurrency:
+                continue
+            remaining = 0
+            if self.quota_tracker is not None:
+                usage = self.quota_tracker.usage(key, model)
+                if usage['available'] <= 0:
+                    continue
+                remaining = usage['day_remaining']
+            candidates.append((key in item.tried_keys, self._key_inflight[key], -remaining, key))
+        if not candidates:
+            return None
+        return min(candidates)[3]
+
+    async def run(self):
+        """调度循环（需在事件循环中作为任务运行）"""
+        self._wakeup = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        while True:
+            try:
+                if not self._pending:
+                    busy = {(item.job_id, item.line) for item in self._inflight.values()}
+                    self._pending.extend(await self._loop.run_in_executor(None, self._load_pending, busy))
+                    if not self._pending:
+                        self._wakeup.clear()
+                        try:
+                            await asyncio.wait_for(self._wakeup.wait(), timeout=5.0)
+                        except asyncio.TimeoutError:
+                            pass
+                        continue
+
+                if len(self._inflight) >= self.workers:
+                    await asyncio.wait(list(self._inflight), return_when=asyncio.FIRST_COMPLETED)
+                    continue
+
+                item, api_key = await self._next_placeable()
+                granted = self.admission.try_acquire(1, self.headroom) if item is not None else 0
+                if not granted:
+                    # 交互请求占满名额、或所有条目的密钥都已到达配额/并发上限时稍后再试
+                    if item is not None:
+                        self._pending.appendleft(item)
+                    if self._pending:
+                        self.stats['waits_for_capacity'] += 1
+                        await asyncio.sleep(self.poll_interval)
+                    continue
+
+                self._key_inflight[api_key] += 1
+                task = asyncio.create_task(self._run_item(item, api_key))
+                self._inflight[task] = item
+                task.add_done_callback(lambda done: self._inflight.pop(done, None))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"批量任务调度出错: {e}")
+                await asyncio.sleep(self.poll_interval)
+
+    async def _next_placeable(self):
+        """
+        按队列顺序找出第一条现在就能分配到密钥的条目并从队列中取出，返回 (条目, 密钥)；
+        暂时分配不到的条目轮换到队尾，不挡住后面使用其他模型/密钥的条目。
+        没有任何密钥可用于其模型的条目直接记为失败。都分配不到时返回 (None, None)
+        """
+        keys_by_model: Dict[Any, List[str]] = {}
+        for _ in range(len(self._pending)):
+            item = self._pending.popleft()
+            if item.job_id in self._cancelled:
+                continue
+            model = item.request.get('model')
+            if model not in keys_by_model:
+                keys_by_model[model] = self.engine.candidate_keys(model)
+            if not keys_by_model[model]:
+                self.stats['failed'] += 1
+                await self._start_job(item.job_id)
+                await self._loop.run_in_executor(
+                    None, self._finish_item, item, 'failed', None, f"没有可用于模型 {model} 的密钥"
+                )
+                continue
+            api_key = self._pick_key(item, keys_by_model[model])
+            if api_key is not None:
+                return item, api_key
+            self._pending.append(item)
+        return None, None
+
+    async def _start_job(self, job_id: str):
+        if job_id not in self._started_jobs:
+            self._started_jobs.add(job_id)
+            await self._loop.run_in_executor(None, self._mark_running, job_id)
+
+    async def _run_item(self, item: BatchItem, api_key: str):
+        started = time.monotonic()
+        result = None
+        error: Optional[EngineError] = None
+        try:
+            await self._start_job(item.job_id)
+            self.stats['attempts'] += 1
+            result = await self.engine.complete_with_key(api_key, item.request)
+        except EngineError as e:
+            error = e
+            logger.error(f"批量任务 {item.job_id} 第 {item.line} 条请求失败: {e.status_code} - {e.detail[:200]}")
+        except Exception as e:
+            error = EngineError(502, f"{type(e).__name__}: {e}")
+            logger.error(f"批量任务 {item.job_id} 第 {item.line} 条请求出错: {e}")
+        finally:
+            self.admission.release(1, time.monotonic() - started)
+            self._key_inflight[api_key] -= 1
+            if self._key_inflight[api_key] <= 0:
+                del self._key_inflight[api_key]
+
+        # 结果写入数据库之前条目仍算进行中，调度循环不会从数据库重新取出它
+        item.attempts += 1
+        if result is not None:
+            self.stats['succeeded'] += 1
+            await self._loop.run_in_executor(
+                None, self._finish_item, item, 'succeeded', result.body.decode('utf-8'), None
+            )
+        elif item.attempts < self.max_attempts and _retryable(error):
+            # 失败的条目换一个密钥重试，排在队尾以免反复占用同一批名额
+            self.stats['retries'] += 1
+            item.tried_keys.add(api_key)
+            self._pending.append(item)
+            self._wakeup.set()
+        else:
+            self.stats['failed'] += 1
+            if isinstance(error, UpstreamError):
+                response = json.dumps({'status_code': error.status_code, 'body': _error_body(error.detail)},
+                                      ensure_ascii=False, separators=(',', ':'))
+                await self._loop.run_in_executor(None, self._finish_item, item, 'failed', response, None)
+            else:
+                await self._loop.run_in_executor(
+                    None, self._finish_item, item, 'failed', None,
+                    f"{item.attempts} 次尝试均失败: {error.detail}"
+                )
+
+    def _mark_running(self, job_id: str):
+        """任务的第一条请求开始发送时标记任务运行中（在线程池中调用）"""
+        with self._lock:
+            with self.conn:
+                self.conn.execute("UPDATE batch_jobs SET status = 'running' WHERE id = ? AND status = 'queued'",
+                                  (job_id,))
+
+    def _finish_item(self, item: BatchItem, status: str, response: Optional[str] = None,
+                     error: Optional[str] = None):
+        """保存一条结果并更新任务计数，全部条目完成时标记任务完成（在线程池中调用）"""
+        column = 'succeeded' if status == 'succeeded' else 'failed'
+        with self._lock:
+            with self.conn:
+                self.conn.execute(
+                    "UPDATE batch_items SET status = ?, attempts = ?, response = ?, error = ? "
+                    "WHERE job_id = ? AND line = ?",
+                    (status, item.attempts, response, error, item.job_id, item.line)
+                )
+                self.conn.execute(f"UPDATE batch_jobs SET {column} = {column} + 1 WHERE id = ?", (item.job_id,))
+                self.conn.execute(
+                    "UPDATE batch_jobs SET status = 'completed', completed_at = ? "
+                    "WHERE id = ? AND status = 'running' AND succeeded + failed >= total",
+                    (time.time(), item.job_id)
+                )
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            jobs = dict(self.conn.execute("SELECT status, COUNT(*) FROM batch_jobs GROUP BY status").fetchall())
+        return dict(
+            self.stats,
+            jobs=jobs,
+            queued_items=len(self._pending),
+            inflight=len(self._inflight),
+            keys_in_use=len(self._key_inflight),
+        )
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+候选响应打分模块
+并发扇出得到多个候选时，原来只比较内容长度（或直接取第一个够长的）。这里用一组可组合的打分器
+（长度、结束原因、重复/退化、拒答、与提示词的语言是否一致）给每个候选打分，
+打分器随流式内容增量更新：原生接口边接收边打分，明显退化的候选可以提前放弃；
+加权总分达到 good_enough 的候选不必再等其他候选。每个打分器的耗时计入统计
+
+    pipeline = ScoringPipeline()
+    score = pipeline.start(request_data)
+    score.feed("第一段内容")
+    score.finish("stop")
+    print(score.total, score.rejected)
+
+自定义打分器继承 Scorer 后用 register_scorer 注册，并在 scorers 参数中按名称启用
+"""
+
+import re
+import time
+import logging
+from typing import Dict, Any, List, Optional, Type
+
+from token_estimator import token_estimator, char_classes
+
+logger = logging.getLogger(__name__)
+
+
+class PromptProfile:
+    """打分需要的提示词信息，每个请求只计算一次，所有候选共用"""
+
+    __slots__ = ('text', 'wide_share')
+
+    def __init__(self, request_data: Dict[str, Any]):
+        self.text = ''
+        for message in reversed(request_data.get('messages') or []):
+            if isinstance(message, dict) and message.get('role') == 'user':
+                content = message.get('content')
+                if isinstance(content, list):
+                    content = ' '.join(part.get('text', '') for part in content if isinstance(part, dict))
+                self.text = content if isinstance(content, str) else ''
+                break
+        ascii_chars, wide_chars, other_chars = char_classes(self.text)
+        letters = ascii_chars + wide_chars + other_chars
+        self.wide_share = wide_chars / letters if letters else 0.0
+
+
+class Scorer:
+    """
+    打分器基类：每个候选一个实例，feed 接收增量内容，finish 接收结束原因，
+    score 返回 0~1 的分数，rejected 不为空时该候选直接淘汰
+    """
+
+    name = ''
+
+    def __init__(self, prompt: PromptProfile, options: Dict[str, Any]):
+        self.prompt = prompt
+        self.options = options
+        self.rejected: Optional[str] = None
+
+    def feed(self, delta: str):
+        pass
+
+    def finish(self, finish_reason: Optional[str]):
+        pass
+
+    def score(self) -> float:
+        return 1.0
+
+
+class LengthScorer(Scorer):
+    """按token数打分：target_tokens 时为0.5，越长越接近1（收益递减）"""
+
+    name = 'length'
+
+    def __init__(self, prompt: PromptProfile, options: Dict[str, Any]):
+        super().__init__(prompt, options)
+        self.tokens = 0.0
+        self.target = max(1, options.get('target_tokens', 500))
+
+    def feed(self, delta: str):
+        self.tokens += token_estimator.estimate(delta)
+
+    def score(self) -> float:
+        return self.tokens / (self.tokens + self.target)
+
+
+class FinishReasonScorer(Scorer):
+    """正常结束得满分，被截断减分，被安全过滤的候选淘汰"""
+
+    name = 'finish_reason'
+
+    SCORES = {'stop': 1.0, 'length': 0.6, 'tool_calls': 1.0}
+    REJECTED = {'content_filter', 'safety', 'recitation', 'blocklist', 'prohibited_content', 'spii'}
+
+    def __init__(self, prompt: PromptProfile, options: Dict[str, Any]):
+        super().__init__(prompt, options)
+        self.finish_reason: Optional[str] = None
+
+    def finish(self, finish_reason: Optional[str]):
+        self.finish_reason = (finish_reason or '').lower() or None
+        if self.finish_reason in self.REJECTED:
+            self.rejected = f"finish_reason={self.finish_reason}"
+
+    def score(self) -> float:
+        if self.finish_reason is None:
+            return 0.8
+        return self.SCORES.get(self.finish_reason, 0.5)
+
+
+class RepetitionScorer(Scorer):
+    """
+    按句子重复比例打分。模型退化时会反复输出同一句话或同一个字：
+    最近 loop_segments 句完全相同，或句子重复比例超过 max_repeat_ratio，或末尾一长段只由极少几种字符组成，都淘汰
+    """
+
+    name = 'repetition'
+
+    _SEGMENT_END = re.compile(r'[。！？!?\n]|\.(?=\s)')
+    MIN_SEGMENT = 10
+    MIN_SEGMENTS = 8
+    RUN_WINDOW = 400
+
+    def __init__(self, prompt: PromptProfile, options: Dict[str, Any]):
+        super().__init__(prompt, options)
+        self.max_repeat_ratio = options.get('max_repeat_ratio', 0.5)
+        self.loop_segments = options.get('loop_segments', 6)
+        self.pending = ''
+        self.seen: set = set()
+        self.segments = 0
+        self.repeated = 0
+        self.last_segment = ''
+        self.same_in_row = 0
+
+    def feed(self, delta: str):
+        if self.rejected:
+            return
+        text = self.pending + delta
+        start = 0
+        for match in self._SEGMENT_END.finditer(text):
+            self._segment(text[start:match.end()])
+            start = match.end()
+        self.pending = text[start:]
+        if len(self.pending) > self.RUN_WINDOW and len(set(self.pending[-self.RUN_WINDOW:])) <= 3:
+            self.rejected = "degenerate: character run"
+
+    def _segment(self, segment: str):
+        segment = ' '.join(segment.split())
+        if len(segment) < self.MIN_SEGMENT:
+            return
+        self.segments += 1
+        if segment in self.seen:
+            self.repeated += 1
+        else:
+            self.seen.add(segment)
+        self.same_in_row = self.same_in_row + 1 if segment == self.last_segment else 1
+        self.last_segment = segment
+        if self.same_in_row >= self.loop_segments:
+            self.rejected = "degenerate: repeated sentence loop"
+        elif self.segments >= self.MIN_SEGMENTS and self.repeated / self.segments > self.max_repeat_ratio:
+            self.rejected = "degenerate: repeated sentences"
+
+    def finish(self, finish_reason: Optional[str]):
+        if self.pending:
+            self._segment(self.pending)
+            self.pending = ''
+        # 打分结果可能随响应保留（如近似缓存），不再需要的句子集合及时释放
+        self.seen = set()
+
+    def score(self) -> float:
+        return 1.0 - self.repeated / self.segments if self.segments else 1.0
+
+
+class RefusalScorer(Scorer):
+    """开头是拒答套话的候选得0分；reject_refusals 为真时直接淘汰"""
+
+    name = 'refusal'
+
+    HEAD_CHARS = 200
+    _PATTERNS = re.compile(
+        r"^\W*(?:"
+        r"(?:i'?m sorry|sorry|i apologi[sz]e)[^.\n]{0,40}?(?:i )?(?:can(?:'|no)?t|won'?t|am not able|am unable)"
+        r"|i (?:can(?:'|no)?t|won'?t|am not able to|am unable to) (?:help|assist|provide|comply|fulfill|do that)"
+        r"|as an ai(?: language model)?\b"
+        r"|(?:抱歉|对不起|很抱歉)[^。\n]{0,20}?(?:无法|不能|没办法)"
+        r"|我?(?:无法|不能)(?:提供|协助|帮助|回答|满足)"
+        r"|作为(?:一个)?(?:ai|人工智能|语言模型)"
+        r")",
+        re.IGNORECASE
+    )
+
+    def __init__(self, prompt: PromptProfile, options: Dict[str, Any]):
+        super().__init__(prompt, options)
+        self.reject_refusals = options.get('reject_refusals', True)
+        self.head = ''
+        self.refused = False
+        self.checked = False
+
+    def feed(self, delta: str):
+        if self.checked:
+            return
+        self.head += delta
+        if len(self.head) >= self.HEAD_CHARS:
+            self._check()
+
+    def finish(self, finish_reason: Optional[str]):
+        if not self.checked:
+            self._check()
+
+    def _check(self):
+        self.checked = True
+        self.refused = bool(self._PATTERNS.match(self.head[:self.HEAD_CHARS]))
+        self.head = ''
+        if self.refused and self.reject_refusals:
+            self.rejected = "refusal"
+
+    def score(self) -> float:
+        return 0.0 if self.refused else 1.0
+
+
+class LanguageScorer(Scorer):
+    """
+    回答的文字是否与提示词一致：中日韩提示词得到纯英文回答（或反过来）时减分。
+    用户可能明确要求翻译，所以只减分不淘汰
+    """
+
+    name = 'language'
+
+    def __init__(self, prompt: PromptProfile, options: Dict[str, Any]):
+        super().__init__(prompt, options)
+        self.letters = 0
+        self.wide = 0
+
+    def feed(self, delta: str):
+        ascii_chars, wide_chars, other_chars = char_classes(delta)
+        self.letters += ascii_chars + wide_chars + other_chars
+        self.wide += wide_chars
+
+    def score(self) -> float:
+        if not self.letters:
+            return 1.0
+        share = self.wide / self.letters
+        if self.prompt.wide_share >= 0.3:
+            return min(1.0, 0.2 + share / 0.3)
+        if self.prompt.text and self.prompt.wide_share < 0.05:
+            return max(0.0, min(1.0, 1.2 - share / 0.5))
+        return 1.0
+
+
+SCORERS: Dict[str, Type[Scorer]] = {}
+
+
+def register_scorer(scorer: Type[Scorer]):
+    """注册打分器（也可作为类装饰器使用）"""
+    SCORERS[scorer.name] = scorer
+    return scorer
+
+
+for _scorer in (LengthScorer, FinishReasonScorer, RepetitionScorer, RefusalScorer, LanguageScorer):
+    register_scorer(_scorer)
+
+DEFAULT_WEIGHTS = {'length': 1.0, 'finish_reason': 1.0, 'repetition': 2.0, 'refusal': 2.0, 'language': 1.0}
+
+
+class CandidateScore:
+    """一个候选的打分状态"""
+
+    __slots__ = ('pipeline', 'scorers', 'rejected', 'finished')
+
+    def __init__(self, pipeline: 'ScoringPipeline', scorers: List[Scorer]):
+        self.pipeline = pipeline
+        self.scorers = scorers
+        self.rejected: Optional[str] = None
+        self.finished = False
+
+    def feed(self, delta: str):
+        """接收一段增量内容；已被淘汰的候选不再打分"""
+        if not delta or self.rejected:
+            return
+        timings = self.pipeline.timings
+        for scorer in self.scorers:
+            began = time.perf_counter()
+            scorer.feed(delta)
+            timings[scorer.name] += time.perf_counter() - began
+            if scorer.rejected:
+                self._reject(scorer.rejected)
+                return
+
+    def finish(self, finish_reason: Optional[str]):
+        if self.finished:
+            return
+        self.finished = True
+        if self.rejected:
+            return
+        timings = self.pipeline.timings
+        for scorer in self.scorers:
+            began = time.perf_counter()
+            scorer.finish(finish_reason)
+            timings[scorer.name] += time.perf_counter() - began
+            if scorer.rejected:
+                self._reject(scorer.rejected)
+                return
+
+    def _reject(self, reason: str):
+        self.rejected = reason
+        rejections = self.pipeline.stats['rejections']
+        kind = reason.split(':')[0].split('=')[0]
+        rejections[kind] = rejections.get(kind, 0) + 1
+
+    @property
+    def scores(self) -> Dict[str, float]:
+        return {scorer.name: round(scorer.score(), 3) for scorer in self.scorers}
+
+    @property
+    def total(self) -> float:
+        """各打分器分数的加权平均（0~1），被淘汰的候选为0"""
+        if self.rejected:
+            return 0.0
+        weights = self.pipeline.weights
+        weight_sum = sum(weights.get(scorer.name, 1.0) for scorer in self.scorers)
+        if not weight_sum:
+            return 0.0
+        return sum(weights.get(scorer.name, 1.0) * scorer.score() for scorer in self.scorers) / weight_sum
+
+
+class ScoringPipeline:
+    """按配置组合打分器，为每个候选创建打分状态"""
+
+    def __init__(self, scorers: Optional[List[str]] = None, weights: Optional[Dict[str, float]] = None,
+                 good_enough: float = 0.85, target_tokens: int = 500, reject_refusals: bool = True,
+                 **options):
+        """
+        Args:
+            scorers: 启用的打分器名称，默认全部已注册的打分器
+            weights: 各打分器的权重，与 DEFAULT_WEIGHTS 合并
+            good_enough: 加权总分达到该值的候选立即选中，不再等待其他候选
+            target_tokens: 长度打分器得0.5分的token数
+            reject_refusals: 拒答的候选直接淘汰（否则只是0分）
+            options: 传给各打分器的其他参数（如 max_repeat_ratio、loop_segments）
+        """
+        names = scorers or list(SCORERS)
+        unknown = [name for name in names if name not in SCORERS]
+        if unknown:
+            raise ValueError(f"未知的打分器: {', '.join(unknown)}")
+        self.scorer_classes = [SCORERS[name] for name in names]
+        self.weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        self.good_enough = good_enough
+        self.options = dict(options, target_tokens=target_tokens, reject_refusals=reject_refusals)
+        self.timings: Dict[str, float] = {cls.name: 0.0 for cls in self.scorer_classes}
+        self.stats: Dict[str, Any] = {'candidates': 0, 'early_exits': 0, 'rejections': {}}
+
+    def start(self, request_data: Dict[str, Any], prompt: Optional[PromptProfile] = None) -> CandidateScore:
+        """为一个候选创建打分状态，之后随内容到达调用 feed，结束时调用 finish"""
+        prompt = prompt or PromptProfile(request_data)
+        self.stats['candidates'] += 1
+        return CandidateScore(self, [cls(prompt, self.options) for cls in self.scorer_classes])
+
+    def evaluate(self, request_data: Dict[str, Any], content: str, finish_reason: Optional[str],
+                 prompt: Optional[PromptProfile] = None) -> CandidateScore:
+        """一次性给完整内容打分（非流式接收的候选）"""
+        score = self.start(request_data, prompt)
+        score.feed(content)
+        score.finish(finish_reason)
+        return score
+
+    def get_stats(self) -> Dict[str, Any]:
+        candidates = self.stats['candidates']
+        return dict(
+            self.stats,
+            good_enough=self.good_enough,
+            weights={cls.name: self.weights.get(cls.name, 1.0) for cls in self.scorer_classes},
+            scorer_ms_total={name: round(seconds * 1000, 3) for name, seconds in self.timings.items()},
+            scorer_us_per_candidate={
+                name: round(seconds * 1e6 / candidates, 1) if candidates else 0.0
+                for name, seconds in self.timings.items()
+            },
+        )
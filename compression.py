@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+下游响应压缩模块
+对JSON和SSE响应按客户端的 Accept-Encoding 进行 gzip/brotli 压缩；
+流式响应的每个分块单独刷新压缩器，客户端收到分块的时机与不压缩时相同
+"""
+
+import zlib
+import logging
+from typing import Dict, Any, Iterable
+
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# 值得压缩的响应类型
+COMPRESSIBLE_TYPES = (b'application/json', b'text/event-stream')
+
+
+class _GzipEncoder:
+    """逐块刷新的gzip编码器"""
+
+    def __init__(self, level: int = 5):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def chunk(self, data: bytes) -> bytes:
+        # Z_SYNC_FLUSH 让已写入的数据立即可解压，代价只有几个字节
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes = b'') -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_FINISH)
+
+
+class _BrotliEncoder:
+    """逐块刷新的brotli编码器"""
+
+    def __init__(self, quality: int = 4):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def chunk(self, data: bytes) -> bytes:
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self, data: bytes = b'') -> bytes:
+        return self._compressor.process(data) + self._compressor.finish()
+
+
+def _accepted_encodings(headers: Iterable) -> set:
+    for name, value in headers:
+        if name == b'accept-encoding':
+            return {item.split(b';')[0].strip() for item in value.lower().split(b',')}
+    return set()
+
+
+class CompressionStats:
+    """压缩统计，中间件实例由框架创建，统计对象需要单独持有"""
+
+    def __init__(self):
+        self.responses = 0
+        self.streamed_responses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def record(self, raw: bytes, compressed: bytes):
+        self.bytes_in += len(raw)
+        self.bytes_out += len(compressed)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取下游压缩统计（含节省的字节数）"""
+        return {
+            'responses': self.responses,
+            'streamed_responses': self.streamed_responses,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'bytes_saved': self.bytes_in - self.bytes_out,
+            'brotli_available': BROTLI_AVAILABLE,
+        }
+
+
+class CompressionMiddleware:
+    """流式安全的响应压缩ASGI中间件"""
+
+    def __init__(self, app, stats: CompressionStats = None,
+                 paths: Iterable[str] = ('/v1/chat/completions',), minimum_size: int = 512):
+        """
+        Args:
+            app: 下游ASGI应用
+            stats: 统计对象
+            paths: 需要压缩响应的路径
+            minimum_size: 非流式响应小于该字节数时不压缩
+        """
+        self.app = app
+        self.stats = stats or CompressionStats()
+        self.paths = tuple(paths)
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].startswith(self.paths):
+            await self.app(scope, receive, send)
+            return
+
+        accepted = _accepted_encodings(scope.get('headers', []))
+        if BROTLI_AVAILABLE and b'br' in accepted:
+            encoding = b'br'
+        elif b'gzip' in accepted:
+            encoding = b'gzip'
+        else:
+            await self.app(scope, receive, send)
+            return
+
+        state = {'start': None, 'encoder': None, 'passthrough': False}
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                headers = message.get('headers', [])
+                content_type = b''
+                already_encoded = False
+                for name, value in headers:
+                    if name == b'content-type':
+                        content_type = value
+                    elif name == b'content-encoding':
+                        already_encoded = True
+                if already_encoded or not content_type.startswith(COMPRESSIBLE_TYPES):
+                    state['passthrough'] = True
+                    await send(message)
+                else:
+                    # 等到第一个分块才能决定是否压缩（小响应不值得）
+                    state['start'] = message
+                return
+
+            if message['type'] != 'http.response.body' or state['passthrough']:
+                await send(message)
+                return
+
+            body = message.get('body', b'')
+            more_body = message.get('more_body', False)
+
+            if state['encoder'] is None:
+                start = state['start']
+                if not more_body and len(body) < self.minimum_size:
+                    state['passthrough'] = True
+                    await send(start)
+                    await send(message)
+                    return
+                state['encoder'] = _BrotliEncoder() if encoding == b'br' else _GzipEncoder()
+                headers = [(name, value) for name, value in start.get('headers', []) if name != b'content-length']
+                headers.append((b'content-encoding', encoding))
+                headers.append((b'vary', b'Accept-Encoding'))
+                if not more_body:
+                    compressed = state['encoder'].finish(body)
+                    headers.append((b'content-length', str(len(compressed)).encode()))
+                    await send(dict(start, headers=headers))
+                    self.stats.responses += 1
+                    self.stats.record(body, compressed)
+                    await send({'type': 'http.response.body', 'body': compressed})
+                    return
+                self.stats.streamed_responses += 1
+                await send(dict(start, headers=headers))
+
+            encoder = state['encoder']
+            compressed = encoder.chunk(body) if more_body else encoder.finish(body)
+            self.stats.record(body, compressed)
+            await send({'type': 'http.response.body', 'body': compressed, 'more_body': more_body})
+
+        await self.app(scope, receive, send_wrapper)
@@ -8,7 +8,9 @@
 import os
 import json
 import configparser
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional
+
+from key_store import KeyStore, store_path
 
 class ConfigManager:
     """配置文件管理器"""
@@ -21,8 +23,16 @@ class ConfigManager:
             config_file: 配置文件路径
         """
         self.config_file = config_file
-        self.config = configparser.ConfigParser()
-        self.load_config()
+        self._config = None
+        self._key_store = None
+    
+    @property
+    def config(self) -> configparser.ConfigParser:
+        """首次访问时才读取配置文件，导入模块时不做任何文件读写"""
+        if self._config is None:
+            self._config = configparser.ConfigParser()
+            self.load_config()
+        return self._config
     
     def load_config(self):
         """加载配置文件"""
@@ -38,8 +48,12 @@ class ConfigManager:
             'port': '8080',
             'host': '0.0.0.0',
             'api_key': '123',
+            'admin_key': '',
             'min_response_length': '400',
-            'request_timeout': '30'
+            'min_response_unit': 'chars',
+            'request_timeout': '30',
+            'shutdown_timeout': '30',
+            'reuse_port': 'true'
         }
         
         self.config['API_KEYS'] = {
@@ -66,7 +80,105 @@ class ConfigManager:
         }
         
         self.config['API'] = {
-            'base_url': 'https://generativelanguage.googleapis.com/v1beta'
+            'base_url': 'https://generativelanguage.googleapis.com/v1beta',
+            'backend': 'openai',
+            'safety_threshold': ''
+        }
+        
+        self.config['LIMITS'] = {
+            'max_inflight_upstream': '32',
+            'max_queue_size': '64',
+            'queue_timeout': '30',
+            'max_buffered_mb_per_request': '8',
+            'max_buffered_mb_total': '128'
+        }
+        
+        self.config['CACHE'] = {
+            'context_cache': 'false',
+            'min_prefix_chars': '4096',
+            'ttl': '600'
+        }
+        
+        self.config['COMPRESSION'] = {
+            'downstream': 'true',
+            'min_size': '512',
+            'upstream_gzip_requests': 'false',
+            'upstream_gzip_min_bytes': '16384'
+        }
+        
+        self.config['UPSTREAM'] = {
+            'warm_connections': '4',
+            'keepalive_interval': '45',
+            'keepalive_expiry': '120',
+            'dns_cache_ttl': '300'
+        }
+        
+        # 密钥存储默认不启用，需要命名密钥池或批量导入时设为数据库路径（如 keys.db）
+        self.config['KEYS'] = {
+            'store': ''
+        }
+        
+        self.config['PROBER'] = {
+            'enabled': 'true',
+            'method': 'models',
+            'model': 'gemini-2.5-flash',
+            'interval': '600',
+            'rate': '2',
+            'concurrency': '8',
+            'timeout': '15'
+        }
+        
+        self.config['QUOTA'] = {
+            'enabled': 'true',
+            'path': 'quota.db',
+            'default_rpm': '10',
+            'default_rpd': '250',
+            'default_tpm': '250000',
+            'limits': '{}',
+            'flush_interval': '5'
+        }
+        
+        self.config['BATCH'] = {
+            'enabled': 'false',
+            'path': 'batch.db',
+            'workers': '8',
+            'per_key_concurrency': '1',
+            'max_attempts': '3',
+            'headroom': '2'
+        }
+        
+        self.config['EMBEDDINGS'] = {
+            'window_ms': '5',
+            'max_batch': '100'
+        }
+        
+        self.config['APPROX_CACHE'] = {
+            'enabled': 'false',
+            'threshold': '0.95',
+            'models': '',
+            'tenants': '',
+            'ttl': '3600',
+            'max_entries': '10000',
+            'max_mb': '64',
+            'min_query_tokens': '8'
+        }
+        
+        self.config['SCORING'] = {
+            'enabled': 'false',
+            'scorers': '',
+            'weights': '{}',
+            'good_enough': '0.85',
+            'wait_more': '15',
+            'target_tokens': '500',
+            'reject_refusals': 'true'
+        }
+        
+        self.config['RECORDER'] = {
+            'enabled': 'false',
+            'path': 'traffic/traffic.jsonl',
+            'include_bodies': 'false',
+            'max_mb': '50',
+            'backup_count': '5'
         }
         
         self.save_config()
@@ -83,6 +195,7 @@ class ConfigManager:
             'host': self.config['SERVER']['host'],
             'api_key': self.config['SERVER']['api_key'],
             'min_response_length': int(self.config['SERVER']['min_response_length']),
+            'min_response_unit': self.config.get('SERVER', 'min_response_unit', fallback='chars'),
             'request_timeout': int(self.config['SERVER']['request_timeout'])
         }
     
@@ -96,15 +209,57 @@ class ConfigManager:
         self.config['SERVER']['request_timeout'] = str(request_timeout)
         self.save_config()
     
+    def get_lifecycle_config(self) -> Dict[str, Any]:
+        """获取重启相关配置：优雅停止的等待期限、是否以 SO_REUSEPORT 监听以便零停机替换"""
+        return {
+            'shutdown_timeout': self.config.getfloat('SERVER', 'shutdown_timeout', fallback=30.0),
+            'reuse_port': self.config.getboolean('SERVER', 'reuse_port', fallback=True),
+            'pid_file': self.config.get('SERVER', 'pid_file', fallback='')
+        }
+    
+    @property
+    def key_store(self) -> Optional[KeyStore]:
+        """
+        密钥存储（[KEYS] store 为空时不启用，仍使用 [API_KEYS] 中的两组密钥）。
+        数据库不存在时自动从 [API_KEYS] 迁移 group1/group2 两个密钥池
+        """
+        if self._key_store is None:
+            path = store_path(self.config)
+            if not path:
+                return None
+            store = KeyStore(path)
+            if not store.exists() and self.config.has_section('API_KEYS'):
+                for pool in ('group1', 'group2'):
+                    store.import_lines(json.loads(self.config.get('API_KEYS', pool, fallback='[]')), pool)
+            store.load()
+            self._key_store = store
+        return self._key_store
+    
+    def get_key_groups(self) -> List[List[str]]:
+        """获取轮流调度的全部密钥组（启用密钥存储时为所有非空密钥池）"""
+        if self.key_store is not None:
+            return self.key_store.groups()
+        api_keys = self.get_api_keys()
+        return [api_keys['group1'], api_keys['group2']]
+    
     def get_api_keys(self) -> Dict[str, List[str]]:
-        """获取API密钥"""
+        """获取API密钥（界面中编辑的 group1/group2 两组）"""
+        if self.key_store is not None:
+            return {
+                'group1': self.key_store.pool_keys('group1'),
+                'group2': self.key_store.pool_keys('group2')
+            }
         return {
             'group1': json.loads(self.config['API_KEYS']['group1']),
             'group2': json.loads(self.config['API_KEYS']['group2'])
         }
     
     def set_api_keys(self, group1: List[str], group2: List[str]):
-        """设置API密钥"""
+        """设置API密钥（启用密钥存储时只替换这两个密钥池，不改写配置文件）"""
+        if self.key_store is not None:
+            self.key_store.replace_pool('group1', group1)
+            self.key_store.replace_pool('group2', group2)
+            return
         self.config['API_KEYS']['group1'] = json.dumps(group1)
         self.config['API_KEYS']['group2'] = json.dumps(group2)
         self.save_config()
@@ -117,6 +272,163 @@ class ConfigManager:
         """设置基础URL"""
         self.config['API']['base_url'] = base_url
         self.save_config()
+    
+    def get_backend_config(self) -> Dict[str, Any]:
+        """获取上游接口类型配置（openai 兼容层或 native 原生接口）"""
+        backend = self.config.get('API', 'backend', fallback='openai').strip().lower()
+        return {
+            'backend': backend if backend in ('openai', 'native') else 'openai',
+            'safety_threshold': self.config.get('API', 'safety_threshold', fallback='').strip()
+        }
+    
+    def get_tenants_file(self) -> str:
+        """获取多租户密钥表文件路径"""
+        return self.config.get('SERVER', 'tenants_file', fallback='tenants.json')
+    
+    def get_admin_key(self) -> str:
+        """获取管理接口（性能剖析、密钥存储等）的密钥，未配置时这些接口不可用"""
+        return self.config.get('SERVER', 'admin_key', fallback='').strip()
+    
+    def get_limits_config(self) -> Dict[str, Any]:
+        """获取并发准入控制配置（旧配置文件没有该节时使用默认值）"""
+        return {
+            'max_inflight_upstream': self.config.getint('LIMITS', 'max_inflight_upstream', fallback=32),
+            'max_queue_size': self.config.getint('LIMITS', 'max_queue_size', fallback=64),
+            'queue_timeout': self.config.getfloat('LIMITS', 'queue_timeout', fallback=30.0),
+            'max_buffered_mb_per_request': self.config.getint('LIMITS', 'max_buffered_mb_per_request', fallback=8),
+            'max_buffered_mb_total': self.config.getint('LIMITS', 'max_buffered_mb_total', fallback=128)
+        }
+    
+    def get_cache_config(self) -> Dict[str, Any]:
+        """获取上下文缓存配置（默认关闭）"""
+        return {
+            'context_cache': self.config.getboolean('CACHE', 'context_cache', fallback=False),
+            'min_prefix_chars': self.config.getint('CACHE', 'min_prefix_chars', fallback=4096),
+            'ttl': self.config.getint('CACHE', 'ttl', fallback=600)
+        }
+    
+    def get_compression_config(self) -> Dict[str, Any]:
+        """获取压缩配置（上游请求体压缩默认关闭）"""
+        return {
+            'downstream': self.config.getboolean('COMPRESSION', 'downstream', fallback=True),
+            'min_size': self.config.getint('COMPRESSION', 'min_size', fallback=512),
+            'upstream_gzip_requests': self.config.getboolean('COMPRESSION', 'upstream_gzip_requests', fallback=False),
+            'upstream_gzip_min_bytes': self.config.getint('COMPRESSION', 'upstream_gzip_min_bytes', fallback=16384)
+        }
+    
+    def get_upstream_config(self) -> Dict[str, Any]:
+        """获取上游连接预热与保活配置"""
+        return {
+            'warm_connections': self.config.getint('UPSTREAM', 'warm_connections', fallback=4),
+            'keepalive_interval': self.config.getfloat('UPSTREAM', 'keepalive_interval', fallback=45.0),
+            'keepalive_expiry': self.config.getfloat('UPSTREAM', 'keepalive_expiry', fallback=120.0),
+            'dns_cache_ttl': self.config.getfloat('UPSTREAM', 'dns_cache_ttl', fallback=300.0)
+        }
+    
+    def get_prober_config(self) -> Dict[str, Any]:
+        """
+        获取后台密钥探测配置。method=models 不消耗配额但只能发现无效密钥，
+        method=completion 每个密钥消耗1个token，还能发现配额耗尽和地区限制
+        """
+        method = self.config.get('PROBER', 'method', fallback='models').strip().lower()
+        return {
+            'enabled': self.config.getboolean('PROBER', 'enabled', fallback=True),
+            'method': method if method in ('models', 'completion') else 'models',
+            'model': self.config.get('PROBER', 'model', fallback='gemini-2.5-flash'),
+            'interval': self.config.getfloat('PROBER', 'interval', fallback=600.0),
+            'rate': self.config.getfloat('PROBER', 'rate', fallback=2.0),
+            'concurrency': self.config.getint('PROBER', 'concurrency', fallback=8),
+            'timeout': self.config.getfloat('PROBER', 'timeout', fallback=15.0)
+        }
+    
+    def get_quota_config(self) -> Dict[str, Any]:
+        """
+        获取配额统计配置。limits 为 JSON 对象 {"模型": [RPM, RPD]} 或 {"模型": [RPM, RPD, TPM]}，
+        覆盖 quota_tracker.DEFAULT_LIMITS 中的免费档默认值（如使用付费密钥时）
+        """
+        try:
+            limits = json.loads(self.config.get('QUOTA', 'limits', fallback='{}') or '{}')
+        except json.JSONDecodeError:
+            limits = {}
+        return {
+            'enabled': self.config.getboolean('QUOTA', 'enabled', fallback=True),
+            'path': self.config.get('QUOTA', 'path', fallback='quota.db'),
+            'default_rpm': self.config.getint('QUOTA', 'default_rpm', fallback=10),
+            'default_rpd': self.config.getint('QUOTA', 'default_rpd', fallback=250),
+            'default_tpm': self.config.getint('QUOTA', 'default_tpm', fallback=250000),
+            'limits': {model: tuple(int(value) for value in values[:3]) for model, values in limits.items()},
+            'flush_interval': self.config.getfloat('QUOTA', 'flush_interval', fallback=5.0)
+        }
+    
+    def get_batch_config(self) -> Dict[str, Any]:
+        """
+        获取批量请求配置（默认关闭，开启后才创建 batch.db）。
+        headroom 为交互请求保留的准入名额，批量请求只使用其余的空闲名额
+        """
+        return {
+            'enabled': self.config.getboolean('BATCH', 'enabled', fallback=False),
+            'path': self.config.get('BATCH', 'path', fallback='batch.db'),
+            'workers': self.config.getint('BATCH', 'workers', fallback=8),
+            'per_key_concurrency': self.config.getint('BATCH', 'per_key_concurrency', fallback=1),
+            'max_attempts': self.config.getint('BATCH', 'max_attempts', fallback=3),
+            'headroom': self.config.getint('BATCH', 'headroom', fallback=2)
+        }
+    
+    def get_embeddings_config(self) -> Dict[str, Any]:
+        """获取嵌入微批处理配置：window_ms 内到达的输入合并为一次上游调用，每次最多 max_batch 条"""
+        return {
+            'window_ms': self.config.getfloat('EMBEDDINGS', 'window_ms', fallback=5.0),
+            'max_batch': self.config.getint('EMBEDDINGS', 'max_batch', fallback=100)
+        }
+    
+    def get_approx_cache_config(self) -> Dict[str, Any]:
+        """
+        获取近似重复请求缓存配置（默认关闭）。models/tenants 为逗号分隔的选择加入列表，"*" 表示全部；
+        threshold 为SimHash相似度阈值，0.95 即64位指纹中最多3位不同
+        """
+        def names(option: str) -> List[str]:
+            value = self.config.get('APPROX_CACHE', option, fallback='')
+            return [name.strip() for name in value.split(',') if name.strip()]
+        return {
+            'enabled': self.config.getboolean('APPROX_CACHE', 'enabled', fallback=False),
+            'threshold': self.config.getfloat('APPROX_CACHE', 'threshold', fallback=0.95),
+            'models': names('models'),
+            'tenants': names('tenants'),
+            'ttl': self.config.getfloat('APPROX_CACHE', 'ttl', fallback=3600.0),
+            'max_entries': self.config.getint('APPROX_CACHE', 'max_entries', fallback=10000),
+            'max_mb': self.config.getint('APPROX_CACHE', 'max_mb', fallback=64),
+            'min_query_tokens': self.config.getint('APPROX_CACHE', 'min_query_tokens', fallback=8)
+        }
+    
+    def get_scoring_config(self) -> Dict[str, Any]:
+        """
+        获取候选打分配置（默认关闭，关闭时仍按 first 规则返回第一个有效响应）。
+        scorers 为逗号分隔的打分器名称，留空表示全部；weights 为JSON对象，如 {"repetition": 3}
+        """
+        scorers = self.config.get('SCORING', 'scorers', fallback='')
+        try:
+            weights = json.loads(self.config.get('SCORING', 'weights', fallback='{}') or '{}')
+        except json.JSONDecodeError:
+            weights = {}
+        return {
+            'enabled': self.config.getboolean('SCORING', 'enabled', fallback=False),
+            'scorers': [name.strip() for name in scorers.split(',') if name.strip()],
+            'weights': weights if isinstance(weights, dict) else {},
+            'good_enough': self.config.getfloat('SCORING', 'good_enough', fallback=0.85),
+            'wait_more': self.config.getfloat('SCORING', 'wait_more', fallback=15.0),
+            'target_tokens': self.config.getint('SCORING', 'target_tokens', fallback=500),
+            'reject_refusals': self.config.getboolean('SCORING', 'reject_refusals', fallback=True)
+        }
+    
+    def get_recorder_config(self) -> Dict[str, Any]:
+        """获取流量录制配置（默认关闭）"""
+        return {
+            'enabled': self.config.getboolean('RECORDER', 'enabled', fallback=False),
+            'path': self.config.get('RECORDER', 'path', fallback='traffic/traffic.jsonl'),
+            'include_bodies': self.config.getboolean('RECORDER', 'include_bodies', fallback=False),
+            'max_mb': self.config.getint('RECORDER', 'max_mb', fallback=50),
+            'backup_count': self.config.getint('RECORDER', 'backup_count', fallback=5)
+        }
 
 # 全局配置管理器实例
 config_manager = ConfigManager()
\ No newline at end of file
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+pytest 共用夹具：在后台线程中启动 mock_upstream，测试通过真实的HTTP请求访问模拟上游，
+被测组件都按正常配置运行，不替换任何组件
+"""
+
+import socket
+import threading
+import time
+
+import pytest
+import uvicorn
+
+import mock_upstream
+
+# 需要图形界面或已启动服务的手动测试脚本，以及打包目录，不作为自动测试收集
+collect_ignore = ["test_icon.py"]
+collect_ignore_glob = ["build/*", "dist/*"]
+
+
+@pytest.fixture(scope="session")
+def upstream_url():
+    """启动模拟上游，返回与 config.ini 中 base_url 格式相同的地址"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(mock_upstream.app, log_level="warning"))
+    thread = threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 10
+    while not server.started:
+        if time.monotonic() > deadline or not thread.is_alive():
+            raise RuntimeError("模拟上游启动失败")
+        time.sleep(0.01)
+    yield f"http://127.0.0.1:{port}/v1beta"
+    server.should_exit = True
+    thread.join(timeout=5)
+    sock.close()
+
+
+@pytest.fixture
+def mock(upstream_url):
+    """每个测试开始时清空模拟上游的计数和缓存条目，并使用较短的延迟"""
+    saved = dict(mock_upstream.settings)
+    mock_upstream.settings.update(min_latency=0.01, max_latency=0.05, error_rate=0.0, bad_rate=0.0)
+    mock_upstream.cached_contents.clear()
+    for name in mock_upstream.counters:
+        mock_upstream.counters[name] = 0
+    yield mock_upstream
+    mock_upstream.settings.clear()
+    mock_upstream.settings.update(saved)
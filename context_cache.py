@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Gemini上下文缓存模块
+识别每轮对话中重复出现的系统提示词前缀，为每个(密钥, 模型, 前缀)在上游创建
+cachedContents 缓存条目，后续请求只引用缓存名称而不再上传整段前缀
+"""
+
+import time
+import hashlib
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+
+import httpx
+
+from upstream_client import UpstreamClient
+
+logger = logging.getLogger(__name__)
+
+
+def split_stable_prefix(messages: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """把消息列表拆成开头连续的系统消息（可缓存前缀）和其余对话"""
+    index = 0
+    while index < len(messages) and messages[index].get('role') == 'system':
+        index += 1
+    return messages[:index], messages[index:]
+
+
+def prefix_text(prefix: List[Dict[str, Any]]) -> str:
+    """把前缀消息合并成系统指令文本"""
+    parts = []
+    for message in prefix:
+        content = message.get('content', '')
+        if isinstance(content, list):
+            content = ''.join(part.get('text', '') for part in content if isinstance(part, dict))
+        parts.append(str(content))
+    return '\n\n'.join(parts)
+
+
+def parse_expire_time(value: str) -> Optional[float]:
+    """解析上游返回的 RFC3339 过期时间"""
+    try:
+        # Python 3.11 之前 fromisoformat 不支持 'Z' 和纳秒精度
+        value = value.replace('Z', '+00:00')
+        if '.' in value:
+            head, tail = value.split('.', 1)
+            fraction, _, offset = tail.partition('+')
+            value = f"{head}.{fraction[:6].ljust(6, '0')}+{offset}"
+        return datetime.fromisoformat(value).timestamp()
+    except (ValueError, AttributeError):
+        return None
+
+
+class ContextCacheManager:
+    """上下文缓存管理器"""
+
+    def __init__(self, base_url: str, enabled: bool = False, min_prefix_chars: int = 4096,
+                 ttl_seconds: int = 600, min_hits: int = 2, max_entries: int = 512,
+                 upstream: Optional[UpstreamClient] = None):
+        """
+        初始化上下文缓存管理器
+
+        Args:
+            base_url: 上游API基础URL
+            enabled: 是否启用上下文缓存
+            min_prefix_chars: 前缀达到该长度才值得缓存（上游对缓存内容有最小token数要求）
+            ttl_seconds: 上游缓存条目的存活时间
+            min_hits: 同一前缀出现多少次后才创建缓存，避免为一次性提示词付存储费用
+            max_entries: 本地最多记录的缓存条目数
+            upstream: 创建缓存条目使用的共享上游客户端（与代理引擎共用连接池），未提供时新建
+        """
+        self.base_url = base_url
+        self.upstream = upstream or UpstreamClient()
+        self.enabled = enabled
+        self.min_prefix_chars = min_prefix_chars
+        self.ttl_seconds = ttl_seconds
+        self.min_hits = min_hits
+        self.max_entries = max_entries
+
+        # (密钥, 模型, 前缀哈希) -> {'name': 缓存名称, 'expire_at': 过期时间戳}
+        self._entries: "OrderedDict[Tuple[str, str, str], Dict[str, Any]]" = OrderedDict()
+        # 前缀哈希出现次数，用于判断前缀是否稳定
+        self._prefix_hits: "OrderedDict[str, int]" = OrderedDict()
+        # 创建失败的条目在退避期内不再尝试
+        self._failures: Dict[Tuple[str, str, str], float] = {}
+        self._pending = set()
+        self._tasks = set()
+
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'created': 0,
+            'create_failed': 0,
+            'invalidated': 0,
+            'bytes_saved': 0,
+        }
+
+    # 缓存条目到期前多少秒就不再使用，避免请求途中过期
+    EXPIRY_MARGIN = 30
+    # 创建失败后的退避时间（秒）
+    FAILURE_BACKOFF = 300
+
+    @staticmethod
+    def model_resource(model: str) -> str:
+        return model if model.startswith('models/') else f"models/{model}"
+
+    def _count_hit(self, digest: str) -> int:
+        count = self._prefix_hits.pop(digest, 0) + 1
+        self._prefix_hits[digest] = count
+        while len(self._prefix_hits) > self.max_entries * 4:
+            self._prefix_hits.popitem(last=False)
+        return count
+
+    def prepare(self, api_key: str, request_data: dict) -> Tuple[dict, Optional[tuple]]:
+        """
+        为单个密钥准备要发送的请求体
+
+        命中缓存时去掉前缀消息并引用缓存名称；未命中时原样返回，
+        并在前缀足够稳定时于后台创建缓存，不阻塞当前请求
+
+        Returns:
+            (要发送的请求体, 使用的缓存条目键，未使用缓存时为None)
+        """
+        if not self.enabled:
+            return request_data, None
+
+        prefix, rest = split_stable_prefix(request_data.get('messages', []))
+        if not prefix or not rest:
+            return request_data, None
+        text = prefix_text(prefix)
+        if len(text) < self.min_prefix_chars:
+            return request_data, None
+
+        model = request_data.get('model', '')
+        digest = hashlib.sha256(f"{model}\0{text}".encode('utf-8')).hexdigest()
+        entry_key = (api_key, model, digest)
+
+        entry = self._entries.get(entry_key)
+        if entry and entry['expire_at'] - time.time() > self.EXPIRY_MARGIN:
+            self._entries.move_to_end(entry_key)
+            self.stats['hits'] += 1
+            self.stats['bytes_saved'] += len(text.encode('utf-8'))
+            cached_data = dict(request_data)
+            cached_data['messages'] = rest
+            cached_data['extra_body'] = {'google': {'cached_content': entry['name']}}
+            return cached_data, entry_key
+
+        self.stats['misses'] += 1
+        if entry:
+            self._entries.pop(entry_key, None)
+        # 上游缓存条目按密钥隔离，出现次数也按密钥分别统计
+        if self._count_hit(f"{api_key}\0{digest}") >= self.min_hits:
+            self._schedule_create(entry_key, text)
+        return request_data, None
+
+    def _schedule_create(self, entry_key: tuple, text: str):
+        if entry_key in self._pending:
+            return
+        if self._failures.get(entry_key, 0) > time.time():
+            return
+        self._pending.add(entry_key)
+        task = asyncio.create_task(self._create(entry_key, text))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _create(self, entry_key: tuple, text: str):
+        """在上游创建缓存条目（后台任务，经由共享上游客户端的连接池发送）"""
+        api_key, model, digest = entry_key
+        body = {
+            'model': self.model_resource(model),
+            'systemInstruction': {'parts': [{'text': text}]},
+            'ttl': f"{self.ttl_seconds}s",
+        }
+        content, headers = self.upstream.encode_body(body, {'x-goog-api-key': api_key})
+        try:
+            response = await self.upstream.client.post(
+                f"{self.base_url}/cachedContents", headers=headers, content=content, timeout=30
+            )
+            self.upstream.record_response(response)
+            response.raise_for_status()
+            data = response.json()
+            expire_at = parse_expire_time(data.get('expireTime', '')) or time.time() + self.ttl_seconds
+            self._entries[entry_key] = {'name': data['name'], 'expire_at': expire_at}
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._failures.pop(entry_key, None)
+            self.stats['created'] += 1
+            logger.info(f"密钥 [***{api_key[-4:]}] 已创建上下文缓存 {data['name']} (前缀长度: {len(text)})")
+        except (httpx.HTTPError, ValueError, KeyError) as e:
+            self._failures[entry_key] = time.time() + self.FAILURE_BACKOFF
+            self.stats['create_failed'] += 1
+            logger.warning(f"密钥 [***{api_key[-4:]}] 创建上下文缓存失败: {e}")
+        finally:
+            self._pending.discard(entry_key)
+
+    def invalidate(self, entry_key: tuple):
+        """上游拒绝缓存引用（已过期或被删除）时丢弃本地记录"""
+        if self._entries.pop(entry_key, None) is not None:
+            self.stats['invalidated'] += 1
+            logger.info(f"密钥 [***{entry_key[0][-4:]}] 的上下文缓存已失效")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取上下文缓存统计信息"""
+        return dict(self.stats, enabled=self.enabled, entries=len(self._entries), pending=len(self._pending))
@@ -8,8 +8,10 @@ LLM代理服务诊断工具
 import os
 import sys
 import socket
+import asyncio
 import requests
 import subprocess
+import configparser
 from pathlib import Path
 
 def check_port(host, port):
@@ -30,6 +32,30 @@ def check_service_health(url):
     except Exception as e:
         return False, str(e)
 
+def read_ports(config_file="config.ini"):
+    """从配置文件读取API端口和管理界面端口，没有配置文件时使用默认值"""
+    config = configparser.ConfigParser()
+    config.read(config_file, encoding='utf-8')
+    return (config.getint('SERVER', 'port', fallback=5000),
+            config.getint('SERVER', 'web_port', fallback=5000))
+
+def check_keys(config_file="config.ini"):
+    """并发检查配置中的全部上游密钥（只列出模型，不消耗配额）"""
+    # key_prober 与仓库根目录共用同一份代码，由安装脚本复制到本目录
+    try:
+        from key_prober import KeyProber, load_config_keys, print_report
+    except ImportError:
+        print(f"  ❓ 无法检查密钥: {Path(__file__).parent} 中缺少 key_prober.py（重新运行安装脚本或从项目根目录复制）")
+        return
+    try:
+        settings = load_config_keys(config_file)
+    except (OSError, KeyError, ValueError, configparser.Error) as e:
+        print(f"  ❓ 无法读取密钥配置: {e}")
+        return
+    prober = KeyProber(settings['base_url'], method='models', concurrency=8, timeout=10)
+    asyncio.run(prober.probe_keys(key for keys in settings['pools'].values() for key in keys))
+    print_report(settings['pools'], prober)
+
 def diagnose():
     """运行诊断"""
     print("🔍 LLM代理服务诊断工具")
@@ -57,7 +83,8 @@ def diagnose():
     
     # 检查端口
     print("\n🔌 检查端口状态:")
-    ports_to_check = [8080, 8081]
+    api_port, web_port = read_ports()
+    ports_to_check = sorted({api_port, web_port})
     
     for port in ports_to_check:
         if check_port('localhost', port):
@@ -85,11 +112,18 @@ def diagnose():
     except ImportError:
         print("  ❌ httpx 未安装")
     
+    # 检查上游密钥
+    print("\n🔑 检查上游密钥:")
+    if Path("config.ini").exists():
+        check_keys()
+    else:
+        print("  ❌ config.ini 缺失，跳过")
+    
     # 提供访问建议
     print("\n🌐 访问建议:")
-    print("  管理界面: http://localhost:8081")
-    print("  API端点: http://localhost:8080/v1/chat/completions")
-    print("  健康检查: http://localhost:8081/api")
+    print(f"  管理界面: http://localhost:{web_port}")
+    print(f"  API端点: http://localhost:{api_port}/v1/chat/completions")
+    print(f"  健康检查: http://localhost:{web_port}/api")
     
     # 检查防火墙（Windows）
     if os.name == 'nt':
@@ -34,6 +34,21 @@ except ImportError:
     print("错误：缺少FastAPI依赖。请运行 'pip install fastapi uvicorn httpx pydantic python-multipart aiofiles'")
     sys.exit(1)
 
+# live_metrics / key_prober 与仓库根目录的服务共用同一份代码，由安装脚本复制到本目录。
+# 缺少时只关闭对应的功能（实时指标推送 / 后台密钥探测），代理功能不受影响
+try:
+    from live_metrics import MetricsAggregator
+except ImportError:
+    MetricsAggregator = None
+    print(f"提示：{Path(__file__).parent} 中缺少 live_metrics.py，实时指标推送已关闭。"
+          "重新运行安装脚本或从项目根目录复制该文件后重启即可启用")
+try:
+    from key_prober import KeyProber
+except ImportError:
+    KeyProber = None
+    print(f"提示：{Path(__file__).parent} 中缺少 key_prober.py，后台密钥探测已关闭。"
+          "重新运行安装脚本或从项目根目录复制该文件后重启即可启用")
+
 # ==================== 辅助函数 ====================
 def is_termux_environment() -> bool:
     """检测是否在Termux环境中运行"""
@@ -238,6 +253,32 @@ if FASTAPI_AVAILABLE:
     # 轮询计数器
     current_group_index = 0
 
+    # 实时指标：每秒汇总一次，Web界面通过 /api/metrics/stream 接收增量（缺少 live_metrics 时为None）
+    dashboard_metrics = MetricsAggregator() if MetricsAggregator is not None else None
+
+    def record_fanout_metrics(current_keys: List[str], tasks: list, best_response, start_time: float):
+        """记录一次并发请求的指标（已取消的上游请求不计入密钥统计）"""
+        if dashboard_metrics is None:
+            return
+        best_result = best_response['result'] if best_response else None
+        for key, task in zip(current_keys, tasks):
+            if not task.done() or task.cancelled():
+                continue
+            result = task.result()
+            dashboard_metrics.record_leg(f"***{key[-4:]}", bool(result and result.get("choices")),
+                                         won=result is best_result)
+        dashboard_metrics.record_request((time.time() - start_time) * 1000, best_result is not None, len(tasks))
+
+    # 密钥探测：后台低频率只列出模型（不消耗配额），请求时跳过已知无效的密钥
+    # （缺少 key_prober 时为None，不跳过任何密钥）
+    key_prober = (KeyProber(config_manager.get_base_url(), method='models', concurrency=4, interval=600, rate=1.0)
+                  if KeyProber is not None else None)
+
+    def all_api_keys() -> List[str]:
+        """两组中的全部密钥（后台探测每轮调用一次，以便使用最新配置）"""
+        api_keys = config_manager.get_api_keys()
+        return api_keys['group1'] + api_keys['group2']
+
     def get_current_api_keys():
         """根据轮询机制返回当前应该使用的API密钥组"""
         global current_group_index
@@ -254,6 +295,8 @@ if FASTAPI_AVAILABLE:
             current_group_index = 0
         
         valid_keys = [key for key in keys if key and not key.startswith("YOUR_") and len(key) > 10]
+        if key_prober is not None:
+            valid_keys = key_prober.usable(valid_keys)
         
         # 记录当前使用的密钥组信息，便于调试
         logger.info(f"当前使用密钥组: {'group1' if current_group_index == 1 else 'group2'}, 有效密钥数量: {len(valid_keys)}")
@@ -350,6 +393,7 @@ if FASTAPI_AVAILABLE:
     async def generate_fake_stream_response(request_data: dict):
         """获取完整的响应内容，等待15秒后选择token最长的响应，然后以流式方式发送给前端"""
         try:
+            start_time = time.time()
             current_keys = get_current_api_keys()
             if not current_keys:
                 raise HTTPException(status_code=500, detail="没有可用的API密钥")
@@ -410,8 +454,9 @@ if FASTAPI_AVAILABLE:
                             pass
                 
                 # 选择token最长的响应
-                if valid_responses:
-                    best_response = max(valid_responses, key=lambda x: x['token_count'])
+                best_response = max(valid_responses, key=lambda x: x['token_count']) if valid_responses else None
+                record_fanout_metrics(current_keys, tasks, best_response, start_time)
+                if best_response:
                     return await stream_response_content(best_response['result'], best_response['content'])
 
             raise HTTPException(status_code=503, detail="所有上游API请求均失败")
@@ -454,6 +499,14 @@ if FASTAPI_AVAILABLE:
         allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"]
     )
 
+    @app_fastapi.on_event("startup")
+    async def start_metrics_ticker():
+        """无论打开多少个页面，指标都只由这一个后台任务每秒汇总一次"""
+        if dashboard_metrics is not None:
+            asyncio.create_task(dashboard_metrics.run_ticker())
+        if key_prober is not None:
+            asyncio.create_task(key_prober.run_background(all_api_keys))
+
     @app_fastapi.post("/v1/chat/completions")
     async def chat_completions_proxy(chat_request: ChatRequest, request: Request):
         try:
@@ -471,6 +524,7 @@ if FASTAPI_AVAILABLE:
             if chat_request.stream:
                 return await generate_fake_stream_response(request_data)
             
+            start_time = time.time()
             current_keys = get_current_api_keys()
             if not current_keys:
                 raise HTTPException(status_code=500, detail="服务器未配置有效的API密钥")
@@ -531,8 +585,9 @@ if FASTAPI_AVAILABLE:
                             pass
                 
                 # 选择token最长的响应
-                if valid_responses:
-                    best_response = max(valid_responses, key=lambda x: x['token_count'])
+                best_response = max(valid_responses, key=lambda x: x['token_count']) if valid_responses else None
+                record_fanout_metrics(current_keys, tasks, best_response, start_time)
+                if best_response:
                     return JSONResponse(content=best_response['result'])
 
             raise HTTPException(status_code=503, detail="所有上游API请求均失败")
@@ -612,6 +667,8 @@ async def save_config(request: Request):
         # 保存基础URL
         if 'base_url' in data:
             config_manager.set_base_url(data['base_url'])
+            if key_prober is not None:
+                key_prober.base_url = data['base_url']
         
         # 返回成功消息，包含配置更新时间戳
         return {
@@ -664,6 +721,28 @@ async def get_server_status():
         'is_running': is_api_server_running
     }
 
+@app_fastapi.get("/api/metrics/stream")
+async def metrics_stream():
+    """实时指标的Server-Sent Events流：连接时发送完整快照，之后每秒只发送变化的字段"""
+    if dashboard_metrics is None:
+        # 非200响应时浏览器的 EventSource 不再重连
+        return JSONResponse(status_code=503, content={'error': '实时指标未启用：缺少 live_metrics.py'})
+    return StreamingResponse(
+        dashboard_metrics.sse_events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app_fastapi.get("/api/readiness")
+async def get_readiness():
+    """密钥就绪状态（只读）：根据后台探测结果统计可用密钥数，没有可用密钥时返回503"""
+    if key_prober is None:
+        # 未启用探测时只能按已配置的密钥数判断
+        keys = all_api_keys()
+        return {'ready': bool(keys), 'keys': len(keys), 'probing': False}
+    readiness = key_prober.readiness(all_api_keys())
+    return JSONResponse(status_code=200 if readiness['ready'] else 503, content=readiness)
+
 # ==================== 主程序入口 ====================
 def main():
     """主程序入口"""
@@ -50,11 +50,27 @@ check_environment() {
     fi
 }
 
+# 复制与仓库根目录共用的Python模块（本目录不保留副本）
+SHARED_MODULES="live_metrics.py key_prober.py"
+copy_shared_modules() {
+    local shared_dir
+    shared_dir="$(cd ../../.. 2>/dev/null && pwd)"
+    for module in $SHARED_MODULES; do
+        if [[ -f "$shared_dir/$module" ]]; then
+            cp "$shared_dir/$module" .
+            print_info "已复制共用模块 $module"
+        elif [[ ! -f "$module" ]]; then
+            print_warning "找不到 $module，相关功能将被关闭（可从项目根目录手动复制）"
+        fi
+    done
+}
+
 # 主安装流程
 main() {
     print_banner
     
     check_environment
+    copy_shared_modules
     
     TOTAL_STEPS=6
     CURRENT_STEP=0
@@ -4,6 +4,7 @@
 class LLMProxyApp {
     constructor() {
         this.currentConfig = null;
+        this.metrics = {};
         this.init();
     }
 
@@ -12,6 +13,57 @@ class LLMProxyApp {
         this.loadConfig();
         this.updateWebUrl();
         this.checkTermuxEnvironment();
+        this.connectMetrics();
+    }
+
+    connectMetrics() {
+        // 服务端每秒汇总一次，连接时收到完整快照，之后只收到变化的字段
+        if (!window.EventSource) return;
+
+        const source = new EventSource('/api/metrics/stream');
+        source.addEventListener('snapshot', (event) => {
+            this.metrics = JSON.parse(event.data);
+            this.renderMetrics();
+        });
+        source.addEventListener('delta', (event) => {
+            this.mergeMetrics(this.metrics, JSON.parse(event.data));
+            this.renderMetrics();
+        });
+    }
+
+    mergeMetrics(target, delta) {
+        for (const [key, value] of Object.entries(delta)) {
+            if (value === null) {
+                delete target[key];
+            } else if (typeof value === 'object' && typeof target[key] === 'object' && target[key] !== null) {
+                this.mergeMetrics(target[key], value);
+            } else {
+                target[key] = value;
+            }
+        }
+    }
+
+    renderMetrics() {
+        const m = this.metrics;
+        const format = (value, unit = '') => (value === null || value === undefined) ? '-' : `${value}${unit}`;
+        const setText = (id, text) => {
+            const element = document.getElementById(id);
+            if (element) element.textContent = text;
+        };
+
+        setText('metric-rps', format(m.rps));
+        setText('metric-latency', `${format(m.latency_p50_ms, 'ms')} / ${format(m.latency_p95_ms, 'ms')}`);
+        setText('metric-upstream-calls', format(m.upstream_calls_per_request));
+        setText('metric-totals', `${format(m.requests_total)} / ${format(m.failed_total)}`);
+
+        const keys = document.getElementById('metric-keys');
+        if (keys) {
+            const badges = {ok: 'bg-success', failing: 'bg-warning', cooldown: 'bg-danger'};
+            keys.innerHTML = Object.entries(m.keys || {}).map(([hint, key]) =>
+                `<div>${hint} <span class="badge ${badges[key.state] || 'bg-secondary'}">${key.state}</span> ` +
+                `调用 ${key.calls} / 获胜 ${key.wins} / 失败 ${key.errors}</div>`
+            ).join('');
+        }
     }
 
     checkTermuxEnvironment() {
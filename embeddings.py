@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+向量嵌入微批处理模块
+RAG 入库时大量并发请求各自只嵌入一两段文本。这里把短时间窗口（几毫秒）内
+不同调用方的输入按 (模型, 维度) 合并成上游的批量嵌入调用（不超过上游单批上限），
+结果再按顺序拆回给各个调用方，上游请求数可减少一个数量级
+
+    batcher = EmbeddingBatcher(engine)
+    vectors, tokens = await batcher.embed("gemini-embedding-001", ["文本1", "文本2"])
+"""
+
+import time
+import asyncio
+import logging
+from typing import Dict, Any, List, Optional, Tuple
+
+import httpx
+
+from admission_control import AdmissionController
+from token_estimator import token_estimator
+
+logger = logging.getLogger(__name__)
+
+# 单个上游批量嵌入调用最多包含的输入数（Gemini batchEmbedContents 的上限）
+MAX_UPSTREAM_BATCH = 100
+
+
+class EmbeddingError(Exception):
+    """上游嵌入调用失败"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class _Waiter:
+    """一个调用方的全部输入，所有输入都拿到结果后唤醒调用方"""
+
+    __slots__ = ('future', 'vectors', 'remaining', 'tokens')
+
+    def __init__(self, future: asyncio.Future, count: int):
+        self.future = future
+        self.vectors: List[Optional[List[float]]] = [None] * count
+        self.remaining = count
+        self.tokens = 0.0
+
+    def set(self, index: int, vector: List[float], tokens: float):
+        if self.future.done():
+            return
+        self.vectors[index] = vector
+        self.tokens += tokens
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.future.set_result((self.vectors, int(round(self.tokens))))
+
+    def fail(self, error: Exception):
+        if not self.future.done():
+            self.future.set_exception(error)
+
+
+class EmbeddingBatcher:
+    """跨请求合并嵌入输入的微批处理器"""
+
+    def __init__(self, engine, window_ms: float = 5.0, max_batch: int = MAX_UPSTREAM_BATCH,
+                 max_attempts: int = 2):
+        """
+        Args:
+            engine: ProxyEngine，提供上游地址、连接、可用密钥、准入控制和配额统计
+            window_ms: 第一个输入到达后等待其他调用方的毫秒数
+            max_batch: 单个上游调用最多包含的输入数，攒满时立即发送
+            max_attempts: 上游调用失败时换密钥重试的总次数（含第一次）
+        """
+        self.engine = engine
+        self.window = window_ms / 1000
+        self.max_batch = max(1, min(max_batch, MAX_UPSTREAM_BATCH))
+        self.max_attempts = max(1, max_attempts)
+
+        # (模型, 维度) -> [(文本, 调用方, 在调用方输入中的位置), ...]
+        self._queues: Dict[Tuple[str, Optional[int]], List[Tuple[str, _Waiter, int]]] = {}
+        self._timers: Dict[Tuple[str, Optional[int]], asyncio.TimerHandle] = {}
+        self._tasks: set = set()
+        self._next_key = 0
+        self.stats = {'requests': 0, 'inputs': 0, 'upstream_calls': 0, 'failed_calls': 0, 'largest_batch': 0}
+
+    async def embed(self, model: str, texts: List[str], dimensions: Optional[int] = None
+                    ) -> Tuple[List[List[float]], int]:
+        """
+        嵌入一组文本（与其他并发调用方的输入合并发送）
+
+        Returns:
+            (与输入顺序一致的向量列表, 估算的输入token数)
+
+        Raises:
+            EmbeddingError: 上游调用失败
+            AdmissionRejected: 准入队列已满或排队超时
+        """
+        self.stats['requests'] += 1
+        self.stats['inputs'] += len(texts)
+        if not texts:
+            return [], 0
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(loop.create_future(), len(texts))
+
+        group = (model, dimensions)
+        for index, text in enumerate(texts):
+            queue = self._queues.setdefault(group, [])
+            queue.append((text, waiter, index))
+            if len(queue) >= self.max_batch:
+                self._flush(group)
+        if self._queues.get(group) and group not in self._timers:
+            self._timers[group] = loop.call_later(self.window, self._flush, group)
+        return await waiter.future
+
+    def _flush(self, group: Tuple[str, Optional[int]]):
+        """把该组排队的输入发往上游（窗口到期或攒满一批时调用）"""
+        timer = self._timers.pop(group, None)
+        if timer is not None:
+            timer.cancel()
+        queue = self._queues.pop(group, [])
+        for start in range(0, len(queue), self.max_batch):
+            task = asyncio.create_task(self._send(group, queue[start:start + self.max_batch]))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, group: Tuple[str, Optional[int]], chunk: List[Tuple[str, _Waiter, int]]):
+        model, dimensions = group
+        # 调用方都已放弃（如客户端断开）时不再请求上游
+        chunk = [entry for entry in chunk if not entry[1].future.done()]
+        if not chunk:
+            return
+        texts = [text for text, _, _ in chunk]
+        self.stats['largest_batch'] = max(self.stats['largest_batch'], len(texts))
+        try:
+            vectors, tokens = await self._call_upstream(model, dimensions, texts)
+        except Exception as e:
+            for _, waiter, _ in chunk:
+                waiter.fail(e)
+            return
+        # 上游只返回整批的token数，按各个输入的估算token数分摊
+        estimates = [token_estimator.count(text) for text in texts]
+        total_estimate = sum(estimates) or 1
+        for (text, waiter, index), vector, estimate in zip(chunk, vectors, estimates):
+            waiter.set(index, vector, tokens * estimate / total_estimate)
+
+    def _pick_key(self, model: str, tried: set) -> Optional[str]:
+        """优先选配额余量最多的密钥，没有配额统计时在可用密钥间轮询"""
+        keys = [key for key in self.engine.candidate_keys(model) if key not in tried]
+        if not keys:
+            return None
+        if self.engine.quota_tracker is not None:
+            return self.engine.quota_tracker.select(keys, model)[0]
+        self._next_key += 1
+        return keys[self._next_key % len(keys)]
+
+    async def _call_upstream(self, model: str, dimensions: Optional[int], texts: List[str]
+                             ) -> Tuple[List[List[float]], int]:
+        admission: AdmissionController = self.engine.admission
+        quota_tracker = self.engine.quota_tracker
+        tried: set = set()
+        error = EmbeddingError(500, "没有可用的API密钥，请检查配置")
+        async with admission.admit(1, "embeddings"):
+            for _ in range(self.max_attempts):
+                api_key = self._pick_key(model, tried)
+                if api_key is None:
+                    break
+                tried.add(api_key)
+                self.stats['upstream_calls'] += 1
+                if quota_tracker is not None:
+                    quota_tracker.record_call(api_key, model)
+                began = time.perf_counter()
+                try:
+                    if self.engine.backend == 'native':
+                        status_code, error_text, result = await self._post_native(api_key, model, dimensions, texts)
+                    else:
+                        status_code, error_text, result = await self._post_openai(api_key, model, dimensions, texts)
+                except (httpx.RequestError, ValueError, KeyError, TypeError) as e:
+                    status_code, error_text, result = 502, f"{type(e).__name__}: {e}", None
+                if result is not None and len(result[0]) == len(texts):
+                    if quota_tracker is not None:
+                        quota_tracker.record_tokens(api_key, model, result[1])
+                    logger.info(f"密钥 [***{api_key[-4:]}] 嵌入 {len(texts)} 条输入，"
+                                f"耗时 {(time.perf_counter() - began) * 1000:.0f}ms")
+                    return result
+                if quota_tracker is not None:
+                    quota_tracker.record_rejected(api_key, model, status_code, error_text)
+                self.stats['failed_calls'] += 1
+                logger.error(f"密钥 [***{api_key[-4:]}] 嵌入请求失败: {status_code} - {error_text[:200]}")
+                error = EmbeddingError(502 if status_code < 400 else status_code, error_text[:500])
+        raise error
+
+    async def _post_openai(self, api_key: str, model: str, dimensions: Optional[int], texts: List[str]):
+        """OpenAI兼容层的 /embeddings 接口"""
+        data: Dict[str, Any] = {"model": model, "input": texts}
+        if dimensions:
+            data["dimensions"] = dimensions
+        body, headers = self.engine.upstream.encode_body(data, {"Authorization": f"Bearer {api_key}"})
+        response = await self.engine.upstream.client.post(
+            f"{self.engine.base_url}/openai/embeddings", headers=headers, content=body,
+            timeout=self.engine.request_timeout
+        )
+        self.engine.upstream.record_response(response)
+        if response.status_code >= 400:
+            return response.status_code, response.text, None
+        payload = response.json()
+        items = sorted(payload["data"], key=lambda item: item.get("index", 0))
+        tokens = payload.get("usage", {}).get("prompt_tokens")
+        if tokens:
+            token_estimator.observe("\n".join(texts), tokens)
+        else:
+            tokens = sum(token_estimator.count(text) for text in texts)
+        return response.status_code, "", ([item["embedding"] for item in items], tokens)
+
+    async def _post_native(self, api_key: str, model: str, dimensions: Optional[int], texts: List[str]):
+        """Gemini原生的 batchEmbedContents 接口（不返回token数，用本地估算值）"""
+        name = model[len('models/'):] if model.startswith('models/') else model
+        requests = []
+        for text in texts:
+            request: Dict[str, Any] = {"model": f"models/{name}", "content": {"parts": [{"text": text}]}}
+            if dimensions:
+                request["outputDimensionality"] = dimensions
+            requests.append(request)
+        body, headers = self.engine.upstream.encode_body({"requests": requests}, {"x-goog-api-key": api_key})
+        response = await self.engine.upstream.client.post(
+            f"{self.engine.base_url}/models/{name}:batchEmbedContents", headers=headers, content=body,
+            timeout=self.engine.request_timeout
+        )
+        self.engine.upstream.record_response(response)
+        if response.status_code >= 400:
+            return response.status_code, response.text, None
+        vectors = [item["values"] for item in response.json()["embeddings"]]
+        return response.status_code, "", (vectors, sum(token_estimator.count(text) for text in texts))
+
+    def get_stats(self) -> Dict[str, Any]:
+        calls = self.stats['upstream_calls']
+        return dict(
+            self.stats,
+            window_ms=self.window * 1000,
+            max_batch=self.max_batch,
+            inputs_per_call=round(self.stats['inputs'] / calls, 1) if calls else 0.0,
+        )
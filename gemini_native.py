@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Gemini原生接口适配模块
+在OpenAI格式与Gemini原生 generateContent / streamGenerateContent 格式之间双向转换，
+保留OpenAI兼容层会丢弃的参数（思考预算、安全设置、候选数等），
+并提供原生的逐候选结束原因和用量信息
+"""
+
+import json
+import time
+from typing import Dict, Any, List, Optional, Tuple
+
+# Gemini结束原因到OpenAI finish_reason的映射
+FINISH_REASON_MAP = {
+    'STOP': 'stop',
+    'MAX_TOKENS': 'length',
+    'SAFETY': 'content_filter',
+    'RECITATION': 'content_filter',
+    'BLOCKLIST': 'content_filter',
+    'PROHIBITED_CONTENT': 'content_filter',
+    'SPII': 'content_filter',
+    'IMAGE_SAFETY': 'content_filter',
+    'MALFORMED_FUNCTION_CALL': 'stop',
+    'LANGUAGE': 'stop',
+    'OTHER': 'stop',
+}
+
+# 被上游拦截、不可能成为有效响应的结束原因
+BLOCKED_FINISH_REASONS = {'SAFETY', 'RECITATION', 'BLOCKLIST', 'PROHIBITED_CONTENT', 'SPII', 'IMAGE_SAFETY'}
+
+# reasoning_effort 到思考预算(token)的映射
+REASONING_EFFORT_BUDGETS = {
+    'none': 0,
+    'low': 1024,
+    'medium': 8192,
+    'high': 24576,
+}
+
+# 可配置统一阈值的安全类别
+SAFETY_CATEGORIES = [
+    'HARM_CATEGORY_HARASSMENT',
+    'HARM_CATEGORY_HATE_SPEECH',
+    'HARM_CATEGORY_SEXUALLY_EXPLICIT',
+    'HARM_CATEGORY_DANGEROUS_CONTENT',
+    'HARM_CATEGORY_CIVIC_INTEGRITY',
+]
+
+
+def native_url(base_url: str, model: str, stream: bool) -> str:
+    """构造原生接口URL"""
+    model = model[len('models/'):] if model.startswith('models/') else model
+    if stream:
+        return f"{base_url}/models/{model}:streamGenerateContent?alt=sse"
+    return f"{base_url}/models/{model}:generateContent"
+
+
+def _content_to_parts(content: Any) -> List[Dict[str, Any]]:
+    """把OpenAI消息内容转换为Gemini parts"""
+    if content is None:
+        return []
+    if isinstance(content, str):
+        return [{'text': content}] if content else []
+
+    parts = []
+    for item in content:
+        if not isinstance(item, dict):
+            continue
+        if item.get('type') == 'text':
+            parts.append({'text': item.get('text', '')})
+        elif item.get('type') == 'image_url':
+            url = item.get('image_url', {}).get('url', '')
+            if url.startswith('data:') and ';base64,' in url:
+                mime_type, data = url[5:].split(';base64,', 1)
+                parts.append({'inlineData': {'mimeType': mime_type, 'data': data}})
+            elif url:
+                parts.append({'fileData': {'fileUri': url}})
+    return parts
+
+
+def openai_to_native(request_data: dict, safety_threshold: str = "") -> Tuple[str, Dict[str, Any]]:
+    """
+    把OpenAI聊天请求转换为Gemini原生请求体
+
+    Args:
+        request_data: OpenAI格式的请求数据
+        safety_threshold: 统一应用到所有安全类别的阈值，为空时使用上游默认值
+
+    Returns:
+        (模型名称, 原生请求体)
+    """
+    system_parts = []
+    contents = []
+    for message in request_data.get('messages', []):
+        role = message.get('role')
+        parts = _content_to_parts(message.get('content'))
+        if role in ('system', 'developer'):
+            system_parts.extend(parts)
+            continue
+        if not parts:
+            continue
+        native_role = 'model' if role == 'assistant' else 'user'
+        # Gemini要求user/model交替出现，连续的同角色消息合并为一条
+        if contents and contents[-1]['role'] == native_role:
+            contents[-1]['parts'].extend(parts)
+        else:
+            contents.append({'role': native_role, 'parts': parts})
+
+    body: Dict[str, Any] = {'contents': contents}
+    if system_parts:
+        body['systemInstruction'] = {'parts': system_parts}
+
+    generation_config: Dict[str, Any] = {}
+    param_map = {
+        'temperature': 'temperature',
+        'top_p': 'topP',
+        'top_k': 'topK',
+        'n': 'candidateCount',
+        'presence_penalty': 'presencePenalty',
+        'frequency_penalty': 'frequencyPenalty',
+        'seed': 'seed',
+    }
+    for openai_name, native_name in param_map.items():
+        if request_data.get(openai_name) is not None:
+            generation_config[native_name] = request_data[openai_name]
+
+    max_tokens = request_data.get('max_completion_tokens') or request_data.get('max_tokens')
+    if max_tokens:
+        generation_config['maxOutputTokens'] = max_tokens
+
+    stop = request_data.get('stop')
+    if stop:
+        generation_config['stopSequences'] = [stop] if isinstance(stop, str) else list(stop)
+
+    response_format = request_data.get('response_format') or {}
+    if response_format.get('type') in ('json_object', 'json_schema'):
+        generation_config['responseMimeType'] = 'application/json'
+        schema = response_format.get('json_schema', {}).get('schema')
+        if schema:
+            generation_config['responseJsonSchema'] = schema
+
+    google_options = (request_data.get('extra_body') or {}).get('google', {})
+
+    thinking_config = {}
+    effort = request_data.get('reasoning_effort')
+    if effort in REASONING_EFFORT_BUDGETS:
+        thinking_config['thinkingBudget'] = REASONING_EFFORT_BUDGETS[effort]
+    explicit_thinking = google_options.get('thinking_config') or {}
+    if 'thinking_budget' in explicit_thinking:
+        thinking_config['thinkingBudget'] = explicit_thinking['thinking_budget']
+    if 'include_thoughts' in explicit_thinking:
+        thinking_config['includeThoughts'] = explicit_thinking['include_thoughts']
+    if thinking_config:
+        generation_config['thinkingConfig'] = thinking_config
+
+    if generation_config:
+        body['generationConfig'] = generation_config
+
+    if google_options.get('safety_settings'):
+        body['safetySettings'] = google_options['safety_settings']
+    elif safety_threshold:
+        body['safetySettings'] = [
+            {'category': category, 'threshold': safety_threshold}
+            for category in SAFETY_CATEGORIES
+        ]
+
+    if google_options.get('cached_content'):
+        body['cachedContent'] = google_options['cached_content']
+
+    return request_data.get('model', ''), body
+
+
+def _usage_to_openai(usage: Dict[str, Any]) -> Dict[str, Any]:
+    prompt_tokens = usage.get('promptTokenCount', 0)
+    completion_tokens = usage.get('candidatesTokenCount', 0) + usage.get('thoughtsTokenCount', 0)
+    result = {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': usage.get('totalTokenCount', prompt_tokens + completion_tokens),
+    }
+    if usage.get('thoughtsTokenCount'):
+        # 与OpenAI一样单独列出思考token，便于区分可见内容的token数
+        result['completion_tokens_details'] = {'reasoning_tokens': usage['thoughtsTokenCount']}
+    return result
+
+
+class NativeResponseAccumulator:
+    """
+    累积原生响应（完整响应或SSE分块），转换为OpenAI格式
+
+    流式接收时可以随时查看已累积的内容长度和结束原因，
+    便于在被拦截时提前放弃该路请求
+    """
+
+    def __init__(self, model: str):
+        self.model = model
+        self.response_id = ""
+        self.created = int(time.time())
+        self.contents: Dict[int, List[str]] = {}
+        self.thoughts: Dict[int, List[str]] = {}
+        self.finish_reasons: Dict[int, str] = {}
+        self.usage: Dict[str, Any] = {}
+        self.block_reason: Optional[str] = None
+
+    def feed(self, data: Dict[str, Any]):
+        """合并一个原生响应或响应分块"""
+        self.response_id = data.get('responseId') or self.response_id
+        self.model = data.get('modelVersion') or self.model
+        if data.get('usageMetadata'):
+            self.usage = data['usageMetadata']
+        block_reason = data.get('promptFeedback', {}).get('blockReason')
+        if block_reason:
+            self.block_reason = block_reason
+
+        for candidate in data.get('candidates', []):
+            index = candidate.get('index', 0)
+            for part in candidate.get('content', {}).get('parts', []):
+                text = part.get('text')
+                if text is None:
+                    continue
+                target = self.thoughts if part.get('thought') else self.contents
+                target.setdefault(index, []).append(text)
+            if candidate.get('finishReason'):
+                self.finish_reasons[index] = candidate['finishReason']
+
+    @property
+    def blocked(self) -> bool:
+        """提示词被拦截，或所有已结束的候选都因安全原因被拦截"""
+        if self.block_reason:
+            return True
+        return bool(self.finish_reasons) and all(
+            reason in BLOCKED_FINISH_REASONS for reason in self.finish_reasons.values()
+        )
+
+    def content_length(self, index: int = 0) -> int:
+        return sum(len(chunk) for chunk in self.contents.get(index, []))
+
+    def to_openai(self) -> Dict[str, Any]:
+        """转换为OpenAI chat.completion格式"""
+        indexes = sorted(set(self.contents) | set(self.finish_reasons)) or [0]
+        choices = []
+        for index in indexes:
+            message = {'role': 'assistant', 'content': ''.join(self.contents.get(index, []))}
+            if self.thoughts.get(index):
+                message['reasoning_content'] = ''.join(self.thoughts[index])
+            native_reason = self.finish_reasons.get(index)
+            if self.block_reason and not native_reason:
+                finish_reason = 'content_filter'
+            else:
+                finish_reason = FINISH_REASON_MAP.get(native_reason, 'stop')
+            choices.append({'index': index, 'message': message, 'finish_reason': finish_reason})
+
+        return {
+            'id': f"chatcmpl-{self.response_id}" if self.response_id else f"chatcmpl-{self.created}",
+            'object': 'chat.completion',
+            'created': self.created,
+            'model': self.model,
+            'choices': choices,
+            'usage': _usage_to_openai(self.usage),
+        }
+
+    def chunk_to_openai(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """把单个原生SSE分块转换为OpenAI chat.completion.chunk（先调用feed）"""
+        choices = []
+        for candidate in data.get('candidates', []):
+            index = candidate.get('index', 0)
+            delta: Dict[str, Any] = {}
+            texts = [part for part in candidate.get('content', {}).get('parts', []) if 'text' in part]
+            content = ''.join(part['text'] for part in texts if not part.get('thought'))
+            reasoning = ''.join(part['text'] for part in texts if part.get('thought'))
+            if content:
+                delta['content'] = content
+            if reasoning:
+                delta['reasoning_content'] = reasoning
+            native_reason = candidate.get('finishReason')
+            choices.append({
+                'index': index,
+                'delta': delta,
+                'finish_reason': FINISH_REASON_MAP.get(native_reason, 'stop') if native_reason else None,
+            })
+        chunk = {
+            'id': f"chatcmpl-{self.response_id}" if self.response_id else f"chatcmpl-{self.created}",
+            'object': 'chat.completion.chunk',
+            'created': self.created,
+            'model': self.model,
+            'choices': choices,
+        }
+        if data.get('usageMetadata'):
+            chunk['usage'] = _usage_to_openai(data['usageMetadata'])
+        return chunk
+
+
+def parse_sse_line(line: str) -> Optional[Dict[str, Any]]:
+    """解析一行原生SSE数据，非数据行返回None"""
+    if not line.startswith('data:'):
+        return None
+    payload = line[5:].strip()
+    if not payload or payload == '[DONE]':
+        return None
+    try:
+        return json.loads(payload)
+    except json.JSONDecodeError:
+        return None
+
+
+def candidate_text(data: Dict[str, Any], index: int = 0) -> str:
+    """一个原生响应分块中某个候选新增的可见文本（不含思考内容）"""
+    for candidate in data.get('candidates', []):
+        if candidate.get('index', 0) == index:
+            return ''.join(part.get('text', '') for part in candidate.get('content', {}).get('parts', [])
+                           if not part.get('thought'))
+    return ''
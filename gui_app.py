@@ -13,8 +13,17 @@ import os
 import sys
 import signal
 import time
+import queue
+from collections import deque
 from config_manager import config_manager
 
+# 日志视图最多保留的行数（超出后丢弃最早的行）
+LOG_MAX_LINES = 5000
+# 主线程每隔多少毫秒取一次日志队列
+LOG_POLL_MS = 100
+# 每次最多取出的日志行数，避免大量日志一次性阻塞界面
+LOG_BATCH_LINES = 500
+
 class LLMProxyGUI:
     """LLM代理服务GUI主类"""
     
@@ -43,12 +52,19 @@ class LLMProxyGUI:
         self.server_process = None
         self.is_running = False
         
+        # 读取线程把日志行 (内容, 是否来自stderr) 放入队列，由主线程批量取出显示
+        self.log_queue = queue.Queue()
+        self.log_lines = deque(maxlen=LOG_MAX_LINES)
+        
         # 创建GUI组件
         self.create_widgets()
         
         # 加载配置
         self.load_config()
         
+        # 开始定时取日志队列
+        self.root.after(LOG_POLL_MS, self.poll_log)
+        
         # 设置关闭事件
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
     
@@ -214,15 +230,30 @@ class LLMProxyGUI:
         
         # 配置网格权重
         log_frame.columnconfigure(0, weight=1)
-        log_frame.rowconfigure(0, weight=1)
+        log_frame.rowconfigure(1, weight=1)
+        
+        # 日志过滤
+        filter_frame = ttk.Frame(log_frame)
+        filter_frame.grid(row=0, column=0, sticky=(tk.W, tk.E), pady=(0, 5))
+        filter_frame.columnconfigure(1, weight=1)
+        
+        ttk.Label(filter_frame, text="过滤:").grid(row=0, column=0, padx=(0, 5))
+        self.log_filter_var = tk.StringVar()
+        self.log_filter_var.trace_add('write', lambda *args: self.render_log())
+        ttk.Entry(filter_frame, textvariable=self.log_filter_var).grid(row=0, column=1, sticky=(tk.W, tk.E))
+        
+        self.log_errors_only_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(filter_frame, text="仅显示错误输出", variable=self.log_errors_only_var,
+                        command=self.render_log).grid(row=0, column=2, padx=(10, 0))
         
         # 日志文本框
         self.log_text = scrolledtext.ScrolledText(log_frame, state='disabled', height=20, width=70)
-        self.log_text.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
+        self.log_text.grid(row=1, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
+        self.log_text.tag_config('error', foreground='red')
         
         # 日志控制按钮
         button_frame = ttk.Frame(log_frame)
-        button_frame.grid(row=1, column=0, pady=(10, 0))
+        button_frame.grid(row=2, column=0, pady=(10, 0))
         
         clear_log_button = ttk.Button(button_frame, text="清空日志", command=self.clear_log)
         clear_log_button.grid(row=0, column=0, padx=5)
@@ -335,9 +366,9 @@ class LLMProxyGUI:
             self.start_button.config(text="停止服务")
             self.status_var.set("服务运行中...")
             
-            # 启动日志线程
-            self.log_thread = threading.Thread(target=self.update_log, daemon=True)
-            self.log_thread.start()
+            # stdout 和 stderr 各用一个线程读取，一个流没有输出时不会卡住另一个
+            for stream, is_error in ((self.server_process.stdout, False), (self.server_process.stderr, True)):
+                threading.Thread(target=self.read_log_stream, args=(stream, is_error), daemon=True).start()
             
             messagebox.showinfo("成功", "服务已启动")
             
@@ -371,30 +402,66 @@ class LLMProxyGUI:
         except Exception as e:
             messagebox.showerror("错误", f"停止服务失败: {str(e)}")
     
-    def update_log(self):
-        """更新日志显示"""
-        if self.server_process:
-            while self.is_running:
-                try:
-                    # 读取输出
-                    line = self.server_process.stdout.readline()
-                    if line:
-                        self.log_text.config(state='normal')
-                        self.log_text.insert(tk.END, line)
-                        self.log_text.see(tk.END)
-                        self.log_text.config(state='disabled')
-                    
-                    # 读取错误
-                    error_line = self.server_process.stderr.readline()
-                    if error_line:
-                        self.log_text.config(state='normal')
-                        self.log_text.insert(tk.END, f"ERROR: {error_line}", 'error')
-                        self.log_text.tag_config('error', foreground='red')
-                        self.log_text.see(tk.END)
-                        self.log_text.config(state='disabled')
-                        
-                except Exception:
-                    break
+    def read_log_stream(self, stream, is_error: bool):
+        """在后台线程中逐行读取服务输出并放入队列（不直接操作界面）"""
+        try:
+            for line in iter(stream.readline, ''):
+                self.log_queue.put((line, is_error))
+        except (ValueError, OSError):
+            # 进程结束后管道被关闭
+            pass
+    
+    def poll_log(self):
+        """在主线程中批量取出日志并追加到视图"""
+        batch = []
+        try:
+            while len(batch) < LOG_BATCH_LINES:
+                batch.append(self.log_queue.get_nowait())
+        except queue.Empty:
+            pass
+        
+        if batch:
+            self.log_lines.extend(batch)
+            self.append_log(batch)
+        
+        # 队列中还有积压时尽快继续处理
+        self.root.after(1 if len(batch) == LOG_BATCH_LINES else LOG_POLL_MS, self.poll_log)
+    
+    def log_line_visible(self, line: str, is_error: bool) -> bool:
+        """判断日志行是否满足当前的过滤条件"""
+        if self.log_errors_only_var.get() and not is_error:
+            return False
+        keyword = self.log_filter_var.get()
+        return not keyword or keyword.lower() in line.lower()
+    
+    def append_log(self, entries):
+        """把一批日志行一次性插入文本框，并删除超出上限的旧行"""
+        entries = [(line, is_error) for line, is_error in entries if self.log_line_visible(line, is_error)]
+        if not entries:
+            return
+        
+        # 只有视图本来就在底部时才自动滚动，方便查看历史日志
+        at_bottom = self.log_text.yview()[1] >= 0.999
+        self.log_text.config(state='normal')
+        for line, is_error in entries:
+            if is_error:
+                self.log_text.insert(tk.END, f"ERROR: {line}", 'error')
+            else:
+                self.log_text.insert(tk.END, line)
+        
+        excess = int(self.log_text.index('end-1c').split('.')[0]) - 1 - LOG_MAX_LINES
+        if excess > 0:
+            self.log_text.delete('1.0', f'{excess + 1}.0')
+        self.log_text.config(state='disabled')
+        if at_bottom:
+            self.log_text.see(tk.END)
+    
+    def render_log(self):
+        """过滤条件改变时按缓冲区重新显示日志"""
+        self.log_text.config(state='normal')
+        self.log_text.delete(1.0, tk.END)
+        self.log_text.config(state='disabled')
+        self.append_log(self.log_lines)
     
     def import_keys(self):
         """从文件导入API密钥"""
@@ -406,12 +473,25 @@ class LLMProxyGUI:
             )
             
             if filename:
-                with open(filename, 'r', encoding='utf-8') as f:
-                    keys = [line.strip() for line in f if line.strip()]
-                
                 # 根据当前标签页决定导入到哪一组
                 current_tab = self.notebook.tab(self.notebook.select(), "text")
                 
+                # 启用密钥存储时逐行写入对应的密钥池（支持带元数据的JSON行），不改写配置文件
+                key_store = config_manager.key_store
+                pool = 'group1' if "第一组" in current_tab else 'group2' if "第二组" in current_tab else None
+                if key_store is not None and pool is not None:
+                    with open(filename, 'r', encoding='utf-8') as f:
+                        counts = key_store.import_lines(f, pool, replace=True)
+                    text = self.group1_text if pool == 'group1' else self.group2_text
+                    text.delete(1.0, tk.END)
+                    text.insert(1.0, '\n'.join(key_store.pool_keys(pool)))
+                    messagebox.showinfo("成功", f"已导入 {counts['imported']} 个API密钥"
+                                              f"（无效 {counts['invalid']} 个，重复 {counts['duplicates']} 个）")
+                    return
+                
+                with open(filename, 'r', encoding='utf-8') as f:
+                    keys = [line.strip() for line in f if line.strip()]
+                
                 if "第一组" in current_tab:
                     self.group1_text.delete(1.0, tk.END)
                     self.group1_text.insert(1.0, '\n'.join(keys))
@@ -474,6 +554,7 @@ class LLMProxyGUI:
     
     def clear_log(self):
         """清空日志"""
+        self.log_lines.clear()
         self.log_text.config(state='normal')
         self.log_text.delete(1.0, tk.END)
         self.log_text.config(state='disabled')
@@ -489,9 +570,10 @@ class LLMProxyGUI:
             )
             
             if filename:
-                log_content = self.log_text.get(1.0, tk.END)
+                # 保存缓冲区中的全部日志，不受当前过滤条件影响
                 with open(filename, 'w', encoding='utf-8') as f:
-                    f.write(log_content)
+                    for line, is_error in self.log_lines:
+                        f.write(f"ERROR: {line}" if is_error else line)
                 
                 messagebox.showinfo("成功", "日志已保存")
                 
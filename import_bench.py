@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+启动导入耗时基准
+在全新的解释器中用 python -X importtime 测量各启动模式的模块导入耗时，
+列出最慢的模块，并与桌面/Termux 的目标值对比（超出目标时退出码为1，可用于回归检查）
+
+用法:
+    python import_bench.py                       # 测量全部模式，使用桌面目标
+    python import_bench.py cli --profile termux --runs 5
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, Any, List, Tuple
+
+# 各启动模式要执行的代码
+MODES = {
+    'cli': "import app",
+    'web': "import app; app.create_web_app() if app.FLASK_AVAILABLE else None",
+    'proxy': "import llm_proxy",
+}
+
+# 导入耗时目标（毫秒）。Termux 上的目标按中端手机比桌面慢约4倍估算
+TARGETS = {
+    'desktop': {'cli': 1200, 'web': 1800, 'proxy': 1500},
+    'termux': {'cli': 5000, 'web': 7000, 'proxy': 6000},
+}
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_importtime(output: str) -> Tuple[float, List[Tuple[str, float, float]]]:
+    """
+    解析 -X importtime 的输出
+
+    Returns:
+        (顶层导入的累计耗时合计毫秒, [(模块名, 自身耗时毫秒, 累计耗时毫秒), ...])
+    """
+    total_us = 0
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        try:
+            self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+            self_us, cumulative_us = int(self_us), int(cumulative_us)
+        except ValueError:
+            continue
+        # 模块名前的缩进表示嵌套深度，只有顶层导入的累计耗时相加才不会重复计算
+        if not name[1:].startswith(' '):
+            total_us += cumulative_us
+        modules.append((name.strip(), self_us / 1000, cumulative_us / 1000))
+    return total_us / 1000, modules
+
+
+def measure(code: str) -> Dict[str, Any]:
+    """在新的解释器进程中执行一次并测量导入耗时"""
+    begin = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=REPO_DIR, capture_output=True, text=True
+    )
+    wall_ms = (time.perf_counter() - begin) * 1000
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "导入失败")
+    import_ms, modules = parse_importtime(proc.stderr)
+    return {'import_ms': import_ms, 'wall_ms': wall_ms, 'modules': modules}
+
+
+def bench_mode(mode: str, runs: int, top: int) -> Dict[str, Any]:
+    """多次测量取中位数，并汇总自身耗时最长的模块"""
+    results = [measure(MODES[mode]) for _ in range(runs)]
+    slowest: Dict[str, float] = {}
+    for result in results:
+        for name, self_ms, _ in result['modules']:
+            slowest[name] = slowest.get(name, 0) + self_ms / runs
+    return {
+        'import_ms': round(statistics.median(result['import_ms'] for result in results), 1),
+        'wall_ms': round(statistics.median(result['wall_ms'] for result in results), 1),
+        'modules': len(results[0]['modules']),
+        'slowest': sorted(slowest.items(), key=lambda item: item[1], reverse=True)[:top],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="测量各启动模式的模块导入耗时")
+    parser.add_argument('modes', nargs='*', help=f"要测量的模式（{'/'.join(MODES)}），默认全部")
+    parser.add_argument('--profile', choices=list(TARGETS), default='desktop', help="对比的目标值")
+    parser.add_argument('--runs', type=int, default=3, help="每个模式的测量次数（取中位数）")
+    parser.add_argument('--top', type=int, default=10, help="列出自身耗时最长的N个模块")
+    args = parser.parse_args()
+
+    unknown = [mode for mode in args.modes if mode not in MODES]
+    if unknown:
+        parser.error(f"未知的模式: {', '.join(unknown)}")
+
+    targets = TARGETS[args.profile]
+    failed = False
+    for mode in args.modes or list(MODES):
+        try:
+            result = bench_mode(mode, max(1, args.runs), args.top)
+        except RuntimeError as e:
+            print(f"[{mode}] 无法测量: {e}")
+            failed = True
+            continue
+
+        target = targets[mode]
+        passed = result['import_ms'] <= target
+        failed = failed or not passed
+        print(f"[{mode}] 导入 {result['import_ms']}ms (目标 {target}ms, {'通过' if passed else '超出'})，"
+              f"进程总耗时 {result['wall_ms']}ms，共 {result['modules']} 个模块")
+        for name, self_ms in result['slowest']:
+            print(f"    {self_ms:8.1f}ms  {name}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上游密钥探测模块
+以有上限的并发，用最小的请求（列出模型，或只生成1个token的对话）逐个检查密钥，
+把结果分为 有效 / 无效 / 配额耗尽 / 地区受限 / 暂时错误。
+既可以作为命令行工具批量检查全部密钥，也可以作为低频率后台任务持续更新密钥健康状态，
+让代理在用户请求命中坏密钥之前就跳过它们
+
+命令行用法:
+    python key_prober.py                         # 用 config.ini 中的全部密钥做1个token的对话探测
+    python key_prober.py --method models --concurrency 16
+    python key_prober.py --json > probe.json
+"""
+
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import configparser
+from typing import Dict, Any, List, Iterable, Callable
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+VALID = 'valid'
+INVALID = 'invalid'
+QUOTA_EXHAUSTED = 'quota_exhausted'
+REGION_BLOCKED = 'region_blocked'
+ERROR = 'error'
+
+STATUS_LABELS = {
+    VALID: '有效',
+    INVALID: '无效',
+    QUOTA_EXHAUSTED: '配额耗尽',
+    REGION_BLOCKED: '地区受限',
+    ERROR: '暂时错误',
+}
+
+# 这些状态的密钥暂时不参与调度；ERROR 可能只是网络抖动，不据此跳过密钥
+UNUSABLE = (INVALID, QUOTA_EXHAUSTED, REGION_BLOCKED)
+
+
+def classify(status_code: int, body: str) -> str:
+    """根据上游的状态码和错误信息判断密钥状态"""
+    if 200 <= status_code < 300:
+        return VALID
+    text = body.lower()
+    if status_code == 429 or 'resource_exhausted' in text or 'quota' in text:
+        return QUOTA_EXHAUSTED
+    if 'location is not supported' in text or 'failed_precondition' in text:
+        return REGION_BLOCKED
+    if status_code in (401, 403) or 'api_key_invalid' in text or 'api key not valid' in text \
+            or 'api key expired' in text or 'permission_denied' in text:
+        return INVALID
+    return ERROR
+
+
+class KeyProber:
+    """并发密钥探测器，保存每个密钥最近一次的探测结果"""
+
+    def __init__(self, base_url: str, method: str = 'completion', model: str = 'gemini-2.5-flash',
+                 concurrency: int = 8, timeout: float = 15.0, interval: float = 600.0, rate: float = 2.0):
+        """
+        Args:
+            base_url: 上游API基础URL（如 https://generativelanguage.googleapis.com/v1beta）
+            method: completion 发送只生成1个token的对话（能发现配额耗尽和地区限制）；
+                    models 只列出模型（不消耗配额，只能发现无效密钥）
+            model: completion 探测使用的模型
+            concurrency: 同时进行的探测请求数上限
+            timeout: 单个探测请求的超时时间（秒）
+            interval: 后台任务两轮探测之间的间隔（秒）
+            rate: 后台任务每秒最多发起的探测数，避免密钥很多时集中占用上游配额（0表示不限制）
+        """
+        self.base_url = base_url
+        self.method = method
+        self.model = model
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.interval = interval
+        self.rate = rate
+        # 密钥 -> 最近一次探测结果
+        self.health: Dict[str, Dict[str, Any]] = {}
+        self.stats = {'rounds': 0, 'probes': 0, 'last_round_at': None, 'last_round_ms': 0.0}
+
+    async def probe_key(self, client: httpx.AsyncClient, api_key: str, method: str = '') -> Dict[str, Any]:
+        """探测单个密钥（method 为空时使用构造时的设置）"""
+        begin = time.perf_counter()
+        try:
+            if (method or self.method) == 'models':
+                response = await client.get(f"{self.base_url}/models", headers={"x-goog-api-key": api_key})
+            else:
+                response = await client.post(
+                    f"{self.base_url}/openai/chat/completions",
+                    headers={"Authorization": f"Bearer {api_key}"},
+                    json={"model": self.model, "messages": [{"role": "user", "content": "hi"}], "max_tokens": 1}
+                )
+            status = classify(response.status_code, response.text)
+            http_status = response.status_code
+            detail = '' if status == VALID else response.text[:200]
+        except httpx.HTTPError as e:
+            status, http_status, detail = ERROR, None, f"{type(e).__name__}: {e}"
+
+        result = {
+            'key': f"***{api_key[-4:]}",
+            'status': status,
+            'http_status': http_status,
+            'latency_ms': round((time.perf_counter() - begin) * 1000, 1),
+            'detail': detail,
+            'checked_at': time.time(),
+        }
+        self.health[api_key] = result
+        self.stats['probes'] += 1
+        return result
+
+    async def probe_keys(self, keys: Iterable[str], rate: float = 0, method: str = '') -> List[Dict[str, Any]]:
+        """
+        并发探测一批密钥（同时进行的请求数不超过 concurrency），按输入顺序返回结果
+
+        Args:
+            rate: 每秒最多发起的探测数，0表示不限制
+            method: 本次使用的探测方式，为空时使用构造时的设置
+        """
+        keys = list(dict.fromkeys(keys))
+        semaphore = asyncio.Semaphore(self.concurrency)
+        begin = time.perf_counter()
+
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        async with httpx.AsyncClient(timeout=self.timeout, limits=limits) as client:
+            async def bounded(index: int, api_key: str):
+                if rate > 0:
+                    await asyncio.sleep(max(0.0, begin + index / rate - time.perf_counter()))
+                async with semaphore:
+                    return await self.probe_key(client, api_key, method)
+
+            results = await asyncio.gather(*(bounded(index, api_key) for index, api_key in enumerate(keys)))
+
+        self.stats['rounds'] += 1
+        self.stats['last_round_at'] = time.time()
+        self.stats['last_round_ms'] = round((time.perf_counter() - begin) * 1000, 1)
+        return list(results)
+
+    def is_usable(self, api_key: str) -> bool:
+        """未探测过或最近一次结果不是无效/配额耗尽/地区受限的密钥都可以使用"""
+        result = self.health.get(api_key)
+        return result is None or result['status'] not in UNUSABLE
+
+    def usable(self, keys: List[str]) -> List[str]:
+        """过滤掉已知不可用的密钥；一组中全部不可用时原样返回（探测结果可能已过时，不至于完全无法服务）"""
+        usable = [api_key for api_key in keys if self.is_usable(api_key)]
+        return usable or keys
+
+    def readiness(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """
+        就绪状态汇总（不包含密钥本身）
+
+        Returns:
+            {'ready': 是否至少有一个可用密钥, 'keys': 密钥总数, 'usable': 可用数, 'unprobed': 未探测数,
+             'by_status': {状态: 数量}, 'last_round_at': 最近一轮探测完成时间}
+        """
+        keys = list(dict.fromkeys(keys))
+        by_status: Dict[str, int] = {}
+        unprobed = 0
+        for api_key in keys:
+            result = self.health.get(api_key)
+            if result is None:
+                unprobed += 1
+            else:
+                by_status[result['status']] = by_status.get(result['status'], 0) + 1
+        usable = sum(1 for api_key in keys if self.is_usable(api_key))
+        return {
+            'ready': usable > 0,
+            'keys': len(keys),
+            'usable': usable,
+            'unprobed': unprobed,
+            'by_status': by_status,
+            'last_round_at': self.stats['last_round_at'],
+        }
+
+    async def run_background(self, get_keys: Callable[[], Iterable[str]], initial_delay: float = 5.0):
+        """
+        低频率后台探测：每隔 interval 秒探测一轮全部密钥
+        （需在事件循环中作为任务运行；get_keys 每轮调用一次，以便使用最新配置的密钥）
+        """
+        await asyncio.sleep(initial_delay)
+        while True:
+            keys = list(get_keys())
+            try:
+                results = await self.probe_keys(keys, rate=self.rate)
+                # 清理已从配置中删除的密钥的结果
+                current = set(keys)
+                for api_key in [api_key for api_key in self.health if api_key not in current]:
+                    del self.health[api_key]
+                bad = [result for result in results if result['status'] in UNUSABLE]
+                logger.info(f"密钥探测完成: {len(results)} 个密钥，{len(bad)} 个不可用，耗时 {self.stats['last_round_ms']}ms")
+                for result in bad:
+                    logger.warning(f"密钥 [{result['key']}] {STATUS_LABELS[result['status']]}")
+            except Exception as e:
+                logger.error(f"密钥探测出错: {e}")
+            await asyncio.sleep(self.interval)
+
+    def get_stats(self) -> Dict[str, Any]:
+        by_status: Dict[str, int] = {}
+        for result in self.health.values():
+            by_status[result['status']] = by_status.get(result['status'], 0) + 1
+        return dict(self.stats, method=self.method, concurrency=self.concurrency, by_status=by_status)
+
+
+def load_config_keys(config_file: str) -> Dict[str, Any]:
+    """
+    从配置文件读取上游地址和全部密钥（启用了 key_store.py 密钥存储时读取所有密钥池）
+
+    Returns:
+        {'base_url': ..., 'pools': {池名: [密钥, ...]}}
+    """
+    config = configparser.ConfigParser()
+    if not config.read(config_file, encoding='utf-8'):
+        raise FileNotFoundError(f"配置文件不存在: {config_file}")
+
+    pools: Dict[str, List[str]] = {}
+    try:
+        # 单独部署的Termux版没有 key_store.py，此时只能使用 [API_KEYS]
+        from key_store import KeyStore, store_path
+        path = store_path(config)
+    except ImportError:
+        path = ''
+    if path:
+        store = KeyStore(path)
+        if store.exists():
+            store.load()
+            pools = {pool: store.pool_keys(pool) for pool in store.pool_names()}
+    if not pools and config.has_section('API_KEYS'):
+        pools = {name: json.loads(value) for name, value in config.items('API_KEYS')}
+    return {'base_url': config.get('API', 'base_url'), 'pools': pools}
+
+
+def print_report(pools: Dict[str, List[str]], prober: KeyProber):
+    """按密钥池打印探测结果和汇总"""
+    totals: Dict[str, int] = {}
+    for pool, keys in pools.items():
+        print(f"\n[{pool}] {len(keys)} 个密钥")
+        for api_key in keys:
+            result = prober.health.get(api_key)
+            if result is None:
+                continue
+            totals[result['status']] = totals.get(result['status'], 0) + 1
+            mark = '✅' if result['status'] == VALID else '⚠️ ' if result['status'] == ERROR else '❌'
+            line = f"  {mark} {result['key']}  {STATUS_LABELS[result['status']]}  {result['latency_ms']}ms"
+            if result['status'] != VALID:
+                line += f"  {result['http_status'] or ''} {result['detail'][:80]}"
+            print(line)
+    summary = '，'.join(f"{STATUS_LABELS[status]} {count}" for status, count in totals.items())
+    print(f"\n共 {sum(totals.values())} 个密钥: {summary}，耗时 {prober.stats['last_round_ms']}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="并发检查上游API密钥是否可用")
+    parser.add_argument('--config', default='config.ini', help="配置文件路径")
+    parser.add_argument('--method', choices=['completion', 'models'], default='completion',
+                        help="completion: 1个token的对话（可发现配额耗尽/地区限制）；models: 只列出模型（不消耗配额）")
+    parser.add_argument('--model', default='gemini-2.5-flash', help="completion 探测使用的模型")
+    parser.add_argument('--concurrency', type=int, default=8, help="同时进行的探测请求数")
+    parser.add_argument('--timeout', type=float, default=15.0, help="单个请求的超时时间（秒）")
+    parser.add_argument('--json', action='store_true', help="以JSON输出结果")
+    args = parser.parse_args()
+
+    settings = load_config_keys(args.config)
+    pools = settings['pools']
+    prober = KeyProber(settings['base_url'], method=args.method, model=args.model,
+                       concurrency=args.concurrency, timeout=args.timeout)
+    asyncio.run(prober.probe_keys(key for keys in pools.values() for key in keys))
+
+    if args.json:
+        print(json.dumps({
+            pool: [prober.health[api_key] for api_key in keys if api_key in prober.health]
+            for pool, keys in pools.items()
+        }, ensure_ascii=False, indent=2))
+    else:
+        print_report(pools, prober)
+
+    # 没有任何有效密钥时退出码为1，便于脚本判断
+    sys.exit(0 if any(result['status'] == VALID for result in prober.health.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上游密钥存储模块
+用SQLite保存任意数量的命名密钥池（不再是 config.ini 中的两个JSON数组），
+每个密钥可带模型白名单、档位和标签。加载时只校验一次，内存中按密钥建立索引；
+批量导入/导出逐行流式处理，不需要改写整个配置文件
+
+命令行用法:
+    python key_store.py import keys.txt --pool group1       # 每行一个密钥，或每行一个JSON对象
+    python key_store.py export --pool group1 > keys.jsonl
+    python key_store.py list
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+import configparser
+from typing import Dict, Any, List, Optional, Iterable, Iterator
+
+logger = logging.getLogger(__name__)
+
+# 批量导入时每批写入的行数
+IMPORT_BATCH_SIZE = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS api_keys (
+    key TEXT PRIMARY KEY,
+    pool TEXT NOT NULL,
+    tier TEXT NOT NULL DEFAULT '',
+    models TEXT NOT NULL DEFAULT '[]',
+    labels TEXT NOT NULL DEFAULT '[]',
+    enabled INTEGER NOT NULL DEFAULT 1,
+    added_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_api_keys_pool ON api_keys (pool);
+"""
+
+
+def store_path(config: configparser.ConfigParser) -> str:
+    """
+    [KEYS] store 配置的数据库路径，为空表示不启用密钥存储。
+    config_manager 和 key_prober 都通过它读取，未配置时的默认值保持一致
+    """
+    return config.get('KEYS', 'store', fallback='').strip()
+
+
+def validate_key(key: str) -> Optional[str]:
+    """
+    校验单个密钥
+
+    Returns:
+        不合法的原因，合法时返回None
+    """
+    if not key:
+        return "密钥为空"
+    if key.startswith("YOUR_"):
+        return "占位符密钥"
+    if len(key) <= 10:
+        return "密钥过短"
+    if any(ch.isspace() for ch in key):
+        return "密钥包含空白字符"
+    return None
+
+
+class KeyRecord:
+    """单个上游密钥及其元数据"""
+
+    __slots__ = ('key', 'pool', 'tier', 'models', 'labels', 'enabled')
+
+    def __init__(self, key: str, pool: str, tier: str = '', models: Iterable[str] = (),
+                 labels: Iterable[str] = (), enabled: bool = True):
+        """
+        Args:
+            key: 上游API密钥
+            pool: 所属密钥池
+            tier: 档位（如 free / paid），仅作标记
+            models: 允许使用的模型，为空表示不限制
+            labels: 自定义标签
+            enabled: 是否参与调度
+        """
+        self.key = key
+        self.pool = pool
+        self.tier = tier
+        self.models = frozenset(models)
+        self.labels = tuple(labels)
+        self.enabled = enabled
+
+    def allows(self, model: Optional[str]) -> bool:
+        """该密钥是否可以请求指定模型"""
+        return not self.models or not model or model in self.models
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'key': self.key,
+            'pool': self.pool,
+            'tier': self.tier,
+            'models': sorted(self.models),
+            'labels': list(self.labels),
+            'enabled': self.enabled,
+        }
+
+    @classmethod
+    def from_line(cls, line: str, default_pool: str) -> 'KeyRecord':
+        """解析导入文件中的一行：纯密钥，或 {"key": ..., "pool": ..., "models": [...]} 形式的JSON对象"""
+        if line.startswith('{'):
+            data = json.loads(line)
+            return cls(
+                key=str(data.get('key', '')).strip(),
+                pool=data.get('pool') or default_pool,
+                tier=data.get('tier', ''),
+                models=data.get('models') or (),
+                labels=data.get('labels') or (),
+                enabled=bool(data.get('enabled', True)),
+            )
+        return cls(key=line, pool=default_pool)
+
+
+class KeyStore:
+    """SQLite 密钥存储，内存中保存已校验的索引"""
+
+    def __init__(self, path: str = "keys.db"):
+        """
+        Args:
+            path: SQLite数据库文件路径
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        # 密钥 -> 记录，按密钥查元数据为O(1)
+        self._index: Dict[str, KeyRecord] = {}
+        # 密钥池 -> 启用的密钥列表（保持导入顺序）
+        self._pools: Dict[str, List[str]] = {}
+        self.stats = {'loaded': 0, 'invalid': 0, 'load_ms': 0.0}
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def load(self):
+        """从数据库加载全部密钥并校验，之后的查询都只访问内存索引"""
+        begin = time.perf_counter()
+        index: Dict[str, KeyRecord] = {}
+        pools: Dict[str, List[str]] = {}
+        invalid = 0
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT key, pool, tier, models, labels, enabled FROM api_keys ORDER BY rowid"
+            )
+            for key, pool, tier, models, labels, enabled in rows:
+                if validate_key(key):
+                    invalid += 1
+                    continue
+                record = KeyRecord(key, pool, tier, json.loads(models), json.loads(labels), bool(enabled))
+                index[key] = record
+                pools.setdefault(pool, [])
+                if record.enabled:
+                    pools[pool].append(key)
+            self._index, self._pools = index, pools
+        self.stats.update(loaded=len(index), invalid=invalid,
+                          load_ms=round((time.perf_counter() - begin) * 1000, 1))
+        if invalid:
+            logger.warning(f"密钥存储中有 {invalid} 个无效密钥被忽略")
+        logger.info(f"已加载 {len(index)} 个密钥，{len(pools)} 个密钥池")
+
+    # --- 查询（只读内存索引） ---
+
+    def get(self, key: str) -> Optional[KeyRecord]:
+        return self._index.get(key)
+
+    def pool_names(self) -> List[str]:
+        return list(self._pools)
+
+    def pool_keys(self, pool: str) -> List[str]:
+        """某个密钥池中启用的密钥"""
+        return list(self._pools.get(pool, ()))
+
+    def groups(self) -> List[List[str]]:
+        """所有非空密钥池，按创建顺序排列，供 ProxyEngine 轮流调度"""
+        return [list(keys) for keys in self._pools.values() if keys]
+
+    def filter_for_model(self, keys: List[str], model: Optional[str]) -> List[str]:
+        """去掉模型白名单中不包含该模型的密钥（不在存储中的密钥原样保留）"""
+        result = []
+        for key in keys:
+            record = self._index.get(key)
+            if record is None or record.allows(model):
+                result.append(key)
+        return result
+
+    # --- 修改 ---
+
+    def _write(self, records: List[KeyRecord]):
+        self.conn.executemany(
+            "INSERT INTO api_keys (key, pool, tier, models, labels, enabled, added_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET pool=excluded.pool, tier=excluded.tier, "
+            "models=excluded.models, labels=excluded.labels, enabled=excluded.enabled",
+            [
+                (r.key, r.pool, r.tier, json.dumps(sorted(r.models)), json.dumps(list(r.labels)),
+                 int(r.enabled), time.time())
+                for r in records
+            ]
+        )
+
+    def import_lines(self, lines: Iterable[str], pool: str, replace: bool = False) -> Dict[str, int]:
+        """
+        流式批量导入（在同一个事务中完成），已存在的密钥更新其所属池和元数据
+
+        Args:
+            lines: 每行一个密钥，或一个JSON对象（可指定 pool/tier/models/labels/enabled）
+            pool: 未指定池时导入到的密钥池
+            replace: 导入前先清空该密钥池
+
+        Returns:
+            {'imported': 写入数, 'invalid': 无效行数, 'duplicates': 文件内重复数}
+        """
+        counts = {'imported': 0, 'invalid': 0, 'duplicates': 0}
+        seen = set()
+        batch: List[KeyRecord] = []
+        with self._lock:
+            with self.conn:
+                if replace:
+                    self.conn.execute("DELETE FROM api_keys WHERE pool = ?", (pool,))
+                for line in lines:
+                    line = line.strip()
+                    if not line or line.startswith('#'):
+                        continue
+                    try:
+                        record = KeyRecord.from_line(line, pool)
+                    except (ValueError, TypeError) as e:
+                        logger.warning(f"无法解析的导入行: {e}")
+                        counts['invalid'] += 1
+                        continue
+                    if validate_key(record.key):
+                        counts['invalid'] += 1
+                        continue
+                    if record.key in seen:
+                        counts['duplicates'] += 1
+                        continue
+                    seen.add(record.key)
+                    batch.append(record)
+                    if len(batch) >= IMPORT_BATCH_SIZE:
+                        self._write(batch)
+                        counts['imported'] += len(batch)
+                        batch = []
+                if batch:
+                    self._write(batch)
+                    counts['imported'] += len(batch)
+        self.load()
+        return counts
+
+    def replace_pool(self, pool: str, keys: Iterable[str]) -> Dict[str, int]:
+        """用给定的密钥替换整个密钥池（界面中编辑一组密钥后保存时使用）"""
+        return self.import_lines(keys, pool, replace=True)
+
+    def remove(self, keys: Iterable[str]) -> int:
+        """删除密钥，返回删除数量"""
+        with self._lock:
+            with self.conn:
+                cursor = self.conn.executemany("DELETE FROM api_keys WHERE key = ?", [(key,) for key in keys])
+        self.load()
+        return cursor.rowcount
+
+    def export_lines(self, pool: Optional[str] = None, masked: bool = False) -> Iterator[str]:
+        """
+        逐行导出为JSON对象（可直接再导入），不一次性读入全部行
+
+        Args:
+            masked: 只导出密钥末4位（用于查看，不能再导入）
+        """
+        query = "SELECT key, pool, tier, models, labels, enabled FROM api_keys"
+        params: tuple = ()
+        if pool is not None:
+            query += " WHERE pool = ?"
+            params = (pool,)
+        for key, pool_name, tier, models, labels, enabled in self.conn.execute(query + " ORDER BY rowid", params):
+            yield json.dumps({
+                'key': f"***{key[-4:]}" if masked else key, 'pool': pool_name, 'tier': tier,
+                'models': json.loads(models), 'labels': json.loads(labels), 'enabled': bool(enabled),
+            }, ensure_ascii=False)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """各密钥池的密钥数（不包含密钥本身）"""
+        return dict(
+            self.stats,
+            pools={pool: len(keys) for pool, keys in self._pools.items()},
+            disabled=sum(1 for record in self._index.values() if not record.enabled),
+        )
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="管理上游密钥存储")
+    parser.add_argument('--db', default=None, help="数据库路径，默认使用 config.ini 中 [KEYS] store 的设置")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = commands.add_parser('import', help="从文件导入密钥（- 表示标准输入）")
+    import_parser.add_argument('file')
+    import_parser.add_argument('--pool', default='group1', help="未在行中指定池时导入到的密钥池")
+    import_parser.add_argument('--replace', action='store_true', help="先清空该密钥池")
+
+    export_parser = commands.add_parser('export', help="导出密钥为JSON行")
+    export_parser.add_argument('--pool', default=None)
+
+    commands.add_parser('list', help="列出各密钥池的密钥数")
+    args = parser.parse_args()
+
+    if args.db is None:
+        from config_manager import config_manager
+        store = config_manager.key_store
+        if store is None:
+            parser.error("config.ini 中未启用密钥存储（[KEYS] store 为空），请用 --db 指定数据库")
+    else:
+        store = KeyStore(args.db)
+        store.load()
+
+    if args.command == 'import':
+        source = sys.stdin if args.file == '-' else open(args.file, 'r', encoding='utf-8')
+        with source:
+            counts = store.import_lines(source, args.pool, replace=args.replace)
+        print(f"导入 {counts['imported']} 个，无效 {counts['invalid']} 个，重复 {counts['duplicates']} 个")
+    elif args.command == 'export':
+        for line in store.export_lines(args.pool):
+            print(line)
+    else:
+        for pool, count in store.get_stats()['pools'].items():
+            print(f"{pool}: {count}")
+
+
+if __name__ == "__main__":
+    main()
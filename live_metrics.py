@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+实时运行指标模块
+在服务端按固定间隔（默认每秒）汇总一次指标：每秒请求数、p50/p95延迟、每个密钥的获胜/失败/冷却状态、
+排队深度和每个请求的上游调用数，只把与上一次相比发生变化的字段推送给仪表盘。
+无论打开多少个浏览器标签页，每个间隔都只计算一次
+"""
+
+import json
+import time
+import asyncio
+import threading
+from collections import deque
+from typing import Dict, Any, Callable, Optional, List, Tuple, AsyncIterator
+
+
+def diff_snapshot(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    计算两个快照之间的差异
+
+    Returns:
+        只包含变化字段的字典；嵌套字典递归比较，被删除的字段值为None
+    """
+    delta = {}
+    for key, value in new.items():
+        previous = old.get(key)
+        if isinstance(value, dict) and isinstance(previous, dict):
+            nested = diff_snapshot(previous, value)
+            if nested:
+                delta[key] = nested
+        elif key not in old or previous != value:
+            delta[key] = value
+    for key in old:
+        if key not in new:
+            delta[key] = None
+    return delta
+
+
+def _percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * fraction))], 1)
+
+
+class MetricsAggregator:
+    """运行指标聚合器（线程安全，可在不同线程的事件循环中记录）"""
+
+    def __init__(self, interval: float = 1.0, window: float = 10.0, cooldown_after: int = 3,
+                 gauges: Optional[Callable[[], Dict[str, Any]]] = None, history: int = 60):
+        """
+        Args:
+            interval: 汇总间隔（秒）
+            window: 计算每秒请求数和延迟分位数的滑动窗口（秒）
+            cooldown_after: 密钥连续失败多少次后标记为冷却
+            gauges: 返回瞬时值（如排队深度、进行中的上游请求数）的函数
+            history: 保留最近多少个增量，落后更多的订阅者会重新收到完整快照
+        """
+        self.interval = interval
+        self.window = window
+        self.cooldown_after = cooldown_after
+        self.gauges = gauges
+
+        self._lock = threading.Lock()
+        # (完成时间, 延迟毫秒, 是否成功, 上游调用数)
+        self._requests: deque = deque()
+        self._keys: Dict[str, Dict[str, int]] = {}
+        self._totals = {'requests': 0, 'failed': 0}
+
+        self.seq = 0
+        self.snapshot: Dict[str, Any] = {}
+        self._deltas: deque = deque(maxlen=history)
+
+    def record_request(self, latency_ms: float, success: bool, upstream_calls: int):
+        """记录一个已完成的客户端请求"""
+        with self._lock:
+            self._requests.append((time.monotonic(), latency_ms, success, upstream_calls))
+            self._totals['requests'] += 1
+            if not success:
+                self._totals['failed'] += 1
+
+    def record_leg(self, key_hint: str, success: bool, won: bool = False):
+        """记录一路上游请求的结果（被取消的请求不要记录）"""
+        with self._lock:
+            state = self._keys.setdefault(key_hint, {'calls': 0, 'wins': 0, 'errors': 0, 'consecutive_errors': 0})
+            state['calls'] += 1
+            if won:
+                state['wins'] += 1
+            if success:
+                state['consecutive_errors'] = 0
+            else:
+                state['errors'] += 1
+                state['consecutive_errors'] += 1
+
+    def observe_trace(self, trace):
+        """从 request_trace 的请求追踪记录中提取指标（作为 RequestTraceMiddleware 的观察者）"""
+        data = trace.to_dict()
+        for entry in data['upstream']:
+            outcome = entry.get('outcome')
+            if outcome in ('winner', 'ok'):
+                self.record_leg(entry['key'], True, won=outcome == 'winner')
+            elif outcome in ('failed', 'error'):
+                self.record_leg(entry['key'], False)
+        status = data.get('status') or 0
+        self.record_request(data.get('total_ms') or trace.elapsed_ms(), 200 <= status < 400, len(data['upstream']))
+
+    def _key_state(self, state: Dict[str, int]) -> str:
+        if state['consecutive_errors'] >= self.cooldown_after:
+            return 'cooldown'
+        return 'failing' if state['consecutive_errors'] else 'ok'
+
+    def _build_snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        while self._requests and self._requests[0][0] < now - self.window:
+            self._requests.popleft()
+        latencies = [latency for _, latency, success, _ in self._requests if success]
+        calls = [upstream_calls for _, _, _, upstream_calls in self._requests]
+        snapshot = {
+            'rps': round(len(self._requests) / self.window, 2),
+            'latency_p50_ms': _percentile(latencies, 0.50),
+            'latency_p95_ms': _percentile(latencies, 0.95),
+            'upstream_calls_per_request': round(sum(calls) / len(calls), 2) if calls else None,
+            'requests_total': self._totals['requests'],
+            'failed_total': self._totals['failed'],
+            'keys': {
+                hint: {
+                    'calls': state['calls'],
+                    'wins': state['wins'],
+                    'errors': state['errors'],
+                    'state': self._key_state(state),
+                }
+                for hint, state in self._keys.items()
+            },
+        }
+        if self.gauges is not None:
+            snapshot.update(self.gauges())
+        return snapshot
+
+    def tick(self) -> Optional[Dict[str, Any]]:
+        """
+        汇总一次指标（每个间隔由一个后台任务调用一次）
+
+        Returns:
+            与上一次快照的差异，没有变化时返回None
+        """
+        with self._lock:
+            snapshot = self._build_snapshot()
+            delta = diff_snapshot(self.snapshot, snapshot)
+            self.snapshot = snapshot
+            if not delta:
+                return None
+            self.seq += 1
+            self._deltas.append((self.seq, delta))
+            return delta
+
+    def current(self) -> Tuple[int, Dict[str, Any]]:
+        """当前的完整快照，供新连接的仪表盘初始化"""
+        with self._lock:
+            return self.seq, self.snapshot
+
+    def deltas_since(self, seq: int) -> Optional[List[Tuple[int, Dict[str, Any]]]]:
+        """
+        取出序号 seq 之后的所有增量
+
+        Returns:
+            增量列表；所需的增量已被淘汰时返回None（调用方应重新发送完整快照）
+        """
+        with self._lock:
+            if seq >= self.seq:
+                return []
+            if not self._deltas or self._deltas[0][0] > seq + 1:
+                return None
+            return [(number, delta) for number, delta in self._deltas if number > seq]
+
+    async def run_ticker(self):
+        """在事件循环中定时汇总（asyncio 服务使用）"""
+        while True:
+            await asyncio.sleep(self.interval)
+            self.tick()
+
+    async def sse_events(self) -> AsyncIterator[str]:
+        """
+        Server-Sent Events 指标流：先发送 snapshot 事件，之后每个间隔发送一次 delta 事件
+        （需要另有任务运行 run_ticker）
+        """
+        seq, snapshot = self.current()
+        yield f"event: snapshot\nid: {seq}\ndata: {json.dumps(snapshot)}\n\n"
+        while True:
+            await asyncio.sleep(self.interval)
+            deltas = self.deltas_since(seq)
+            if deltas is None:
+                seq, snapshot = self.current()
+                yield f"event: snapshot\nid: {seq}\ndata: {json.dumps(snapshot)}\n\n"
+                continue
+            for seq, delta in deltas:
+                yield f"event: delta\nid: {seq}\ndata: {json.dumps(delta)}\n\n"
+            if not deltas:
+                # 注释行用于保持连接，防止代理或浏览器判定连接空闲
+                yield ": keepalive\n\n"
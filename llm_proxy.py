@@ -5,22 +5,42 @@ LLM代理服务 - 支持配置文件版本
 使用配置文件管理API密钥和服务设置
 """
 
+import sys
+import hmac
+import base64
 import asyncio
-import httpx
-import uvicorn
-import os
 import logging
-import json
-import time
-import sys
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse, StreamingResponse
+from array import array
+from fastapi import FastAPI, Request, HTTPException, Depends
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Union
+from starlette.concurrency import run_in_threadpool
 
 # 导入配置管理器
 from config_manager import config_manager
+from admission_control import AdmissionController, AdmissionRejected
+from tenant_manager import TenantManager, Tenant
+from context_cache import ContextCacheManager
+from raw_completion import RawCompletion
+from compression import CompressionMiddleware, CompressionStats
+from upstream_client import UpstreamClient
+from traffic_recorder import TrafficRecorder, TrafficRecorderMiddleware
+from request_trace import (
+    get_trace, span, trace_store, RequestTraceMiddleware
+)
+from profiling import live_profiler, ProfilerBusy
+from memory_budget import MemoryBudget
+from proxy_engine import ProxyEngine, EngineError, to_sse
+from key_prober import KeyProber
+from quota_tracker import QuotaTracker
+from approx_cache import ApproxResponseCache
+from candidate_scoring import ScoringPipeline
+from token_estimator import token_estimator
+from batch_jobs import BatchRunner
+from embeddings import EmbeddingBatcher, EmbeddingError
+from socket_handoff import serve
 
 # --- 从配置管理器获取配置 ---
 
@@ -29,34 +49,181 @@ server_config = config_manager.get_server_config()
 PORT = server_config['port']
 HOST = server_config['host']
 API_KEY = server_config['api_key']
+ADMIN_KEY = config_manager.get_admin_key()
 MIN_RESPONSE_LENGTH = server_config['min_response_length']
+MIN_RESPONSE_UNIT = server_config['min_response_unit']
 REQUEST_TIMEOUT = server_config['request_timeout']
 
 # 获取API配置
 BASE_URL = config_manager.get_base_url()
 
-# 获取API密钥
-api_keys = config_manager.get_api_keys()
-API_KEYS_GROUP_1 = api_keys['group1']
-API_KEYS_GROUP_2 = api_keys['group2']
-
-# 轮询计数器，用于跟踪当前应该使用哪组密钥
-current_group_index = 0
-
-# 获取当前应该使用的密钥组
-def get_current_api_keys():
-    """根据轮询机制返回当前应该使用的API密钥组"""
-    global current_group_index
-    if current_group_index == 0:
-        keys = API_KEYS_GROUP_1
-        current_group_index = 1
-    else:
-        keys = API_KEYS_GROUP_2
-        current_group_index = 0
-    
-    # 过滤掉无效的密钥
-    valid_keys = [key for key in keys if key and not key.startswith("YOUR_") and len(key) > 10]
-    return valid_keys
+# 上游接口类型：openai 使用OpenAI兼容层，native 使用Gemini原生接口
+backend_config = config_manager.get_backend_config()
+UPSTREAM_BACKEND = backend_config['backend']
+SAFETY_THRESHOLD = backend_config['safety_threshold']
+
+# 获取API密钥：启用密钥存储时为所有密钥池，否则为 [API_KEYS] 中的两组
+key_store = config_manager.key_store
+KEY_GROUPS = config_manager.get_key_groups()
+
+# 获取并发准入控制配置
+limits_config = config_manager.get_limits_config()
+
+# 全局准入控制器，限制同时进行的上游请求数
+admission_controller = AdmissionController(
+    max_inflight=limits_config['max_inflight_upstream'],
+    max_queue=limits_config['max_queue_size'],
+    queue_timeout=limits_config['queue_timeout']
+)
+
+# 上游响应缓冲内存预算，突发请求时限制同时驻留内存的候选响应字节数
+memory_budget = MemoryBudget(
+    max_total_bytes=limits_config['max_buffered_mb_total'] * 1024 * 1024,
+    max_request_bytes=limits_config['max_buffered_mb_per_request'] * 1024 * 1024
+)
+
+# 租户表，租户文件不存在时使用 [SERVER] 中的共享API_KEY
+tenant_manager = TenantManager(
+    tenants_file=config_manager.get_tenants_file(),
+    default_api_key=API_KEY
+)
+
+# 压缩配置：下游响应压缩，以及共享上游客户端的请求体压缩
+compression_config = config_manager.get_compression_config()
+compression_stats = CompressionStats()
+
+# 共享上游客户端：连接预热保活、DNS缓存
+upstream_config = config_manager.get_upstream_config()
+upstream = UpstreamClient(
+    gzip_requests=compression_config['upstream_gzip_requests'],
+    gzip_min_bytes=compression_config['upstream_gzip_min_bytes'],
+    warm_connections=upstream_config['warm_connections'],
+    keepalive_interval=upstream_config['keepalive_interval'],
+    keepalive_expiry=upstream_config['keepalive_expiry'],
+    dns_cache_ttl=upstream_config['dns_cache_ttl']
+)
+
+# 上下文缓存，复用每轮重复发送的长系统提示词（经由共享上游客户端创建缓存条目）
+cache_config = config_manager.get_cache_config()
+context_cache = ContextCacheManager(
+    base_url=BASE_URL,
+    enabled=cache_config['context_cache'],
+    min_prefix_chars=cache_config['min_prefix_chars'],
+    ttl_seconds=cache_config['ttl'],
+    upstream=upstream
+)
+
+# 流量录制（默认关闭），用于 replay.py 回放做性能回归对比
+recorder_config = config_manager.get_recorder_config()
+traffic_recorder = None
+if recorder_config['enabled']:
+    traffic_recorder = TrafficRecorder(
+        path=recorder_config['path'],
+        include_bodies=recorder_config['include_bodies'],
+        max_bytes=recorder_config['max_mb'] * 1024 * 1024,
+        backup_count=recorder_config['backup_count']
+    )
+
+# 密钥探测：后台低频率检查全部密钥，调度时跳过已知不可用的密钥
+prober_config = config_manager.get_prober_config()
+key_prober = KeyProber(
+    base_url=BASE_URL,
+    method=prober_config['method'],
+    model=prober_config['model'],
+    concurrency=prober_config['concurrency'],
+    timeout=prober_config['timeout'],
+    interval=prober_config['interval'],
+    rate=prober_config['rate']
+)
+
+# 配额统计：按 (密钥, 模型) 累计当天用量（太平洋时间午夜重置），调度时优先使用余量多的密钥
+quota_config = config_manager.get_quota_config()
+quota_tracker = None
+if quota_config['enabled']:
+    quota_tracker = QuotaTracker(
+        path=quota_config['path'],
+        limits=quota_config['limits'],
+        default_rpm=quota_config['default_rpm'],
+        default_rpd=quota_config['default_rpd'],
+        default_tpm=quota_config['default_tpm'],
+        flush_interval=quota_config['flush_interval']
+    )
+    quota_tracker.load()
+
+# 近似重复请求缓存：只对选择加入的模型/租户生效
+approx_cache_config = config_manager.get_approx_cache_config()
+response_cache = None
+if approx_cache_config['enabled']:
+    response_cache = ApproxResponseCache(
+        threshold=approx_cache_config['threshold'],
+        ttl=approx_cache_config['ttl'],
+        max_entries=approx_cache_config['max_entries'],
+        max_bytes=approx_cache_config['max_mb'] * 1024 * 1024,
+        min_query_tokens=approx_cache_config['min_query_tokens'],
+        models=approx_cache_config['models'],
+        tenants=approx_cache_config['tenants']
+    )
+
+# 候选打分：开启后按打分选择候选，淘汰拒答、重复退化和被过滤的响应
+scoring_config = config_manager.get_scoring_config()
+scoring = None
+if scoring_config['enabled']:
+    scoring = ScoringPipeline(
+        scorers=scoring_config['scorers'] or None,
+        weights=scoring_config['weights'],
+        good_enough=scoring_config['good_enough'],
+        target_tokens=scoring_config['target_tokens'],
+        reject_refusals=scoring_config['reject_refusals']
+    )
+
+# 代理引擎：密钥轮询、并发扇出与候选选择的共享实现（app.py 也使用它）
+engine = ProxyEngine(
+    base_url=BASE_URL,
+    key_groups=KEY_GROUPS,
+    min_response_length=MIN_RESPONSE_LENGTH,
+    length_unit=MIN_RESPONSE_UNIT,
+    request_timeout=REQUEST_TIMEOUT,
+    backend=UPSTREAM_BACKEND,
+    safety_threshold=SAFETY_THRESHOLD,
+    selection='score' if scoring is not None else 'first',
+    wait_more=scoring_config['wait_more'],
+    admission=admission_controller,
+    upstream=upstream,
+    context_cache=context_cache,
+    memory_budget=memory_budget,
+    tenant_manager=tenant_manager,
+    key_store=key_store,
+    key_prober=key_prober,
+    quota_tracker=quota_tracker,
+    response_cache=response_cache,
+    scoring=scoring
+)
+
+# 批量请求：每条只用一个密钥，只占用交互请求没有用到的准入名额
+batch_config = config_manager.get_batch_config()
+batch_runner = None
+if batch_config['enabled']:
+    batch_runner = BatchRunner(
+        engine, admission_controller,
+        quota_tracker=quota_tracker,
+        path=batch_config['path'],
+        workers=batch_config['workers'],
+        per_key_concurrency=batch_config['per_key_concurrency'],
+        max_attempts=batch_config['max_attempts'],
+        headroom=batch_config['headroom']
+    )
+
+# 向量嵌入：几毫秒内各个调用方的输入合并为一次上游批量调用
+embeddings_config = config_manager.get_embeddings_config()
+embedding_batcher = EmbeddingBatcher(
+    engine,
+    window_ms=embeddings_config['window_ms'],
+    max_batch=embeddings_config['max_batch']
+)
+
+def all_keys() -> List[str]:
+    """当前参与调度的全部密钥"""
+    return [key for group in engine.scheduler.groups for key in group]
 
 # --- FastAPI应用设置 ---
 
@@ -76,6 +243,22 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 添加响应压缩中间件（按 Accept-Encoding 协商，流式响应逐块刷新）
+if compression_config['downstream']:
+    app.add_middleware(
+        CompressionMiddleware,
+        stats=compression_stats,
+        minimum_size=compression_config['min_size']
+    )
+
+# 添加流量录制中间件（在压缩中间件外层，记录的耗时和字节数与客户端实际收到的一致）
+if traffic_recorder is not None:
+    app.add_middleware(TrafficRecorderMiddleware, recorder=traffic_recorder)
+
+# 添加请求追踪中间件：返回 Server-Timing / X-Proxy-Request-Id，并保存最近的请求时间线。
+# 后添加的中间件在外层，所以它是最外层：内层的流量录制中间件沿用它创建的追踪记录，两者记录的上游调用一致
+app.add_middleware(RequestTraceMiddleware, store=trace_store)
+
 # 设置日志
 logging.basicConfig(
     level=logging.INFO,
@@ -83,6 +266,44 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected):
+    """队列已满或排队超时时快速返回，并告知客户端何时重试"""
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.detail},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+@app.exception_handler(EngineError)
+async def engine_error_handler(request: Request, exc: EngineError):
+    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail})
+
+@app.exception_handler(EmbeddingError)
+async def embedding_error_handler(request: Request, exc: EmbeddingError):
+    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail})
+
+@app.on_event("startup")
+async def warm_upstream_connections():
+    engine.start()
+    if prober_config['enabled']:
+        asyncio.create_task(key_prober.run_background(all_keys))
+    if quota_tracker is not None:
+        asyncio.create_task(quota_tracker.run_flusher())
+    if batch_runner is not None:
+        # 重启后从未完成的条目继续
+        asyncio.create_task(batch_runner.run())
+
+@app.on_event("shutdown")
+async def close_upstream_client():
+    await engine.aclose()
+    if traffic_recorder is not None:
+        traffic_recorder.close()
+    if quota_tracker is not None:
+        quota_tracker.close()
+    if batch_runner is not None:
+        batch_runner.close()
+
 # 定义与OpenAI API兼容的请求体模型
 class ChatRequest(BaseModel):
     model: str
@@ -91,228 +312,12 @@ class ChatRequest(BaseModel):
     max_tokens: int = 4096
     stream: bool = False
 
-# --- 核心并发逻辑 ---
-
-async def send_single_request(client: httpx.AsyncClient, api_key: str, request_data: dict):
-    """
-    使用单个API密钥发送请求。
-    """
-    # 清理请求数据，移除Google API不支持的参数
-    cleaned_data = {}
-    
-    # Google API支持的参数
-    supported_params = {
-        'model', 'messages', 'temperature', 'max_tokens',
-        'top_p', 'top_k', 'stop'
-    }
-    
-    # 只保留支持的参数
-    for key, value in request_data.items():
-        if key in supported_params:
-            cleaned_data[key] = value
-    
-    logger.info(f"清理后的请求参数: {list(cleaned_data.keys())}")
-    
-    # 构造请求头
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-    }
-    
-    # 构造请求URL
-    url = f"{BASE_URL}/openai/chat/completions"
-
-    try:
-        logger.info(f"使用密钥 [***{api_key[-4:]}] 发送请求...")
-        response = await client.post(url, headers=headers, json=cleaned_data, timeout=REQUEST_TIMEOUT)
-        
-        response.raise_for_status()
-        logger.info(f"密钥 [***{api_key[-4:]}] 收到响应，状态码: {response.status_code}")
-        
-        response_text = response.text
-        
-        # 检查是否是流式响应
-        if "data:" in response_text:
-            logger.info(f"密钥 [***{api_key[-4:]}] 检测到流式响应，转换为标准格式")
-            # 解析流式响应
-            lines = response_text.strip().split('\n')
-            content = ""
-            final_id = ""
-            final_model = ""
-            final_created = int(time.time())
-            
-            for line in lines:
-                if line.startswith("data: "):
-                    try:
-                        data = json.loads(line[6:])
-                        if data == "[DONE]":
-                            continue
-                            
-                        if "choices" in data and data["choices"]:
-                            delta = data["choices"][0].get("delta", {})
-                            if "content" in delta:
-                                content += delta["content"]
-                            
-                            if "id" in data:
-                                final_id = data["id"]
-                            if "model" in data:
-                                final_model = data["model"]
-                            if "created" in data:
-                                final_created = data["created"]
-                                
-                    except json.JSONDecodeError:
-                        continue
-            
-            if content:
-                logger.info(f"密钥 [***{api_key[-4:]}] 成功解析流式响应，内容长度: {len(content)}")
-                return {
-                    "id": final_id or "chatcmpl-" + str(int(time.time())),
-                    "object": "chat.completion",
-                    "created": final_created,
-                    "model": final_model or "gemini-2.5-flash",
-                    "choices": [
-                        {
-                            "index": 0,
-                            "message": {
-                                "role": "assistant",
-                                "content": content,
-                                "reasoning_content": "",
-                                "tool_calls": []
-                            },
-                            "finish_reason": "stop"
-                        }
-                    ],
-                    "usage": {
-                        "prompt_tokens": 0,
-                        "completion_tokens": 0,
-                        "total_tokens": 0
-                    }
-                }
-        
-        # 尝试解析标准JSON响应
-        try:
-            json_response = response.json()
-            logger.info(f"密钥 [***{api_key[-4:]}] 成功解析标准JSON响应")
-            return json_response
-        except ValueError as json_error:
-            logger.error(f"密钥 [***{api_key[-4:]}] JSON解析失败: {json_error}")
-            logger.error(f"密钥 [***{api_key[-4:]}] 原始响应: {response_text}")
-            return None
-            
-    except httpx.HTTPStatusError as e:
-        logger.error(f"密钥 [***{api_key[-4:]}] 请求失败 (HTTP状态错误): {e.response.status_code} - {e.response.text}")
-        return None
-    except httpx.RequestError as e:
-        logger.error(f"密钥 [***{api_key[-4:]}] 请求失败 (网络或连接错误): {e}")
-        return None
-    except Exception as e:
-        logger.error(f"密钥 [***{api_key[-4:]}] 发生未知错误: {e}")
-        return None
-
-async def generate_fake_stream_response(request_data: dict):
-    """
-    获取完整的响应内容，然后以流式方式发送给前端。
-    """
-    
-    # 获取当前应该使用的API密钥组
-    current_keys = get_current_api_keys()
-    if not current_keys:
-        raise HTTPException(
-            status_code=500,
-            detail="没有可用的API密钥，请检查配置"
-        )
-    
-    logger.info(f"使用第 {2 - current_group_index} 组API密钥进行并发请求")
-    
-    async with httpx.AsyncClient() as client:
-        tasks = [
-            asyncio.create_task(send_single_request(client, key, request_data))
-            for key in current_keys
-        ]
-
-        for future in asyncio.as_completed(tasks):
-            try:
-                result = await future
-                
-                if result:
-                    if "choices" in result and result["choices"]:
-                        message_content = result["choices"][0].get("message", {}).get("content", "")
-                        
-                        if len(message_content) >= MIN_RESPONSE_LENGTH:
-                            logger.info(f"找到满足条件的响应 (长度: {len(message_content)}), 开始流式发送。")
-                            
-                            for task in tasks:
-                                if not task.done():
-                                    task.cancel()
-                            
-                            return await stream_response_content(result, message_content)
-                        else:
-                            logger.warning(f"收到一个过短的响应 (长度: {len(message_content)}), 已丢弃。")
-                    else:
-                        logger.warning(f"收到一个格式不正确的响应: {result}")
-
-            except asyncio.CancelledError:
-                logger.info("一个任务被成功取消。")
-            except Exception as e:
-                logger.error(f"处理任务时发生错误: {e}")
-
-    logger.error("所有并发请求均失败或未返回满足条件的结果。")
-    raise HTTPException(
-        status_code=503,
-        detail="所有上游API请求均失败或返回的响应过短，服务暂时不可用。"
-    )
-
-async def stream_response_content(result: dict, content: str):
+def stream_response_content(result: RawCompletion):
     """
     将完整的响应内容以流式方式发送给前端。
     """
-    response_id = result.get("id", f"chatcmpl-{int(time.time())}")
-    created_time = result.get("created", int(time.time()))
-    model_name = result.get("model", "gemini-2.5-flash")
-    
-    async def generate_stream():
-        # 将内容按字符分割，逐个发送
-        chunk_size = max(1, len(content) // 50)  # 分成50个块左右
-        for i in range(0, len(content), chunk_size):
-            chunk = content[i:i+chunk_size]
-            chunk_data = {
-                "id": response_id,
-                "object": "chat.completion.chunk",
-                "created": created_time,
-                "model": model_name,
-                "choices": [
-                    {
-                        "index": 0,
-                        "delta": {
-                            "content": chunk
-                        },
-                        "finish_reason": None
-                    }
-                ]
-            }
-            
-            yield f"data: {json.dumps(chunk_data)}\n\n"
-            await asyncio.sleep(0.01)
-        
-        final_data = {
-            "id": response_id,
-            "object": "chat.completion.chunk",
-            "created": created_time,
-            "model": model_name,
-            "choices": [
-                {
-                    "index": 0,
-                    "delta": {},
-                    "finish_reason": "stop"
-                }
-            ]
-        }
-        
-        yield f"data: {json.dumps(final_data)}\n\n"
-        yield "data: [DONE]\n\n"
-    
     return StreamingResponse(
-        generate_stream(),
+        to_sse(engine.iter_chunks(result)),
         media_type="text/event-stream",
         headers={
             "Cache-Control": "no-cache",
@@ -334,76 +339,41 @@ async def chat_completions_proxy(chat_request: ChatRequest, request: Request):
     if not api_key_header or not api_key_header.startswith("Bearer "):
         raise HTTPException(
             status_code=401,
-            detail=f"缺少API密钥或格式不正确。请在请求头中添加 Authorization: Bearer {API_KEY}"
+            detail="缺少API密钥或格式不正确。请在请求头中添加 Authorization: Bearer <API密钥>"
         )
     
     provided_key = api_key_header.split(" ")[1]
-    if provided_key != API_KEY:
+    with span("auth"):
+        tenant = tenant_manager.authenticate(provided_key)
+    if tenant is None:
         raise HTTPException(
             status_code=401,
             detail="API密钥无效。"
         )
     
-    logger.info("API密钥认证成功")
-    return await chat_completions_proxy_handler(chat_request, request)
-
-async def chat_completions_proxy_handler(chat_request: ChatRequest, request: Request):
+    logger.info(f"API密钥认证成功 (租户: {tenant.name})")
+    trace = get_trace()
+    if trace is not None:
+        trace.tenant = tenant.name
+    tenant_manager.check_rate(tenant)
+    async with tenant_manager.track(tenant):
+        return await chat_completions_proxy_handler(chat_request, request, tenant)
+
+async def chat_completions_proxy_handler(chat_request: ChatRequest, request: Request, tenant: Tenant):
     """
     代理OpenAI的chat completions端点。
     """
-    current_keys = get_current_api_keys()
-    if not current_keys:
-        raise HTTPException(
-            status_code=500,
-            detail="服务器未配置有效的API密钥。请使用GUI配置API密钥。"
-        )
+    with span("parse"):
+        request_data = await request.json()
 
-    request_data = await request.json()
+    result = await engine.complete(request_data, tenant)
 
     if chat_request.stream:
         logger.info("检测到流式响应请求，返回流式响应")
-        return await generate_fake_stream_response(request_data)
+        return stream_response_content(result)
 
-    current_keys = get_current_api_keys()
-    logger.info(f"使用第 {2 - current_group_index} 组API密钥进行并发请求")
-    
-    async with httpx.AsyncClient() as client:
-        tasks = [
-            asyncio.create_task(send_single_request(client, key, request_data))
-            for key in current_keys
-        ]
-
-        for future in asyncio.as_completed(tasks):
-            try:
-                result = await future
-                
-                if result:
-                    if "choices" in result and result["choices"]:
-                        message_content = result["choices"][0].get("message", {}).get("content", "")
-                        
-                        if len(message_content) >= MIN_RESPONSE_LENGTH:
-                            logger.info(f"找到满足条件的响应 (长度: {len(message_content)}), 立即返回。")
-                            
-                            for task in tasks:
-                                if not task.done():
-                                    task.cancel()
-                            
-                            return JSONResponse(content=result)
-                        else:
-                            logger.warning(f"收到一个过短的响应 (长度: {len(message_content)}), 已丢弃。")
-                    else:
-                        logger.warning(f"收到一个格式不正确的响应: {result}")
-
-            except asyncio.CancelledError:
-                logger.info("一个任务被成功取消。")
-            except Exception as e:
-                logger.error(f"处理任务时发生错误: {e}")
-
-    logger.error("所有并发请求均失败或未返回满足条件的结果。")
-    raise HTTPException(
-        status_code=503,
-        detail="所有上游API请求均失败或返回的响应过短，服务暂时不可用。"
-    )
+    # 直接转发上游原始字节，不再重新编码
+    return Response(content=result.body, media_type="application/json")
 
 @app.get("/")
 def read_root():
@@ -414,21 +384,287 @@ def read_root():
             "port": PORT,
             "host": HOST,
             "min_response_length": MIN_RESPONSE_LENGTH,
+            "min_response_unit": MIN_RESPONSE_UNIT,
             "request_timeout": REQUEST_TIMEOUT
         }
     }
 
+# --- 批量请求 ---
+
+def require_tenant(request: Request) -> Tenant:
+    """校验客户端API密钥并返回对应的租户"""
+    api_key_header = request.headers.get("Authorization", "")
+    if not api_key_header.startswith("Bearer "):
+        raise HTTPException(
+            status_code=401,
+            detail="缺少API密钥或格式不正确。请在请求头中添加 Authorization: Bearer <API密钥>"
+        )
+    tenant = tenant_manager.authenticate(api_key_header[7:])
+    if tenant is None:
+        raise HTTPException(status_code=401, detail="API密钥无效。")
+    return tenant
+
+def require_batch_runner():
+    if batch_runner is None:
+        raise HTTPException(status_code=404, detail="未启用批量请求（config.ini 中 [BATCH] enabled 为 false）")
+
+@app.post("/v1/batch", dependencies=[Depends(require_batch_runner)])
+async def create_batch(request: Request, model: str = "", tenant: Tenant = Depends(require_tenant)):
+    """上传JSONL创建批量任务，每行一个请求；model 为未在行中指定模型时使用的默认模型"""
+    body = (await request.body()).decode("utf-8", errors="replace")
+    try:
+        return await run_in_threadpool(batch_runner.create_job, body.splitlines(), tenant.name, model)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/v1/batch", dependencies=[Depends(require_batch_runner)])
+def list_batches(limit: int = 20, tenant: Tenant = Depends(require_tenant)):
+    """该租户最近的批量任务"""
+    return {"object": "list", "data": batch_runner.list_jobs(tenant.name, limit)}
+
+def get_tenant_batch(batch_id: str, tenant: Tenant) -> Dict[str, Any]:
+    job = batch_runner.get_job(batch_id, tenant.name)
+    if job is None:
+        raise HTTPException(status_code=404, detail="批量任务不存在")
+    return job
+
+@app.get("/v1/batch/{batch_id}", dependencies=[Depends(require_batch_runner)])
+def get_batch(batch_id: str, tenant: Tenant = Depends(require_tenant)):
+    """任务进度（轮询）"""
+    return get_tenant_batch(batch_id, tenant)
+
+@app.get("/v1/batch/{batch_id}/results", dependencies=[Depends(require_batch_runner)])
+def download_batch_results(batch_id: str, tenant: Tenant = Depends(require_tenant)):
+    """下载已完成条目的结果（JSONL，按上传顺序；任务未完成时只包含已完成的条目）"""
+    get_tenant_batch(batch_id, tenant)
+    return StreamingResponse(
+        batch_runner.iter_results(batch_id),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{batch_id}.jsonl"'}
+    )
+
+@app.post("/v1/batch/{batch_id}/cancel", dependencies=[Depends(require_batch_runner)])
+def cancel_batch(batch_id: str, tenant: Tenant = Depends(require_tenant)):
+    """取消任务，未开始的条目不再发送"""
+    get_tenant_batch(batch_id, tenant)
+    return batch_runner.cancel_job(batch_id, tenant.name)
+
+# --- 向量嵌入 ---
+
+class EmbeddingRequest(BaseModel):
+    model: str
+    input: Union[str, List[str]]
+    encoding_format: str = "float"
+    dimensions: Optional[int] = None
+
+def encode_embedding(vector: List[float], encoding_format: str):
+    """base64 格式为小端 float32 字节（OpenAI SDK 默认请求这种格式）"""
+    if encoding_format != "base64":
+        return vector
+    values = array("f", vector)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return base64.b64encode(values.tobytes()).decode("ascii")
+
+@app.post("/v1/embeddings")
+async def create_embeddings(embedding_request: EmbeddingRequest, tenant: Tenant = Depends(require_tenant)):
+    """OpenAI兼容的嵌入接口，输入与其他并发请求合并后批量发往上游"""
+    if embedding_request.encoding_format not in ("float", "base64"):
+        raise HTTPException(status_code=400, detail="encoding_format 只能是 float 或 base64")
+    texts = [embedding_request.input] if isinstance(embedding_request.input, str) else embedding_request.input
+    if not texts:
+        raise HTTPException(status_code=400, detail="input 不能为空")
+    tenant_manager.check_rate(tenant)
+    async with tenant_manager.track(tenant):
+        vectors, tokens = await embedding_batcher.embed(
+            embedding_request.model, texts, embedding_request.dimensions
+        )
+    return {
+        "object": "list",
+        "data": [
+            {"object": "embedding", "index": index,
+             "embedding": encode_embedding(vector, embedding_request.encoding_format)}
+            for index, vector in enumerate(vectors)
+        ],
+        "model": embedding_request.model,
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+    }
+
+# --- 运行统计与请求时间线（包含租户名和密钥末4位，需要管理密钥） ---
+
+def admin_enabled() -> bool:
+    """单独配置了管理密钥，且它不是任何客户端（租户）的密钥时，管理接口才可用"""
+    return bool(ADMIN_KEY) and tenant_manager.authenticate(ADMIN_KEY) is None
+
+def require_admin(request: Request):
+    """校验管理密钥，未单独配置 [SERVER] admin_key 时管理接口不存在"""
+    if not admin_enabled():
+        raise HTTPException(status_code=404, detail="Not Found")
+    api_key_header = request.headers.get("Authorization", "")
+    provided_key = api_key_header[7:] if api_key_header.startswith("Bearer ") else ""
+    if not provided_key or not hmac.compare_digest(provided_key.encode(), ADMIN_KEY.encode()):
+        raise HTTPException(status_code=401, detail="管理密钥无效。")
+
+@app.get("/stats", dependencies=[Depends(require_admin)])
+def get_stats():
+    """运行统计端点"""
+    return {
+        "admission": admission_controller.get_stats(),
+        "tenants": tenant_manager.get_stats(),
+        "context_cache": context_cache.get_stats(),
+        "compression": {
+            "downstream": compression_stats.get_stats(),
+            "upstream": upstream.get_stats()
+        },
+        "upstream_connections": upstream.get_connection_stats(),
+        "recorder": traffic_recorder.get_stats() if traffic_recorder is not None else {"enabled": False},
+        "memory": memory_budget.get_stats(),
+        "engine": engine.get_stats(),
+        "token_estimator": token_estimator.get_stats(),
+        "key_prober": key_prober.get_stats(),
+        "quota": quota_tracker.get_stats() if quota_tracker is not None else {"enabled": False},
+        "batch": batch_runner.get_stats() if batch_runner is not None else {"enabled": False},
+        "embeddings": embedding_batcher.get_stats(),
+        "approx_cache": response_cache.get_stats() if response_cache is not None else {"enabled": False}
+    }
+
+@app.get("/metrics", dependencies=[Depends(require_admin)])
+def prometheus_metrics():
+    """
+    Prometheus 抓取端点：每个密钥×模型的当天用量、剩余配额和暂停状态（密钥只显示末4位）。
+    与 /stats 一样需要管理密钥（抓取配置中用 authorization.credentials 提供）
+    """
+    lines = [
+        "# HELP llm_proxy_requests_total 收到的请求数",
+        "# TYPE llm_proxy_requests_total counter",
+        f"llm_proxy_requests_total {engine.stats['requests']}",
+        "# HELP llm_proxy_upstream_calls_total 发往上游的调用数",
+        "# TYPE llm_proxy_upstream_calls_total counter",
+        f"llm_proxy_upstream_calls_total {engine.stats['upstream_calls']}",
+    ]
+    body = '\n'.join(lines) + '\n'
+    if quota_tracker is not None:
+        body += quota_tracker.prometheus()
+    return Response(content=body, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/debug/requests", dependencies=[Depends(require_admin)])
+def list_debug_requests(limit: int = 50):
+    """最近请求的时间线摘要（最新的在前）"""
+    return {"requests": trace_store.list(limit)}
+
+@app.get("/debug/requests/{request_id}", dependencies=[Depends(require_admin)])
+def get_debug_request(request_id: str):
+    """单个请求的完整时间线，包括每一路上游请求的状态、耗时和字节数"""
+    timeline = trace_store.get(request_id)
+    if timeline is None:
+        raise HTTPException(status_code=404, detail="请求记录不存在或已被淘汰")
+    return timeline
+
+# --- 管理端点（性能剖析） ---
+
+@app.post("/admin/profile/cpu", dependencies=[Depends(require_admin)])
+async def profile_cpu(seconds: float = 10, output: str = "collapsed"):
+    """
+    对运行中的服务进行CPU剖析，剖析期间服务照常处理请求。
+    output=collapsed 返回折叠调用栈（flamegraph.pl / speedscope 可直接打开），
+    output=pstats 返回 pstats 文件（python -m pstats 或 snakeviz 查看）
+    """
+    if output not in ("collapsed", "pstats"):
+        raise HTTPException(status_code=400, detail="output 只能是 collapsed 或 pstats")
+    try:
+        content, media_type, filename = await live_profiler.profile_cpu(seconds, output)
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return Response(
+        content=content,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@app.post("/admin/profile/memory", dependencies=[Depends(require_admin)])
+async def profile_memory(top: int = 25, key_type: str = "lineno"):
+    """拍摄内存分配快照，并与上一次快照对比（首次调用时开始跟踪）"""
+    if key_type not in ("lineno", "traceback", "filename"):
+        raise HTTPException(status_code=400, detail="key_type 只能是 lineno、traceback 或 filename")
+    return await live_profiler.memory_snapshot(top, key_type)
+
+@app.delete("/admin/profile/memory", dependencies=[Depends(require_admin)])
+def stop_memory_profiling():
+    """停止跟踪内存分配"""
+    return {"stopped": live_profiler.stop_memory_tracing()}
+
+@app.get("/admin/tasks", dependencies=[Depends(require_admin)])
+async def dump_tasks(max_frames: int = 20):
+    """导出所有asyncio任务及其堆栈"""
+    tasks = live_profiler.dump_tasks(max_frames)
+    return {"count": len(tasks), "tasks": tasks}
+
+# --- 管理端点（密钥存储） ---
+
+def require_key_store():
+    if key_store is None:
+        raise HTTPException(status_code=404, detail="未启用密钥存储（config.ini 中 [KEYS] store 为空）")
+
+@app.get("/admin/keys", dependencies=[Depends(require_admin), Depends(require_key_store)])
+def list_key_pools():
+    """各密钥池的密钥数"""
+    return key_store.get_stats()
+
+@app.post("/admin/keys/import", dependencies=[Depends(require_admin), Depends(require_key_store)])
+async def import_keys(request: Request, pool: str = "group1", replace: bool = False):
+    """
+    批量导入密钥：请求体每行一个密钥，或每行一个JSON对象（可指定 pool/tier/models/labels/enabled）。
+    写入SQLite后立即用于调度，不改写 config.ini
+    """
+    lines = (await request.body()).decode('utf-8', errors='replace').splitlines()
+    counts = await run_in_threadpool(key_store.import_lines, lines, pool, replace)
+    engine.configure(key_groups=key_store.groups())
+    return dict(counts, pools=key_store.get_stats()['pools'])
+
+@app.get("/admin/keys/export", dependencies=[Depends(require_admin), Depends(require_key_store)])
+def export_keys(pool: Optional[str] = None, raw: bool = False):
+    """
+    逐行导出密钥（JSON行）。默认只显示密钥末4位；raw=true 时导出完整密钥，可直接再导入
+    """
+    if raw:
+        logger.warning(f"管理接口导出了完整密钥（密钥池: {pool or '全部'}）")
+    return StreamingResponse(
+        (line + "\n" for line in key_store.export_lines(pool, masked=not raw)),
+        media_type="application/x-ndjson"
+    )
+
+@app.post("/admin/keys/reload", dependencies=[Depends(require_admin), Depends(require_key_store)])
+def reload_keys():
+    """重新加载密钥存储（用 key_store.py 命令行修改数据库之后调用）"""
+    key_store.load()
+    engine.configure(key_groups=key_store.groups())
+    return key_store.get_stats()
+
+@app.post("/admin/keys/probe", dependencies=[Depends(require_admin)])
+async def probe_keys(method: Optional[str] = None):
+    """立即并发探测全部密钥，返回每个密钥的结果（密钥已脱敏）"""
+    if method not in (None, "models", "completion"):
+        raise HTTPException(status_code=400, detail="method 只能是 models 或 completion")
+    results = await key_prober.probe_keys(all_keys(), method=method or '')
+    return {"readiness": key_prober.readiness(all_keys()), "results": results}
+
+@app.get("/ready")
+def readiness_check():
+    """就绪检查：至少有一个未被探测为不可用的密钥时返回200，否则503（只读，不影响轮询）"""
+    readiness = key_prober.readiness(all_keys())
+    return JSONResponse(status_code=200 if readiness['ready'] else 503, content=readiness)
+
 @app.get("/health")
 def health_check():
     """健康检查端点"""
-    current_keys = get_current_api_keys()
     return {
         "status": "healthy",
-        "api_keys_count": len(current_keys),
+        "api_keys_count": sum(len(group) for group in engine.scheduler.groups),
         "config": {
             "port": PORT,
             "host": HOST,
             "min_response_length": MIN_RESPONSE_LENGTH,
+            "min_response_unit": MIN_RESPONSE_UNIT,
             "request_timeout": REQUEST_TIMEOUT
         }
     }
@@ -441,12 +677,23 @@ if __name__ == "__main__":
     print(f"访问地址: http://{HOST}:{PORT}")
     print(f"API密钥: {API_KEY}")
     print("使用方法: 在请求头中添加 Authorization: Bearer <API密钥>")
+    if not ADMIN_KEY:
+        print("未配置管理密钥（[SERVER] admin_key），/stats、/debug 和 /admin 接口已禁用")
+    elif not admin_enabled():
+        print("警告: 管理密钥与客户端密钥相同，/stats、/debug 和 /admin 接口已禁用，请单独设置 admin_key")
     print("=" * 50)
     
     # 检查是否有有效的API密钥
-    current_keys = get_current_api_keys()
-    if not current_keys:
+    if not any(engine.scheduler.groups):
         print("警告: 没有配置有效的API密钥，服务可能无法正常工作！")
         print("请使用GUI程序配置API密钥。")
     
-    uvicorn.run(app, host=HOST, port=PORT)
\ No newline at end of file
+    # --replace: 新进程开始监听后，旧进程处理完进行中的请求再退出
+    lifecycle_config = config_manager.get_lifecycle_config()
+    serve(
+        app, HOST, PORT,
+        drain_timeout=lifecycle_config['shutdown_timeout'],
+        replace='--replace' in sys.argv[1:],
+        reuse_port=lifecycle_config['reuse_port'],
+        pid_file=lifecycle_config['pid_file'] or None
+    )
\ No newline at end of file
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上游响应缓冲内存预算模块
+并发扇出时每一路上游响应都要先完整读入内存才能比较，突发请求时容易造成内存峰值。
+这里为单个客户端请求和整个进程分别设置缓冲字节上限，超出时放弃读取该路响应
+"""
+
+from typing import Dict, Any
+
+
+class RequestBuffer:
+    """单个客户端请求持有的上游缓冲字节"""
+
+    def __init__(self, budget: 'MemoryBudget'):
+        self.budget = budget
+        self.held = 0
+        self.peak = 0
+
+    def reserve(self, size: int) -> bool:
+        """
+        申请缓冲 size 字节
+
+        Returns:
+            是否申请成功；超出单请求或全局预算时返回False
+        """
+        if self.held + size > self.budget.max_request_bytes or not self.budget._reserve(size):
+            self.budget.stats['over_budget'] += 1
+            return False
+        self.held += size
+        self.peak = max(self.peak, self.held)
+        return True
+
+    def release(self, size: int):
+        """归还已丢弃数据占用的字节"""
+        size = min(size, self.held)
+        self.held -= size
+        self.budget._release(size)
+
+    def close(self):
+        """请求结束时归还全部字节"""
+        self.release(self.held)
+        stats = self.budget.stats
+        stats['peak_request_bytes'] = max(stats['peak_request_bytes'], self.peak)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class MemoryBudget:
+    """全局缓冲内存预算"""
+
+    def __init__(self, max_total_bytes: int = 128 * 1024 * 1024, max_request_bytes: int = 8 * 1024 * 1024):
+        """
+        Args:
+            max_total_bytes: 所有请求合计最多缓冲的上游响应字节数
+            max_request_bytes: 单个客户端请求（所有扇出分路合计）最多缓冲的字节数
+        """
+        self.max_total_bytes = max_total_bytes
+        self.max_request_bytes = max_request_bytes
+        self.buffered = 0
+        self.stats = {
+            'peak_buffered_bytes': 0,
+            'peak_request_bytes': 0,
+            'over_budget': 0,
+        }
+
+    def request(self) -> RequestBuffer:
+        """为一个客户端请求创建缓冲记账（用 with 语句保证归还）"""
+        return RequestBuffer(self)
+
+    def _reserve(self, size: int) -> bool:
+        if self.buffered + size > self.max_total_bytes:
+            return False
+        self.buffered += size
+        self.stats['peak_buffered_bytes'] = max(self.stats['peak_buffered_bytes'], self.buffered)
+        return True
+
+    def _release(self, size: int):
+        self.buffered = max(0, self.buffered - size)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取当前和峰值缓冲字节数"""
+        return dict(
+            self.stats,
+            buffered_bytes=self.buffered,
+            max_total_bytes=self.max_total_bytes,
+            max_request_bytes=self.max_request_bytes,
+        )
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地模拟上游服务
+模拟Gemini的OpenAI兼容接口、原生generateContent接口和cachedContents接口，用于在不消耗真实配额的情况下
+开发和验证代理的并发、缓存等逻辑
+
+用法:
+    python mock_upstream.py --port 18999
+    然后把 config.ini 中的 base_url 设置为 http://127.0.0.1:18999/v1beta
+"""
+
+import argparse
+import asyncio
+import gzip
+import json
+import random
+import re
+import time
+import uuid
+from datetime import datetime, timezone
+
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.middleware.gzip import GZipMiddleware
+
+app = FastAPI(title="模拟上游服务")
+# 与真实上游一样按 Accept-Encoding 压缩响应
+app.add_middleware(GZipMiddleware, minimum_size=500)
+
+# 模拟行为参数，可通过命令行调整
+settings = {
+    'min_latency': 0.2,
+    'max_latency': 1.5,
+    'error_rate': 0.0,
+    'response_chars': 800,
+    'bad_rate': 0.0,
+}
+
+# 拼接模拟回答用的句子（内容不重复，避免被当作退化的输出）
+SENTENCES = [
+    '秋天的风吹过山岗，', '稻田里一片金黄。', '远处的村庄升起炊烟，', '孩子们在田埂上奔跑。',
+    '夕阳把湖面染成了橙色，', '归鸟成群地掠过树梢。', '老人坐在门前讲着从前的故事，', '屋檐下挂满了火红的柿子。',
+    '月亮慢慢爬上了东边的山头，', '虫鸣声此起彼伏。',
+]
+
+# 模拟的异常回答：拒答、重复同一句话、同一个字
+BAD_CONTENTS = [
+    lambda length: '抱歉，我无法满足这个请求。' + '。' * max(0, length - 13),
+    lambda length: ('这句话会一直重复下去。' * (length // 11 + 1))[:length],
+    lambda length: '模' * length,
+]
+
+
+def sample_text(length: int) -> str:
+    """指定字符数的模拟回答；按 bad_rate 的概率返回异常回答"""
+    if random.random() < settings['bad_rate']:
+        return random.choice(BAD_CONTENTS)(length)
+    parts = []
+    total = 0
+    while total < length:
+        sentence = f"{random.choice(SENTENCES)}{random.randint(1, 9999)}。"
+        parts.append(sentence)
+        total += len(sentence)
+    return ''.join(parts)[:length]
+
+# 已创建的缓存条目: 名称 -> {'model', 'system_chars', 'expire_at', 'api_key'}
+cached_contents = {}
+
+# 调用计数，便于对比不同版本的上游调用次数
+counters = {
+    'chat_completions': 0,
+    'native_requests': 0,
+    'cached_requests': 0,
+    'prompt_chars': 0,
+    'cache_created': 0,
+    'gzipped_requests': 0,
+    'model_list_requests': 0,
+    'embedding_requests': 0,
+    'embedded_inputs': 0,
+}
+
+
+def request_api_key(request: Request) -> str:
+    """兼容 Bearer、x-goog-api-key 和 ?key= 三种传递密钥的方式"""
+    auth = request.headers.get('Authorization', '')
+    if auth.startswith('Bearer '):
+        return auth[7:]
+    return request.headers.get('x-goog-api-key') or request.query_params.get('key', '')
+
+
+async def read_json(request: Request) -> dict:
+    """读取请求体，兼容gzip压缩的请求"""
+    body = await request.body()
+    if request.headers.get('content-encoding') == 'gzip':
+        counters['gzipped_requests'] += 1
+        body = gzip.decompress(body)
+    return json.loads(body)
+
+
+# 密钥中包含这些标记时模拟对应的上游错误（与真实Gemini的错误响应格式一致），用于验证密钥探测
+KEY_FAILURES = {
+    'INVALID': (400, 'INVALID_ARGUMENT', 'API key not valid. Please pass a valid API key.'),
+    'QUOTA': (429, 'RESOURCE_EXHAUSTED', 'You exceeded your current quota. '
+                                         'quotaId: GenerateRequestsPerDayPerProjectPerModel-FreeTier'),
+    'REGION': (400, 'FAILED_PRECONDITION', 'User location is not supported for the API use.'),
+}
+
+
+def key_failure(request: Request):
+    """按密钥中的标记返回模拟的错误响应，正常密钥返回None"""
+    api_key = request_api_key(request)
+    for marker, (status_code, status, message) in KEY_FAILURES.items():
+        if marker in api_key:
+            return JSONResponse(status_code=status_code,
+                                content={'error': {'code': status_code, 'message': message, 'status': status}})
+    return None
+
+
+def key_response(request: Request) -> str:
+    """
+    按密钥中的标记决定回答内容，用于验证候选选择：LEN<字符数> 固定回答长度，
+    REFUSE 返回拒答，LOOP 返回重复同一句话的回答；没有标记时返回随机长度的正常回答
+    """
+    api_key = request_api_key(request)
+    match = re.search(r'LEN(\d+)', api_key)
+    if match:
+        length = int(match.group(1))
+    else:
+        length = random.randint(settings['response_chars'] // 2, settings['response_chars'])
+    if 'REFUSE' in api_key:
+        return BAD_CONTENTS[0](length)
+    if 'LOOP' in api_key:
+        return BAD_CONTENTS[1](length)
+    return sample_text(length)
+
+
+def format_expire_time(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+@app.get("/v1beta/models")
+async def list_models(request: Request):
+    """模型列表（代理用它预热连接）"""
+    counters['model_list_requests'] += 1
+    failure = key_failure(request)
+    if failure is not None and 'INVALID' in request_api_key(request):
+        # 与真实上游一样，列出模型只校验密钥本身，不受配额和地区限制
+        return failure
+    return {'models': [{'name': 'models/gemini-2.5-flash'}, {'name': 'models/gemini-2.5-pro'}]}
+
+
+@app.post("/v1beta/cachedContents")
+async def create_cached_content(request: Request):
+    """创建缓存条目"""
+    body = await read_json(request)
+    ttl = float(str(body.get('ttl', '300s')).rstrip('s'))
+    parts = body.get('systemInstruction', {}).get('parts', [])
+    name = f"cachedContents/{uuid.uuid4().hex[:12]}"
+    expire_at = time.time() + ttl
+    cached_contents[name] = {
+        'model': body.get('model'),
+        'system_chars': sum(len(part.get('text', '')) for part in parts),
+        'expire_at': expire_at,
+        'api_key': request_api_key(request),
+    }
+    counters['cache_created'] += 1
+    return {'name': name, 'model': body.get('model'), 'expireTime': format_expire_time(expire_at)}
+
+
+@app.get("/v1beta/cachedContents/{cache_id}")
+async def get_cached_content(cache_id: str):
+    entry = cached_contents.get(f"cachedContents/{cache_id}")
+    if not entry or entry['expire_at'] < time.time():
+        raise HTTPException(status_code=404, detail="cached content not found")
+    return {'name': f"cachedContents/{cache_id}", 'model': entry['model'],
+            'expireTime': format_expire_time(entry['expire_at'])}
+
+
+@app.delete("/v1beta/cachedContents/{cache_id}")
+async def delete_cached_content(cache_id: str):
+    cached_contents.pop(f"cachedContents/{cache_id}", None)
+    return {}
+
+
+@app.post("/v1beta/openai/chat/completions")
+async def chat_completions(request: Request):
+    """模拟OpenAI兼容的聊天接口"""
+    body = await read_json(request)
+    counters['chat_completions'] += 1
+    failure = key_failure(request)
+    if failure is not None:
+        return failure
+    counters['prompt_chars'] += sum(len(str(m.get('content', ''))) for m in body.get('messages', []))
+
+    cache_name = body.get('extra_body', {}).get('google', {}).get('cached_content')
+    if cache_name:
+        entry = cached_contents.get(cache_name)
+        if not entry or entry['expire_at'] < time.time() or entry['api_key'] != request_api_key(request):
+            return JSONResponse(status_code=400, content={'error': {'message': 'CachedContent not found'}})
+        counters['cached_requests'] += 1
+
+    await asyncio.sleep(random.uniform(settings['min_latency'], settings['max_latency']))
+    if random.random() < settings['error_rate']:
+        return JSONResponse(status_code=429, content={'error': {'message': 'Resource has been exhausted'}})
+
+    text = key_response(request)
+    length = len(text)
+    return {
+        'id': f"chatcmpl-{uuid.uuid4().hex[:8]}",
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': body.get('model', 'gemini-2.5-flash'),
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': text},
+            'finish_reason': 'stop'
+        }],
+        'usage': {'prompt_tokens': 0, 'completion_tokens': length, 'total_tokens': length}
+    }
+
+
+def fake_embedding(text: str, dimensions: int) -> list:
+    """同一文本总是得到同一向量"""
+    rng = random.Random(text)
+    return [round(rng.uniform(-1, 1), 6) for _ in range(dimensions)]
+
+
+@app.post("/v1beta/openai/embeddings")
+async def openai_embeddings(request: Request):
+    """模拟OpenAI兼容的批量嵌入接口"""
+    body = await read_json(request)
+    failure = key_failure(request)
+    if failure is not None:
+        return failure
+    inputs = body['input'] if isinstance(body['input'], list) else [body['input']]
+    if len(inputs) > 100:
+        return JSONResponse(status_code=400, content={'error': {'message': 'at most 100 requests can be in one batch'}})
+    counters['embedding_requests'] += 1
+    counters['embedded_inputs'] += len(inputs)
+    await asyncio.sleep(random.uniform(settings['min_latency'], settings['max_latency']) / 4)
+    dimensions = body.get('dimensions') or 8
+    tokens = sum(len(text) for text in inputs) // 4
+    return {
+        'object': 'list',
+        'data': [{'object': 'embedding', 'index': i, 'embedding': fake_embedding(text, dimensions)}
+                 for i, text in enumerate(inputs)],
+        'model': body['model'],
+        'usage': {'prompt_tokens': tokens, 'total_tokens': tokens},
+    }
+
+
+@app.post("/v1beta/models/{model_action}")
+async def native_generate(model_action: str, request: Request):
+    """模拟原生 generateContent / streamGenerateContent / batchEmbedContents 接口"""
+    model, _, action = model_action.partition(':')
+    if action == 'batchEmbedContents':
+        body = await read_json(request)
+        requests = body.get('requests', [])
+        if len(requests) > 100:
+            return JSONResponse(status_code=400, content={'error': {'message': 'at most 100 requests can be in one batch'}})
+        counters['embedding_requests'] += 1
+        counters['embedded_inputs'] += len(requests)
+        await asyncio.sleep(random.uniform(settings['min_latency'], settings['max_latency']) / 4)
+        return {'embeddings': [
+            {'values': fake_embedding(r['content']['parts'][0]['text'], r.get('outputDimensionality') or 8)}
+            for r in requests
+        ]}
+    if action not in ('generateContent', 'streamGenerateContent'):
+        raise HTTPException(status_code=404, detail="unknown method")
+    body = await read_json(request)
+    counters['native_requests'] += 1
+
+    cache_name = body.get('cachedContent')
+    if cache_name:
+        entry = cached_contents.get(cache_name)
+        if not entry or entry['expire_at'] < time.time() or entry['api_key'] != request_api_key(request):
+            return JSONResponse(status_code=400, content={'error': {'message': 'CachedContent not found'}})
+        counters['cached_requests'] += 1
+
+    await asyncio.sleep(random.uniform(settings['min_latency'], settings['max_latency']))
+    if random.random() < settings['error_rate']:
+        return JSONResponse(status_code=429, content={'error': {'message': 'Resource has been exhausted'}})
+
+    text = key_response(request)
+    length = len(text)
+    response_id = uuid.uuid4().hex[:8]
+    usage = {'promptTokenCount': 10, 'candidatesTokenCount': length, 'totalTokenCount': length + 10}
+
+    if action == 'generateContent':
+        return {
+            'candidates': [{'index': 0, 'content': {'role': 'model', 'parts': [{'text': text}]},
+                            'finishReason': 'STOP'}],
+            'usageMetadata': usage,
+            'modelVersion': model,
+            'responseId': response_id,
+        }
+
+    async def generate():
+        chunk_size = max(1, length // 5)
+        for start in range(0, length, chunk_size):
+            chunk = {
+                'candidates': [{'index': 0, 'content': {'role': 'model',
+                                                        'parts': [{'text': text[start:start + chunk_size]}]}}],
+                'modelVersion': model,
+                'responseId': response_id,
+            }
+            if start + chunk_size >= length:
+                chunk['candidates'][0]['finishReason'] = 'STOP'
+                chunk['usageMetadata'] = usage
+            yield f"data: {json.dumps(chunk)}\r\n\r\n"
+            await asyncio.sleep(0.01)
+
+    return StreamingResponse(generate(), media_type="text/event-stream")
+
+
+@app.get("/mock/counters")
+async def get_counters():
+    """查看模拟上游收到的调用统计"""
+    return dict(counters, cached_contents=len(cached_contents))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟上游服务")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18999)
+    parser.add_argument('--min-latency', type=float, default=settings['min_latency'])
+    parser.add_argument('--max-latency', type=float, default=settings['max_latency'])
+    parser.add_argument('--error-rate', type=float, default=settings['error_rate'])
+    parser.add_argument('--response-chars', type=int, default=settings['response_chars'])
+    parser.add_argument('--bad-rate', type=float, default=settings['bad_rate'],
+                        help='返回拒答/重复等异常回答的概率')
+    args = parser.parse_args()
+
+    settings.update(
+        min_latency=args.min_latency,
+        max_latency=args.max_latency,
+        error_rate=args.error_rate,
+        response_chars=args.response_chars,
+        bad_rate=args.bad_rate,
+    )
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
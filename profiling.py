@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+在线性能剖析模块
+为运行中的代理提供按需的CPU剖析、内存分配快照对比和asyncio任务堆栈导出，
+不需要在手机上附加外部工具。只在被调用时启用剖析器，空闲时没有任何开销
+"""
+
+import os
+import sys
+import time
+import asyncio
+import cProfile
+import pstats
+import tempfile
+import threading
+import tracemalloc
+from collections import Counter
+from typing import Dict, Any, List, Optional, Tuple
+
+try:
+    import yappi
+    YAPPI_AVAILABLE = True
+except ImportError:
+    YAPPI_AVAILABLE = False
+
+# 单次CPU剖析的最长时间（秒）
+MAX_PROFILE_SECONDS = 120
+
+
+class ProfilerBusy(Exception):
+    """已有一个CPU剖析正在进行"""
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def sample_stacks(thread_id: int, seconds: float, interval: float = 0.005) -> Counter:
+    """
+    定时采样指定线程的调用栈（在另一个线程中运行）
+
+    Returns:
+        折叠后的调用栈（以 ; 连接，从外到内） -> 采样次数
+    """
+    counts: Counter = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(_frame_name(frame))
+            frame = frame.f_back
+        if stack:
+            counts[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return counts
+
+
+def _stat_entry(stat, key_type: str) -> Dict[str, Any]:
+    entry = {
+        'location': str(stat.traceback[0]),
+        'size_kb': round(stat.size / 1024, 1),
+        'count': stat.count,
+    }
+    if hasattr(stat, 'size_diff'):
+        entry['size_diff_kb'] = round(stat.size_diff / 1024, 1)
+        entry['count_diff'] = stat.count_diff
+    if key_type == 'traceback':
+        entry['traceback'] = stat.traceback.format()
+    return entry
+
+
+class LiveProfiler:
+    """运行中进程的剖析工具"""
+
+    def __init__(self, trace_frames: int = 25):
+        """
+        Args:
+            trace_frames: tracemalloc 为每次分配保存的调用栈深度
+        """
+        self.trace_frames = trace_frames
+        self._cpu_busy = False
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+
+    async def profile_cpu(self, seconds: float, output: str = 'collapsed') -> Tuple[bytes, str, str]:
+        """
+        对事件循环所在线程进行N秒CPU剖析
+
+        Args:
+            seconds: 剖析时长
+            output: collapsed 为采样得到的折叠调用栈（可直接生成火焰图），
+                    pstats 为确定性剖析结果（安装了 yappi 时使用 yappi，否则使用 cProfile）
+
+        Returns:
+            (文件内容, 媒体类型, 文件名)
+        """
+        if self._cpu_busy:
+            raise ProfilerBusy("已有一个CPU剖析正在进行")
+        seconds = max(0.1, min(float(seconds), MAX_PROFILE_SECONDS))
+        self._cpu_busy = True
+        try:
+            if output == 'pstats':
+                return await self._profile_pstats(seconds), 'application/octet-stream', 'proxy-cpu.pstats'
+            loop = asyncio.get_running_loop()
+            counts = await loop.run_in_executor(None, sample_stacks, threading.get_ident(), seconds)
+            lines = [f"{stack} {count}" for stack, count in counts.most_common()]
+            return ('\n'.join(lines) + '\n').encode('utf-8'), 'text/plain', 'proxy-cpu.collapsed'
+        finally:
+            self._cpu_busy = False
+
+    async def _profile_pstats(self, seconds: float) -> bytes:
+        fd, path = tempfile.mkstemp(suffix='.pstats')
+        os.close(fd)
+        try:
+            if YAPPI_AVAILABLE:
+                # yappi 能把协程在 await 前后的耗时归到同一个函数上
+                yappi.set_clock_type('cpu')
+                yappi.clear_stats()
+                yappi.start()
+                try:
+                    await asyncio.sleep(seconds)
+                finally:
+                    yappi.stop()
+                yappi.get_func_stats().save(path, type='pstat')
+                yappi.clear_stats()
+            else:
+                # 事件循环是单线程的，剖析本线程即可覆盖这段时间内运行的所有协程
+                profiler = cProfile.Profile()
+                profiler.enable()
+                try:
+                    await asyncio.sleep(seconds)
+                finally:
+                    profiler.disable()
+                pstats.Stats(profiler).dump_stats(path)
+            with open(path, 'rb') as f:
+                return f.read()
+        finally:
+            os.remove(path)
+
+    async def memory_snapshot(self, top: int = 25, key_type: str = 'lineno') -> Dict[str, Any]:
+        """
+        拍摄内存分配快照；已有上一次快照时同时返回两次之间的差异
+
+        首次调用时才开始跟踪分配（此后有少量开销，直到调用 stop_memory_tracing）
+        """
+        started = False
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.trace_frames)
+            self._snapshot = None
+            started = True
+
+        def analyze(previous):
+            snapshot = tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            ))
+            stats = snapshot.statistics(key_type)[:top]
+            diff = snapshot.compare_to(previous, key_type)[:top] if previous is not None else None
+            return snapshot, stats, diff
+
+        # 快照统计比较耗时，放到线程池中执行，避免阻塞请求处理
+        loop = asyncio.get_running_loop()
+        snapshot, stats, diff = await loop.run_in_executor(None, analyze, self._snapshot)
+        self._snapshot = snapshot
+
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            'tracing_started': started,
+            'traced_current_kb': round(current / 1024, 1),
+            'traced_peak_kb': round(peak / 1024, 1),
+            'top': [_stat_entry(stat, key_type) for stat in stats],
+            'diff': [_stat_entry(stat, key_type) for stat in diff] if diff is not None else None,
+        }
+
+    def stop_memory_tracing(self) -> bool:
+        """停止跟踪内存分配并丢弃快照"""
+        was_tracing = tracemalloc.is_tracing()
+        tracemalloc.stop()
+        self._snapshot = None
+        return was_tracing
+
+    @staticmethod
+    def dump_tasks(max_frames: int = 20) -> List[Dict[str, Any]]:
+        """导出当前事件循环中所有任务及其堆栈（需在事件循环线程中调用）"""
+        tasks = []
+        for task in asyncio.all_tasks():
+            coro = task.get_coro()
+            tasks.append({
+                'name': task.get_name(),
+                'coro': getattr(coro, '__qualname__', repr(coro)),
+                'done': task.done(),
+                'stack': [
+                    f"{frame.f_code.co_filename}:{frame.f_lineno} in {frame.f_code.co_name}"
+                    for frame in task.get_stack(limit=max_frames)
+                ],
+            })
+        return tasks
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'cpu_profiling': self._cpu_busy,
+            'memory_tracing': tracemalloc.is_tracing(),
+            'yappi_available': YAPPI_AVAILABLE,
+        }
+
+
+# 全局剖析工具实例
+live_profiler = LiveProfiler()
@@ -0,0 +1,799 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+代理引擎模块
+多密钥并发请求上游、按规则选出候选响应的核心实现。
+llm_proxy.py 和 app.py 的HTTP服务都只是这个引擎的外壳；
+本地Python程序（批处理脚本、机器人等）也可以直接在进程内调用，省去HTTP往返和JSON编解码:
+
+    engine = ProxyEngine(base_url, [group1, group2])
+    result = await engine.complete({"model": "gemini-2.5-flash", "messages": [...]})
+    print(result.content())
+"""
+
+import io
+import json
+import time
+import asyncio
+import logging
+from typing import Dict, Any, List, Optional, Tuple, AsyncIterator
+
+import httpx
+
+from admission_control import AdmissionController
+from tenant_manager import TenantManager, Tenant
+from context_cache import ContextCacheManager
+from gemini_native import openai_to_native, native_url, parse_sse_line, candidate_text, NativeResponseAccumulator
+from raw_completion import RawCompletion, scan_completion
+from upstream_client import UpstreamClient
+from memory_budget import MemoryBudget, RequestBuffer
+from key_store import KeyStore
+from key_prober import KeyProber
+from quota_tracker import QuotaTracker
+from approx_cache import ApproxResponseCache
+from token_estimator import token_estimator
+from candidate_scoring import ScoringPipeline, CandidateScore, PromptProfile
+from request_trace import track_upstream, mark_winner, span, add_span, note_upstream, upstream_extensions
+
+logger = logging.getLogger(__name__)
+
+
+class EngineError(Exception):
+    """引擎无法给出响应（没有可用密钥，或所有上游请求均失败）"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class UpstreamError(EngineError):
+    """上游返回了错误状态码（status_code 和 detail 为上游的状态码和响应内容）"""
+
+
+def filter_keys(keys: List[str]) -> List[str]:
+    """过滤掉无效的密钥（空值、占位符）"""
+    return [key for key in keys if key and not key.startswith("YOUR_") and len(key) > 10]
+
+
+class KeyScheduler:
+    """在多组密钥之间轮流调度，每个请求使用一整组密钥并发"""
+
+    def __init__(self, groups: List[List[str]]):
+        self._next = 0
+        self.rotations = 0
+        self.set_groups(groups)
+
+    def set_groups(self, groups: List[List[str]]):
+        """更换密钥组（热重载配置时调用），轮询位置保持不变"""
+        self.groups = [filter_keys(group) for group in groups]
+
+    def next_keys(self) -> Tuple[int, List[str]]:
+        """
+        取出下一组密钥，空的密钥组会被跳过
+
+        Returns:
+            (组号（从1开始）, 密钥列表)；没有任何可用密钥时返回 (0, [])
+        """
+        for _ in range(len(self.groups)):
+            index = self._next % len(self.groups)
+            self._next = index + 1
+            if self.groups[index]:
+                self.rotations += 1
+                return index + 1, list(self.groups[index])
+        return 0, []
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'groups': [len(group) for group in self.groups],
+            'next_group': self._next % len(self.groups) + 1 if self.groups else 0,
+            'rotations': self.rotations,
+        }
+
+
+def fill_usage(data: Dict[str, Any], request_data: Dict[str, Any]) -> bool:
+    """
+    上游没有报告 usage（或全为0）时用本地估算填入，返回是否做了估算
+    """
+    usage = data.get("usage") or {}
+    if usage.get("completion_tokens"):
+        return False
+    choices = data.get("choices") or [{}]
+    content = choices[0].get("message", {}).get("content")
+    prompt_tokens = usage.get("prompt_tokens") or token_estimator.count_messages(request_data.get("messages"))
+    completion_tokens = token_estimator.count(content if isinstance(content, str) else "")
+    data["usage"] = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
+    }
+    return True
+
+
+def _parse_event_stream(response_body: bytes, request_data: Dict[str, Any]):
+    """把上游返回的SSE响应合并为标准 chat.completion，逐行解析，不复制整个响应文本"""
+    parts = []
+    usage = None
+    final_id = ""
+    final_model = ""
+    final_created = int(time.time())
+    
+    for raw_line in io.BytesIO(response_body):
+        line = raw_line.decode("utf-8", errors="replace").strip()
+        if not line.startswith("data: "):
+            continue
+        try:
+            data = json.loads(line[6:])
+        except json.JSONDecodeError:
+            continue
+        if data == "[DONE]" or not isinstance(data, dict):
+            continue
+            
+        if "choices" in data and data["choices"]:
+            delta = data["choices"][0].get("delta", {})
+            if "content" in delta:
+                parts.append(delta["content"])
+            
+            if "id" in data:
+                final_id = data["id"]
+            if "model" in data:
+                final_model = data["model"]
+            if "created" in data:
+                final_created = data["created"]
+        if data.get("usage"):
+            # 要求了 stream_options.include_usage 时最后一个分块带有 usage
+            usage = data["usage"]
+    
+    content = "".join(parts)
+    if not content:
+        return None
+    data = {
+        "id": final_id or "chatcmpl-" + str(int(time.time())),
+        "object": "chat.completion",
+        "created": final_created,
+        "model": final_model or "gemini-2.5-flash",
+        "choices": [
+            {
+                "index": 0,
+                "message": {
+                    "role": "assistant",
+                    "content": content,
+                    "reasoning_content": "",
+                    "tool_calls": []
+                },
+                "finish_reason": "stop"
+            }
+        ],
+        "usage": usage or {}
+    }
+    estimated = fill_usage(data, request_data)
+    return RawCompletion.from_dict(data, calibrate=not estimated)
+
+
+class ProxyEngine:
+    """多密钥并发代理引擎"""
+
+    def __init__(self, base_url: str, key_groups: List[List[str]], min_response_length: int = 400,
+                 request_timeout: float = 180, backend: str = 'openai', safety_threshold: str = '',
+                 selection: str = 'first', wait_more: float = 15.0, length_unit: str = 'chars',
+                 admission: Optional[AdmissionController] = None,
+                 upstream: Optional[UpstreamClient] = None,
+                 context_cache: Optional[ContextCacheManager] = None,
+                 memory_budget: Optional[MemoryBudget] = None,
+                 tenant_manager: Optional[TenantManager] = None,
+                 key_store: Optional[KeyStore] = None,
+                 key_prober: Optional[KeyProber] = None,
+                 quota_tracker: Optional[QuotaTracker] = None,
+                 response_cache: Optional[ApproxResponseCache] = None,
+                 scoring: Optional[ScoringPipeline] = None):
+        """
+        Args:
+            base_url: 上游API基础URL
+            key_groups: 轮流使用的密钥组
+            min_response_length: 响应内容达到该长度才算有效
+            length_unit: min_response_length 和 longest 模式比较长度的单位，chars 为字符数，tokens 为token数
+            request_timeout: 单个上游请求的超时时间（秒）
+            backend: openai 使用OpenAI兼容层，native 使用Gemini原生接口
+            safety_threshold: 原生接口统一使用的安全阈值
+            selection: first 返回第一个有效响应；longest 出现有效响应后再等待 wait_more 秒，返回其中最长的；
+                score 返回打分最高的，总分达到 scoring.good_enough 时立即返回，否则最多再等 wait_more 秒
+            wait_more: longest/score 模式下额外等待的秒数
+            admission / upstream / context_cache / memory_budget: 共享组件，未提供时使用默认配置新建
+            tenant_manager: 提供时把上游调用数和结果记入租户用量
+            key_store: 提供时按密钥的模型白名单过滤每组密钥
+            key_prober: 提供时跳过最近探测为无效/配额耗尽/地区受限的密钥
+            quota_tracker: 提供时统计每个密钥在每个模型上的用量，优先使用剩余配额多的密钥
+            response_cache: 提供时对选择加入的模型/租户，近似重复的请求直接返回缓存的响应
+            scoring: 候选打分流水线，提供时被打分器淘汰的候选（拒答、退化、被过滤）在任何模式下都不会被选中；
+                score 模式下未提供时使用默认配置
+        """
+        self.base_url = base_url
+        self.scheduler = KeyScheduler(key_groups)
+        self.min_response_length = min_response_length
+        self.request_timeout = request_timeout
+        self.backend = backend
+        self.safety_threshold = safety_threshold
+        self.selection = selection
+        self.wait_more = wait_more
+        self.length_unit = length_unit
+        self.admission = admission or AdmissionController()
+        self.upstream = upstream or UpstreamClient()
+        self.context_cache = context_cache or ContextCacheManager(base_url=base_url, upstream=self.upstream)
+        self.memory_budget = memory_budget or MemoryBudget()
+        self.tenant_manager = tenant_manager
+        self.key_store = key_store
+        self.key_prober = key_prober
+        self.quota_tracker = quota_tracker
+        self.response_cache = response_cache
+        self.scoring = scoring if scoring is not None or selection != 'score' else ScoringPipeline()
+
+        self.stats = {
+            'requests': 0,
+            'successful': 0,
+            'failed': 0,
+            'upstream_calls': 0,
+            'cache_hits': 0,
+        }
+
+    def configure(self, base_url: Optional[str] = None, key_groups: Optional[List[List[str]]] = None,
+                  min_response_length: Optional[int] = None, request_timeout: Optional[float] = None,
+                  selection: Optional[str] = None, wait_more: Optional[float] = None,
+                  length_unit: Optional[str] = None):
+        """热更新配置，未提供的参数保持不变；进行中的请求不受影响"""
+        if base_url is not None:
+            self.base_url = base_url
+            self.context_cache.base_url = base_url
+        if key_groups is not None:
+            self.scheduler.set_groups(key_groups)
+        if min_response_length is not None:
+            self.min_response_length = min_response_length
+        if request_timeout is not None:
+            self.request_timeout = request_timeout
+        if selection is not None:
+            self.selection = selection
+            if selection == 'score' and self.scoring is None:
+                self.scoring = ScoringPipeline()
+        if wait_more is not None:
+            self.wait_more = wait_more
+        if length_unit is not None:
+            self.length_unit = length_unit
+
+    def start(self):
+        """开始预热上游连接（需在事件循环中调用）"""
+        # 并发扇出时每路都需要一个连接，提前建立好以免首个请求付出握手开销
+        self.upstream.start_warming(f"{self.base_url}/models")
+
+    async def aclose(self):
+        await self.upstream.aclose()
+
+    async def complete(self, request_data: Dict[str, Any], tenant: Optional[Tenant] = None) -> RawCompletion:
+        """
+        用下一组密钥并发请求上游，返回选中的响应
+
+        Args:
+            request_data: OpenAI格式的请求体
+            tenant: 发起请求的租户（用于公平排队和用量统计），进程内调用可不提供
+
+        Raises:
+            EngineError: 没有可用密钥，或所有上游请求均失败/响应过短
+            AdmissionRejected: 准入队列已满或排队超时
+        """
+        self.stats['requests'] += 1
+        tenant_name, share = (tenant.name, tenant.weight) if tenant is not None else ("default", 1.0)
+        if self.response_cache is not None:
+            with span("cache"):
+                cached = self.response_cache.lookup(request_data, tenant_name)
+            if cached is not None:
+                logger.info(f"近似重复请求命中缓存 (长度: {cached.content_length})")
+                self.stats['cache_hits'] += 1
+                self._record_result(tenant, True, cached.content_length)
+                return cached
+
+        with span("keys"):
+            group, keys = self.scheduler.next_keys()
+            if keys and self.key_store is not None:
+                # 轮到的密钥池都不允许该模型时继续轮询下一个池，最多轮询一圈
+                for _ in range(len(self.scheduler.groups)):
+                    keys = self.key_store.filter_for_model(keys, request_data.get("model"))
+                    if keys:
+                        break
+                    group, keys = self.scheduler.next_keys()
+                else:
+                    self.stats['failed'] += 1
+                    raise EngineError(400, f"没有允许请求模型 {request_data.get('model')} 的API密钥")
+            if keys and self.key_prober is not None:
+                keys = self.key_prober.usable(keys)
+            if keys and self.quota_tracker is not None:
+                keys = self.quota_tracker.select(keys, request_data.get("model"))
+        if not keys:
+            self.stats['failed'] += 1
+            raise EngineError(500, "没有可用的API密钥，请检查配置")
+        
+        logger.info(f"使用第 {group} 组API密钥进行并发请求")
+        
+        queued_at = time.perf_counter()
+        with self.memory_budget.request() as buffer:
+            async with self.admission.admit(len(keys), tenant_name, share) as granted:
+                add_span("queue", queued_at)
+                fanout_at = time.perf_counter()
+                client = self.upstream.client
+                self.stats['upstream_calls'] += granted
+                if tenant is not None and self.tenant_manager is not None:
+                    self.tenant_manager.record_upstream_calls(tenant, granted)
+                tasks = [
+                    asyncio.create_task(track_upstream(key, self.send_single_request(client, key, request_data, buffer)))
+                    for key in keys[:granted]
+                ]
+                try:
+                    result = await self._select(tasks, buffer, request_data)
+                finally:
+                    for task in tasks:
+                        if not task.done():
+                            task.cancel()
+                
+                if result is not None:
+                    logger.info(f"选中满足条件的响应 (长度: {self._describe_length(result)})")
+                    self._record_result(tenant, True, result.content_length)
+                    mark_winner(result)
+                    add_span("fanout", fanout_at)
+                    if self.response_cache is not None:
+                        self.response_cache.store(request_data, result, tenant_name)
+                    return result
+
+        logger.error("所有并发请求均失败或未返回满足条件的结果。")
+        self._record_result(tenant, False)
+        raise EngineError(503, "所有上游API请求均失败或返回的响应过短，服务暂时不可用。")
+
+    def candidate_keys(self, model: Optional[str]) -> List[str]:
+        """全部密钥池中允许请求该模型、且未被探测为不可用的密钥（批处理任务在其中分配请求）"""
+        keys = [key for group in self.scheduler.groups for key in group]
+        if self.key_store is not None:
+            keys = self.key_store.filter_for_model(keys, model)
+        if self.key_prober is not None:
+            keys = [key for key in keys if self.key_prober.is_usable(key)]
+        return keys
+
+    async def complete_with_key(self, api_key: str, request_data: Dict[str, Any]) -> RawCompletion:
+        """
+        只用一个密钥请求一次，不扇出、不经过准入队列（调用方自行申请名额）
+
+        Raises:
+            UpstreamError: 上游返回了错误状态码
+            EngineError: 网络错误、响应格式不正确等没有上游错误响应的失败（502）
+        """
+        self.stats['upstream_calls'] += 1
+        failure: Dict[str, Any] = {}
+        with self.memory_budget.request() as buffer:
+            result = await self.send_single_request(self.upstream.client, api_key, request_data, buffer, failure)
+        if 'status_code' in failure:
+            raise UpstreamError(failure['status_code'], failure['detail'])
+        if result is None or not result.has_choices:
+            raise EngineError(502, failure.get('detail') or "上游没有返回有效的响应")
+        return result
+
+    async def _select(self, tasks: List[asyncio.Task], buffer: RequestBuffer,
+                      request_data: Dict[str, Any]) -> Optional[RawCompletion]:
+        """按 selection 规则等待并选出候选，落选的候选立即归还缓冲预算"""
+        loop = asyncio.get_running_loop()
+        prompt = PromptProfile(request_data) if self.scoring is not None else None
+        best = None
+        best_rank = None
+        deadline = None
+        pending = set(tasks)
+        collect_at = time.perf_counter()
+        wait_at = None
+        try:
+            while pending:
+                timeout = None if deadline is None else max(0.0, deadline - loop.time())
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # longest/score 模式的额外等待时间已到
+                    break
+                for task in done:
+                    result = self._task_result(task)
+                    if result is None:
+                        continue
+                    if not result.has_choices:
+                        logger.warning(f"收到一个格式不正确的响应: {result}")
+                        buffer.release(len(result.body))
+                        continue
+                    if self.response_length(result) < self.min_response_length:
+                        logger.warning(f"收到一个过短的响应 (长度: {self._describe_length(result)}), 已丢弃。")
+                        buffer.release(len(result.body))
+                        continue
+                    if self.scoring is not None:
+                        score = self._score(result, request_data, prompt)
+                        if score.rejected:
+                            logger.warning(f"候选被打分器淘汰 ({score.rejected}), 已丢弃。")
+                            buffer.release(len(result.body))
+                            continue
+                        logger.info(f"候选得分 {score.total:.3f} {score.scores}")
+                    rank = score.total if self.selection == 'score' else self.response_length(result)
+                    if best is None or rank > best_rank:
+                        if best is not None:
+                            buffer.release(len(best.body))
+                        best, best_rank = result, rank
+                    else:
+                        buffer.release(len(result.body))
+                if best is not None:
+                    if self.selection == 'first':
+                        return best
+                    if self.selection == 'score' and best_rank >= self.scoring.good_enough:
+                        # 已经足够好，不必再等其他候选
+                        self.scoring.stats['early_exits'] += 1
+                        return best
+                    if deadline is None:
+                        wait_at = time.perf_counter()
+                        deadline = loop.time() + self.wait_more
+            return best
+        finally:
+            # 等到第一个有效候选为 collect，之后为 longest/score 模式额外等待其他候选的 wait_more
+            add_span("collect", collect_at, wait_at)
+            if wait_at is not None:
+                add_span("wait_more", wait_at)
+
+    def _score(self, result: RawCompletion, request_data: Dict[str, Any],
+               prompt: Optional[PromptProfile]) -> CandidateScore:
+        """接收时已增量打分的候选补上结束原因，其余的在这里一次性打分（需要完整解析响应）"""
+        if result.score is None:
+            result.score = self.scoring.evaluate(request_data, result.content(), result.finish_reason, prompt)
+        else:
+            result.score.finish(result.finish_reason)
+        return result.score
+
+    def response_length(self, result: RawCompletion) -> int:
+        """按 length_unit 计算的响应长度"""
+        return result.tokens if self.length_unit == 'tokens' else result.content_length
+
+    @staticmethod
+    def _describe_length(result: RawCompletion) -> str:
+        return f"{result.content_length} 字符 / {result.tokens} tokens"
+
+    @staticmethod
+    def _task_result(task: asyncio.Task) -> Optional[RawCompletion]:
+        if task.cancelled():
+            logger.info("一个任务被成功取消。")
+            return None
+        exc = task.exception()
+        if exc is not None:
+            logger.error(f"处理任务时发生错误: {exc}")
+            return None
+        return task.result()
+
+    def _record_result(self, tenant: Optional[Tenant], success: bool, response_chars: int = 0):
+        self.stats['successful' if success else 'failed'] += 1
+        if tenant is not None and self.tenant_manager is not None:
+            self.tenant_manager.record_result(tenant, success, response_chars)
+
+    async def stream(self, request_data: Dict[str, Any], tenant: Optional[Tenant] = None,
+                     pace: float = 0.0) -> AsyncIterator[Dict[str, Any]]:
+        """
+        与 complete 相同，但以 chat.completion.chunk 字典的形式逐块产出选中的响应
+
+        Args:
+            pace: 相邻分块之间的间隔（秒），进程内调用通常不需要
+        """
+        result = await self.complete(request_data, tenant)
+        async for chunk in self.iter_chunks(result, pace):
+            yield chunk
+
+    @staticmethod
+    async def iter_chunks(result: RawCompletion, pace: float = 0.01,
+                          pieces: int = 50) -> AsyncIterator[Dict[str, Any]]:
+        """把完整响应切成约 pieces 个 chat.completion.chunk，最后一块带结束原因"""
+        data = result.json()
+        content = result.content()
+        response_id = data.get("id", f"chatcmpl-{int(time.time())}")
+        created_time = data.get("created", int(time.time()))
+        model_name = data.get("model", "gemini-2.5-flash")
+        
+        chunk_size = max(1, len(content) // pieces)
+        for i in range(0, len(content), chunk_size):
+            yield {
+                "id": response_id,
+                "object": "chat.completion.chunk",
+                "created": created_time,
+                "model": model_name,
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {
+                            "content": content[i:i + chunk_size]
+                        },
+                        "finish_reason": None
+                    }
+                ]
+            }
+            if pace:
+                await asyncio.sleep(pace)
+        
+        yield {
+            "id": response_id,
+            "object": "chat.completion.chunk",
+            "created": created_time,
+            "model": model_name,
+            "choices": [
+                {
+                    "index": 0,
+                    "delta": {},
+                    "finish_reason": "stop"
+                }
+            ]
+        }
+
+    def _record_call(self, api_key: str, model: Optional[str], messages: Any = None):
+        if self.quota_tracker is not None:
+            # 提示词token在发送时就计入每分钟token数（落选被取消的请求同样消耗）
+            self.quota_tracker.record_call(api_key, model, token_estimator.count_messages(messages))
+
+    def _record_tokens(self, api_key: str, model: Optional[str], tokens: int):
+        if self.quota_tracker is not None:
+            self.quota_tracker.record_tokens(api_key, model, tokens)
+
+    def _record_rejected(self, api_key: str, model: Optional[str], status_code: int, error_text: str):
+        if self.quota_tracker is not None:
+            self.quota_tracker.record_rejected(api_key, model, status_code, error_text)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return dict(
+            self.stats,
+            selection=self.selection,
+            backend=self.backend,
+            scoring=self.scoring.get_stats() if self.scoring is not None else None,
+            key_groups=self.scheduler.get_stats(),
+        )
+
+    # --- 单路上游请求 ---
+
+    async def _read_upstream(self, client: httpx.AsyncClient, url: str, headers: dict, data: dict,
+                             buffer: RequestBuffer):
+        """
+        发送请求并在内存预算内读取响应体，返回(响应, 响应体字节)。
+        超出预算时立即停止读取，响应体为None；读取成功时响应体占用的预算由调用方归还。
+        """
+        body, body_headers = self.upstream.encode_body(data, headers)
+        chunks = []
+        size = 0
+        async with client.stream("POST", url, headers=body_headers, content=body, timeout=self.request_timeout,
+                                 extensions=upstream_extensions()) as response:
+            try:
+                async for chunk in response.aiter_bytes():
+                    if not buffer.reserve(len(chunk)):
+                        buffer.release(size)
+                        return response, None
+                    chunks.append(chunk)
+                    size += len(chunk)
+            except BaseException:
+                buffer.release(size)
+                raise
+            finally:
+                self.upstream.record_response(response, size)
+                note_upstream(status=response.status_code, bytes=response.num_bytes_downloaded)
+        return response, b"".join(chunks)
+
+    async def send_single_request(self, client: httpx.AsyncClient, api_key: str, request_data: dict,
+                                  buffer: RequestBuffer, failure: Optional[Dict[str, Any]] = None):
+        """
+        使用单个API密钥发送请求，返回 RawCompletion 或 None。
+        返回的 RawCompletion 的字节数计入 buffer，调用方丢弃它时应归还。
+        提供 failure 时在其中记录失败原因：上游错误响应的 status_code 和 detail，或网络错误的 detail
+        """
+        if self.backend == 'native':
+            return await self.send_native_request(client, api_key, request_data, buffer, failure)
+    
+        # 清理请求数据，移除Google API不支持的参数
+        cleaned_data = {}
+    
+        # Google API支持的参数
+        supported_params = {
+            'model', 'messages', 'temperature', 'max_tokens',
+            'top_p', 'top_k', 'stop'
+        }
+    
+        # 只保留支持的参数
+        for key, value in request_data.items():
+            if key in supported_params:
+                cleaned_data[key] = value
+    
+        logger.info(f"清理后的请求参数: {list(cleaned_data.keys())}")
+    
+        # 命中上下文缓存时只发送缓存前缀之后的对话
+        send_data, cache_entry = self.context_cache.prepare(api_key, cleaned_data)
+    
+        # 构造请求头
+        headers = {
+            "Authorization": f"Bearer {api_key}",
+        }
+    
+        # 构造请求URL
+        url = f"{self.base_url}/openai/chat/completions"
+
+        try:
+            logger.info(f"使用密钥 [***{api_key[-4:]}] 发送请求...")
+            self._record_call(api_key, cleaned_data.get("model"), cleaned_data.get("messages"))
+            response, response_body = await self._read_upstream(client, url, headers, send_data, buffer)
+        
+            if cache_entry and response.status_code in (400, 403, 404):
+                # 缓存条目已过期或被删除，丢弃后改为发送完整请求
+                self.context_cache.invalidate(cache_entry)
+                if response_body is not None:
+                    buffer.release(len(response_body))
+                self._record_call(api_key, cleaned_data.get("model"), cleaned_data.get("messages"))
+                response, response_body = await self._read_upstream(client, url, headers, cleaned_data, buffer)
+        
+            if response_body is None:
+                logger.warning(f"密钥 [***{api_key[-4:]}] 的响应超出缓冲内存预算，已放弃。")
+                return None
+        
+            if response.status_code >= 400:
+                buffer.release(len(response_body))
+                error_text = response_body.decode("utf-8", errors="replace")
+                self._record_rejected(api_key, cleaned_data.get("model"), response.status_code, error_text)
+                logger.error(f"密钥 [***{api_key[-4:]}] 请求失败 (HTTP状态错误): {response.status_code} - {error_text}")
+                if failure is not None:
+                    failure.update(status_code=response.status_code, detail=error_text)
+                return None
+            logger.info(f"密钥 [***{api_key[-4:]}] 收到响应，状态码: {response.status_code}")
+        
+            # 检查是否是流式响应（只看响应头和开头，避免扫描整个响应体）
+            is_event_stream = response.headers.get("content-type", "").startswith("text/event-stream")
+            if is_event_stream or response_body.lstrip().startswith(b"data:"):
+                logger.info(f"密钥 [***{api_key[-4:]}] 检测到流式响应，转换为标准格式")
+                completion = _parse_event_stream(response_body, cleaned_data)
+                # 原始SSE字节解析后即可丢弃，只为合并后的响应保留预算
+                buffer.release(len(response_body))
+                if completion is not None:
+                    if not buffer.reserve(len(completion.body)):
+                        logger.warning(f"密钥 [***{api_key[-4:]}] 的响应超出缓冲内存预算，已放弃。")
+                        return None
+                    logger.info(f"密钥 [***{api_key[-4:]}] 成功解析流式响应，内容长度: {completion.content_length}")
+                    self._record_tokens(api_key, cleaned_data.get("model"), completion.tokens)
+                    return completion
+                response_body = b""
+        
+            # 标准JSON响应只做局部解析，原始字节留给获胜时直接转发
+            completion = scan_completion(response_body)
+            if completion is None:
+                buffer.release(len(response_body))
+                logger.error(f"密钥 [***{api_key[-4:]}] JSON解析失败")
+                logger.error(f"密钥 [***{api_key[-4:]}] 原始响应: {response_body.decode('utf-8', errors='replace')}")
+                return None
+            logger.info(f"密钥 [***{api_key[-4:]}] 成功解析标准JSON响应")
+            self._record_tokens(api_key, cleaned_data.get("model"), completion.tokens)
+            return completion
+            
+        except httpx.RequestError as e:
+            logger.error(f"密钥 [***{api_key[-4:]}] 请求失败 (网络或连接错误): {e}")
+            if failure is not None:
+                failure['detail'] = f"网络或连接错误: {e}"
+            return None
+        except Exception as e:
+            logger.error(f"密钥 [***{api_key[-4:]}] 发生未知错误: {e}")
+            return None
+
+    async def _stream_native(self, client: httpx.AsyncClient, api_key: str, model: str, body: dict,
+                             accumulator: NativeResponseAccumulator, buffer: RequestBuffer,
+                             score: Optional[CandidateScore] = None):
+        """
+        流式接收原生响应并累积到accumulator，返回(状态码, 错误内容, 占用的缓冲字节数)。
+        超出缓冲内存预算时停止接收，错误内容为说明文字。
+        提供score时边接收边打分，候选被打分器淘汰后不再接收剩余分块。
+        """
+        content, headers = self.upstream.encode_body(body, {"x-goog-api-key": api_key})
+        url = native_url(self.base_url, model, stream=True)
+        async with client.stream("POST", url, headers=headers, content=content, timeout=self.request_timeout,
+                                 extensions=upstream_extensions()) as response:
+            note_upstream(status=response.status_code)
+            if response.status_code >= 400:
+                error_text = (await response.aread()).decode('utf-8', errors='replace')
+                self.upstream.record_response(response)
+                note_upstream(bytes=response.num_bytes_downloaded)
+                return response.status_code, error_text, 0
+        
+            decoded_bytes = 0
+            held = 0
+            try:
+                async for line in response.aiter_lines():
+                    line_bytes = len(line.encode('utf-8')) + 1
+                    decoded_bytes += line_bytes
+                    data = parse_sse_line(line)
+                    if data is None:
+                        continue
+                    if not buffer.reserve(line_bytes):
+                        return response.status_code, "超出缓冲内存预算", held
+                    held += line_bytes
+                    accumulator.feed(data)
+                    if accumulator.blocked:
+                        # 被拦截的候选不可能满足条件，不必等待剩余分块
+                        break
+                    if score is not None:
+                        score.feed(candidate_text(data))
+                        if score.rejected:
+                            break
+            except BaseException:
+                buffer.release(held)
+                raise
+            finally:
+                self.upstream.record_response(response, decoded_bytes)
+                note_upstream(bytes=response.num_bytes_downloaded)
+            return response.status_code, "", held
+
+    async def send_native_request(self, client: httpx.AsyncClient, api_key: str, request_data: dict,
+                                  buffer: RequestBuffer, failure: Optional[Dict[str, Any]] = None):
+        """
+        使用Gemini原生 streamGenerateContent 接口发送请求，并转换为OpenAI格式。
+        """
+        # 原生接口能表达完整参数，因此不像兼容层那样裁剪请求数据
+        send_data, cache_entry = self.context_cache.prepare(api_key, request_data)
+        model, body = openai_to_native(send_data, self.safety_threshold)
+        accumulator = NativeResponseAccumulator(model)
+        score = self.scoring.start(request_data) if self.scoring is not None else None
+    
+        try:
+            logger.info(f"使用密钥 [***{api_key[-4:]}] 发送原生请求...")
+            self._record_call(api_key, model, request_data.get("messages"))
+            status_code, error_text, held = await self._stream_native(client, api_key, model, body, accumulator,
+                                                                      buffer, score)
+        
+            if cache_entry and status_code in (400, 403, 404):
+                # 缓存条目已过期或被删除，丢弃后改为发送完整请求
+                self.context_cache.invalidate(cache_entry)
+                buffer.release(held)
+                model, body = openai_to_native(request_data, self.safety_threshold)
+                accumulator = NativeResponseAccumulator(model)
+                score = self.scoring.start(request_data) if self.scoring is not None else None
+                self._record_call(api_key, model, request_data.get("messages"))
+                status_code, error_text, held = await self._stream_native(client, api_key, model, body, accumulator,
+                                                                          buffer, score)
+        
+            # 累积的分块转换后即可丢弃，只为转换后的响应保留预算
+            buffer.release(held)
+        
+            if status_code >= 400:
+                self._record_rejected(api_key, model, status_code, error_text)
+                logger.error(f"密钥 [***{api_key[-4:]}] 请求失败 (HTTP状态错误): {status_code} - {error_text}")
+                if failure is not None:
+                    failure.update(status_code=status_code, detail=error_text)
+                return None
+        
+            if error_text:
+                logger.warning(f"密钥 [***{api_key[-4:]}] 的响应{error_text}，已放弃。")
+                return None
+        
+            if accumulator.blocked:
+                logger.warning(f"密钥 [***{api_key[-4:]}] 的响应被上游拦截 ({accumulator.block_reason or accumulator.finish_reasons}), 已丢弃。")
+                return None
+        
+            if score is not None and score.rejected:
+                logger.warning(f"密钥 [***{api_key[-4:]}] 的响应被打分器淘汰 ({score.rejected}), 已提前放弃。")
+                return None
+        
+            logger.info(f"密钥 [***{api_key[-4:]}] 成功接收原生响应，内容长度: {accumulator.content_length()}")
+            data = accumulator.to_openai()
+            estimated = fill_usage(data, request_data)
+            completion = RawCompletion.from_dict(data, calibrate=not estimated)
+            if not buffer.reserve(len(completion.body)):
+                logger.warning(f"密钥 [***{api_key[-4:]}] 的响应超出缓冲内存预算，已放弃。")
+                return None
+            self._record_tokens(api_key, model, completion.tokens)
+            completion.score = score
+            return completion
+    
+        except httpx.RequestError as e:
+            logger.error(f"密钥 [***{api_key[-4:]}] 请求失败 (网络或连接错误): {e}")
+            if failure is not None:
+                failure['detail'] = f"网络或连接错误: {e}"
+            return None
+        except Exception as e:
+            logger.error(f"密钥 [***{api_key[-4:]}] 发生未知错误: {e}")
+            return None
+
+
+async def to_sse(chunks: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[str]:
+    """把分块编码为SSE事件（HTTP外壳使用），结尾追加 [DONE]"""
+    paced_at = time.perf_counter()
+    async for chunk in chunks:
+        yield f"data: {json.dumps(chunk)}\n\n"
+    yield "data: [DONE]\n\n"
+    # 伪流式的分块节奏耗时（响应头已发出，只出现在 /debug/requests 中）
+    add_span("pacing", paced_at)
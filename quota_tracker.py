@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上游配额统计模块
+Gemini 免费档的配额按 密钥 × 模型 计算（每分钟请求数 RPM、每天请求数 RPD、每分钟token数 TPM），
+每天在太平洋时间午夜重置。这里按 (密钥, 模型) 统计当天的调用数，定期批量写入
+SQLite（WAL模式，重启后继续累计），据此预测剩余容量，并让调度优先使用余量多的密钥，
+跳过当天已被上游拒绝（429）的密钥
+"""
+
+import re
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+from collections import deque
+from datetime import datetime, date, timedelta, timezone, time as dtime
+from typing import Dict, Any, List, Optional, Tuple, Deque
+
+try:
+    from zoneinfo import ZoneInfo
+    PACIFIC = ZoneInfo('America/Los_Angeles')
+except Exception:
+    # Windows 上没有安装 tzdata 时按美国夏令时规则自行换算
+    PACIFIC = None
+
+logger = logging.getLogger(__name__)
+
+# 免费档默认配额 (RPM, RPD, TPM)；未列出的模型按最长前缀匹配，都不匹配时使用默认值。
+# 配置中只给出 (RPM, RPD) 时 TPM 使用默认值，TPM 为0表示不限制
+DEFAULT_LIMITS: Dict[str, Tuple[int, ...]] = {
+    'gemini-2.5-pro': (5, 100, 250000),
+    'gemini-2.5-flash': (10, 250, 250000),
+    'gemini-2.5-flash-lite': (15, 1000, 250000),
+    'gemini-2.0-flash': (15, 200, 1000000),
+    'gemini-2.0-flash-lite': (30, 200, 1000000),
+    'gemini-embedding-001': (100, 1000, 30000),
+}
+
+# 每分钟配额被拒绝后暂停使用该密钥的秒数
+MINUTE_COOLDOWN = 60.0
+
+# 数据库中保留的历史天数
+RETENTION_DAYS = 7
+
+# 每个配额日最多单独统计的模型数（DEFAULT_LIMITS 和配置中列出的模型不占名额）。
+# 模型名来自客户端请求，超出后的新模型名和不合法的模型名都计入 OTHER_MODEL，
+# 避免任意字符串让内存中的统计表和数据库无限增长
+MAX_MODELS = 32
+OTHER_MODEL = 'other'
+_MODEL_NAME = re.compile(r'[A-Za-z0-9][A-Za-z0-9._-]{0,79}')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS quota_usage (
+    day TEXT NOT NULL,
+    key TEXT NOT NULL,
+    model TEXT NOT NULL,
+    requests INTEGER NOT NULL DEFAULT 0,
+    rejected INTEGER NOT NULL DEFAULT 0,
+    exhausted_until REAL NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (day, key, model)
+);
+"""
+
+
+def _us_dst(utc: datetime) -> bool:
+    """美国夏令时：三月第二个周日 02:00 至十一月第一个周日 02:00（当地时间）"""
+    march = datetime(utc.year, 3, 8, 10, tzinfo=timezone.utc)
+    start = march + timedelta(days=(6 - march.weekday()) % 7)
+    november = datetime(utc.year, 11, 1, 9, tzinfo=timezone.utc)
+    end = november + timedelta(days=(6 - november.weekday()) % 7)
+    return start <= utc < end
+
+
+def pacific_now(now: Optional[float] = None) -> datetime:
+    """当前的太平洋时间"""
+    now = time.time() if now is None else now
+    if PACIFIC is not None:
+        return datetime.fromtimestamp(now, PACIFIC)
+    utc = datetime.fromtimestamp(now, timezone.utc)
+    return utc.astimezone(timezone(timedelta(hours=-7 if _us_dst(utc) else -8)))
+
+
+def quota_day(now: Optional[float] = None) -> str:
+    """配额所属的日期（太平洋时间）"""
+    return pacific_now(now).date().isoformat()
+
+
+def next_reset(now: Optional[float] = None) -> float:
+    """下一次每日配额重置（太平洋时间午夜）的时间戳"""
+    local = pacific_now(now)
+    midnight = datetime.combine(local.date() + timedelta(days=1), dtime(0), tzinfo=local.tzinfo)
+    return midnight.timestamp()
+
+
+def normalize_model(model: Optional[str]) -> str:
+    """去掉 models/ 前缀；不是合法模型名（字母数字和 ._-，最长80字符）时返回 OTHER_MODEL"""
+    model = (model or '').strip()
+    model = model[len('models/'):] if model.startswith('models/') else model
+    return model if _MODEL_NAME.fullmatch(model) else OTHER_MODEL
+
+
+def prometheus_label(value: str) -> str:
+    """按 Prometheus 文本格式转义标签值中的反斜杠、双引号和换行"""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class QuotaTracker:
+    """按 (密钥, 模型) 统计当天用量并预测剩余容量"""
+
+    def __init__(self, path: str = "quota.db", limits: Optional[Dict[str, Tuple[int, ...]]] = None,
+                 default_rpm: int = 10, default_rpd: int = 250, default_tpm: int = 250000,
+                 flush_interval: float = 5.0):
+        """
+        Args:
+            path: SQLite数据库文件路径
+            limits: 模型 -> (RPM, RPD) 或 (RPM, RPD, TPM)，与默认配额合并
+            default_rpm / default_rpd / default_tpm: 未匹配到任何模型（或未给出TPM）时使用的配额
+            flush_interval: 把内存中的计数写入数据库的间隔（秒）
+        """
+        self.path = path
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.default_rpm = default_rpm
+        self.default_rpd = default_rpd
+        self.default_tpm = default_tpm
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        # (密钥, 模型) -> {'requests': 当天调用数, 'rejected': 被429拒绝数, 'exhausted_until': 暂停使用到的时间}
+        self._usage: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        # (密钥, 模型) -> 最近一分钟内的调用时间
+        self._minute: Dict[Tuple[str, str], Deque[float]] = {}
+        # (密钥, 模型) -> 最近一分钟内的 (时间, token数)，token数为本地估算或上游报告的值
+        self._minute_tokens: Dict[Tuple[str, str], Deque[Tuple[float, int]]] = {}
+        self._dirty: set = set()
+        # 当天单独统计的模型名（不含 self.limits 中列出的模型），最多 MAX_MODELS 个
+        self._models: set = set()
+        self.day = quota_day()
+        self.reset_at = next_reset()
+        self.day_started_at = self.reset_at - 86400
+        self.stats = {'flushes': 0, 'rows_written': 0, 'resets': 0}
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            # WAL 模式下写入不阻塞读取，断电时最多丢失最近一次未完成的批量写入
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    def load(self):
+        """加载当天（太平洋时间）的用量，并删除过期的历史记录"""
+        oldest = (date.fromisoformat(self.day) - timedelta(days=RETENTION_DAYS)).isoformat()
+        with self._lock:
+            with self.conn:
+                self.conn.execute("DELETE FROM quota_usage WHERE day < ?", (oldest,))
+            rows = self.conn.execute(
+                "SELECT key, model, requests, rejected, exhausted_until FROM quota_usage WHERE day = ?",
+                (self.day,)
+            ).fetchall()
+            for key, model, requests, rejected, exhausted_until in rows:
+                self._usage[(key, model)] = {
+                    'requests': requests, 'rejected': rejected, 'exhausted_until': exhausted_until
+                }
+                if model != OTHER_MODEL and model not in self.limits:
+                    self._models.add(model)
+        logger.info(f"已加载 {self.day} 的配额用量: {len(rows)} 个 密钥×模型")
+
+    def limits_for(self, model: str) -> Tuple[int, int, int]:
+        """模型的 (RPM, RPD, TPM)：精确匹配，其次最长前缀匹配（如 gemini-2.5-flash-preview-xx）"""
+        limit = self.limits.get(model)
+        if limit is None:
+            matches = [name for name in self.limits if model.startswith(name)]
+            if not matches:
+                return self.default_rpm, self.default_rpd, self.default_tpm
+            limit = self.limits[max(matches, key=len)]
+        return limit[0], limit[1], limit[2] if len(limit) > 2 else self.default_tpm
+
+    # --- 记录 ---
+
+    def _roll_day(self, now: float):
+        """过了太平洋时间午夜后把前一天的计数写入数据库并清零"""
+        if now < self.reset_at:
+            return
+        self.flush()
+        with self._lock:
+            self._usage.clear()
+            self._minute.clear()
+            self._minute_tokens.clear()
+            self._dirty.clear()
+            self._models.clear()
+            self.day = quota_day(now)
+            self.reset_at = next_reset(now)
+            self.day_started_at = self.reset_at - 86400
+        self.stats['resets'] += 1
+        logger.info(f"每日配额已重置，新的配额日: {self.day}")
+
+    def _model(self, model: Optional[str], register: bool = False) -> str:
+        """
+        统计使用的模型名：配额表中列出的模型总是单独统计，其他模型名在当天名额用完后计入 OTHER_MODEL
+
+        Args:
+            register: 是否占用名额（记录调用时占用，查询时不占用）
+        """
+        model = normalize_model(model)
+        if model == OTHER_MODEL or model in self.limits or model in self._models:
+            return model
+        if len(self._models) >= MAX_MODELS:
+            return OTHER_MODEL
+        if register:
+            self._models.add(model)
+        return model
+
+    def _entry(self, key: str, model: str) -> Dict[str, Any]:
+        entry = self._usage.get((key, model))
+        if entry is None:
+            entry = self._usage[(key, model)] = {'requests': 0, 'rejected': 0, 'exhausted_until': 0.0}
+        return entry
+
+    def record_call(self, key: str, model: Optional[str], tokens: int = 0):
+        """
+        记录一次发往上游的调用（在发送前调用：被取消的落选请求同样消耗配额）
+
+        Args:
+            tokens: 提示词的token数（估算值），计入每分钟token数
+        """
+        now = time.time()
+        self._roll_day(now)
+        with self._lock:
+            model = self._model(model, register=True)
+            self._entry(key, model)['requests'] += 1
+            self._minute.setdefault((key, model), deque()).append(now)
+            if tokens > 0:
+                self._minute_tokens.setdefault((key, model), deque()).append((now, tokens))
+            self._dirty.add((key, model))
+
+    def record_tokens(self, key: str, model: Optional[str], tokens: int):
+        """记录一次响应的输出token数，计入每分钟token数"""
+        if tokens <= 0:
+            return
+        with self._lock:
+            model = self._model(model)
+            self._minute_tokens.setdefault((key, model), deque()).append((time.time(), tokens))
+
+    def record_rejected(self, key: str, model: Optional[str], status_code: int, body: str = ''):
+        """
+        记录上游的错误响应。只处理429：被拒绝的调用不计入用量；
+        每日配额耗尽时暂停使用到下次重置，每分钟配额耗尽时暂停 MINUTE_COOLDOWN 秒
+        """
+        if status_code != 429:
+            return
+        now = time.time()
+        per_day = 'perday' in body.lower().replace(' ', '').replace('_', '')
+        with self._lock:
+            model = self._model(model, register=True)
+            entry = self._entry(key, model)
+            entry['requests'] = max(0, entry['requests'] - 1)
+            entry['rejected'] += 1
+            until = self.reset_at if per_day else now + MINUTE_COOLDOWN
+            entry['exhausted_until'] = max(entry['exhausted_until'], until)
+            self._dirty.add((key, model))
+        logger.warning(f"密钥 [***{key[-4:]}] 的 {model} {'每日' if per_day else '每分钟'}配额已耗尽")
+
+    # --- 查询与调度 ---
+
+    def usage(self, key: str, model: Optional[str], now: Optional[float] = None) -> Dict[str, Any]:
+        """某个密钥在某个模型上的用量和剩余容量"""
+        now = time.time() if now is None else now
+        model = self._model(model)
+        rpm, rpd, tpm = self.limits_for(model)
+        entry = self._usage.get((key, model)) or {'requests': 0, 'rejected': 0, 'exhausted_until': 0.0}
+        window = self._minute.get((key, model))
+        while window and window[0] <= now - 60:
+            window.popleft()
+        token_window = self._minute_tokens.get((key, model))
+        while token_window and token_window[0][0] <= now - 60:
+            token_window.popleft()
+        minute_tokens = sum(tokens for _, tokens in token_window or ())
+        until = entry['exhausted_until'] if entry['exhausted_until'] > now else None
+        if tpm > 0 and minute_tokens >= tpm:
+            # 每分钟token数用满时，等最早的记录移出窗口后恢复
+            until = max(until or 0.0, token_window[0][0] + 60)
+        exhausted = until is not None
+        day_remaining = max(0, rpd - entry['requests'])
+        minute_remaining = max(0, rpm - len(window or ()))
+        return {
+            'requests': entry['requests'],
+            'rejected': entry['rejected'],
+            'limit_rpd': rpd,
+            'limit_rpm': rpm,
+            'limit_tpm': tpm,
+            'minute_tokens': minute_tokens,
+            'day_remaining': 0 if exhausted and entry['exhausted_until'] >= self.reset_at else day_remaining,
+            'minute_remaining': minute_remaining,
+            'available': 0 if exhausted else min(day_remaining, minute_remaining),
+            'exhausted_until': until,
+        }
+
+    def select(self, keys: List[str], model: Optional[str]) -> List[str]:
+        """
+        按当天剩余配额从多到少排列有余量的密钥（准入控制只放行部分并发时先用余量多的）；
+        全部没有余量时原样返回（配额设置可能低于实际，如付费密钥）
+        """
+        now = time.time()
+        self._roll_day(now)
+        ranked = []
+        for index, key in enumerate(keys):
+            usage = self.usage(key, model, now)
+            if usage['available'] > 0:
+                ranked.append((-usage['day_remaining'], index, key))
+        if not ranked:
+            return keys
+        return [key for _, _, key in sorted(ranked)]
+
+    def forecast(self, model: str, keys: List[str], now: Optional[float] = None) -> Dict[str, Any]:
+        """
+        预测某个模型在给定密钥上的剩余容量：按当天至今的平均速率，
+        估计在下次重置前是否会用完，以及用完的时间
+        """
+        now = time.time() if now is None else now
+        usages = [self.usage(key, model, now) for key in keys]
+        used = sum(usage['requests'] for usage in usages)
+        remaining = sum(usage['day_remaining'] for usage in usages)
+        elapsed = max(60.0, now - self.day_started_at)
+        rate = used / elapsed
+        exhausted_at = None
+        if rate > 0 and now + remaining / rate < self.reset_at:
+            exhausted_at = round(now + remaining / rate)
+        return {
+            'requests': used,
+            'remaining': remaining,
+            'keys': len(keys),
+            'exhausted_keys': sum(1 for usage in usages if usage['exhausted_until'] is not None),
+            'requests_per_hour': round(rate * 3600, 1),
+            'projected_exhausted_at': exhausted_at,
+        }
+
+    # --- 持久化 ---
+
+    def flush(self):
+        """把变化的计数批量写入数据库"""
+        with self._lock:
+            if not self._dirty:
+                return
+            now = time.time()
+            rows = []
+            for key, model in self._dirty:
+                entry = self._usage[(key, model)]
+                rows.append((self.day, key, model, entry['requests'], entry['rejected'], entry['exhausted_until'], now))
+            self._dirty.clear()
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT INTO quota_usage (day, key, model, requests, rejected, exhausted_until, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(day, key, model) DO UPDATE SET requests=excluded.requests, "
+                    "rejected=excluded.rejected, exhausted_until=excluded.exhausted_until, "
+                    "updated_at=excluded.updated_at",
+                    rows
+                )
+        self.stats['flushes'] += 1
+        self.stats['rows_written'] += len(rows)
+
+    async def run_flusher(self):
+        """定期在线程池中写入数据库（需在事件循环中作为任务运行）"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self._roll_day(time.time())
+                await loop.run_in_executor(None, self.flush)
+            except Exception as e:
+                logger.error(f"写入配额用量失败: {e}")
+
+    def close(self):
+        self.flush()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    # --- 导出 ---
+
+    def get_stats(self) -> Dict[str, Any]:
+        """当天用量、各模型的容量预测和每个密钥的余量（只显示密钥末4位）"""
+        now = time.time()
+        keys_by_model: Dict[str, List[str]] = {}
+        for key, model in self._usage:
+            keys_by_model.setdefault(model, []).append(key)
+        per_key: Dict[str, Dict[str, Any]] = {}
+        for (key, model) in list(self._usage):
+            usage = self.usage(key, model, now)
+            per_key.setdefault(f"***{key[-4:]}", {})[model] = {
+                name: usage[name] for name in ('requests', 'rejected', 'minute_tokens', 'day_remaining', 'available',
+                                               'exhausted_until')
+            }
+        return dict(
+            self.stats,
+            day=self.day,
+            reset_at=self.reset_at,
+            seconds_to_reset=round(self.reset_at - now),
+            models={model: self.forecast(model, keys, now) for model, keys in sorted(keys_by_model.items())},
+            keys=per_key,
+        )
+
+    def prometheus(self) -> str:
+        """Prometheus 文本格式的配额指标"""
+        now = time.time()
+        lines = [
+            "# HELP llm_proxy_quota_requests_today 当天（太平洋时间）发往上游的调用数",
+            "# TYPE llm_proxy_quota_requests_today gauge",
+        ]
+        samples = []
+        for (key, model) in sorted(self._usage):
+            labels = f'key="***{prometheus_label(key[-4:])}",model="{prometheus_label(model)}"'
+            samples.append((labels, self.usage(key, model, now)))
+        lines += [f"llm_proxy_quota_requests_today{{{labels}}} {usage['requests']}" for labels, usage in samples]
+        lines += [
+            "# HELP llm_proxy_quota_rejected_today 当天被上游以429拒绝的调用数",
+            "# TYPE llm_proxy_quota_rejected_today gauge",
+        ]
+        lines += [f"llm_proxy_quota_rejected_today{{{labels}}} {usage['rejected']}" for labels, usage in samples]
+        lines += [
+            "# HELP llm_proxy_quota_remaining_today 预计当天剩余的请求数",
+            "# TYPE llm_proxy_quota_remaining_today gauge",
+        ]
+        lines += [f"llm_proxy_quota_remaining_today{{{labels}}} {usage['day_remaining']}" for labels, usage in samples]
+        lines += [
+            "# HELP llm_proxy_quota_minute_tokens 最近一分钟内的token数（提示词为本地估算）",
+            "# TYPE llm_proxy_quota_minute_tokens gauge",
+        ]
+        lines += [f"llm_proxy_quota_minute_tokens{{{labels}}} {usage['minute_tokens']}" for labels, usage in samples]
+        lines += [
+            "# HELP llm_proxy_quota_exhausted 密钥是否因429暂停使用（1为暂停）",
+            "# TYPE llm_proxy_quota_exhausted gauge",
+        ]
+        lines += [
+            f"llm_proxy_quota_exhausted{{{labels}}} {0 if usage['exhausted_until'] is None else 1}"
+            for labels, usage in samples
+        ]
+        lines += [
+            "# HELP llm_proxy_quota_reset_seconds 距离每日配额重置（太平洋时间午夜）的秒数",
+            "# TYPE llm_proxy_quota_reset_seconds gauge",
+            f"llm_proxy_quota_reset_seconds {round(self.reset_at - now)}",
+        ]
+        return '\n'.join(lines) + '\n'
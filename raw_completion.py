@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上游响应原样转发模块
+非流式的获胜响应直接转发上游返回的原始字节，不再经过一次完整的JSON解码和重新编码；
+并发竞速只需要的内容长度、token数和结束原因通过局部解析获得
+"""
+
+import re
+import json
+from typing import Dict, Any, Optional, Tuple
+
+from token_estimator import token_estimator
+
+_CHOICES_RE = re.compile(r'"choices"\s*:\s*\[\s*\{')
+_CONTENT_RE = re.compile(r'"content"\s*:\s*')
+_FINISH_REASON_RE = re.compile(r'"finish_reason"\s*:\s*(?:"([^"]*)"|null)')
+_PROMPT_TOKENS_RE = re.compile(r'"prompt_tokens"\s*:\s*(\d+)')
+_COMPLETION_TOKENS_RE = re.compile(r'"completion_tokens"\s*:\s*(\d+)')
+_REASONING_TOKENS_RE = re.compile(r'"reasoning_tokens"\s*:\s*(\d+)')
+_decoder = json.JSONDecoder()
+
+
+def _message_text(data: Dict[str, Any]) -> str:
+    """取出第一个候选的文本内容（兼容分段数组形式的content）"""
+    choices = data.get('choices') or [{}]
+    content = choices[0].get('message', {}).get('content') or ''
+    if isinstance(content, list):
+        content = ''.join(part.get('text', '') for part in content if isinstance(part, dict))
+    return content
+
+
+def _count_tokens(content: str, completion_tokens: int, reasoning_tokens: int, calibrate: bool = True) -> int:
+    """
+    可见内容的token数：上游报告了 usage 时以它为准（扣除思考token）并用于校准本地估算，
+    否则本地估算
+    """
+    visible = completion_tokens - reasoning_tokens
+    if content and visible > 0:
+        if calibrate:
+            token_estimator.observe(content, visible)
+        return visible
+    return token_estimator.count(content)
+
+
+def _usage_tokens(data: Dict[str, Any], calibrate: bool = True) -> Tuple[int, int]:
+    """(上游报告的提示词token数, 可见内容的token数)"""
+    usage = data.get('usage') or {}
+    details = usage.get('completion_tokens_details') or {}
+    tokens = _count_tokens(_message_text(data), usage.get('completion_tokens') or 0,
+                           details.get('reasoning_tokens') or 0, calibrate)
+    return usage.get('prompt_tokens') or 0, tokens
+
+
+def _summarize(data: Dict[str, Any]):
+    """从已解析的响应字典中取出第一个候选的内容长度和结束原因"""
+    choices = data.get('choices') or []
+    if not choices:
+        return 0, None, False
+    return len(_message_text(data)), choices[0].get('finish_reason'), True
+
+
+class RawCompletion:
+    """保留上游原始字节的chat.completion响应"""
+
+    __slots__ = ('body', 'content_length', 'finish_reason', 'has_choices', '_data', 'tokens', 'prompt_tokens',
+                 'score')
+
+    def __init__(self, body: bytes, content_length: int, finish_reason: Optional[str],
+                 has_choices: bool = True, data: Optional[Dict[str, Any]] = None,
+                 tokens: int = 0, prompt_tokens: int = 0):
+        """
+        Args:
+            body: 要发给客户端的JSON字节
+            content_length: 第一个候选的内容字符数
+            finish_reason: 第一个候选的结束原因
+            has_choices: 响应中是否包含候选
+            data: 已解析的字典（如果有），避免重复解析
+            tokens: 第一个候选内容的token数（上游报告的或本地估算的）
+            prompt_tokens: 上游报告的提示词token数，未报告时为0
+        """
+        self.body = body
+        self.content_length = content_length
+        self.finish_reason = finish_reason
+        self.has_choices = has_choices
+        self._data = data
+        self.tokens = tokens
+        self.prompt_tokens = prompt_tokens
+        # 接收时已增量打分的结果（candidate_scoring.CandidateScore），否则在选择时再打分
+        self.score = None
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], calibrate: bool = True) -> 'RawCompletion':
+        """
+        由已解析（或本地重建）的响应字典构造，只编码一次
+
+        Args:
+            calibrate: usage 来自上游时用它校准本地估算；本地估算填入的 usage 应传 False
+        """
+        body = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        prompt_tokens, tokens = _usage_tokens(data, calibrate)
+        return cls(body, *_summarize(data), data, tokens=tokens, prompt_tokens=prompt_tokens)
+
+    def json(self) -> Dict[str, Any]:
+        """按需完整解析（伪流式输出等确实需要完整内容时才调用）"""
+        if self._data is None:
+            self._data = json.loads(self.body)
+        return self._data
+
+    def content(self) -> str:
+        return _message_text(self.json())
+
+    def __repr__(self) -> str:
+        return (f"RawCompletion(bytes={len(self.body)}, content_length={self.content_length}, "
+                f"tokens={self.tokens}, finish_reason={self.finish_reason!r})")
+
+
+def scan_completion(body: bytes) -> Optional[RawCompletion]:
+    """
+    局部解析上游返回的JSON响应
+
+    只定位第一个候选的 content 字符串、finish_reason 和 usage 中的token数，原始字节保留用于转发；
+    结构不符合预期时退回完整解析
+
+    Returns:
+        RawCompletion，无法解析为JSON时返回None
+    """
+    try:
+        text = body.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+
+    choices_match = _CHOICES_RE.search(text)
+    if choices_match:
+        content_match = _CONTENT_RE.search(text, choices_match.end())
+        if content_match:
+            try:
+                content, content_end = _decoder.raw_decode(text, content_match.end())
+            except ValueError:
+                content, content_end = False, 0
+            if content is None or isinstance(content, str):
+                finish_match = _FINISH_REASON_RE.search(text, choices_match.end())
+                finish_reason = finish_match.group(1) if finish_match else None
+                # usage 在候选之后，从内容字符串结束处开始找，避免匹配到内容里的文字
+                numbers = [pattern.search(text, content_end) for pattern in
+                           (_PROMPT_TOKENS_RE, _COMPLETION_TOKENS_RE, _REASONING_TOKENS_RE)]
+                prompt_tokens, completion_tokens, reasoning_tokens = [
+                    int(match.group(1)) if match else 0 for match in numbers
+                ]
+                tokens = _count_tokens(content or '', completion_tokens, reasoning_tokens)
+                return RawCompletion(body, len(content or ''), finish_reason,
+                                     tokens=tokens, prompt_tokens=prompt_tokens)
+
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    prompt_tokens, tokens = _usage_tokens(data)
+    return RawCompletion(body, *_summarize(data), data, tokens=tokens, prompt_tokens=prompt_tokens)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+流量回放工具
+按录制时的时间间隔（可加速）把 traffic_recorder 录制的请求重新发送给代理，
+统计延迟和上游调用次数，并可与另一个版本的回放结果对比
+
+用法:
+    python replay.py traffic/traffic.jsonl --target http://127.0.0.1:8080 --api-key 123 --speed 4 --output new.json
+    python replay.py traffic/traffic.jsonl --api-key 123 --baseline old.json
+"""
+
+import argparse
+import asyncio
+import glob
+import json
+import sys
+import time
+from typing import Dict, Any, List, Optional
+
+import httpx
+
+
+def load_entries(patterns: List[str], limit: int = 0) -> List[Dict[str, Any]]:
+    """读取录制文件（支持通配符，按时间排序）"""
+    entries = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entries.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue
+    entries.sort(key=lambda entry: entry.get('ts', 0))
+    return entries[:limit] if limit else entries
+
+
+def build_body(entry: Dict[str, Any]) -> Dict[str, Any]:
+    """优先使用录制的请求体；只有摘要时构造同等规模的确定性请求"""
+    if entry.get('body'):
+        return entry['body']
+
+    summary = entry.get('request') or {}
+    count = max(1, summary.get('messages') or 1)
+    chars = max(1, summary.get('prompt_chars') or 1)
+    per_message = max(1, chars // count)
+    messages = []
+    for index in range(count):
+        # 最后一条必须是用户消息
+        role = 'user' if (count - index) % 2 == 1 else 'assistant'
+        messages.append({'role': role, 'content': '回' * per_message})
+
+    body = {
+        'model': summary.get('model') or 'gemini-2.5-flash',
+        'messages': messages,
+        'stream': bool(summary.get('stream')),
+    }
+    if summary.get('max_tokens'):
+        body['max_tokens'] = summary['max_tokens']
+    return body
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * fraction))], 1)
+
+
+async def fetch_upstream_calls(client: httpx.AsyncClient, target: str, admin_key: str) -> Optional[int]:
+    """从代理的 /stats 读取所有租户累计的上游调用次数（需要管理密钥，未提供时不统计）"""
+    if not admin_key:
+        return None
+    try:
+        response = await client.get(f"{target}/stats", timeout=5,
+                                    headers={"Authorization": f"Bearer {admin_key}"})
+        if response.status_code != 200:
+            return None
+        tenants = response.json().get('tenants', {})
+        return sum(tenant.get('usage', {}).get('upstream_calls', 0) for tenant in tenants.values())
+    except (httpx.HTTPError, ValueError, AttributeError):
+        return None
+
+
+async def replay_one(client: httpx.AsyncClient, target: str, api_key: str, body: Dict[str, Any],
+                     timeout: float) -> Dict[str, Any]:
+    """发送一个请求并测量总耗时和首字节耗时"""
+    begin = time.perf_counter()
+    first_byte_ms = None
+    size = 0
+    try:
+        async with client.stream("POST", f"{target}/v1/chat/completions", json=body, timeout=timeout,
+                                 headers={"Authorization": f"Bearer {api_key}"}) as response:
+            async for chunk in response.aiter_raw():
+                if first_byte_ms is None:
+                    first_byte_ms = (time.perf_counter() - begin) * 1000
+                size += len(chunk)
+            status = response.status_code
+    except httpx.HTTPError as e:
+        status = f"error: {type(e).__name__}"
+    return {
+        'status': status,
+        'latency_ms': round((time.perf_counter() - begin) * 1000, 1),
+        'first_byte_ms': round(first_byte_ms, 1) if first_byte_ms is not None else None,
+        'bytes': size,
+    }
+
+
+async def replay(entries: List[Dict[str, Any]], target: str, api_key: str, speed: float,
+                 timeout: float, admin_key: str = '') -> Dict[str, Any]:
+    """
+    按录制的时间间隔回放
+
+    Args:
+        speed: 回放倍速，1为原速，0为不等待（尽快发送全部请求）
+        admin_key: 代理的管理密钥，用于读取 /stats 中的上游调用次数
+    """
+    if not entries:
+        return {'requests': 0}
+
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=None)) as client:
+        calls_before = await fetch_upstream_calls(client, target, admin_key)
+        first_ts = entries[0].get('ts', 0)
+        start = time.perf_counter()
+
+        async def scheduled(entry):
+            if speed > 0:
+                delay = (entry.get('ts', first_ts) - first_ts) / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            return await replay_one(client, target, api_key, build_body(entry), timeout)
+
+        results = await asyncio.gather(*(scheduled(entry) for entry in entries))
+        wall_seconds = time.perf_counter() - start
+        calls_after = await fetch_upstream_calls(client, target, admin_key)
+
+    latencies = [result['latency_ms'] for result in results if result['status'] == 200]
+    first_bytes = [result['first_byte_ms'] for result in results
+                   if result['status'] == 200 and result['first_byte_ms'] is not None]
+    status_counts: Dict[str, int] = {}
+    for result in results:
+        status_counts[str(result['status'])] = status_counts.get(str(result['status']), 0) + 1
+
+    upstream_calls = None
+    if calls_before is not None and calls_after is not None:
+        upstream_calls = calls_after - calls_before
+    recorded_calls = sum(entry.get('upstream_calls', 0) for entry in entries)
+    recorded_latencies = [entry['latency_ms'] for entry in entries
+                          if entry.get('status') == 200 and entry.get('latency_ms') is not None]
+
+    return {
+        'requests': len(results),
+        'ok': len(latencies),
+        'status_counts': status_counts,
+        'wall_seconds': round(wall_seconds, 2),
+        'latency_mean_ms': round(sum(latencies) / len(latencies), 1) if latencies else None,
+        'latency_p50_ms': percentile(latencies, 0.50),
+        'latency_p95_ms': percentile(latencies, 0.95),
+        'latency_p99_ms': percentile(latencies, 0.99),
+        'latency_max_ms': max(latencies) if latencies else None,
+        'first_byte_p50_ms': percentile(first_bytes, 0.50),
+        'first_byte_p95_ms': percentile(first_bytes, 0.95),
+        'upstream_calls': upstream_calls,
+        'upstream_calls_per_request': round(upstream_calls / len(results), 2) if upstream_calls is not None else None,
+        'recorded_upstream_calls_per_request': round(recorded_calls / len(entries), 2),
+        'recorded_latency_p50_ms': percentile(recorded_latencies, 0.50),
+        'recorded_latency_p95_ms': percentile(recorded_latencies, 0.95),
+    }
+
+
+# 对比时展示的指标
+COMPARE_METRICS = [
+    'ok', 'wall_seconds', 'latency_mean_ms', 'latency_p50_ms', 'latency_p95_ms', 'latency_p99_ms',
+    'first_byte_p50_ms', 'first_byte_p95_ms', 'upstream_calls', 'upstream_calls_per_request',
+]
+
+
+def print_comparison(baseline: Dict[str, Any], current: Dict[str, Any]):
+    print(f"{'指标':<28}{'基线':>12}{'本次':>12}{'变化':>10}")
+    for metric in COMPARE_METRICS:
+        old, new = baseline.get(metric), current.get(metric)
+        change = ""
+        if isinstance(old, (int, float)) and isinstance(new, (int, float)) and old:
+            change = f"{(new - old) / old * 100:+.1f}%"
+        print(f"{metric:<28}{str(old):>12}{str(new):>12}{change:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="回放录制的流量并统计延迟和上游调用次数")
+    parser.add_argument('files', nargs='+', help="录制文件，支持通配符（如 'traffic/traffic.jsonl*'）")
+    parser.add_argument('--target', default='http://127.0.0.1:8080', help="代理地址")
+    parser.add_argument('--api-key', required=True, help="代理的访问密钥")
+    parser.add_argument('--admin-key', default='', help="代理的管理密钥，提供时统计回放期间的上游调用次数")
+    parser.add_argument('--speed', type=float, default=1.0, help="回放倍速，0 表示不等待")
+    parser.add_argument('--limit', type=int, default=0, help="最多回放的请求数")
+    parser.add_argument('--timeout', type=float, default=120.0, help="单个请求的超时时间（秒）")
+    parser.add_argument('--output', help="把统计结果写入JSON文件，供之后对比")
+    parser.add_argument('--baseline', help="与之前保存的统计结果对比")
+    args = parser.parse_args()
+
+    entries = load_entries(args.files, args.limit)
+    if not entries:
+        print("没有可回放的记录")
+        sys.exit(1)
+
+    print(f"回放 {len(entries)} 个请求到 {args.target} (倍速: {args.speed or '不等待'})")
+    summary = asyncio.run(replay(entries, args.target.rstrip('/'), args.api_key, args.speed, args.timeout,
+                                 args.admin_key))
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"统计结果已保存到 {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            print_comparison(json.load(f), summary)
+
+
+if __name__ == "__main__":
+    main()
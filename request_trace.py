@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+请求追踪模块
+为每个客户端请求保存一份追踪记录（通过 contextvars 传递，并发任务中同样可见），
+记录各阶段耗时、各密钥的上游请求结果和最终选中的响应。
+响应头中返回 Server-Timing 和 X-Proxy-Request-Id，最近的请求时间线保存在内存中供排查
+"""
+
+import time
+import asyncio
+import uuid
+import logging
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Any, List, Optional, Iterable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+def key_hint(api_key: str) -> str:
+    """密钥脱敏，只保留末4位"""
+    return f"***{api_key[-4:]}"
+
+
+def _result_summary(result) -> Dict[str, Any]:
+    """取出上游结果的内容长度和结束原因（兼容 RawCompletion 和响应字典）"""
+    if hasattr(result, 'content_length'):
+        return {'content_length': result.content_length, 'finish_reason': result.finish_reason}
+    choices = (result.get('choices') if isinstance(result, dict) else None) or [{}]
+    content = choices[0].get('message', {}).get('content') or ''
+    return {'content_length': len(content), 'finish_reason': choices[0].get('finish_reason')}
+
+
+# httpcore 追踪事件 -> 记录到上游请求条目中的字段
+_UPSTREAM_EVENTS = {
+    'connection.connect_tcp.complete': 'connect_ms',
+    'connection.start_tls.complete': 'tls_ms',
+    'http11.receive_response_headers.complete': 'ttfb_ms',
+    'http2.receive_response_headers.complete': 'ttfb_ms',
+}
+
+
+class RequestTrace:
+    """单个客户端请求的追踪记录"""
+
+    def __init__(self, path: str = ""):
+        self.request_id = uuid.uuid4().hex[:16]
+        self.path = path
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.tenant: Optional[str] = None
+        self.status: Optional[int] = None
+        self.total_ms: Optional[float] = None
+        self.spans: List[Dict[str, Any]] = []
+        self.upstream: List[Dict[str, Any]] = []
+        self.winner: Optional[str] = None
+        self.winner_ms: Optional[float] = None
+        # 上游结果对象 -> upstream 列表下标，用于标记获胜的密钥
+        self._results: Dict[int, int] = {}
+
+    def elapsed_ms(self) -> float:
+        return round((time.perf_counter() - self.start) * 1000, 1)
+
+    def add_span(self, name: str, begin: float, end: Optional[float] = None):
+        """
+        记录一个阶段
+
+        Args:
+            name: 阶段名称
+            begin: 开始时间（time.perf_counter()）
+            end: 结束时间，默认为现在
+        """
+        end = end if end is not None else time.perf_counter()
+        self.spans.append({
+            'name': name,
+            'start_ms': round((begin - self.start) * 1000, 1),
+            'dur_ms': round((end - begin) * 1000, 1),
+        })
+
+    def finish(self):
+        if self.total_ms is None:
+            self.total_ms = self.elapsed_ms()
+
+    def server_timing(self) -> str:
+        """生成 Server-Timing 响应头（只包含发送响应头之前已结束的阶段）"""
+        parts = [f"{span['name']};dur={span['dur_ms']}" for span in self.spans]
+        parts.append(f"total;dur={self.elapsed_ms()}")
+        return ', '.join(parts)
+
+    async def track_upstream(self, api_key: str, coro):
+        """
+        等待单个上游请求并记录其耗时和结果
+
+        Args:
+            api_key: 使用的密钥（只记录脱敏后的末4位）
+            coro: 上游请求协程，返回 RawCompletion、响应字典或 None
+        """
+        entry = {'key': key_hint(api_key), 'start_ms': self.elapsed_ms()}
+        index = len(self.upstream)
+        self.upstream.append(entry)
+        # 每路请求运行在各自的任务中，这里设置的值只对本路可见
+        _current_leg.set(entry)
+        begin = time.perf_counter()
+        try:
+            result = await coro
+        except asyncio.CancelledError:
+            entry['outcome'] = 'cancelled'
+            raise
+        except Exception:
+            entry['outcome'] = 'error'
+            raise
+        finally:
+            entry['latency_ms'] = round((time.perf_counter() - begin) * 1000, 1)
+        if result is None:
+            entry['outcome'] = 'failed'
+        else:
+            entry['outcome'] = 'ok'
+            entry.update(_result_summary(result))
+            self._results[id(result)] = index
+        return result
+
+    def mark_winner(self, result):
+        """标记被选中返回给客户端的上游结果"""
+        index = self._results.get(id(result))
+        if index is not None:
+            self.upstream[index]['outcome'] = 'winner'
+            self.winner = self.upstream[index]['key']
+            self.winner_ms = self.elapsed_ms()
+            entry = self.upstream[index]
+            if 'ttfb_ms' in entry:
+                self.spans.append({'name': 'winner_ttfb', 'start_ms': entry['start_ms'], 'dur_ms': entry['ttfb_ms']})
+
+    def to_dict(self) -> Dict[str, Any]:
+        # 选出获胜者时仍未完成的请求随即被取消，取消的收尾可能还没执行
+        for entry in self.upstream:
+            if 'outcome' not in entry:
+                entry['outcome'] = 'cancelled' if self.winner else 'pending'
+                if self.winner_ms is not None:
+                    entry['latency_ms'] = round(self.winner_ms - entry['start_ms'], 1)
+        return dict(self.summary(), spans=self.spans, upstream=self.upstream)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            'id': self.request_id,
+            'ts': round(self.started_at, 3),
+            'path': self.path,
+            'tenant': self.tenant,
+            'status': self.status,
+            'total_ms': self.total_ms,
+            'upstream_calls': len(self.upstream),
+            'winner': self.winner,
+        }
+
+
+_current_trace: contextvars.ContextVar = contextvars.ContextVar('request_trace', default=None)
+_current_leg: contextvars.ContextVar = contextvars.ContextVar('upstream_leg', default=None)
+
+
+def start_trace(path: str = "") -> RequestTrace:
+    """为当前请求创建追踪记录"""
+    trace = RequestTrace(path)
+    _current_trace.set(trace)
+    return trace
+
+
+def get_trace() -> Optional[RequestTrace]:
+    """获取当前请求的追踪记录，未启用追踪时返回None"""
+    return _current_trace.get()
+
+
+@contextmanager
+def span(name: str):
+    """记录一段代码的耗时；没有追踪记录时什么也不做"""
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_span(name, begin)
+
+
+def add_span(name: str, begin: float, end: Optional[float] = None):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_span(name, begin, end)
+
+
+async def track_upstream(api_key: str, coro):
+    """在当前请求的追踪记录中记录一个上游请求；没有追踪记录时直接等待"""
+    trace = _current_trace.get()
+    if trace is None:
+        return await coro
+    return await trace.track_upstream(api_key, coro)
+
+
+def mark_winner(result):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.mark_winner(result)
+
+
+def note_upstream(**fields):
+    """在当前这一路上游请求的条目中补充信息（状态码、字节数等）"""
+    entry = _current_leg.get()
+    if entry is not None:
+        entry.update(fields)
+
+
+def upstream_extensions() -> Dict[str, Any]:
+    """
+    返回传给 httpx 请求的 extensions，记录这一路请求的建连、TLS握手和首字节耗时
+    """
+    entry = _current_leg.get()
+    if entry is None:
+        return {}
+    begin = time.perf_counter()
+
+    async def trace(event_name: str, info: dict):
+        field = _UPSTREAM_EVENTS.get(event_name)
+        if field:
+            entry[field] = round((time.perf_counter() - begin) * 1000, 1)
+
+    return {'trace': trace}
+
+
+class TraceStore:
+    """保存最近N个请求时间线的内存存储"""
+
+    def __init__(self, max_entries: int = 200):
+        self.max_entries = max_entries
+        self._traces: "OrderedDict[str, RequestTrace]" = OrderedDict()
+
+    def add(self, trace: RequestTrace):
+        self._traces[trace.request_id] = trace
+        while len(self._traces) > self.max_entries:
+            self._traces.popitem(last=False)
+
+    def get(self, request_id: str) -> Optional[Dict[str, Any]]:
+        trace = self._traces.get(request_id)
+        return trace.to_dict() if trace is not None else None
+
+    def list(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """最近的请求摘要，最新的在前"""
+        traces = list(self._traces.values())[-limit:]
+        return [trace.summary() for trace in reversed(traces)]
+
+
+class RequestTraceMiddleware:
+    """为指定路径的请求创建追踪记录并添加计时响应头的ASGI中间件"""
+
+    def __init__(self, app, store: TraceStore, paths: Iterable[str] = ('/v1/chat/completions',),
+                 observers: Iterable[Callable[[RequestTrace], None]] = ()):
+        """
+        Args:
+            observers: 请求结束后依次以追踪记录调用的函数（如实时指标汇总）
+        """
+        self.app = app
+        self.store = store
+        self.paths = tuple(paths)
+        self.observers = tuple(observers)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].startswith(self.paths):
+            await self.app(scope, receive, send)
+            return
+
+        trace = start_trace(scope['path'])
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                trace.status = message['status']
+                headers = list(message.get('headers', []))
+                headers.append((b'server-timing', trace.server_timing().encode('latin-1')))
+                headers.append((b'x-proxy-request-id', trace.request_id.encode('latin-1')))
+                message = dict(message, headers=headers)
+            elif message['type'] == 'http.response.body' and not message.get('more_body', False):
+                trace.finish()
+            await send(message)
+
+        self.store.add(trace)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            trace.finish()
+            for observer in self.observers:
+                try:
+                    observer(trace)
+                except Exception as e:
+                    logger.warning(f"请求追踪观察者出错: {e}")
+
+
+# 全局请求时间线存储
+trace_store = TraceStore()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+API服务生命周期管理模块
+在后台线程中运行受管理的 uvicorn.Server，支持真正的启动、优雅停止和重启：
+停止时先关闭监听端口，进行中的请求在期限内处理完，超过期限才强制断开
+"""
+
+import time
+import threading
+import logging
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ManagedServer:
+    """可在进程内启动、停止和重启的API服务"""
+
+    def __init__(self, app, drain_timeout: float = 30.0, startup_timeout: float = 10.0, log_level: str = "info"):
+        """
+        Args:
+            app: ASGI应用
+            drain_timeout: 停止时等待进行中的请求完成的最长秒数
+            startup_timeout: 启动时等待端口开始监听的最长秒数
+            log_level: uvicorn 日志级别
+        """
+        self.app = app
+        self.drain_timeout = drain_timeout
+        self.startup_timeout = startup_timeout
+        self.log_level = log_level
+
+        self._lock = threading.RLock()
+        self._server = None
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[str] = None
+        self.host: Optional[str] = None
+        self.port: Optional[int] = None
+        self.started_at: Optional[float] = None
+        self.stats = {'starts': 0, 'stops': 0, 'forced_stops': 0}
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive() and not self._server.should_exit
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}" if self.host else ""
+
+    def _run(self, server):
+        try:
+            server.run()
+        except BaseException as e:
+            # 端口被占用等启动错误时 uvicorn 会调用 sys.exit，在后台线程中表现为 SystemExit
+            self._error = f"{type(e).__name__}: {e}"
+            logger.error(f"API服务运行错误: {self._error}")
+
+    def start(self, host: str, port: int):
+        """
+        启动服务并等待端口开始监听
+
+        Raises:
+            RuntimeError: 服务已在运行，或在启动期限内未能开始监听
+        """
+        import uvicorn
+
+        with self._lock:
+            if self.is_running:
+                raise RuntimeError("服务器已在运行中")
+
+            config = uvicorn.Config(
+                self.app, host=host, port=port, log_level=self.log_level,
+                timeout_graceful_shutdown=self.drain_timeout
+            )
+            server = uvicorn.Server(config)
+            self._error = None
+            thread = threading.Thread(target=self._run, args=(server,), name="api-server", daemon=True)
+            thread.start()
+
+            deadline = time.monotonic() + self.startup_timeout
+            while not server.started:
+                if not thread.is_alive() or time.monotonic() > deadline:
+                    server.should_exit = True
+                    thread.join(timeout=1)
+                    raise RuntimeError(self._error or f"API服务未能在{self.startup_timeout}秒内启动")
+                time.sleep(0.05)
+
+            self._server, self._thread = server, thread
+            self.host, self.port = host, port
+            self.started_at = time.time()
+            self.stats['starts'] += 1
+            logger.info(f"API服务已启动: {self.url}")
+
+    def stop(self, drain_timeout: Optional[float] = None) -> bool:
+        """
+        优雅停止服务：立即停止接受新连接，等待进行中的请求完成
+
+        Args:
+            drain_timeout: 本次停止等待的最长秒数，默认使用构造时的设置
+
+        Returns:
+            是否在期限内处理完所有请求；超过期限的连接会被强制断开
+        """
+        with self._lock:
+            if self._thread is None:
+                return True
+            timeout = self.drain_timeout if drain_timeout is None else drain_timeout
+            server, thread = self._server, self._thread
+
+            server.should_exit = True
+            # uvicorn 自身也会在 timeout_graceful_shutdown 后取消剩余任务，这里多留一点余量
+            thread.join(timeout=timeout + 2)
+            drained = not thread.is_alive()
+            if not drained:
+                logger.warning(f"API服务未能在{timeout}秒内处理完进行中的请求，强制停止")
+                server.force_exit = True
+                thread.join(timeout=5)
+                self.stats['forced_stops'] += 1
+
+            self._server = None
+            self._thread = None
+            self.started_at = None
+            self.stats['stops'] += 1
+            logger.info("API服务已停止")
+            return drained
+
+    def restart(self, host: str, port: int, drain_timeout: Optional[float] = None) -> bool:
+        """停止后在新地址上重新启动，返回停止时是否处理完所有请求"""
+        with self._lock:
+            drained = self.stop(drain_timeout)
+            self.start(host, port)
+            return drained
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取运行状态"""
+        server = self._server
+        return dict(
+            self.stats,
+            running=self.is_running,
+            url=self.url if self.is_running else "",
+            uptime=round(time.time() - self.started_at, 1) if self.started_at else 0,
+            connections=len(server.server_state.connections) if server is not None else 0,
+            last_error=self._error,
+        )
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+零停机重启模块
+新进程以 SO_REUSEPORT 绑定同一端口（或直接继承守护进程传入的监听套接字），开始监听后通知旧进程退出；
+旧进程收到 SIGTERM 后不再接受新连接，在期限内处理完进行中的流式响应和并发扇出后退出。
+
+用法:
+    python llm_proxy.py --replace      # 替换正在运行的 llm_proxy.py
+    python app.py cli --replace        # 替换正在运行的 app.py 命令行服务
+
+套接字继承遵循 systemd 的约定：环境变量 LISTEN_FDS / LISTEN_PID，监听套接字从文件描述符3开始
+"""
+
+import os
+import sys
+import time
+import signal
+import socket
+import logging
+import tempfile
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# 继承的第一个监听套接字的文件描述符（systemd 约定）
+LISTEN_FDS_START = 3
+
+REUSEPORT_AVAILABLE = hasattr(socket, 'SO_REUSEPORT')
+
+
+def default_pid_file(port: int) -> str:
+    """按端口区分的PID文件，不同入口（llm_proxy.py / app.py cli）在同一端口上可以互相替换"""
+    return os.path.join(tempfile.gettempdir(), f"llm_proxy_{port}.pid")
+
+
+def read_pid(pid_file: str) -> Optional[int]:
+    """读取PID文件，对应进程已不存在时返回None"""
+    try:
+        with open(pid_file, 'r', encoding='utf-8') as f:
+            pid = int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+    if pid == os.getpid() or not _process_alive(pid):
+        return None
+    return pid
+
+
+def _process_alive(pid: int) -> bool:
+    if os.name == 'nt':
+        # Windows 上 os.kill(pid, 0) 会向进程发送 CTRL_C_EVENT，不能用来探测
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def write_pid(pid_file: str):
+    with open(pid_file, 'w', encoding='utf-8') as f:
+        f.write(str(os.getpid()))
+
+
+def remove_pid(pid_file: str):
+    """只删除仍记录着本进程PID的文件，避免删掉接替者写入的PID"""
+    try:
+        with open(pid_file, 'r', encoding='utf-8') as f:
+            if f.read().strip() != str(os.getpid()):
+                return
+        os.remove(pid_file)
+    except OSError:
+        pass
+
+
+def inherited_socket() -> Optional[socket.socket]:
+    """取出守护进程传入的监听套接字，没有时返回None"""
+    if os.environ.get('LISTEN_PID') not in (None, str(os.getpid())):
+        return None
+    try:
+        count = int(os.environ.get('LISTEN_FDS', '0'))
+    except ValueError:
+        return None
+    if count < 1:
+        return None
+    if count > 1:
+        logger.warning(f"收到{count}个监听套接字，只使用第一个")
+    # 只交给本进程一次，本进程再启动的子进程不应重复继承
+    for name in ('LISTEN_FDS', 'LISTEN_PID', 'LISTEN_FDNAMES'):
+        os.environ.pop(name, None)
+    return socket.socket(fileno=LISTEN_FDS_START)
+
+
+def create_listen_socket(host: str, port: int, reuse_port: bool = True) -> socket.socket:
+    """
+    创建并绑定监听套接字
+
+    Args:
+        reuse_port: 设置 SO_REUSEPORT，允许新旧进程同时监听同一端口（平台不支持时忽略）
+    """
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    if os.name != 'nt':
+        # Windows 上 SO_REUSEADDR 允许其他进程抢占同一端口，不能设置
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port and REUSEPORT_AVAILABLE:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _stop_and_bind(old_pid: int, host: str, port: int, timeout: float) -> socket.socket:
+    """无法与旧进程同时监听时，先让旧进程处理完请求退出再绑定，期间会短暂拒绝新连接"""
+    os.kill(old_pid, signal.SIGTERM)
+    deadline = time.monotonic() + timeout
+    while _process_alive(old_pid) and time.monotonic() < deadline:
+        time.sleep(0.2)
+    return create_listen_socket(host, port, reuse_port=True)
+
+
+def serve(app, host: str, port: int, drain_timeout: float = 30.0, replace: bool = False,
+          reuse_port: bool = True, pid_file: Optional[str] = None, log_level: str = "info"):
+    """
+    运行API服务，支持零停机替换旧进程
+
+    Args:
+        app: ASGI应用
+        drain_timeout: 收到 SIGTERM 后等待进行中的请求完成的最长秒数
+        replace: 替换PID文件中记录的旧进程；为False且旧进程仍在运行时拒绝启动
+        reuse_port: 使用 SO_REUSEPORT 监听，后续才能被新进程无缝替换
+        pid_file: PID文件路径，默认按端口放在临时目录
+    """
+    import uvicorn
+
+    pid_file = pid_file or default_pid_file(port)
+    old_pid = read_pid(pid_file)
+    if old_pid is not None and not replace:
+        print(f"错误：端口 {port} 上已有服务在运行 (PID {old_pid})。")
+        print("如需无缝替换它，请加上 --replace 参数。")
+        sys.exit(1)
+
+    sock = inherited_socket()
+    if sock is not None:
+        logger.info(f"使用继承的监听套接字: {sock.getsockname()}")
+    elif old_pid is not None and not (reuse_port and REUSEPORT_AVAILABLE):
+        logger.warning("当前平台不支持 SO_REUSEPORT，将等待旧进程退出后再监听")
+        sock = _stop_and_bind(old_pid, host, port, drain_timeout + 5)
+        old_pid = None
+    else:
+        try:
+            sock = create_listen_socket(host, port, reuse_port=reuse_port)
+        except OSError as e:
+            if old_pid is None:
+                raise
+            # 旧进程监听时没有设置 SO_REUSEPORT（如升级前的版本）
+            logger.warning(f"无法与旧进程同时监听 ({e})，将等待旧进程退出后再监听")
+            sock = _stop_and_bind(old_pid, host, port, drain_timeout + 5)
+            old_pid = None
+
+    class HandoffServer(uvicorn.Server):
+        """开始监听后再通知旧进程退出，保证端口上始终有进程在接受连接"""
+
+        async def startup(self, sockets=None):
+            await super().startup(sockets=sockets)
+            if not self.started:
+                return
+            write_pid(pid_file)
+            if old_pid is not None:
+                logger.info(f"新进程已开始监听，通知旧进程 (PID {old_pid}) 处理完进行中的请求后退出")
+                try:
+                    os.kill(old_pid, signal.SIGTERM)
+                except OSError as e:
+                    logger.warning(f"通知旧进程失败: {e}")
+
+    config = uvicorn.Config(app, log_level=log_level, timeout_graceful_shutdown=drain_timeout)
+    server = HandoffServer(config)
+    try:
+        server.run(sockets=[sock])
+    finally:
+        remove_pid(pid_file)
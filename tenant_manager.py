@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多租户代理密钥管理模块
+每个租户拥有独立的代理密钥、RPM/并发限制和上游容量权重，
+租户表保存在JSON文件中，修改后无需重启即可生效
+"""
+
+import os
+import json
+import time
+import hmac
+import hashlib
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, Any, List, Optional
+
+from admission_control import AdmissionRejected
+
+logger = logging.getLogger(__name__)
+
+
+def hash_key(key: str) -> bytes:
+    """计算代理密钥的摘要，索引和比较都只使用摘要"""
+    return hashlib.sha256(key.encode('utf-8')).digest()
+
+
+class Tenant:
+    """单个租户的限制配置与用量统计"""
+
+    def __init__(self, name: str, key: str, rpm: int = 0, max_concurrency: int = 0, weight: float = 1.0):
+        """
+        Args:
+            name: 租户名称
+            key: 租户使用的代理密钥
+            rpm: 每分钟请求数上限，0表示不限制
+            max_concurrency: 同时处理的请求数上限，0表示不限制
+            weight: 在上游容量中的公平份额权重
+        """
+        self.name = name
+        self.key_digest = hash_key(key)
+        self.key_hint = key[-4:] if len(key) >= 12 else ''
+        self.rpm = rpm
+        self.max_concurrency = max_concurrency
+        self.weight = weight if weight > 0 else 1.0
+
+        self.active = 0
+        self.recent_requests = deque()
+        self.usage = {
+            'requests': 0,
+            'rejected_rate': 0,
+            'rejected_concurrency': 0,
+            'upstream_calls': 0,
+            'successful': 0,
+            'failed': 0,
+            'response_chars': 0,
+        }
+
+    def update_limits(self, other: 'Tenant'):
+        """重新加载时只更新限制配置，保留运行状态和用量统计"""
+        self.key_digest = other.key_digest
+        self.key_hint = other.key_hint
+        self.rpm = other.rpm
+        self.max_concurrency = other.max_concurrency
+        self.weight = other.weight
+
+
+class TenantManager:
+    """租户表管理器"""
+
+    # 检查租户文件是否变化的最小间隔（秒）
+    RELOAD_CHECK_INTERVAL = 2.0
+
+    def __init__(self, tenants_file: str = "tenants.json", default_api_key: str = ""):
+        """
+        初始化租户管理器
+
+        Args:
+            tenants_file: 租户表文件路径
+            default_api_key: 租户表不存在时使用的共享代理密钥
+        """
+        self.tenants_file = tenants_file
+        self.default_api_key = default_api_key
+        self._tenants: Dict[str, Tenant] = {}
+        self._index: Dict[bytes, Tenant] = {}
+        self._mtime = None
+        self._last_check = 0.0
+        self.load_tenants()
+
+    def load_tenants(self):
+        """加载租户表，文件不存在时退化为单一默认租户；文件内容无效时保留上一次成功加载的租户表"""
+        loaded = []
+        mtime = None
+        if os.path.exists(self.tenants_file):
+            try:
+                mtime = os.path.getmtime(self.tenants_file)
+                with open(self.tenants_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                loaded = self._parse_tenants(data)
+            except (OSError, ValueError, TypeError, AttributeError) as e:
+                logger.error(f"加载租户表失败，继续使用当前租户表: {e}")
+                # 记录本次的修改时间，文件再次修改后才重新尝试，避免每次检查都重复报错
+                self._mtime = mtime
+                return
+        if not loaded and self.default_api_key:
+            loaded.append(Tenant(name='default', key=self.default_api_key))
+
+        tenants = {}
+        for tenant in loaded:
+            existing = self._tenants.get(tenant.name)
+            if existing:
+                existing.update_limits(tenant)
+                tenant = existing
+            tenants[tenant.name] = tenant
+
+        self._tenants = tenants
+        self._index = {tenant.key_digest: tenant for tenant in tenants.values()}
+        self._mtime = mtime
+        logger.info(f"已加载 {len(tenants)} 个租户")
+
+    @staticmethod
+    def _parse_tenants(data: Any) -> List[Tenant]:
+        """
+        校验并解析租户表内容，结构错误时抛出 ValueError。
+        缺少name或key的条目被忽略；名称或密钥重复的条目只保留第一个
+        """
+        if not isinstance(data, dict) or not isinstance(data.get('tenants', []), list):
+            raise ValueError("租户表应为 {\"tenants\": [...]} 格式的JSON对象")
+        loaded = []
+        names = set()
+        digests = set()
+        for position, item in enumerate(data.get('tenants', [])):
+            if not isinstance(item, dict):
+                raise ValueError(f"第 {position + 1} 个租户配置不是JSON对象")
+            name, key = item.get('name'), item.get('key')
+            if not key or not name:
+                logger.warning(f"忽略缺少name或key的租户配置: {name or ''}")
+                continue
+            if not isinstance(name, str) or not isinstance(key, str):
+                raise ValueError(f"第 {position + 1} 个租户配置的name和key必须是字符串")
+            tenant = Tenant(
+                name=name,
+                key=key,
+                rpm=int(item.get('rpm') or 0),
+                max_concurrency=int(item.get('max_concurrency') or 0),
+                weight=float(item.get('weight') or 1.0)
+            )
+            if name in names:
+                logger.warning(f"忽略重复的租户名称: {name}")
+                continue
+            if tenant.key_digest in digests:
+                logger.warning(f"忽略与其他租户密钥重复的租户: {name}")
+                continue
+            names.add(name)
+            digests.add(tenant.key_digest)
+            loaded.append(tenant)
+        return loaded
+
+    def _maybe_reload(self):
+        """租户表文件有变化时自动重新加载"""
+        now = time.monotonic()
+        if now - self._last_check < self.RELOAD_CHECK_INTERVAL:
+            return
+        self._last_check = now
+        try:
+            mtime = os.path.getmtime(self.tenants_file)
+        except OSError:
+            mtime = None
+        if mtime != self._mtime:
+            self.load_tenants()
+
+    def authenticate(self, provided_key: str) -> Optional[Tenant]:
+        """根据代理密钥查找租户，找不到时返回None"""
+        self._maybe_reload()
+        digest = hash_key(provided_key)
+        tenant = self._index.get(digest)
+        if tenant is None or not hmac.compare_digest(digest, tenant.key_digest):
+            return None
+        return tenant
+
+    def check_rate(self, tenant: Tenant):
+        """检查租户的每分钟请求数，超出时抛出429"""
+        now = time.monotonic()
+        window = tenant.recent_requests
+        while window and now - window[0] >= 60:
+            window.popleft()
+        if tenant.rpm and len(window) >= tenant.rpm:
+            tenant.usage['rejected_rate'] += 1
+            retry_after = max(1, int(60 - (now - window[0]) + 0.999))
+            raise AdmissionRejected(429, f"租户 {tenant.name} 已超过每分钟请求数限制。", retry_after)
+        window.append(now)
+        tenant.usage['requests'] += 1
+
+    @asynccontextmanager
+    async def track(self, tenant: Tenant):
+        """在请求处理期间占用租户的并发名额"""
+        if tenant.max_concurrency and tenant.active >= tenant.max_concurrency:
+            tenant.usage['rejected_concurrency'] += 1
+            raise AdmissionRejected(429, f"租户 {tenant.name} 的并发请求数已达上限。", 1)
+        tenant.active += 1
+        try:
+            yield tenant
+        finally:
+            tenant.active -= 1
+
+    def record_upstream_calls(self, tenant: Tenant, count: int):
+        """记录租户本次请求发起的上游调用数"""
+        tenant.usage['upstream_calls'] += count
+
+    def record_result(self, tenant: Tenant, success: bool, response_chars: int = 0):
+        """记录租户本次请求的结果"""
+        if success:
+            tenant.usage['successful'] += 1
+            tenant.usage['response_chars'] += response_chars
+        else:
+            tenant.usage['failed'] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取所有租户的限制配置与用量（不包含密钥）"""
+        return {
+            name: {
+                'key_hint': f"***{tenant.key_hint}",
+                'rpm': tenant.rpm,
+                'max_concurrency': tenant.max_concurrency,
+                'weight': tenant.weight,
+                'active': tenant.active,
+                'usage': dict(tenant.usage),
+            }
+            for name, tenant in self._tenants.items()
+        }
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+准入控制测试：名额用完后按FIFO排队，队列已满或排队超时时快速拒绝；
+多租户时按权重轮流获得名额，后到的小租户不必排在大批量租户的全部请求之后
+"""
+
+import asyncio
+from typing import List
+
+import pytest
+
+from admission_control import AdmissionController, AdmissionRejected
+from proxy_engine import ProxyEngine
+from tenant_manager import Tenant
+
+REQUEST = {
+    "model": "gemini-2.5-flash",
+    "messages": [{"role": "user", "content": "你好"}],
+}
+
+
+async def settle():
+    """让已创建的任务都运行到各自的等待点"""
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_waiters_are_admitted_in_fifo_order():
+    async def run():
+        admission = AdmissionController(max_inflight=1, max_queue=10)
+        order = []
+
+        async def one(name):
+            async with admission.admit():
+                order.append(name)
+                await asyncio.sleep(0.01)
+
+        tasks = [asyncio.create_task(one(name)) for name in "abcd"]
+        await settle()
+        assert admission.inflight == 1
+        assert admission.queue_depth == 3
+        await asyncio.gather(*tasks)
+        assert order == list("abcd")
+        stats = admission.get_stats()
+        assert stats['admitted'] == 4
+        assert stats['queued'] == 3
+        assert stats['peak_inflight'] == 1
+    asyncio.run(run())
+
+
+def test_full_queue_is_rejected_with_retry_after():
+    async def run():
+        admission = AdmissionController(max_inflight=1, max_queue=1)
+        await admission.acquire()
+        waiter = asyncio.create_task(admission.acquire())
+        await settle()
+        with pytest.raises(AdmissionRejected) as rejected:
+            await admission.acquire()
+        assert rejected.value.status_code == 429
+        assert rejected.value.retry_after >= 1
+        assert admission.get_stats()['rejected_queue_full'] == 1
+
+        admission.release(1)
+        assert await waiter == 1
+    asyncio.run(run())
+
+
+def test_queue_timeout_is_rejected_and_leaves_the_queue():
+    async def run():
+        admission = AdmissionController(max_inflight=1, max_queue=4, queue_timeout=0.05)
+        await admission.acquire()
+        with pytest.raises(AdmissionRejected) as rejected:
+            await admission.acquire()
+        assert rejected.value.status_code == 503
+        assert admission.queue_depth == 0
+        assert admission.get_stats()['rejected_timeout'] == 1
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_does_not_hold_a_slot():
+    async def run():
+        admission = AdmissionController(max_inflight=1, max_queue=4)
+        await admission.acquire()
+        waiter = asyncio.create_task(admission.acquire())
+        await settle()
+        waiter.cancel()
+        await settle()
+        assert admission.queue_depth == 0
+        admission.release(1)
+        assert admission.inflight == 0
+        # 名额没有被已取消的等待者占走
+        assert await admission.acquire() == 1
+    asyncio.run(run())
+
+
+def test_weight_is_capped_at_max_inflight():
+    async def run():
+        admission = AdmissionController(max_inflight=4, max_queue=4)
+        assert await admission.acquire(10) == 4
+        assert admission.inflight == 4
+        admission.release(4)
+        assert admission.inflight == 0
+    asyncio.run(run())
+
+
+def test_reconfigure_admits_queued_waiters():
+    async def run():
+        admission = AdmissionController(max_inflight=1, max_queue=4)
+        await admission.acquire()
+        waiters = [asyncio.create_task(admission.acquire()) for _ in range(2)]
+        await settle()
+        admission.reconfigure(max_inflight=3, max_queue=4, queue_timeout=30)
+        assert await asyncio.gather(*waiters) == [1, 1]
+        assert admission.inflight == 3
+    asyncio.run(run())
+
+
+def test_try_acquire_leaves_headroom_for_interactive_requests():
+    async def run():
+        admission = AdmissionController(max_inflight=4, max_queue=4)
+        assert admission.try_acquire(1, headroom=2) == 1
+        assert admission.try_acquire(1, headroom=2) == 1
+        # 再占一个名额就只剩1个留给交互请求
+        assert admission.try_acquire(1, headroom=2) == 0
+        await admission.acquire(2)
+        waiter = asyncio.create_task(admission.acquire())
+        await settle()
+        # 有请求在排队时批处理不能插队
+        admission.release(1)
+        await settle()
+        assert admission.try_acquire(1) == 0
+        assert await waiter == 1
+    asyncio.run(run())
+
+
+def test_late_tenant_is_served_before_bulk_backlog():
+    async def run():
+        admission = AdmissionController(max_inflight=1, max_queue=64)
+        await admission.acquire(1, "bulk")
+        order = []
+
+        async def one(tenant):
+            granted = await admission.acquire(1, tenant)
+            order.append(tenant)
+            admission.release(granted)
+
+        tasks = [asyncio.create_task(one("bulk")) for _ in range(8)]
+        await settle()
+        tasks.append(asyncio.create_task(one("alice")))
+        await settle()
+        admission.release(1)
+        await asyncio.gather(*tasks)
+        # 按FIFO会排在最后；按虚拟时间只需等待批量租户排在最前的一个请求
+        assert order.index("alice") <= 1
+    asyncio.run(run())
+
+
+def test_idle_tenant_does_not_bank_its_share():
+    async def run():
+        admission = AdmissionController(max_inflight=1, max_queue=64)
+        # a 独占一段时间后 b 才出现：b 不能因为之前空闲而连续获得大量名额
+        for _ in range(20):
+            admission.release(await admission.acquire(1, "a"))
+        await admission.acquire(1, "a")
+        order = []
+
+        async def one(tenant):
+            granted = await admission.acquire(1, tenant)
+            order.append(tenant)
+            admission.release(granted)
+
+        tasks = []
+        for _ in range(6):
+            tasks.append(asyncio.create_task(one("a")))
+            tasks.append(asyncio.create_task(one("b")))
+        await settle()
+        admission.release(1)
+        await asyncio.gather(*tasks)
+        assert order[:6].count("a") >= 2
+    asyncio.run(run())
+
+
+def test_tenant_queue_limit_is_proportional_to_share():
+    async def run():
+        admission = AdmissionController(max_inflight=1, max_queue=8)
+        await admission.acquire(1, "heavy", 3.0)
+        heavy = [asyncio.create_task(admission.acquire(1, "heavy", 3.0)) for _ in range(8)]
+        await settle()
+        # 只有一个租户时可以使用整个队列
+        assert sum(1 for task in heavy if task.done()) == 0
+        assert admission.queue_depth == 8
+        with pytest.raises(AdmissionRejected):
+            await admission.acquire(1, "heavy", 3.0)
+        for task in heavy:
+            task.cancel()
+        await asyncio.gather(*heavy, return_exceptions=True)
+
+        light = [asyncio.create_task(admission.acquire(1, "light", 1.0)) for _ in range(2)]
+        await settle()
+        # 两个租户按 3:1 分配8个排队位置，light 最多2个
+        with pytest.raises(AdmissionRejected):
+            await admission.acquire(1, "light", 1.0)
+        for task in light:
+            task.cancel()
+        await asyncio.gather(*light, return_exceptions=True)
+    asyncio.run(run())
+
+
+async def run_in_order(upstream_url: str, arrivals: List[List[Tenant]], gap: float = 0.01) -> List[str]:
+    """
+    按批次提交请求（批次之间间隔 gap 秒），返回各请求完成的租户顺序。
+    上游名额为1，完成顺序就是获得名额的顺序
+    """
+    admission = AdmissionController(max_inflight=1, max_queue=64, queue_timeout=30)
+    engine = ProxyEngine(base_url=upstream_url, key_groups=[["AIzaLEN0200fair"]], min_response_length=100,
+                         admission=admission)
+    order: List[str] = []
+
+    async def one(tenant: Tenant):
+        await engine.complete(dict(REQUEST), tenant)
+        order.append(tenant.name)
+
+    try:
+        tasks = []
+        for batch in arrivals:
+            tasks += [asyncio.create_task(one(tenant)) for tenant in batch]
+            await asyncio.sleep(gap)
+        await asyncio.gather(*tasks)
+    finally:
+        await engine.aclose()
+    return order
+
+
+def test_engine_does_not_queue_late_tenant_behind_bulk_tenant(mock, upstream_url):
+    mock.settings.update(min_latency=0.03, max_latency=0.03)
+    bulk = Tenant("bulk", "sk-bulk-tenant-key")
+    alice = Tenant("alice", "sk-alice-tenant-key")
+    order = asyncio.run(run_in_order(upstream_url, [[bulk] * 8, [alice]]))
+    assert len(order) == 9
+    # 按FIFO会排在第9个；公平调度下只需等待批量租户正在进行和已排在最前的请求
+    assert order.index("alice") <= 2
+
+
+def test_engine_shares_capacity_by_weight(mock, upstream_url):
+    mock.settings.update(min_latency=0.02, max_latency=0.02)
+    heavy = Tenant("heavy", "sk-heavy-tenant-key", weight=3)
+    light = Tenant("light", "sk-light-tenant-key", weight=1)
+    order = asyncio.run(run_in_order(upstream_url, [[heavy, light] * 8]))
+    assert sorted(order) == sorted(["heavy"] * 8 + ["light"] * 8)
+    # 两个租户都有积压时，名额按 3:1 分配
+    assert order[:8].count("heavy") >= 5
+    assert order[:8].count("light") >= 1
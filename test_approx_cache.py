@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+近似重复请求缓存测试：规范化后相同的请求精确命中，只差几个词的请求近似命中，
+问题不同、参数不同或未选择加入时不命中；条目数和存活时间有上限
+"""
+
+import time
+
+import pytest
+
+from approx_cache import (ApproxResponseCache, normalize_context, normalize_query, split_messages, simhash,
+                          hamming, _features, tokenize)
+from raw_completion import RawCompletion
+
+MODEL = "gemini-2.5-flash"
+QUESTION = ("How do I configure the connection pool size for the async http client in python so that many "
+            "concurrent requests to the same host reuse connections instead of opening new sockets every time")
+
+
+def request(question=QUESTION, system="You are a helpful assistant.", **params):
+    return dict(params, model=MODEL, messages=[
+        {"role": "system", "content": system},
+        {"role": "user", "content": question},
+    ])
+
+
+def completion(text="答案"):
+    return RawCompletion.from_dict({"choices": [{"message": {"content": text}, "finish_reason": "stop"}]})
+
+
+def test_normalization():
+    assert normalize_context("Now:  2026-01-15 08:30:00Z\nid 123e4567-e89b-12d3-a456-426614174000") == \
+        "now: <v> id <v>"
+    assert normalize_context("今天是2026年1月15日 9:30") == normalize_context("今天是2026年2月1日 10:05")
+    assert normalize_query("Explain this.  Please continue.") == "explain this"
+    assert normalize_query("请解释一下，继续") == "请解释一下"
+    # 只有“继续”时保留原文
+    assert normalize_query("继续") == "继续"
+    assert split_messages([{"role": "user", "content": "问题"}]) == ("问题", "")
+    assert split_messages([{"role": "user", "content": "问题"}, {"role": "assistant", "content": "回答"}]) == \
+        ("", "user: 问题\nassistant: 回答")
+
+
+def test_simhash_distance_tracks_similarity():
+    base = simhash(_features(tokenize(normalize_query(QUESTION))))
+    close = simhash(_features(tokenize(normalize_query(QUESTION + " please"))))
+    other = simhash(_features(tokenize("what is the capital city of france and how large is its population today "
+                                       "compared with the population of berlin ten years ago")))
+    assert hamming(base, close) < hamming(base, other)
+
+
+def test_exact_hit_ignores_whitespace_and_timestamps():
+    cache = ApproxResponseCache(models=[MODEL])
+    cache.store(request(system="Current time: 2026-01-15 08:30"), completion())
+    hit = cache.lookup(request(question="  " + QUESTION.upper() + " ", system="Current time: 2026-01-16 09:45"))
+    assert hit is not None and hit.content_length == 2
+    assert cache.stats["exact_hits"] == 1
+
+
+def test_near_duplicate_hits_and_different_question_misses():
+    # 内置hash每个进程随机，多一个词时的距离在几位之间浮动，阈值留足余量
+    cache = ApproxResponseCache(threshold=0.8, models=[MODEL])
+    cache.store(request(), completion())
+    assert cache.lookup(request(question=QUESTION + " please")) is not None
+    assert cache.stats["approx_hits"] == 1
+    assert cache.lookup(request(question="What is the capital city of France and how large is its population today "
+                                         "compared with the population of Berlin ten years ago")) is None
+    # 上下文不同时不命中
+    assert cache.lookup(request(system="You are a pirate who only answers in rhymes about the sea.")) is None
+    assert cache.stats["misses"] == 2
+
+
+def test_output_affecting_parameters_must_match():
+    cache = ApproxResponseCache(models=[MODEL])
+    cache.store(request(max_tokens=100), completion())
+    assert cache.lookup(request(max_tokens=100)) is not None
+    assert cache.lookup(request(max_tokens=200)) is None
+    assert cache.lookup(request(max_tokens=100, response_format={"type": "json_object"})) is None
+
+
+def test_only_opted_in_models_or_tenants_are_cached():
+    cache = ApproxResponseCache(models=["gemini-2.5-pro"], tenants=["team-a"])
+    cache.store(request(), completion())
+    assert cache.get_stats()["entries"] == 0
+    cache.store(request(), completion(), tenant="team-a")
+    assert cache.lookup(request(), tenant="team-a") is not None
+    assert cache.lookup(request()) is None
+    assert not cache.enabled_for(MODEL, None)
+    assert ApproxResponseCache(models=["*"]).enabled_for(MODEL, None)
+
+
+def test_entries_are_bounded_and_expire():
+    cache = ApproxResponseCache(max_entries=2, models=[MODEL])
+    for index in range(3):
+        cache.store(request(question=f"question number {index}"), completion())
+    stats = cache.get_stats()
+    assert stats["entries"] == 2
+    assert stats["evictions"] == 1
+    assert cache.lookup(request(question="question number 0")) is None
+    assert cache.lookup(request(question="question number 2")) is not None
+
+    expiring = ApproxResponseCache(ttl=0.05, models=[MODEL])
+    expiring.store(request(), completion())
+    time.sleep(0.1)
+    assert expiring.lookup(request()) is None
+    assert expiring.get_stats()["entries"] == 0
+
+
+def test_tenants_do_not_share_entries():
+    cache = ApproxResponseCache(models=[MODEL])
+    cache.store(request(), completion(), tenant="team-a")
+    assert cache.lookup(request(), tenant="team-a") is not None
+    assert cache.lookup(request(), tenant="team-b") is None
+    assert cache.lookup(request(question=QUESTION + " please"), tenant="team-b") is None
+
+
+@pytest.mark.parametrize("params", [
+    {"temperature": 1.5}, {"top_p": 0.5}, {"n": 2}, {"stop": ["\n"]}, {"seed": 7},
+    {"tool_choice": "none"}, {"reasoning_effort": "high"},
+])
+def test_every_sampling_parameter_is_part_of_the_key(params):
+    cache = ApproxResponseCache(models=[MODEL])
+    cache.store(request(temperature=0.2), completion())
+    assert cache.lookup(request(**dict({"temperature": 0.2}, **params))) is None
+    # 流式与否不影响回答内容
+    assert cache.lookup(request(temperature=0.2, stream=True, stream_options={"include_usage": True})) is not None
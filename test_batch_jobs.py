@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批量任务测试：逐行解析上传内容，条目分散到各个密钥、只在有空闲名额时发送，
+429/5xx 换密钥重试、其他4xx直接失败，结果按输入顺序以 OpenAI Batch 格式导出
+"""
+
+import json
+import asyncio
+
+import pytest
+
+from admission_control import AdmissionController
+from batch_jobs import BatchRunner, parse_line
+from proxy_engine import ProxyEngine
+from quota_tracker import QuotaTracker
+
+FLASH = "gemini-2.5-flash"
+
+
+def request_line(custom_id, content="你好", **body):
+    body.setdefault("model", FLASH)
+    body["messages"] = [{"role": "user", "content": content}]
+    return json.dumps({"custom_id": custom_id, "body": body}, ensure_ascii=False)
+
+
+def test_parse_line():
+    assert parse_line(request_line("a", stream=True), 0) == {
+        "custom_id": "a", "request": {"model": FLASH, "messages": [{"role": "user", "content": "你好"}]}}
+    # 直接是请求体时 custom_id 默认为行号，缺少 model 时使用默认模型
+    assert parse_line('{"messages": []}', 7, FLASH) == {"custom_id": "7", "request": {"messages": [], "model": FLASH}}
+    assert parse_line('{"messages": []}', 7)["error"] == "缺少 model"
+    assert parse_line('{"custom_id": "b", "body": {"model": "m"}}', 1) == {"custom_id": "b", "error": "缺少 messages"}
+    assert parse_line("[1, 2]", 2)["error"] == "每行必须是JSON对象"
+    assert parse_line("{不是JSON", 3)["error"].startswith("JSON解析失败")
+
+
+@pytest.fixture
+def runner(tmp_path):
+    runner = BatchRunner(engine=None, admission=AdmissionController(), path=str(tmp_path / "batch.db"))
+    yield runner
+    runner.close()
+
+
+def test_create_job_records_unparseable_lines_as_failed(runner):
+    job = runner.create_job([request_line("a"), "", "{不是JSON", request_line("c")], "tenant-a")
+    assert job["status"] == "queued"
+    assert job["request_counts"] == {"total": 3, "completed": 0, "failed": 1, "pending": 2}
+    results = [json.loads(line) for line in runner.iter_results(job["id"])]
+    assert results == [{"custom_id": "1", "response": None, "error": {"message": results[0]["error"]["message"]}}]
+
+    # 任务只对所属租户可见
+    assert runner.get_job(job["id"], "tenant-b") is None
+    assert [item["id"] for item in runner.list_jobs("tenant-a")] == [job["id"]]
+    assert runner.cancel_job(job["id"], "tenant-b") is None
+    assert runner.get_job(job["id"], "tenant-a")["status"] == "queued"
+
+    with pytest.raises(ValueError):
+        runner.create_job(["", "  "], "tenant-a")
+    assert runner.create_job(["{不是JSON"], "tenant-a")["status"] == "completed"
+
+
+def test_failed_upload_leaves_no_partial_job(runner, monkeypatch):
+    monkeypatch.setattr("batch_jobs.INSERT_BATCH_SIZE", 2)
+
+    def lines():
+        for index in range(5):
+            yield request_line(str(index))
+        raise ConnectionError("客户端断开")
+
+    with pytest.raises(ConnectionError):
+        runner.create_job(lines(), "tenant-a")
+    assert runner.list_jobs("tenant-a") == []
+    assert runner.conn.execute("SELECT COUNT(*) FROM batch_items").fetchone()[0] == 0
+
+    # 超过一批的上传分多次写入，计数与行数一致
+    job = runner.create_job([request_line(str(index)) for index in range(5)], "tenant-a")
+    assert job["request_counts"]["total"] == 5
+
+
+async def run_job(runner, lines, timeout=10.0):
+    """启动调度循环，等待任务完成后返回任务和结果"""
+    task = asyncio.create_task(runner.run())
+    try:
+        job = runner.create_job(lines, "tenant-a")
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while runner.get_job(job["id"], "tenant-a")["status"] != "completed":
+            assert loop.time() < deadline, runner.get_stats()
+            await asyncio.sleep(0.02)
+        return runner.get_job(job["id"], "tenant-a"), [json.loads(line) for line in runner.iter_results(job["id"])]
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+def test_items_are_spread_over_keys_and_exported_in_order(tmp_path, mock, upstream_url):
+    keys = [f"AIzaLEN0200batch{index}" for index in range(3)]
+
+    async def run():
+        engine = ProxyEngine(base_url=upstream_url, key_groups=[keys], min_response_length=100)
+        admission = AdmissionController(max_inflight=8)
+        runner = BatchRunner(engine, admission, path=str(tmp_path / "batch.db"), workers=4, poll_interval=0.01)
+        try:
+            return await run_job(runner, [request_line(f"req-{index}") for index in range(9)]), runner, admission
+        finally:
+            runner.close()
+            await engine.aclose()
+
+    (job, results), runner, admission = asyncio.run(run())
+    assert job["request_counts"] == {"total": 9, "completed": 9, "failed": 0, "pending": 0}
+    assert [result["custom_id"] for result in results] == [f"req-{index}" for index in range(9)]
+    assert all(result["response"]["status_code"] == 200 and result["error"] is None for result in results)
+    assert results[0]["response"]["body"]["choices"][0]["message"]["content"]
+    # 每条只请求一次上游，不做扇出，名额全部归还
+    assert mock.counters["chat_completions"] == 9
+    assert runner.stats["attempts"] == 9
+    assert admission.inflight == 0
+
+
+def test_batch_leaves_headroom_for_interactive_requests(tmp_path, mock, upstream_url):
+    async def run():
+        engine = ProxyEngine(base_url=upstream_url, key_groups=[["AIzaLEN0200headroom"]], min_response_length=100)
+        admission = AdmissionController(max_inflight=3)
+        runner = BatchRunner(engine, admission, path=str(tmp_path / "batch.db"), workers=8,
+                             per_key_concurrency=8, headroom=2, poll_interval=0.01)
+        peak = 0
+
+        async def watch():
+            nonlocal peak
+            while True:
+                peak = max(peak, admission.inflight)
+                await asyncio.sleep(0.001)
+
+        watcher = asyncio.create_task(watch())
+        try:
+            job, _ = await run_job(runner, [request_line(str(index)) for index in range(4)])
+        finally:
+            watcher.cancel()
+            runner.close()
+            await engine.aclose()
+        return job, peak
+
+    job, peak = asyncio.run(run())
+    assert job["request_counts"]["completed"] == 4
+    # 3个名额中为交互请求保留2个，批量请求同时最多占用1个
+    assert peak == 1
+
+
+def test_failed_items_are_retried_on_another_key(tmp_path, mock, upstream_url):
+    async def run():
+        engine = ProxyEngine(base_url=upstream_url, key_groups=[["AIzaQUOTA-batch1", "AIzaLEN0200retry"]],
+                             min_response_length=100)
+        runner = BatchRunner(engine, AdmissionController(), path=str(tmp_path / "batch.db"), workers=1,
+                             poll_interval=0.01)
+        try:
+            return await run_job(runner, [request_line(str(index)) for index in range(4)]), runner
+        finally:
+            runner.close()
+            await engine.aclose()
+
+    (job, results), runner = asyncio.run(run())
+    assert job["request_counts"]["completed"] == 4
+    assert runner.stats["retries"] == runner.stats["attempts"] - 4
+
+
+def test_items_fail_after_max_attempts(tmp_path, mock, upstream_url):
+    async def run():
+        engine = ProxyEngine(base_url=upstream_url, key_groups=[["AIzaQUOTA-batch1", "AIzaQUOTA-batch2"]])
+        runner = BatchRunner(engine, AdmissionController(), path=str(tmp_path / "batch.db"), max_attempts=2,
+                             poll_interval=0.01)
+        try:
+            return await run_job(runner, [request_line("only")])
+        finally:
+            runner.close()
+            await engine.aclose()
+
+    job, results = asyncio.run(run())
+    assert job["request_counts"] == {"total": 1, "completed": 0, "failed": 1, "pending": 0}
+    # 最后一次的上游错误响应原样写入结果
+    assert results[0]["response"]["status_code"] == 429
+    assert results[0]["response"]["body"]["error"]["status"] == "RESOURCE_EXHAUSTED"
+    assert results[0]["error"] is None
+    assert mock.counters["chat_completions"] == 2
+
+
+def test_client_errors_are_not_retried(tmp_path, mock, upstream_url):
+    async def run():
+        # 按密钥排序先选到 REGION 密钥，400 属于请求本身的问题，不换密钥重试
+        engine = ProxyEngine(base_url=upstream_url, key_groups=[["AIzaREGION-batch1", "AIzaZLEN0200other"]],
+                             min_response_length=100)
+        runner = BatchRunner(engine, AdmissionController(), path=str(tmp_path / "batch.db"), max_attempts=3,
+                             poll_interval=0.01)
+        try:
+            return await run_job(runner, [request_line("only")]), runner
+        finally:
+            runner.close()
+            await engine.aclose()
+
+    (job, results), runner = asyncio.run(run())
+    assert job["request_counts"]["failed"] == 1
+    assert results[0]["response"]["status_code"] == 400
+    assert "User location is not supported" in results[0]["response"]["body"]["error"]["message"]
+    assert runner.stats["retries"] == 0
+    assert mock.counters["chat_completions"] == 1
+
+
+def test_items_without_keys_fail_immediately(tmp_path, mock, upstream_url, monkeypatch):
+    async def run():
+        engine = ProxyEngine(base_url=upstream_url, key_groups=[["AIzaLEN0200nokey"]], min_response_length=100)
+        monkeypatch.setattr(engine, "candidate_keys", lambda model: [] if model == "no-keys" else ["AIzaLEN0200nokey"])
+        runner = BatchRunner(engine, AdmissionController(), path=str(tmp_path / "batch.db"), poll_interval=0.01)
+        try:
+            return await run_job(runner, [request_line("a", model="no-keys"), request_line("b")])
+        finally:
+            runner.close()
+            await engine.aclose()
+
+    job, results = asyncio.run(run())
+    assert job["request_counts"] == {"total": 2, "completed": 1, "failed": 1, "pending": 0}
+    assert results[0] == {"custom_id": "a", "response": None, "error": {"message": "没有可用于模型 no-keys 的密钥"}}
+    assert results[1]["response"]["status_code"] == 200
+    assert mock.counters["chat_completions"] == 1
+
+
+def test_waiting_item_does_not_block_other_models(tmp_path, mock, upstream_url):
+    async def run():
+        # 该模型每分钟0次：排在前面的条目暂时分配不到密钥，后面其他模型的条目照常发送
+        tracker = QuotaTracker(str(tmp_path / "quota.db"), limits={"gemini-2.5-pro": (0, 0)})
+        engine = ProxyEngine(base_url=upstream_url, key_groups=[["AIzaLEN0200hol"]], min_response_length=100)
+        runner = BatchRunner(engine, AdmissionController(), tracker, path=str(tmp_path / "batch.db"),
+                             poll_interval=0.01)
+        task = asyncio.create_task(runner.run())
+        try:
+            job = runner.create_job([request_line("pro", model="gemini-2.5-pro"), request_line("flash")],
+                                    "tenant-a")
+            for _ in range(500):
+                if runner.get_job(job["id"], "tenant-a")["request_counts"]["completed"]:
+                    break
+                await asyncio.sleep(0.01)
+            return runner.get_job(job["id"], "tenant-a"), [json.loads(line) for line in runner.iter_results(job["id"])]
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            runner.close()
+            await engine.aclose()
+            tracker.close()
+
+    job, results = asyncio.run(run())
+    assert job["request_counts"] == {"total": 2, "completed": 1, "failed": 0, "pending": 1}
+    assert [result["custom_id"] for result in results] == ["flash"]
+
+
+def test_cancelled_job_stops_sending(tmp_path, mock, upstream_url):
+    async def run():
+        engine = ProxyEngine(base_url=upstream_url, key_groups=[["AIzaLEN0200cancel"]], min_response_length=100)
+        runner = BatchRunner(engine, AdmissionController(), path=str(tmp_path / "batch.db"), workers=1,
+                             poll_interval=0.01)
+        task = asyncio.create_task(runner.run())
+        try:
+            job = runner.create_job([request_line(str(index)) for index in range(20)], "tenant-a")
+            while runner.get_job(job["id"], "tenant-a")["request_counts"]["completed"] < 1:
+                await asyncio.sleep(0.01)
+            cancelled = runner.cancel_job(job["id"], "tenant-a")
+            await asyncio.sleep(0.2)
+            return cancelled, runner.get_job(job["id"], "tenant-a")
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            runner.close()
+            await engine.aclose()
+
+    cancelled, job = asyncio.run(run())
+    assert cancelled["status"] == "cancelled"
+    assert job["request_counts"]["completed"] <= 3
+    assert mock.counters["chat_completions"] == job["request_counts"]["completed"]
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+候选打分测试：各打分器单独的行为，增量打分与一次性打分结果一致，退化和拒答的候选被淘汰，
+自定义打分器按名称启用
+"""
+
+import pytest
+
+from candidate_scoring import ScoringPipeline, Scorer, register_scorer, SCORERS
+
+CHINESE = {"messages": [{"role": "user", "content": "请介绍一下长城的历史"}]}
+ENGLISH = {"messages": [{"role": "user", "content": "Tell me about the history of the Great Wall"}]}
+ANSWER = "长城始建于春秋战国时期。秦朝统一后把各国的城墙连接起来。明朝又大规模重修了长城。"
+
+
+def test_good_answer_scores_high():
+    pipeline = ScoringPipeline(target_tokens=20)
+    score = pipeline.evaluate(CHINESE, ANSWER, "stop")
+    assert score.rejected is None
+    assert score.scores["finish_reason"] == 1.0
+    assert score.scores["repetition"] == 1.0
+    assert score.scores["language"] == 1.0
+    assert score.total > 0.85
+
+
+def test_incremental_feed_matches_one_shot():
+    pipeline = ScoringPipeline()
+    streamed = pipeline.start(CHINESE)
+    for index in range(0, len(ANSWER), 7):
+        streamed.feed(ANSWER[index:index + 7])
+    streamed.finish("stop")
+    assert streamed.scores == pipeline.evaluate(CHINESE, ANSWER, "stop").scores
+
+
+def test_truncated_and_filtered_answers():
+    pipeline = ScoringPipeline()
+    assert pipeline.evaluate(CHINESE, ANSWER, "length").scores["finish_reason"] == 0.6
+    filtered = pipeline.evaluate(CHINESE, ANSWER, "content_filter")
+    assert filtered.rejected == "finish_reason=content_filter"
+    assert filtered.total == 0.0
+
+
+def test_repetition_loops_are_rejected_while_streaming():
+    pipeline = ScoringPipeline()
+    score = pipeline.start(CHINESE)
+    for _ in range(6):
+        score.feed("这是一句反复出现的话，模型陷入了循环。")
+    assert score.rejected == "degenerate: repeated sentence loop"
+
+    run = pipeline.start(CHINESE)
+    run.feed("哈" * 500)
+    assert run.rejected == "degenerate: character run"
+    assert pipeline.get_stats()["rejections"] == {"degenerate": 2}
+
+
+@pytest.mark.parametrize("content", [
+    "I'm sorry, but I can't help with that request.",
+    "抱歉，我无法提供这方面的信息。",
+    "As an AI language model, I do not have opinions.",
+])
+def test_refusals_are_rejected_or_scored_zero(content):
+    assert ScoringPipeline().evaluate(ENGLISH, content, "stop").rejected == "refusal"
+    kept = ScoringPipeline(reject_refusals=False).evaluate(ENGLISH, content, "stop")
+    assert kept.rejected is None
+    assert kept.scores["refusal"] == 0.0
+
+
+def test_language_mismatch_lowers_the_score():
+    pipeline = ScoringPipeline()
+    english_answer = "The Great Wall was built over many centuries by several dynasties."
+    assert pipeline.evaluate(CHINESE, english_answer, "stop").scores["language"] == 0.2
+    assert pipeline.evaluate(ENGLISH, ANSWER, "stop").scores["language"] == 0.0
+    assert pipeline.evaluate(ENGLISH, english_answer, "stop").scores["language"] == 1.0
+
+
+def test_custom_scorer_and_weights():
+    @register_scorer
+    class KeywordScorer(Scorer):
+        name = "keyword"
+
+        def __init__(self, prompt, options):
+            super().__init__(prompt, options)
+            self.found = False
+
+        def feed(self, delta):
+            self.found = self.found or self.options["keyword"] in delta
+
+        def score(self):
+            return 1.0 if self.found else 0.0
+
+    try:
+        pipeline = ScoringPipeline(scorers=["keyword", "finish_reason"], weights={"keyword": 3.0}, keyword="秦朝")
+        assert pipeline.evaluate(CHINESE, ANSWER, "stop").total == 1.0
+        assert pipeline.evaluate(CHINESE, "没有关键词的回答", "stop").total == 0.25
+        assert set(pipeline.get_stats()["scorer_ms_total"]) == {"keyword", "finish_reason"}
+    finally:
+        SCORERS.pop("keyword")
+
+    with pytest.raises(ValueError):
+        ScoringPipeline(scorers=["missing"])
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+压缩测试：下游流式响应逐块压缩且每块立即可解压，小响应不压缩；上游请求体按阈值gzip压缩
+"""
+
+import json
+import zlib
+import asyncio
+
+from compression import CompressionMiddleware, CompressionStats
+from upstream_client import UpstreamClient
+
+CHAT_PATH = "/v1/chat/completions"
+
+
+def sse_app(chunks, content_type=b"text/event-stream"):
+    """按给定分块发送响应的最小ASGI应用"""
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", content_type)]})
+        for index, chunk in enumerate(chunks):
+            await send({"type": "http.response.body", "body": chunk, "more_body": index < len(chunks) - 1})
+    return app
+
+
+def call(app, path=CHAT_PATH, accept_encoding=b"gzip"):
+    """调用中间件，返回发出的全部ASGI消息"""
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    headers = [(b"accept-encoding", accept_encoding)] if accept_encoding else []
+    scope = {"type": "http", "path": path, "method": "POST", "headers": headers}
+    asyncio.run(app(scope, receive, send))
+    return messages
+
+
+def test_stream_chunks_are_flushed_individually():
+    chunks = [f"data: {json.dumps({'delta': '第%d块' % i * 40}, ensure_ascii=False)}\n\n".encode() for i in range(5)]
+    stats = CompressionStats()
+    messages = call(CompressionMiddleware(sse_app(chunks + [b""]), stats))
+
+    headers = dict(messages[0]["headers"])
+    assert headers[b"content-encoding"] == b"gzip"
+    assert b"content-length" not in headers
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    # 每收到一个压缩分块就能解出对应的原始分块，不需要等后续数据
+    for chunk, message in zip(chunks, messages[1:]):
+        assert decompressor.decompress(message["body"]) == chunk
+    assert decompressor.decompress(messages[-1]["body"]) == b""
+    assert decompressor.eof
+    assert stats.streamed_responses == 1
+    assert stats.get_stats()["bytes_in"] == sum(len(chunk) for chunk in chunks)
+
+
+def test_large_json_response_is_compressed_with_length():
+    body = json.dumps({"content": "秋天的乡村" * 200}, ensure_ascii=False).encode()
+    stats = CompressionStats()
+    messages = call(CompressionMiddleware(sse_app([body], b"application/json"), stats))
+    headers = dict(messages[0]["headers"])
+    assert headers[b"content-encoding"] == b"gzip"
+    assert int(headers[b"content-length"]) == len(messages[1]["body"])
+    assert zlib.decompress(messages[1]["body"], 16 + zlib.MAX_WBITS) == body
+    assert stats.get_stats()["bytes_saved"] > 0
+
+
+def test_small_other_type_or_unaccepted_responses_pass_through():
+    small = call(CompressionMiddleware(sse_app([b'{"ok": true}'], b"application/json")))
+    assert b"content-encoding" not in dict(small[0]["headers"])
+    assert small[1]["body"] == b'{"ok": true}'
+
+    html = b"<html>" + b"x" * 2000 + b"</html>"
+    other = call(CompressionMiddleware(sse_app([html], b"text/html")))
+    assert other[1]["body"] == html
+
+    plain = call(CompressionMiddleware(sse_app([html], b"application/json")), accept_encoding=None)
+    assert plain[1]["body"] == html
+
+    path = call(CompressionMiddleware(sse_app([html], b"application/json")), path="/stats")
+    assert path[1]["body"] == html
+
+
+def test_large_upstream_request_bodies_are_gzipped(mock, upstream_url):
+    async def run():
+        upstream = UpstreamClient(gzip_requests=True, gzip_min_bytes=1024)
+        try:
+            for content in ("短问题", "长问题" * 1000):
+                data = {"model": "gemini-2.5-flash", "messages": [{"role": "user", "content": content}]}
+                body, headers = upstream.encode_body(data, {"Authorization": "Bearer AIzaLEN0200gzip"})
+                response = await upstream.client.post(f"{upstream_url}/openai/chat/completions",
+                                                      content=body, headers=headers)
+                assert response.status_code == 200
+                upstream.record_response(response)
+        finally:
+            await upstream.aclose()
+        stats = upstream.get_stats()
+        assert stats["gzipped_requests"] == 1
+        assert mock.counters["gzipped_requests"] == 1
+        assert stats["request_bytes_saved"] > 0
+        assert stats["responses"] == 2
+    asyncio.run(run())
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上下文缓存测试：重复的系统提示词在上游创建缓存后命中，上游缓存失效时回退为完整请求并重新创建
+"""
+
+import time
+import asyncio
+
+import pytest
+
+from proxy_engine import ProxyEngine
+from upstream_client import UpstreamClient
+from context_cache import ContextCacheManager, parse_expire_time, split_stable_prefix
+
+SYSTEM_PROMPT = "你是一个专业的翻译助手，请把用户的内容翻译成英文，保留原文的语气和格式。" * 10
+
+BACKENDS = ["openai", "native"]
+
+
+def request(question: str) -> dict:
+    return {
+        "model": "gemini-2.5-flash",
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": question},
+        ],
+    }
+
+
+async def wait_created(cache: ContextCacheManager, count: int):
+    """缓存在后台创建，等待创建完成"""
+    deadline = time.monotonic() + 5
+    while cache.stats["created"] < count:
+        assert time.monotonic() < deadline, "上下文缓存没有创建"
+        await asyncio.sleep(0.01)
+
+
+def test_split_stable_prefix_and_expire_time():
+    messages = request("你好")["messages"]
+    prefix, rest = split_stable_prefix(messages)
+    assert [m["role"] for m in prefix] == ["system"]
+    assert [m["role"] for m in rest] == ["user"]
+    assert parse_expire_time("2030-01-02T03:04:05.123456789Z") == pytest.approx(1893553445.123456)
+    assert parse_expire_time("不是时间") is None
+
+
+def test_prefix_is_cached_after_min_hits_and_isolated_per_key(mock, upstream_url):
+    async def run():
+        cache = ContextCacheManager(base_url=upstream_url, enabled=True, min_prefix_chars=200, min_hits=2)
+        data, entry_key = cache.prepare("AIzaKEY-A", request("第一句"))
+        assert entry_key is None
+        assert not cache._tasks
+        cache.prepare("AIzaKEY-A", request("第二句"))
+        await asyncio.gather(*cache._tasks)
+        assert cache.stats["created"] == 1
+        assert mock.cached_contents[next(iter(mock.cached_contents))]["api_key"] == "AIzaKEY-A"
+        # 经由共享上游客户端发送
+        assert cache.upstream.stats["requests"] == cache.upstream.stats["responses"] == 1
+
+        data, entry_key = cache.prepare("AIzaKEY-A", request("第三句"))
+        assert entry_key is not None
+        assert data["messages"] == [{"role": "user", "content": "第三句"}]
+        assert data["extra_body"]["google"]["cached_content"] in mock.cached_contents
+        assert cache.stats["bytes_saved"] == len(SYSTEM_PROMPT.encode("utf-8"))
+
+        # 上游缓存条目属于创建它的密钥，其他密钥要各自积累出现次数
+        data, entry_key = cache.prepare("AIzaKEY-B", request("第三句"))
+        assert entry_key is None
+        assert "extra_body" not in data
+        assert not cache._tasks
+        await cache.upstream.aclose()
+    asyncio.run(run())
+
+
+def test_short_or_prefix_only_requests_are_not_cached(mock, upstream_url):
+    async def run():
+        cache = ContextCacheManager(base_url=upstream_url, enabled=True, min_prefix_chars=200, min_hits=1)
+        short = {"model": "gemini-2.5-flash",
+                 "messages": [{"role": "system", "content": "简短"}, {"role": "user", "content": "你好"}]}
+        only_system = {"model": "gemini-2.5-flash", "messages": [{"role": "system", "content": SYSTEM_PROMPT}]}
+        for data in (short, only_system):
+            assert cache.prepare("AIzaKEY-A", data) == (data, None)
+        assert not cache._tasks
+        assert cache.stats["misses"] == 0
+
+        disabled = ContextCacheManager(base_url=upstream_url, enabled=False, min_prefix_chars=200, min_hits=1)
+        data = request("你好")
+        assert disabled.prepare("AIzaKEY-A", data) == (data, None)
+    asyncio.run(run())
+
+
+def test_failed_create_backs_off(mock):
+    async def run():
+        # 连接不上的上游：创建失败后在退避期内不再重试
+        cache = ContextCacheManager(base_url="http://127.0.0.1:9/v1beta", enabled=True, min_prefix_chars=200,
+                                    min_hits=1)
+        cache.prepare("AIzaKEY-A", request("第一句"))
+        await asyncio.gather(*cache._tasks)
+        assert cache.stats["create_failed"] == 1
+        cache.prepare("AIzaKEY-A", request("第二句"))
+        assert not cache._tasks
+        assert cache.get_stats()["entries"] == 0
+        await cache.upstream.aclose()
+    asyncio.run(run())
+
+
+def new_engine(upstream_url: str, backend: str):
+    upstream = UpstreamClient()
+    cache = ContextCacheManager(base_url=upstream_url, enabled=True, min_prefix_chars=200, min_hits=2,
+                                upstream=upstream)
+    engine = ProxyEngine(base_url=upstream_url, key_groups=[["AIzaLEN0300cache"]], min_response_length=100,
+                         backend=backend, upstream=upstream, context_cache=cache)
+    return engine, cache
+
+
+def test_engine_shares_its_upstream_client_with_the_default_cache():
+    engine = ProxyEngine(base_url="http://127.0.0.1:9/v1beta", key_groups=[["AIzaLEN0300cache"]])
+    assert engine.context_cache.upstream is engine.upstream
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_repeated_prefix_is_cached_and_hit(mock, upstream_url, backend):
+    async def run():
+        engine, cache = new_engine(upstream_url, backend)
+        try:
+            await engine.complete(request("第一句"))
+            assert cache.stats["created"] == 0
+            # 同一前缀第二次出现时在后台创建缓存
+            await engine.complete(request("第二句"))
+            await wait_created(cache, 1)
+            assert mock.counters["cache_created"] == 1
+
+            result = await engine.complete(request("第三句"))
+            assert result.content()
+            assert cache.stats["hits"] == 1
+            assert mock.counters["cached_requests"] == 1
+        finally:
+            await engine.aclose()
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_invalidated_cache_falls_back_and_is_recreated(mock, upstream_url, backend):
+    async def run():
+        engine, cache = new_engine(upstream_url, backend)
+        try:
+            await engine.complete(request("第一句"))
+            await engine.complete(request("第二句"))
+            await wait_created(cache, 1)
+
+            # 上游缓存条目被删除（或过期）：引用它的请求被拒绝，引擎丢弃本地记录并发送完整请求
+            mock.cached_contents.clear()
+            result = await engine.complete(request("第三句"))
+            assert result.content()
+            assert cache.stats["invalidated"] == 1
+            assert mock.counters["cached_requests"] == 0
+
+            # 前缀仍然稳定，下一次请求重新创建缓存，之后再次命中
+            await engine.complete(request("第四句"))
+            await wait_created(cache, 2)
+            await engine.complete(request("第五句"))
+            assert mock.counters["cached_requests"] == 1
+            assert cache.get_stats()["entries"] == 1
+        finally:
+            await engine.aclose()
+    asyncio.run(run())
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+嵌入微批处理测试：窗口内的并发调用合并成一次上游批量调用，结果按顺序拆回各个调用方，
+超过上游单批上限时拆分，失败时换密钥重试
+"""
+
+import asyncio
+
+import pytest
+
+from embeddings import EmbeddingBatcher, EmbeddingError
+from mock_upstream import fake_embedding
+from proxy_engine import ProxyEngine
+from token_estimator import token_estimator
+
+MODEL = "gemini-embedding-001"
+
+
+async def with_batcher(upstream_url, keys, body, backend="openai", **options):
+    engine = ProxyEngine(base_url=upstream_url, key_groups=[keys], backend=backend)
+    batcher = EmbeddingBatcher(engine, **options)
+    try:
+        return await body(batcher)
+    finally:
+        await engine.aclose()
+
+
+@pytest.mark.parametrize("backend", ["openai", "native"])
+def test_concurrent_callers_share_one_upstream_call(mock, upstream_url, backend):
+    async def body(batcher):
+        return await asyncio.gather(*[
+            batcher.embed(MODEL, [f"第{index}段", f"第{index}段补充"], dimensions=4) for index in range(10)
+        ]), batcher
+
+    results, batcher = asyncio.run(with_batcher(upstream_url, ["AIzaEMBED-key01"], body, backend, window_ms=20))
+    assert mock.counters["embedding_requests"] == 1
+    assert mock.counters["embedded_inputs"] == 20
+    for index, (vectors, tokens) in enumerate(results):
+        assert vectors == [fake_embedding(f"第{index}段", 4), fake_embedding(f"第{index}段补充", 4)]
+        assert tokens >= 0
+    stats = batcher.get_stats()
+    assert stats["upstream_calls"] == 1
+    assert stats["largest_batch"] == 20
+    assert stats["inputs_per_call"] == 20.0
+
+
+def test_batches_are_split_at_max_batch_and_grouped_by_dimensions(mock, upstream_url):
+    async def body(batcher):
+        large = batcher.embed(MODEL, [f"文本{index}" for index in range(7)])
+        other = batcher.embed(MODEL, ["另一个维度"], dimensions=16)
+        return await asyncio.gather(large, other)
+
+    (large, _), (other, _) = asyncio.run(
+        with_batcher(upstream_url, ["AIzaEMBED-key01"], body, window_ms=20, max_batch=3))
+    assert large == [fake_embedding(f"文本{index}", 8) for index in range(7)]
+    assert len(other[0]) == 16
+    # 7条输入按每批3条拆成3次调用，不同维度单独一次
+    assert mock.counters["embedding_requests"] == 4
+
+
+def test_failed_call_is_retried_with_another_key(mock, upstream_url):
+    async def body(batcher):
+        return await asyncio.gather(*[batcher.embed(MODEL, [f"文本{index}"]) for index in range(3)]), batcher
+
+    results, batcher = asyncio.run(
+        with_batcher(upstream_url, ["AIzaEMBED-key02", "AIzaINVALID-emb1"], body, window_ms=10))
+    assert [vectors for vectors, _ in results] == [[fake_embedding(f"文本{index}", 8)] for index in range(3)]
+    # 轮询先选到无效密钥，失败后换另一个密钥重试整批
+    assert batcher.stats["failed_calls"] == 1
+    assert batcher.stats["upstream_calls"] == 2
+    assert mock.counters["embedding_requests"] == 1
+
+
+def test_upstream_error_is_raised_to_every_caller(mock, upstream_url):
+    async def body(batcher):
+        return await asyncio.gather(batcher.embed(MODEL, ["一"]), batcher.embed(MODEL, ["二"]),
+                                    return_exceptions=True)
+
+    results = asyncio.run(with_batcher(upstream_url, ["AIzaINVALID-emb1", "AIzaINVALID-emb2"], body))
+    assert all(isinstance(error, EmbeddingError) and error.status_code == 400 for error in results)
+    assert "API key not valid" in results[0].detail
+
+
+def test_empty_input_does_not_call_upstream(mock, upstream_url):
+    async def body(batcher):
+        return await batcher.embed(MODEL, [])
+
+    assert asyncio.run(with_batcher(upstream_url, ["AIzaEMBED-key01"], body)) == ([], 0)
+    assert mock.counters["embedding_requests"] == 0
+
+
+@pytest.mark.parametrize("backend", ["openai", "native"])
+def test_batch_tokens_are_shared_by_estimated_tokens(mock, upstream_url, backend):
+    english, chinese = "a" * 40, "你" * 40
+
+    async def body(batcher):
+        return await asyncio.gather(batcher.embed(MODEL, [english]), batcher.embed(MODEL, [chinese]))
+
+    (_, english_tokens), (_, chinese_tokens) = asyncio.run(
+        with_batcher(upstream_url, ["AIzaEMBED-key01"], body, backend, window_ms=20))
+    estimates = [token_estimator.count(english), token_estimator.count(chinese)]
+    # 原生接口不返回token数，用本地估算；OpenAI兼容层返回整批的token数，按各输入的估算值分摊
+    total = sum(estimates) if backend == "native" else (len(english) + len(chinese)) // 4
+    assert english_tokens == round(total * estimates[0] / sum(estimates))
+    assert chinese_tokens == round(total * estimates[1] / sum(estimates))
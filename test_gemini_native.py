@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+原生接口适配测试：OpenAI请求转换为原生请求体，原生响应（完整或SSE分块）转换回OpenAI格式
+"""
+
+from gemini_native import native_url, openai_to_native, NativeResponseAccumulator, parse_sse_line
+
+
+def test_native_url():
+    base = "https://example.com/v1beta"
+    assert native_url(base, "models/gemini-2.5-pro", False) == f"{base}/models/gemini-2.5-pro:generateContent"
+    assert native_url(base, "gemini-2.5-pro", True) == f"{base}/models/gemini-2.5-pro:streamGenerateContent?alt=sse"
+
+
+def test_messages_are_translated_to_alternating_turns():
+    model, body = openai_to_native({
+        "model": "gemini-2.5-flash",
+        "messages": [
+            {"role": "system", "content": "你是助手"},
+            {"role": "user", "content": "第一句"},
+            {"role": "user", "content": [
+                {"type": "text", "text": "看图"},
+                {"type": "image_url", "image_url": {"url": "data:image/png;base64,AAAA"}},
+            ]},
+            {"role": "assistant", "content": "好的"},
+            {"role": "user", "content": ""},
+        ],
+    })
+    assert model == "gemini-2.5-flash"
+    assert body["systemInstruction"] == {"parts": [{"text": "你是助手"}]}
+    # 连续的用户消息合并为一条，空消息被丢弃
+    assert body["contents"] == [
+        {"role": "user", "parts": [{"text": "第一句"}, {"text": "看图"},
+                                   {"inlineData": {"mimeType": "image/png", "data": "AAAA"}}]},
+        {"role": "model", "parts": [{"text": "好的"}]},
+    ]
+
+
+def test_sampling_thinking_safety_and_cache_options():
+    _, body = openai_to_native({
+        "model": "gemini-2.5-flash",
+        "messages": [{"role": "user", "content": "你好"}],
+        "temperature": 0.2,
+        "top_p": 0.9,
+        "n": 2,
+        "seed": 7,
+        "max_tokens": 256,
+        "stop": "END",
+        "response_format": {"type": "json_object"},
+        "reasoning_effort": "low",
+        "extra_body": {"google": {"cached_content": "cachedContents/abc"}},
+    }, safety_threshold="BLOCK_NONE")
+    assert body["generationConfig"] == {
+        "temperature": 0.2,
+        "topP": 0.9,
+        "candidateCount": 2,
+        "seed": 7,
+        "maxOutputTokens": 256,
+        "stopSequences": ["END"],
+        "responseMimeType": "application/json",
+        "thinkingConfig": {"thinkingBudget": 1024},
+    }
+    assert {item["threshold"] for item in body["safetySettings"]} == {"BLOCK_NONE"}
+    assert body["cachedContent"] == "cachedContents/abc"
+
+    # 请求中显式给出的设置优先于配置
+    _, body = openai_to_native({
+        "messages": [{"role": "user", "content": "你好"}],
+        "reasoning_effort": "high",
+        "extra_body": {"google": {
+            "thinking_config": {"thinking_budget": 0},
+            "safety_settings": [{"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_LOW_AND_ABOVE"}],
+        }},
+    }, safety_threshold="BLOCK_NONE")
+    assert body["generationConfig"]["thinkingConfig"] == {"thinkingBudget": 0}
+    assert len(body["safetySettings"]) == 1
+
+
+def test_stream_chunks_accumulate_into_openai_response():
+    accumulator = NativeResponseAccumulator("gemini-2.5-flash")
+    chunks = [
+        {"responseId": "r1", "candidates": [
+            {"index": 0, "content": {"parts": [{"text": "想一想", "thought": True}]}},
+        ]},
+        {"candidates": [
+            {"index": 0, "content": {"parts": [{"text": "你好，"}]}},
+            {"index": 1, "content": {"parts": [{"text": "嗨"}]}, "finishReason": "STOP"},
+        ]},
+        {"candidates": [{"index": 0, "content": {"parts": [{"text": "世界"}]}, "finishReason": "MAX_TOKENS"}],
+         "usageMetadata": {"promptTokenCount": 3, "candidatesTokenCount": 5, "totalTokenCount": 8}},
+    ]
+    for chunk in chunks:
+        accumulator.feed(chunk)
+    assert accumulator.content_length(0) == 5
+    assert not accumulator.blocked
+
+    result = accumulator.to_openai()
+    assert result["id"] == "chatcmpl-r1"
+    first, second = result["choices"]
+    assert first["message"] == {"role": "assistant", "content": "你好，世界", "reasoning_content": "想一想"}
+    assert first["finish_reason"] == "length"
+    assert second["message"]["content"] == "嗨"
+    assert second["finish_reason"] == "stop"
+    assert result["usage"] == {"prompt_tokens": 3, "completion_tokens": 5, "total_tokens": 8}
+
+    chunk = accumulator.chunk_to_openai(chunks[2])
+    assert chunk["object"] == "chat.completion.chunk"
+    assert chunk["choices"] == [{"index": 0, "delta": {"content": "世界"}, "finish_reason": "length"}]
+    assert chunk["usage"]["total_tokens"] == 8
+
+
+def test_blocked_prompt_and_candidates():
+    accumulator = NativeResponseAccumulator("gemini-2.5-flash")
+    accumulator.feed({"promptFeedback": {"blockReason": "SAFETY"}})
+    assert accumulator.blocked
+    assert accumulator.to_openai()["choices"][0]["finish_reason"] == "content_filter"
+
+    accumulator = NativeResponseAccumulator("gemini-2.5-flash")
+    accumulator.feed({"candidates": [{"index": 0, "finishReason": "SAFETY"}, {"index": 1, "finishReason": "STOP"}]})
+    # 还有一个候选正常结束，不算被拦截
+    assert not accumulator.blocked
+    accumulator = NativeResponseAccumulator("gemini-2.5-flash")
+    accumulator.feed({"candidates": [{"index": 0, "finishReason": "RECITATION"}]})
+    assert accumulator.blocked
+
+
+def test_parse_sse_line():
+    assert parse_sse_line('data: {"candidates": []}') == {"candidates": []}
+    assert parse_sse_line("data: [DONE]") is None
+    assert parse_sse_line(": keep-alive") is None
+    assert parse_sse_line("data: {broken") is None
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+密钥探测测试：按上游错误判断密钥状态，并发上限，不可用的密钥在用户请求之前被跳过
+"""
+
+import time
+import asyncio
+import configparser
+
+import pytest
+
+from key_prober import (KeyProber, classify, load_config_keys, VALID, INVALID, QUOTA_EXHAUSTED, REGION_BLOCKED,
+                        ERROR)
+from proxy_engine import ProxyEngine
+from key_store import KeyStore
+from config_manager import ConfigManager
+
+GOOD = "AIzaLEN0200good"
+BAD = "AIzaINVALID-key1"
+QUOTA = "AIzaQUOTA-key2"
+REGION = "AIzaREGION-key3"
+
+
+def test_classify():
+    assert classify(200, "{}") == VALID
+    assert classify(400, '{"error": {"message": "API key not valid."}}') == INVALID
+    assert classify(403, "PERMISSION_DENIED") == INVALID
+    assert classify(429, "") == QUOTA_EXHAUSTED
+    assert classify(400, "RESOURCE_EXHAUSTED") == QUOTA_EXHAUSTED
+    assert classify(400, "User location is not supported for the API use.") == REGION_BLOCKED
+    assert classify(500, "internal error") == ERROR
+
+
+def test_completion_probe_classifies_each_key(mock, upstream_url):
+    prober = KeyProber(upstream_url, method="completion", concurrency=2)
+    results = asyncio.run(prober.probe_keys([GOOD, BAD, QUOTA, REGION, GOOD]))
+    assert [result["status"] for result in results] == [VALID, INVALID, QUOTA_EXHAUSTED, REGION_BLOCKED]
+    assert [result["key"] for result in results] == ["***good", "***key1", "***key2", "***key3"]
+    assert prober.usable([GOOD, BAD, QUOTA, REGION]) == [GOOD]
+    readiness = prober.readiness([GOOD, BAD, "AIzaNOT-PROBED-1"])
+    assert readiness["ready"]
+    assert readiness["usable"] == 2
+    assert readiness["unprobed"] == 1
+
+
+def test_models_probe_only_detects_invalid_keys(mock, upstream_url):
+    prober = KeyProber(upstream_url, method="models")
+    results = asyncio.run(prober.probe_keys([BAD, QUOTA]))
+    assert [result["status"] for result in results] == [INVALID, VALID]
+    # 列出模型不消耗对话配额
+    assert mock.counters["chat_completions"] == 0
+
+
+def test_concurrency_and_rate_limits(mock, upstream_url):
+    mock.settings.update(min_latency=0.05, max_latency=0.05)
+    keys = [f"AIzaLEN0010key{index:02d}" for index in range(8)]
+    prober = KeyProber(upstream_url, method="completion", concurrency=4)
+    begin = time.monotonic()
+    asyncio.run(prober.probe_keys(keys))
+    # 8个请求、并发4，至少需要两轮
+    assert time.monotonic() - begin >= 0.1
+
+    begin = time.monotonic()
+    asyncio.run(prober.probe_keys(keys[:4], rate=20))
+    assert time.monotonic() - begin >= 0.15
+    assert prober.get_stats()["rounds"] == 2
+
+
+def test_unreachable_upstream_is_a_temporary_error():
+    prober = KeyProber("http://127.0.0.1:9/v1beta", timeout=2)
+    result = asyncio.run(prober.probe_keys([GOOD]))[0]
+    assert result["status"] == ERROR
+    # 网络错误不据此跳过密钥
+    assert prober.is_usable(GOOD)
+
+
+def test_engine_skips_keys_known_to_be_unusable(mock, upstream_url):
+    async def run():
+        prober = KeyProber(upstream_url, method="completion")
+        await prober.probe_keys([GOOD, BAD, QUOTA])
+        engine = ProxyEngine(base_url=upstream_url, key_groups=[[GOOD, BAD, QUOTA]], min_response_length=100,
+                             key_prober=prober)
+        calls = mock.counters["chat_completions"]
+        try:
+            await engine.complete({"model": "gemini-2.5-flash", "messages": [{"role": "user", "content": "你好"}]})
+        finally:
+            await engine.aclose()
+        assert mock.counters["chat_completions"] - calls == 1
+        assert engine.candidate_keys("gemini-2.5-flash") == [GOOD]
+
+        # 一组全部不可用时仍然尝试（探测结果可能已经过时）
+        assert prober.usable([BAD, QUOTA]) == [BAD, QUOTA]
+    asyncio.run(run())
+
+
+def test_load_config_keys(tmp_path):
+    config_file = tmp_path / "config.ini"
+    config = configparser.ConfigParser()
+    config["API"] = {"base_url": "https://example.com/v1beta"}
+    config["API_KEYS"] = {"group1": '["AIzaSyGroupOne001"]', "group2": "[]"}
+    with open(config_file, "w", encoding="utf-8") as f:
+        config.write(f)
+    settings = load_config_keys(str(config_file))
+    assert settings == {"base_url": "https://example.com/v1beta",
+                        "pools": {"group1": ["AIzaSyGroupOne001"], "group2": []}}
+    with pytest.raises(FileNotFoundError):
+        load_config_keys(str(tmp_path / "missing.ini"))
+
+    # 启用密钥存储时读取数据库中的全部密钥池，与 ConfigManager 使用同一个配置项
+    store = KeyStore(str(tmp_path / "keys.db"))
+    store.import_lines(["AIzaSyStoredKey01"], "pro")
+    store.close()
+    config["KEYS"] = {"store": str(tmp_path / "keys.db")}
+    with open(config_file, "w", encoding="utf-8") as f:
+        config.write(f)
+    assert load_config_keys(str(config_file))["pools"] == {"pro": ["AIzaSyStoredKey01"]}
+    manager = ConfigManager(str(config_file))
+    assert manager.get_key_groups() == [["AIzaSyStoredKey01"]]
+    manager.key_store.close()
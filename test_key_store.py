@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+密钥存储测试：批量导入时校验和去重，命名密钥池按导入顺序调度，模型白名单，从 [API_KEYS] 迁移
+"""
+
+import json
+import asyncio
+import configparser
+
+import pytest
+
+from config_manager import ConfigManager
+from key_store import KeyStore, KeyRecord, validate_key
+from proxy_engine import ProxyEngine, EngineError
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = KeyStore(str(tmp_path / "keys.db"))
+    yield store
+    store.close()
+
+
+def test_validate_key():
+    assert validate_key("AIzaSyValidKey0001") is None
+    assert validate_key("") == "密钥为空"
+    assert validate_key("YOUR_API_KEY_1") == "占位符密钥"
+    assert validate_key("short") == "密钥过短"
+    assert validate_key("AIzaSy Valid Key") == "密钥包含空白字符"
+
+
+def test_import_validates_and_deduplicates(store):
+    lines = [
+        "# 注释行",
+        "AIzaSyPoolKey0001",
+        "",
+        "AIzaSyPoolKey0001",
+        "YOUR_API_KEY_1",
+        '{"key": "AIzaSyProKey00002", "pool": "pro", "tier": "paid", "models": ["gemini-2.5-pro"]}',
+        '{"key": 不是JSON',
+        "AIzaSyPoolKey0003",
+    ]
+    counts = store.import_lines(lines, "group1")
+    assert counts == {"imported": 3, "invalid": 2, "duplicates": 1}
+    assert store.groups() == [["AIzaSyPoolKey0001", "AIzaSyPoolKey0003"], ["AIzaSyProKey00002"]]
+    assert store.get("AIzaSyProKey00002").tier == "paid"
+    assert store.get_stats()["pools"] == {"group1": 2, "pro": 1}
+
+    # 重新打开时从数据库加载
+    reopened = KeyStore(store.path)
+    reopened.load()
+    assert reopened.groups() == store.groups()
+    reopened.close()
+
+
+def test_model_whitelist(store):
+    store.import_lines([
+        "AIzaSyAnyModel001",
+        '{"key": "AIzaSyProOnly0002", "models": ["gemini-2.5-pro"]}',
+    ], "group1")
+    keys = ["AIzaSyAnyModel001", "AIzaSyProOnly0002", "AIzaSyNotStored03"]
+    assert store.filter_for_model(keys, "gemini-2.5-flash") == ["AIzaSyAnyModel001", "AIzaSyNotStored03"]
+    assert store.filter_for_model(keys, "gemini-2.5-pro") == keys
+    assert store.filter_for_model(keys, None) == keys
+
+
+def test_disabled_keys_are_not_scheduled(store):
+    store.import_lines(['{"key": "AIzaSyDisabled001", "enabled": false}', "AIzaSyEnabled0002"], "group1")
+    assert store.pool_keys("group1") == ["AIzaSyEnabled0002"]
+    assert store.get_stats()["disabled"] == 1
+
+
+def test_replace_remove_and_export_round_trip(store, tmp_path):
+    store.import_lines(["AIzaSyOldKey00001", "AIzaSyOldKey00002"], "group1")
+    store.import_lines(["AIzaSyOtherPool01"], "group2")
+    store.replace_pool("group1", ["AIzaSyNewKey00001"])
+    assert store.pool_keys("group1") == ["AIzaSyNewKey00001"]
+    assert store.pool_keys("group2") == ["AIzaSyOtherPool01"]
+
+    assert store.remove(["AIzaSyOtherPool01", "AIzaSyMissing0001"]) == 1
+    assert store.groups() == [["AIzaSyNewKey00001"]]
+
+    exported = list(store.export_lines())
+    copy = KeyStore(str(tmp_path / "copy.db"))
+    copy.import_lines(exported, "unused")
+    assert copy.groups() == store.groups()
+    assert copy.get("AIzaSyNewKey00001").pool == "group1"
+    copy.close()
+
+
+def test_masked_export_hides_keys(store):
+    store.import_lines(["AIzaSyMaskedKey01"], "group1")
+    line = json.loads(next(store.export_lines(masked=True)))
+    assert line["key"] == "***ey01"
+    assert line["pool"] == "group1"
+
+
+def test_from_line():
+    record = KeyRecord.from_line('{"key": " AIzaSyJsonKey0001 ", "labels": ["team-a"]}', "group1")
+    assert record.key == "AIzaSyJsonKey0001"
+    assert record.pool == "group1"
+    assert record.labels == ("team-a",)
+    assert record.allows("gemini-2.5-flash")
+
+
+def test_config_keys_are_migrated_once(tmp_path):
+    config_file = tmp_path / "config.ini"
+    config = configparser.ConfigParser()
+    config["API_KEYS"] = {"group1": json.dumps(["AIzaSyGroupOne001"]), "group2": json.dumps(["AIzaSyGroupTwo001"])}
+    config["KEYS"] = {"store": str(tmp_path / "keys.db")}
+    with open(config_file, "w", encoding="utf-8") as f:
+        config.write(f)
+
+    manager = ConfigManager(str(config_file))
+    assert manager.get_key_groups() == [["AIzaSyGroupOne001"], ["AIzaSyGroupTwo001"]]
+    manager.set_api_keys(["AIzaSyGroupOne002"], ["AIzaSyGroupTwo001"])
+    manager.key_store.close()
+
+    # 数据库已存在时不再从配置文件导入
+    manager = ConfigManager(str(config_file))
+    assert manager.get_api_keys() == {"group1": ["AIzaSyGroupOne002"], "group2": ["AIzaSyGroupTwo001"]}
+    manager.key_store.close()
+
+
+def test_key_store_is_opt_in(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config_file = tmp_path / "config.ini"
+    config = configparser.ConfigParser()
+    config["API_KEYS"] = {"group1": json.dumps(["AIzaSyGroupOne001"]), "group2": "[]"}
+    with open(config_file, "w", encoding="utf-8") as f:
+        config.write(f)
+
+    # 没有 [KEYS] store 时直接使用配置文件中的两组密钥，不创建数据库
+    manager = ConfigManager(str(config_file))
+    assert manager.key_store is None
+    assert manager.get_key_groups() == [["AIzaSyGroupOne001"], []]
+    assert not (tmp_path / "keys.db").exists()
+
+
+def test_engine_skips_pools_that_do_not_allow_the_model(store, mock, upstream_url):
+    store.import_lines(['{"key": "AIzaLEN0200proonly", "models": ["gemini-2.5-pro"]}'], "pro")
+    store.import_lines(["AIzaLEN0200anymodel"], "general")
+
+    async def run():
+        engine = ProxyEngine(base_url=upstream_url, key_groups=store.groups(), min_response_length=100,
+                             key_store=store)
+        try:
+            for _ in range(2):
+                result = await engine.complete({"model": "gemini-2.5-flash",
+                                                "messages": [{"role": "user", "content": "你好"}]})
+                assert result.content_length == 200
+        finally:
+            await engine.aclose()
+
+        # 所有密钥池都不允许该模型时直接拒绝，不请求上游
+        engine = ProxyEngine(base_url=upstream_url, key_groups=[store.pool_keys("pro")], key_store=store)
+        try:
+            with pytest.raises(EngineError) as failed:
+                await engine.complete({"model": "gemini-2.5-flash", "messages": [{"role": "user", "content": "你好"}]})
+            assert failed.value.status_code == 400
+            assert engine.stats["upstream_calls"] == 0
+        finally:
+            await engine.aclose()
+    asyncio.run(run())
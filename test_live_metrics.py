@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+实时指标测试：每个间隔只汇总一次，只推送变化的字段，落后太多的订阅者重新收到完整快照
+"""
+
+import json
+import asyncio
+
+from live_metrics import diff_snapshot, MetricsAggregator
+from raw_completion import RawCompletion
+from request_trace import RequestTraceMiddleware, TraceStore, track_upstream, mark_winner
+
+
+def test_diff_snapshot_reports_only_changes():
+    old = {"rps": 1.0, "keys": {"***1111": {"wins": 1, "state": "ok"}, "***2222": {"wins": 0}}, "queue": 3}
+    new = {"rps": 1.0, "keys": {"***1111": {"wins": 2, "state": "ok"}}, "inflight": 4}
+    assert diff_snapshot(old, new) == {
+        "keys": {"***1111": {"wins": 2}, "***2222": None},
+        "inflight": 4,
+        "queue": None,
+    }
+    assert diff_snapshot(new, new) == {}
+
+
+def test_tick_aggregates_requests_and_key_states():
+    metrics = MetricsAggregator(window=10, cooldown_after=2, gauges=lambda: {"queue_depth": 5})
+    for latency in (100, 200, 300, 400):
+        metrics.record_request(latency, True, 2)
+    metrics.record_request(5000, False, 2)
+    metrics.record_leg("***1111", True, won=True)
+    metrics.record_leg("***2222", False)
+    metrics.record_leg("***2222", False)
+    metrics.record_leg("***3333", False)
+
+    snapshot = metrics.tick()
+    assert snapshot["rps"] == 0.5
+    # 失败请求不计入延迟分位数
+    assert snapshot["latency_p50_ms"] == 300
+    assert snapshot["latency_p95_ms"] == 400
+    assert snapshot["upstream_calls_per_request"] == 2
+    assert snapshot["failed_total"] == 1
+    assert snapshot["queue_depth"] == 5
+    assert {hint: key["state"] for hint, key in snapshot["keys"].items()} == {
+        "***1111": "ok", "***2222": "cooldown", "***3333": "failing"}
+
+    # 没有变化时不产生增量
+    assert metrics.tick() is None
+    metrics.record_leg("***2222", True)
+    assert metrics.tick() == {"keys": {"***2222": {"calls": 3, "state": "ok"}}}
+
+
+def test_subscribers_that_fall_behind_get_a_full_snapshot():
+    metrics = MetricsAggregator(history=3)
+    for index in range(5):
+        metrics.record_request(100 + index, True, 1)
+        metrics.tick()
+    seq, snapshot = metrics.current()
+    assert seq == 5
+    assert snapshot["requests_total"] == 5
+    assert metrics.deltas_since(5) == []
+    assert [number for number, _ in metrics.deltas_since(3)] == [4, 5]
+    assert metrics.deltas_since(1) is None
+
+
+def test_sse_stream_starts_with_snapshot_then_deltas():
+    async def run():
+        metrics = MetricsAggregator(interval=0.01)
+        metrics.record_request(100, True, 1)
+        metrics.tick()
+        events = metrics.sse_events()
+        first = await events.__anext__()
+        metrics.record_request(200, True, 1)
+        metrics.tick()
+        second = await events.__anext__()
+        await events.aclose()
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first.startswith("event: snapshot\nid: 1\n")
+    assert json.loads(first.split("data: ", 1)[1])["requests_total"] == 1
+    assert second.startswith("event: delta\nid: 2\n")
+    assert json.loads(second.split("data: ", 1)[1])["requests_total"] == 2
+
+
+def test_trace_observer_records_legs_and_request():
+    async def app(scope, receive, send):
+        async def leg(content):
+            return RawCompletion.from_dict({"choices": [{"message": {"content": content}, "finish_reason": "stop"}]})
+
+        async def failed():
+            return None
+
+        winner = await track_upstream("AIzaWIN-1111", leg("好的"))
+        await track_upstream("AIzaFAIL-2222", failed())
+        mark_winner(winner)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"{}"})
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    metrics = MetricsAggregator()
+    middleware = RequestTraceMiddleware(app, TraceStore(), observers=[metrics.observe_trace])
+    asyncio.run(middleware({"type": "http", "path": "/v1/chat/completions", "headers": []}, receive, send))
+    snapshot = metrics.tick()
+    assert snapshot["requests_total"] == 1
+    assert snapshot["upstream_calls_per_request"] == 2
+    assert snapshot["keys"]["***1111"]["wins"] == 1
+    assert snapshot["keys"]["***2222"]["errors"] == 1
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+内存预算测试：单请求和全局缓冲字节上限，请求结束后归还全部字节
+"""
+
+from memory_budget import MemoryBudget
+
+
+def test_request_limit():
+    budget = MemoryBudget(max_total_bytes=1000, max_request_bytes=100)
+    with budget.request() as buffer:
+        assert buffer.reserve(60)
+        assert not buffer.reserve(50)
+        assert buffer.held == 60
+        buffer.release(60)
+        assert buffer.reserve(100)
+    assert budget.buffered == 0
+    stats = budget.get_stats()
+    assert stats['over_budget'] == 1
+    assert stats['peak_request_bytes'] == 100
+
+
+def test_global_limit_is_shared_between_requests():
+    budget = MemoryBudget(max_total_bytes=150, max_request_bytes=100)
+    first = budget.request()
+    second = budget.request()
+    assert first.reserve(100)
+    assert not second.reserve(60)
+    assert second.reserve(50)
+    assert budget.buffered == 150
+    # 一个请求结束后，其他请求可以使用归还的字节
+    first.close()
+    assert second.reserve(50)
+    second.close()
+    assert budget.buffered == 0
+    assert budget.get_stats()['peak_buffered_bytes'] == 150
+
+
+def test_release_never_goes_negative():
+    budget = MemoryBudget(max_total_bytes=100, max_request_bytes=100)
+    with budget.request() as buffer:
+        buffer.reserve(10)
+        buffer.release(50)
+        assert buffer.held == 0
+        buffer.close()
+    assert budget.buffered == 0
+
+
+def test_buffer_is_released_on_error():
+    budget = MemoryBudget(max_total_bytes=100, max_request_bytes=100)
+    try:
+        with budget.request() as buffer:
+            buffer.reserve(80)
+            raise RuntimeError("上游连接中断")
+    except RuntimeError:
+        pass
+    assert budget.buffered == 0
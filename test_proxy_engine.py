@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+候选选择规则测试（first / longest / score），通过模拟上游验证。
+模拟上游按密钥中的标记返回回答：LEN<字符数> 固定长度，REFUSE 拒答，LOOP 重复同一句话
+"""
+
+import time
+import asyncio
+
+import pytest
+
+from proxy_engine import ProxyEngine, EngineError
+from memory_budget import MemoryBudget
+from candidate_scoring import ScoringPipeline
+
+SHORT = "AIzaLEN0500short"
+LONG = "AIzaLEN0900long"
+REFUSAL = "AIzaREFUSE-LEN0900"
+LOOP = "AIzaLOOP-LEN0900"
+
+REQUEST = {
+    "model": "gemini-2.5-flash",
+    "messages": [{"role": "user", "content": "写一段描写秋天乡村的短文"}],
+}
+
+BACKENDS = ["openai", "native"]
+
+
+def complete(upstream_url, keys, **options):
+    """用一组密钥完成一次请求，返回 (回答内容, 耗时秒数)"""
+    async def run():
+        engine = ProxyEngine(base_url=upstream_url, key_groups=[keys], min_response_length=400, **options)
+        try:
+            started = time.monotonic()
+            result = await engine.complete(dict(REQUEST))
+            return result.content(), time.monotonic() - started
+        finally:
+            await engine.aclose()
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_first_returns_first_valid_response_without_waiting(mock, upstream_url, backend):
+    content, elapsed = complete(upstream_url, [SHORT, LONG], backend=backend, selection="first", wait_more=5)
+    assert len(content) in (500, 900)
+    assert elapsed < 2
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_longest_returns_longest_response(mock, upstream_url, backend):
+    mock.settings.update(min_latency=0.01, max_latency=0.01)
+    content, elapsed = complete(upstream_url, [SHORT, LONG], backend=backend, selection="longest", wait_more=5)
+    assert len(content) == 900
+    # 所有候选都已返回时不必等满 wait_more
+    assert elapsed < 2
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_responses_over_memory_budget_are_dropped(mock, upstream_url, backend):
+    async def run():
+        budget = MemoryBudget(max_total_bytes=1024 * 1024, max_request_bytes=600)
+        engine = ProxyEngine(base_url=upstream_url, key_groups=[[SHORT, LONG]], min_response_length=100,
+                             backend=backend, memory_budget=budget)
+        try:
+            with pytest.raises(EngineError) as failed:
+                await engine.complete(dict(REQUEST))
+            assert failed.value.status_code == 503
+        finally:
+            await engine.aclose()
+        assert budget.buffered == 0
+        assert budget.get_stats()["over_budget"] >= 1
+    asyncio.run(run())
+
+
+def test_no_usable_keys_is_an_engine_error(upstream_url):
+    async def run():
+        engine = ProxyEngine(base_url=upstream_url, key_groups=[["YOUR_API_KEY_1", ""]])
+        try:
+            with pytest.raises(EngineError) as failed:
+                await engine.complete(dict(REQUEST))
+            assert failed.value.status_code == 500
+        finally:
+            await engine.aclose()
+    asyncio.run(run())
+
+
+def test_stream_yields_chunks_of_selected_response(mock, upstream_url):
+    async def run():
+        engine = ProxyEngine(base_url=upstream_url, key_groups=[[SHORT]], min_response_length=400)
+        try:
+            chunks = [chunk async for chunk in engine.stream(dict(REQUEST))]
+        finally:
+            await engine.aclose()
+        content = "".join(chunk["choices"][0]["delta"].get("content", "") for chunk in chunks)
+        assert len(content) == 500
+        assert chunks[-1]["choices"][0]["finish_reason"] == "stop"
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_longest_without_scoring_can_pick_a_refusal(mock, upstream_url, backend):
+    content, _ = complete(upstream_url, [REFUSAL, SHORT], backend=backend, selection="longest", wait_more=5)
+    assert content.startswith("抱歉")
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_score_skips_refusal_and_repetition(mock, upstream_url, backend):
+    content, _ = complete(upstream_url, [REFUSAL, LOOP, SHORT], backend=backend, selection="score", wait_more=5)
+    assert len(content) == 500
+    assert not content.startswith("抱歉")
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_scoring_rejects_bad_candidates_in_first_mode(mock, upstream_url, backend):
+    # 让拒答和重复的候选先返回
+    for _ in range(3):
+        content, _ = complete(upstream_url, [REFUSAL, LOOP, SHORT], backend=backend, selection="first",
+                              scoring=ScoringPipeline())
+        assert len(content) == 500
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+配额统计测试：按 (密钥, 模型) 统计当天用量，429 后暂停使用，按剩余配额排序密钥，重启后继续累计
+"""
+
+import time
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+import quota_tracker
+from quota_tracker import QuotaTracker, quota_day, next_reset, normalize_model, prometheus_label
+from proxy_engine import ProxyEngine
+
+FLASH = "gemini-2.5-flash"
+
+
+@pytest.fixture
+def tracker(tmp_path):
+    tracker = QuotaTracker(str(tmp_path / "quota.db"), limits={"test-model": (2, 3)})
+    yield tracker
+    tracker.close()
+
+
+def test_quota_day_resets_at_pacific_midnight():
+    # 2026-01-15 07:59 UTC 是太平洋时间（冬令时 UTC-8）前一天 23:59
+    before = datetime(2026, 1, 15, 7, 59, tzinfo=timezone.utc).timestamp()
+    assert quota_day(before) == "2026-01-14"
+    assert next_reset(before) == datetime(2026, 1, 15, 8, 0, tzinfo=timezone.utc).timestamp()
+    # 夏令时 UTC-7
+    summer = datetime(2026, 7, 1, 7, 30, tzinfo=timezone.utc).timestamp()
+    assert quota_day(summer) == "2026-07-01"
+    assert next_reset(summer) == datetime(2026, 7, 2, 7, 0, tzinfo=timezone.utc).timestamp()
+
+
+def test_limits_match_longest_prefix(tracker):
+    assert tracker.limits_for("gemini-2.5-flash-lite")[:2] == (15, 1000)
+    assert tracker.limits_for("gemini-2.5-flash-preview-09-2025")[:2] == (10, 250)
+    assert tracker.limits_for("unknown-model")[:2] == (10, 250)
+    assert normalize_model("models/gemini-2.5-pro") == "gemini-2.5-pro"
+
+
+def test_usage_and_minute_window(tracker):
+    tracker.record_call("AIzaKEY-1111", "test-model")
+    tracker.record_call("AIzaKEY-1111", "models/test-model")
+    usage = tracker.usage("AIzaKEY-1111", "test-model")
+    assert usage["requests"] == 2
+    assert usage["day_remaining"] == 1
+    assert usage["minute_remaining"] == 0
+    assert usage["available"] == 0
+    # 一分钟后每分钟配额恢复
+    later = tracker.usage("AIzaKEY-1111", "test-model", now=time.time() + 61)
+    assert later["available"] == 1
+
+
+def test_select_prefers_keys_with_more_remaining_quota(tracker):
+    for _ in range(2):
+        tracker.record_call("AIzaKEY-BUSY", FLASH)
+    tracker.record_call("AIzaKEY-SOME", FLASH)
+    assert tracker.select(["AIzaKEY-BUSY", "AIzaKEY-SOME", "AIzaKEY-IDLE"], FLASH) == [
+        "AIzaKEY-IDLE", "AIzaKEY-SOME", "AIzaKEY-BUSY"]
+
+
+def test_429_pauses_key_until_reset_or_for_a_minute(tracker):
+    tracker.record_call("AIzaKEY-DAY1", FLASH)
+    tracker.record_rejected("AIzaKEY-DAY1", FLASH, 429, "quotaId: GenerateRequestsPerDayPerProjectPerModel-FreeTier")
+    usage = tracker.usage("AIzaKEY-DAY1", FLASH)
+    # 被拒绝的调用不计入用量
+    assert usage["requests"] == 0
+    assert usage["rejected"] == 1
+    assert usage["exhausted_until"] == tracker.reset_at
+
+    tracker.record_rejected("AIzaKEY-MIN1", FLASH, 429, "GenerateRequestsPerMinutePerProjectPerModel")
+    assert tracker.usage("AIzaKEY-MIN1", FLASH)["exhausted_until"] <= time.time() + 60
+    tracker.record_rejected("AIzaKEY-OK01", FLASH, 500, "internal")
+    assert tracker.usage("AIzaKEY-OK01", FLASH)["rejected"] == 0
+
+    assert tracker.select(["AIzaKEY-DAY1", "AIzaKEY-MIN1", "AIzaKEY-OK01"], FLASH) == ["AIzaKEY-OK01"]
+    # 全部暂停时原样返回
+    assert tracker.select(["AIzaKEY-DAY1", "AIzaKEY-MIN1"], FLASH) == ["AIzaKEY-DAY1", "AIzaKEY-MIN1"]
+
+
+def test_usage_survives_restart(tmp_path):
+    path = str(tmp_path / "quota.db")
+    tracker = QuotaTracker(path)
+    for _ in range(3):
+        tracker.record_call("AIzaKEY-1111", FLASH)
+    tracker.record_rejected("AIzaKEY-2222", FLASH, 429, "PerDay")
+    tracker.close()
+    assert tracker.stats["rows_written"] == 2
+
+    reopened = QuotaTracker(path)
+    reopened.load()
+    assert reopened.usage("AIzaKEY-1111", FLASH)["requests"] == 3
+    assert reopened.usage("AIzaKEY-2222", FLASH)["exhausted_until"] is not None
+    reopened.close()
+
+
+def test_day_rollover_clears_counters(tracker, monkeypatch):
+    tracker.record_call("AIzaKEY-1111", FLASH)
+    tomorrow = tracker.reset_at + 10
+    monkeypatch.setattr(quota_tracker.time, "time", lambda: tomorrow)
+    tracker.record_call("AIzaKEY-1111", FLASH)
+    assert tracker.day == quota_day(tomorrow)
+    assert tracker.usage("AIzaKEY-1111", FLASH, now=tomorrow)["requests"] == 1
+    assert tracker.stats["resets"] == 1
+
+
+def test_forecast_and_stats_hide_keys(tracker):
+    for _ in range(5):
+        tracker.record_call("AIzaSECRET-1111", FLASH)
+    forecast = tracker.forecast(FLASH, ["AIzaSECRET-1111", "AIzaSECRET-2222"])
+    assert forecast["requests"] == 5
+    assert forecast["remaining"] == 495
+    stats = tracker.get_stats()
+    assert "***1111" in stats["keys"]
+    assert "AIzaSECRET" not in str(stats) + tracker.prometheus()
+    assert 'llm_proxy_quota_requests_today{key="***1111",model="gemini-2.5-flash"} 5' in tracker.prometheus()
+
+
+def test_engine_records_calls_and_skips_rejected_keys(tmp_path, mock, upstream_url):
+    async def run():
+        tracker = QuotaTracker(str(tmp_path / "quota.db"))
+        engine = ProxyEngine(base_url=upstream_url, key_groups=[["AIzaLEN0200good", "AIzaQUOTA-key2"]],
+                             min_response_length=100, quota_tracker=tracker)
+        request = {"model": FLASH, "messages": [{"role": "user", "content": "你好"}]}
+        try:
+            await engine.complete(dict(request))
+            assert tracker.usage("AIzaQUOTA-key2", FLASH)["rejected"] == 1
+            assert tracker.usage("AIzaLEN0200good", FLASH)["requests"] == 1
+            calls = mock.counters["chat_completions"]
+            await engine.complete(dict(request))
+            # 当天配额已耗尽的密钥不再被请求
+            assert mock.counters["chat_completions"] - calls == 1
+        finally:
+            await engine.aclose()
+            tracker.close()
+    asyncio.run(run())
+
+
+def test_prometheus_labels_are_escaped_and_models_are_bounded(tracker):
+    tracker.record_call("AIzaKEY-1111", 'evil"}\nllm_proxy_fake 1')
+    text = tracker.prometheus()
+    assert not any(line.startswith("llm_proxy_fake") for line in text.splitlines())
+    assert 'model="other"' in text
+    assert prometheus_label('a"b\\c\nd') == 'a\\"b\\\\c\\nd'
+
+    for index in range(quota_tracker.MAX_MODELS + 5):
+        tracker.record_call("AIzaKEY-1111", f"custom-model-{index}")
+    models = {model for _, model in tracker._usage}
+    # 配额表中列出的模型不占名额，超出名额的模型名计入 other
+    assert len(models - set(tracker.limits)) == quota_tracker.MAX_MODELS + 1
+    assert tracker.usage("AIzaKEY-1111", "custom-model-99")["requests"] == 5 + 1
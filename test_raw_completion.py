@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+原始响应局部解析测试：只取内容长度和结束原因，原始字节原样保留用于转发
+"""
+
+import json
+
+from raw_completion import RawCompletion, scan_completion
+
+
+def completion(content, finish_reason="stop", **extra) -> dict:
+    data = {
+        "id": "chatcmpl-1",
+        "object": "chat.completion",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                     "finish_reason": finish_reason}],
+    }
+    data.update(extra)
+    return data
+
+
+def test_scan_keeps_raw_bytes_and_reads_summary():
+    body = json.dumps(completion('他说："你好"\n"content": 不是字段'), ensure_ascii=False).encode('utf-8')
+    result = scan_completion(body)
+    assert result.body is body
+    assert result.content_length == len('他说："你好"\n"content": 不是字段')
+    assert result.finish_reason == "stop"
+    assert result.content() == '他说："你好"\n"content": 不是字段'
+
+
+def test_scan_handles_null_content_and_unusual_layout():
+    result = scan_completion(json.dumps(completion(None, None)).encode('utf-8'))
+    assert result.content_length == 0
+    assert result.finish_reason is None
+
+    # 内容是分段数组时退回完整解析
+    data = completion([{"type": "text", "text": "分段"}, {"type": "text", "text": "内容"}], "length")
+    result = scan_completion(json.dumps(data).encode('utf-8'))
+    assert result.content_length == 4
+    assert result.finish_reason == "length"
+
+    result = scan_completion(b'{"error": {"message": "quota"}}')
+    assert not result.has_choices
+
+
+def test_scan_rejects_non_json():
+    assert scan_completion(b"<html>502 Bad Gateway</html>") is None
+    assert scan_completion(b"[1, 2]") is None
+    assert scan_completion(b"\xff\xfe") is None
+
+
+def test_from_dict_encodes_once_without_escaping():
+    data = completion("中文回答")
+    result = RawCompletion.from_dict(data)
+    assert "中文回答".encode('utf-8') in result.body
+    assert result.json() is data
+    assert json.loads(result.body) == data
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+请求追踪测试：各阶段耗时写入 Server-Timing 响应头，上游请求的建连和首字节耗时记录在时间线中
+"""
+
+import asyncio
+
+import httpx
+
+from raw_completion import RawCompletion
+from proxy_engine import ProxyEngine
+from request_trace import (RequestTraceMiddleware, TraceStore, span, track_upstream, mark_winner,
+                           note_upstream, upstream_extensions, start_trace)
+
+
+def call(app, path="/v1/chat/completions"):
+    """调用ASGI应用，返回响应头字典"""
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(app({"type": "http", "path": path, "method": "POST", "headers": []}, receive, send))
+    return dict(messages[0]["headers"])
+
+
+def proxy_app(upstream_url):
+    """模拟代理：先做准备工作，再经由追踪记录请求上游"""
+    async def app(scope, receive, send):
+        with span("admission"):
+            await asyncio.sleep(0.01)
+
+        async def leg():
+            async with httpx.AsyncClient() as client:
+                response = await client.get(f"{upstream_url}/models", extensions=upstream_extensions())
+            note_upstream(status=response.status_code)
+            return RawCompletion.from_dict({"choices": [{"message": {"content": "好"}, "finish_reason": "stop"}]})
+
+        result = await asyncio.create_task(track_upstream("AIzaTRACE-1234", leg()))
+        mark_winner(result)
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": result.body})
+    return app
+
+
+def test_timeline_and_server_timing_header(mock, upstream_url):
+    store = TraceStore()
+    headers = call(RequestTraceMiddleware(proxy_app(upstream_url), store))
+
+    timing = headers[b"server-timing"].decode()
+    assert timing.startswith("admission;dur=")
+    assert "winner_ttfb;dur=" in timing
+    assert "total;dur=" in timing
+
+    request_id = headers[b"x-proxy-request-id"].decode()
+    trace = store.get(request_id)
+    assert trace["status"] == 200
+    assert trace["total_ms"] >= trace["spans"][0]["dur_ms"] >= 10
+    assert trace["winner"] == "***1234"
+    leg = trace["upstream"][0]
+    assert leg["outcome"] == "winner"
+    assert leg["status"] == 200
+    assert 0 < leg["connect_ms"] <= leg["ttfb_ms"] <= leg["latency_ms"]
+    assert store.list()[0]["id"] == request_id
+
+
+def test_other_paths_are_not_traced():
+    async def app(scope, receive, send):
+        with span("noop"):
+            pass
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    store = TraceStore()
+    headers = call(RequestTraceMiddleware(app, store), path="/stats")
+    assert b"server-timing" not in headers
+    assert store.list() == []
+
+
+def test_store_keeps_only_recent_traces(mock, upstream_url):
+    store = TraceStore(max_entries=2)
+    app = RequestTraceMiddleware(proxy_app(upstream_url), store)
+    ids = [call(app)[b"x-proxy-request-id"].decode() for _ in range(3)]
+    assert [entry["id"] for entry in store.list()] == ids[:0:-1]
+    assert store.get(ids[0]) is None
+
+
+def test_engine_records_collect_and_wait_more_spans(mock, upstream_url):
+    mock.settings.update(min_latency=0.01, max_latency=0.01)
+
+    async def run(selection):
+        trace = start_trace("/v1/chat/completions")
+        engine = ProxyEngine(base_url=upstream_url, key_groups=[["AIzaLEN0500trace1", "AIzaLEN0900trace2"]],
+                             min_response_length=100, selection=selection, wait_more=5)
+        try:
+            await engine.complete({"model": "gemini-2.5-flash", "messages": [{"role": "user", "content": "你好"}]})
+        finally:
+            await engine.aclose()
+        return {item["name"]: item for item in trace.spans}
+
+    spans = asyncio.run(run("longest"))
+    # 收到第一个有效候选之后才开始额外等待，两段首尾相接
+    assert spans["wait_more"]["start_ms"] >= spans["collect"]["start_ms"] + spans["collect"]["dur_ms"] - 0.2
+    assert "fanout" in spans
+    assert "wait_more" not in asyncio.run(run("first"))
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+租户管理测试：按代理密钥识别租户，每个租户各自的RPM和并发限制，租户表修改后自动重新加载
+"""
+
+import os
+import json
+import asyncio
+
+import pytest
+
+from admission_control import AdmissionRejected
+from tenant_manager import TenantManager
+
+TENANTS = {
+    "tenants": [
+        {"name": "alice", "key": "sk-alice-test-key", "rpm": 2, "max_concurrency": 1, "weight": 1},
+        {"name": "bots", "key": "sk-bots-test-key", "rpm": 0, "max_concurrency": 0, "weight": 3},
+    ]
+}
+
+
+def write_tenants(path, data):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(data if isinstance(data, str) else json.dumps(data))
+    # 保证修改时间变化（有些文件系统的时间精度只有1秒）
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 2))
+
+
+@pytest.fixture
+def tenants_file(tmp_path):
+    path = str(tmp_path / "tenants.json")
+    write_tenants(path, TENANTS)
+    return path
+
+
+def new_manager(path, default_api_key=""):
+    manager = TenantManager(path, default_api_key)
+    # 测试中每次访问都检查文件是否变化
+    manager.RELOAD_CHECK_INTERVAL = 0
+    return manager
+
+
+def test_authenticate_by_proxy_key(tenants_file):
+    manager = new_manager(tenants_file)
+    assert manager.authenticate("sk-alice-test-key").name == "alice"
+    assert manager.authenticate("sk-bots-test-key").weight == 3
+    assert manager.authenticate("sk-unknown-key") is None
+
+
+def test_missing_file_falls_back_to_default_tenant(tmp_path):
+    manager = new_manager(str(tmp_path / "missing.json"), default_api_key="123")
+    assert manager.authenticate("123").name == "default"
+    assert manager.authenticate("456") is None
+
+
+def test_rpm_limit_rejects_with_retry_after(tenants_file):
+    manager = new_manager(tenants_file)
+    alice = manager.authenticate("sk-alice-test-key")
+    manager.check_rate(alice)
+    manager.check_rate(alice)
+    with pytest.raises(AdmissionRejected) as rejected:
+        manager.check_rate(alice)
+    assert rejected.value.status_code == 429
+    assert 1 <= rejected.value.retry_after <= 60
+    assert alice.usage['rejected_rate'] == 1
+
+    bots = manager.authenticate("sk-bots-test-key")
+    for _ in range(50):
+        manager.check_rate(bots)
+
+
+def test_concurrency_limit(tenants_file):
+    async def run():
+        manager = new_manager(tenants_file)
+        alice = manager.authenticate("sk-alice-test-key")
+        async with manager.track(alice):
+            assert alice.active == 1
+            with pytest.raises(AdmissionRejected):
+                async with manager.track(alice):
+                    pass
+        assert alice.active == 0
+        async with manager.track(alice):
+            pass
+        assert alice.usage['rejected_concurrency'] == 1
+    asyncio.run(run())
+
+
+def test_reload_keeps_usage_and_applies_new_limits(tenants_file):
+    manager = new_manager(tenants_file)
+    alice = manager.authenticate("sk-alice-test-key")
+    manager.check_rate(alice)
+    manager.record_result(alice, True, 120)
+
+    data = json.loads(json.dumps(TENANTS))
+    data["tenants"][0].update(key="sk-alice-rotated-key", rpm=10)
+    data["tenants"].append({"name": "carol", "key": "sk-carol-test-key"})
+    write_tenants(tenants_file, data)
+
+    assert manager.authenticate("sk-alice-test-key") is None
+    reloaded = manager.authenticate("sk-alice-rotated-key")
+    assert reloaded is alice
+    assert alice.rpm == 10
+    assert alice.usage['requests'] == 1
+    assert alice.usage['response_chars'] == 120
+    assert manager.authenticate("sk-carol-test-key").name == "carol"
+    assert "carol" in manager.get_stats()
+
+
+def test_stats_do_not_contain_keys(tenants_file):
+    manager = new_manager(tenants_file)
+    text = json.dumps(manager.get_stats())
+    assert "sk-alice-test-key" not in text
+    assert manager.get_stats()["alice"]["key_hint"] == "***-key"
+
+
+@pytest.mark.parametrize("content", [
+    "{not json",
+    "[]",
+    '{"tenants": {"name": "alice"}}',
+    '{"tenants": ["alice"]}',
+    '{"tenants": [{"name": "alice", "key": 12345678901234}]}',
+    '{"tenants": [{"name": "alice", "key": "sk-alice-test-key", "rpm": "many"}]}',
+])
+def test_invalid_file_keeps_last_good_tenants(tenants_file, content):
+    manager = new_manager(tenants_file)
+    write_tenants(tenants_file, content)
+    assert manager.authenticate("sk-alice-test-key").name == "alice"
+    assert set(manager.get_stats()) == {"alice", "bots"}
+
+
+def test_duplicate_names_and_keys_keep_the_first_entry(tenants_file):
+    manager = new_manager(tenants_file)
+    write_tenants(tenants_file, {"tenants": [
+        {"name": "alice", "key": "sk-alice-test-key"},
+        {"name": "alice", "key": "sk-alice-second-key"},
+        {"name": "mallory", "key": "sk-alice-test-key"},
+        {"name": "bots", "key": "sk-bots-test-key", "rpm": None, "weight": None},
+    ]})
+    assert manager.authenticate("sk-alice-test-key").name == "alice"
+    assert manager.authenticate("sk-alice-second-key") is None
+    assert set(manager.get_stats()) == {"alice", "bots"}
+    bots = manager.authenticate("sk-bots-test-key")
+    assert bots.rpm == 0
+    assert bots.weight == 1.0
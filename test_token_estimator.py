@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+token估算测试：按字符类别计数，只用单一类别占主导的样本校准，
+响应的token数优先取上游 usage（扣除思考token），配额按每分钟token数限流
+"""
+
+from quota_tracker import QuotaTracker
+from raw_completion import RawCompletion, scan_completion
+from token_estimator import TokenEstimator, char_classes
+
+
+def test_char_classes():
+    assert char_classes("hello") == (5, 0, 0)
+    assert char_classes("你好，world") == (5, 3, 0)
+    assert char_classes("Привет") == (0, 0, 6)
+    assert char_classes("naïve 日本") == (5, 2, 1)
+
+
+def test_count_uses_per_class_ratios():
+    estimator = TokenEstimator()
+    assert estimator.count("") == 0
+    assert estimator.count("a" * 40) == 10
+    assert estimator.count("你" * 40) == 30
+    assert estimator.count("a" * 40 + "你" * 40) == 40
+    assert estimator.count_messages([{"role": "user", "content": "a" * 40},
+                                     {"role": "user", "content": [{"type": "text", "text": "a" * 8}]}]) == 20
+    assert estimator.get_stats()["estimates"] == 5
+    # 逐段累加不取整的估算值，与整段估算一致
+    assert sum(estimator.estimate("a" * 2) for _ in range(20)) == estimator.count("a" * 40)
+
+
+def test_calibration_only_uses_dominant_class_samples():
+    estimator = TokenEstimator(alpha=0.5)
+    estimator.observe("你" * 100, 100)
+    # 估算75，实际100：比例按 alpha 向实际值移动一半
+    assert abs(estimator.ratios["cjk"] - 0.75 * (1 + 0.5 * (100 / 75 - 1))) < 1e-9
+    assert estimator.ratios["ascii"] == 0.25
+
+    # 混合文本只统计误差，不更新比例
+    ratios = dict(estimator.ratios)
+    estimator.observe("a" * 100 + "你" * 40, 60)
+    assert estimator.ratios == ratios
+
+    # 明显不合理的样本（如计入了思考token）跳过
+    estimator.observe("a" * 100, 500)
+    assert estimator.ratios == ratios
+    stats = estimator.get_stats()
+    assert stats["samples"] == 3
+    assert stats["calibrated"] == 1
+    assert stats["skipped"] == 1
+    assert stats["mean_error"] is not None
+
+
+def test_response_tokens_prefer_upstream_usage_without_reasoning():
+    body = (b'{"choices":[{"message":{"content":"hello world"},"finish_reason":"stop"}],'
+            b'"usage":{"prompt_tokens":7,"completion_tokens":30,"completion_tokens_details":{"reasoning_tokens":28}}}')
+    result = scan_completion(body)
+    assert result.tokens == 2
+    assert result.prompt_tokens == 7
+
+    # 没有 usage 时本地估算
+    estimated = RawCompletion.from_dict({"choices": [{"message": {"content": "a" * 40}, "finish_reason": "stop"}]})
+    assert estimated.tokens == 10
+    assert estimated.prompt_tokens == 0
+
+
+def test_quota_tracker_limits_tokens_per_minute(tmp_path):
+    tracker = QuotaTracker(str(tmp_path / "quota.db"), limits={"test-model": (10, 100, 1000)})
+    try:
+        assert tracker.limits_for("test-model") == (10, 100, 1000)
+        # 只给出 RPM/RPD 的模型使用默认TPM
+        assert QuotaTracker(str(tmp_path / "other.db"), limits={"m": (1, 2)}, default_tpm=5).limits_for("m") == (1, 2, 5)
+
+        tracker.record_call("AIzaKEY-1111", "test-model", tokens=600)
+        assert tracker.usage("AIzaKEY-1111", "test-model")["available"] > 0
+        tracker.record_tokens("AIzaKEY-1111", "test-model", 400)
+        usage = tracker.usage("AIzaKEY-1111", "test-model")
+        assert usage["minute_tokens"] == 1000
+        assert usage["available"] == 0
+        assert tracker.select(["AIzaKEY-1111", "AIzaKEY-2222"], "test-model") == ["AIzaKEY-2222"]
+    finally:
+        tracker.close()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+流量录制和回放测试：中间件把请求耗时、各密钥的上游结果写入JSONL，回放工具据此重建请求
+"""
+
+import json
+import asyncio
+
+from raw_completion import RawCompletion
+from request_trace import track_upstream, mark_winner
+from traffic_recorder import TrafficRecorder, TrafficRecorderMiddleware, summarize_body
+from replay import load_entries, build_body, percentile
+
+REQUEST = {
+    "model": "gemini-2.5-flash",
+    "messages": [{"role": "system", "content": "你是助手"}, {"role": "user", "content": "写一首诗"}],
+    "max_tokens": 64,
+}
+
+
+def completion(content: str) -> RawCompletion:
+    return RawCompletion.from_dict({"choices": [{"message": {"content": content}, "finish_reason": "stop"}]})
+
+
+async def racing_app(scope, receive, send):
+    """模拟代理：两个密钥并发请求，较快的一个获胜"""
+    await receive()
+
+    async def leg(delay, content):
+        await asyncio.sleep(delay)
+        return completion(content)
+
+    fast = asyncio.create_task(track_upstream("AIzaFAST-1111", leg(0.01, "床前明月光")))
+    slow = asyncio.create_task(track_upstream("AIzaSLOW-2222", leg(1, "太慢了")))
+    winner = await fast
+    mark_winner(winner)
+    slow.cancel()
+    await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+    await send({"type": "http.response.body", "body": winner.body})
+
+
+def call(app, path, body: bytes):
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        pass
+
+    asyncio.run(app({"type": "http", "path": path, "method": "POST", "headers": []}, receive, send))
+
+
+def test_middleware_records_upstream_legs_and_winner(tmp_path):
+    path = str(tmp_path / "traffic" / "traffic.jsonl")
+    recorder = TrafficRecorder(path)
+    app = TrafficRecorderMiddleware(racing_app, recorder)
+    call(app, "/v1/chat/completions", json.dumps(REQUEST).encode())
+    call(app, "/health", b"")
+    recorder.close()
+
+    entries = load_entries([path])
+    assert len(entries) == 1
+    entry = entries[0]
+    assert entry["status"] == 200
+    assert entry["upstream_calls"] == 2
+    assert entry["winner"] == "***1111"
+    assert [leg["outcome"] for leg in entry["upstream"]] == ["winner", "cancelled"]
+    assert entry["first_byte_ms"] <= entry["latency_ms"]
+    assert entry["request"] == summarize_body(REQUEST)
+    # 默认不录制对话内容，密钥只保留末4位
+    assert "body" not in entry
+    text = open(path, encoding="utf-8").read()
+    assert "写一首诗" not in text
+    assert "AIzaFAST" not in text
+
+
+def test_bodies_are_recorded_only_when_enabled(tmp_path):
+    path = str(tmp_path / "traffic.jsonl")
+    recorder = TrafficRecorder(path, include_bodies=True)
+    call(TrafficRecorderMiddleware(racing_app, recorder), "/v1/chat/completions", json.dumps(REQUEST).encode())
+    recorder.close()
+    entry = load_entries([path])[0]
+    assert entry["body"] == REQUEST
+    assert build_body(entry) == REQUEST
+
+
+def test_build_body_from_summary():
+    entry = {"request": {"model": "gemini-2.5-pro", "stream": True, "messages": 3, "prompt_chars": 300,
+                         "max_tokens": 128}}
+    body = build_body(entry)
+    assert body["model"] == "gemini-2.5-pro"
+    assert body["stream"] is True
+    assert body["max_tokens"] == 128
+    assert [message["role"] for message in body["messages"]] == ["user", "assistant", "user"]
+    assert sum(len(message["content"]) for message in body["messages"]) == 300
+
+
+def test_load_entries_sorts_by_time_and_skips_bad_lines(tmp_path):
+    path = tmp_path / "traffic.jsonl"
+    path.write_text('{"ts": 2, "id": "b"}\n不是JSON\n\n{"ts": 1, "id": "a"}\n', encoding="utf-8")
+    assert [entry["id"] for entry in load_entries([str(path)])] == ["a", "b"]
+    assert len(load_entries([str(tmp_path / "*.jsonl")], limit=1)) == 1
+    assert percentile([], 0.5) is None
+    assert percentile([5, 1, 3, 2, 4], 0.5) == 3
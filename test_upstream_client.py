@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上游连接测试：DNS解析缓存（并发合并、TTL、解析失败时沿用旧地址）和连接预热
+"""
+
+import time
+import socket
+import asyncio
+
+import pytest
+
+from upstream_client import DNSCache, UpstreamClient
+
+
+@pytest.fixture
+def resolver(monkeypatch):
+    """替换事件循环的 getaddrinfo，记录解析次数，可设置为解析失败"""
+    state = {'calls': 0, 'fail': False, 'address': '127.0.0.1'}
+
+    async def getaddrinfo(self, host, port, **kwargs):
+        state['calls'] += 1
+        await asyncio.sleep(0.01)
+        if state['fail']:
+            raise socket.gaierror("temporary failure in name resolution")
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', (state['address'], port))]
+
+    monkeypatch.setattr(asyncio.BaseEventLoop, 'getaddrinfo', getaddrinfo)
+    return state
+
+
+def test_concurrent_lookups_are_shared(resolver):
+    async def run():
+        cache = DNSCache(ttl=60)
+        addresses = await asyncio.gather(*(cache.resolve("api.example.com", 443) for _ in range(10)))
+        assert addresses == ["127.0.0.1"] * 10
+        assert resolver['calls'] == 1
+        assert await cache.resolve("api.example.com", 443) == "127.0.0.1"
+        assert cache.stats == {'hits': 1, 'misses': 1, 'failures': 0}
+    asyncio.run(run())
+
+
+def test_ip_and_localhost_are_not_cached(resolver):
+    async def run():
+        cache = DNSCache(ttl=60)
+        assert await cache.resolve("127.0.0.1", 443) is None
+        assert await cache.resolve("localhost", 443) is None
+        assert await DNSCache(ttl=0).resolve("api.example.com", 443) is None
+        assert resolver['calls'] == 0
+    asyncio.run(run())
+
+
+def test_expired_entry_is_refreshed_and_kept_when_lookup_fails(resolver):
+    async def run():
+        cache = DNSCache(ttl=60)
+        await cache.resolve("api.example.com", 443)
+        host_entry = cache._entries["api.example.com"]
+        cache._entries["api.example.com"] = (host_entry[0], time.monotonic() - 1)
+
+        resolver['address'] = '127.0.0.2'
+        assert await cache.resolve("api.example.com", 443) == "127.0.0.2"
+        cache._entries["api.example.com"] = ("127.0.0.2", time.monotonic() - 1)
+
+        # 解析失败时沿用过期的地址
+        resolver['fail'] = True
+        assert await cache.resolve("api.example.com", 443) == "127.0.0.2"
+        assert cache.stats['failures'] == 1
+        assert await cache.resolve("unknown.example.com", 443) is None
+    asyncio.run(run())
+
+
+def test_requests_connect_to_cached_address(mock, upstream_url, resolver):
+    async def run():
+        upstream = UpstreamClient()
+        try:
+            url = upstream_url.replace("127.0.0.1", "upstream.test")
+            for _ in range(3):
+                response = await upstream.client.get(f"{url}/models")
+                assert response.status_code == 200
+            # 请求的 Host 仍是原域名
+            assert response.request.url.host == "upstream.test"
+        finally:
+            await upstream.aclose()
+        assert resolver['calls'] == 1
+        assert upstream.get_connection_stats()['dns']['entries'] == {"upstream.test": "127.0.0.1"}
+    asyncio.run(run())
+
+
+def test_warm_opens_idle_connections(mock, upstream_url):
+    async def run():
+        upstream = UpstreamClient(warm_connections=4)
+        try:
+            assert await upstream.warm(f"{upstream_url}/models") == 4
+            stats = upstream.get_connection_stats()
+            assert stats['warm']['rounds'] == 1
+            assert stats['pool']['idle_connections'] >= 1
+            assert mock.counters['model_list_requests'] == 4
+
+            # 请求复用已预热的连接，不新建连接
+            connections = stats['pool']['connections']
+            await upstream.client.get(f"{upstream_url}/models")
+            assert upstream.get_connection_stats()['pool']['connections'] == connections
+        finally:
+            await upstream.aclose()
+    asyncio.run(run())
+
+
+def test_warm_failures_are_counted():
+    async def run():
+        upstream = UpstreamClient(warm_connections=2)
+        try:
+            assert await upstream.warm("http://127.0.0.1:9/v1beta/models") == 0
+            assert upstream.warm_stats['failures'] == 2
+        finally:
+            await upstream.aclose()
+    asyncio.run(run())
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地token数估算模块
+长度检查和用量统计原来都按字符数计算，中日韩文本的字符数和token数相差很大。
+这里按字符类别（ASCII、中日韩等三字节字符、其他非ASCII）分别计数并乘以每类的token/字符比例，
+比例在上游返回 usage 时按该类占主导的样本在线校准（Gemini各模型共用同一个分词器，
+所以校准系数不分模型）。
+
+计数只用 str.isascii / str.encode 这类C实现的整串操作（由UTF-8字节数反推各类字符数），
+每个响应只需几微秒
+"""
+
+import math
+import logging
+import threading
+from typing import Dict, Any, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 未校准时每类字符的token/字符比例（英文约4字符一个token，汉字约0.75个token）
+DEFAULT_RATIOS = {'ascii': 0.25, 'cjk': 0.75, 'other': 0.5}
+
+# 某类字符贡献的估算token数占比达到该值时，才用这个样本校准该类比例
+DOMINANT_SHARE = 0.8
+
+# 上游token数与估算值之比超出该范围的样本不用于校准（如计入了思考token）
+PLAUSIBLE_RATIO = (0.5, 2.0)
+
+
+def char_classes(text: str) -> Tuple[int, int, int]:
+    """
+    (ASCII字符数, 三字节字符数, 其他字符数)。UTF-8中ASCII占1字节，拉丁扩展/西里尔等占2字节，
+    中日韩（以及泰文、天城文等）占3字节，由总字节数即可算出各类字符数，不必逐字符判断
+    """
+    total = len(text)
+    if text.isascii():
+        return total, 0, 0
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    extra = len(text.encode('utf-8', 'surrogatepass')) - total
+    non_ascii = total - ascii_chars
+    # extra = 其他字符数 + 2 × 三字节字符数（四字节的表情符号按三字节计）
+    wide = min(non_ascii, max(0, extra - non_ascii))
+    return ascii_chars, wide, non_ascii - wide
+
+
+class TokenEstimator:
+    """按字符类别估算token数，并根据上游返回的usage在线校准"""
+
+    def __init__(self, ratios: Optional[Dict[str, float]] = None, alpha: float = 0.05):
+        """
+        Args:
+            ratios: 初始的每类字符token/字符比例，未提供的类别使用 DEFAULT_RATIOS
+            alpha: 校准的指数滑动平均系数
+        """
+        self.ratios = dict(DEFAULT_RATIOS, **(ratios or {}))
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self.stats = {'estimates': 0, 'chars': 0, 'samples': 0, 'calibrated': 0, 'skipped': 0}
+        # 校准前估算误差（|估算-实际|/实际）的滑动平均，用于观察估算质量
+        self._error = None
+
+    def _parts(self, text: str) -> Dict[str, float]:
+        ascii_chars, cjk_chars, other_chars = char_classes(text)
+        ratios = self.ratios
+        return {
+            'ascii': ascii_chars * ratios['ascii'],
+            'cjk': cjk_chars * ratios['cjk'],
+            'other': other_chars * ratios['other'],
+        }
+
+    def estimate(self, text: Optional[str]) -> float:
+        """不取整的估算值（流式内容逐段累加时使用，避免每段都向上取整使结果偏大）"""
+        if not text:
+            return 0.0
+        self.stats['estimates'] += 1
+        self.stats['chars'] += len(text)
+        return sum(self._parts(text).values())
+
+    def count(self, text: Optional[str]) -> int:
+        """估算一段文本的token数"""
+        return math.ceil(self.estimate(text))
+
+    def count_messages(self, messages: Any) -> int:
+        """估算OpenAI格式消息列表的token数（每条消息另加约4个token的角色和分隔开销）"""
+        if not isinstance(messages, list):
+            return 0
+        total = 0
+        for message in messages:
+            if not isinstance(message, dict):
+                continue
+            content = message.get('content')
+            if isinstance(content, list):
+                content = ' '.join(part.get('text', '') for part in content if isinstance(part, dict))
+            total += self.count(content if isinstance(content, str) else '') + 4
+        return total
+
+    def observe(self, text: Optional[str], tokens: int):
+        """
+        用上游返回的实际token数校准：只有某类字符占主导的样本才更新该类的比例，
+        混合文本无法分清误差来自哪一类，只用于统计误差
+        """
+        if not text or tokens <= 0:
+            return
+        parts = self._parts(text)
+        estimate = sum(parts.values())
+        if estimate <= 0:
+            return
+        self.stats['samples'] += 1
+        error = abs(estimate - tokens) / tokens
+        ratio = tokens / estimate
+        with self._lock:
+            self._error = error if self._error is None else self._error + 0.05 * (error - self._error)
+            if not PLAUSIBLE_RATIO[0] <= ratio <= PLAUSIBLE_RATIO[1]:
+                self.stats['skipped'] += 1
+                return
+            for name, value in parts.items():
+                if value >= DOMINANT_SHARE * estimate:
+                    self.ratios[name] *= 1 + self.alpha * (ratio - 1)
+                    self.stats['calibrated'] += 1
+                    break
+
+    def get_stats(self) -> Dict[str, Any]:
+        return dict(
+            self.stats,
+            ratios={name: round(value, 4) for name, value in self.ratios.items()},
+            mean_error=None if self._error is None else round(self._error, 3),
+        )
+
+
+# 全局估算器（各模块共用同一份校准结果）
+token_estimator = TokenEstimator()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+流量录制模块
+把每个客户端请求的耗时、各密钥的上游结果和最终选中的密钥写入滚动的JSONL文件，
+供 replay.py 回放，对比不同版本的延迟和上游调用次数。
+文件写入在后台线程中进行，不阻塞事件循环；密钥只保留末4位
+"""
+
+import os
+import json
+import queue
+import logging
+import logging.handlers
+from typing import Dict, Any, Iterable, Optional
+
+from request_trace import start_trace, get_trace
+
+logger = logging.getLogger(__name__)
+
+
+def summarize_body(body: Optional[dict]) -> Dict[str, Any]:
+    """不录制请求体时保存的摘要，足以在回放时构造同等规模的请求"""
+    if not isinstance(body, dict):
+        return {}
+    messages = body.get('messages') or []
+    return {
+        'model': body.get('model'),
+        'stream': bool(body.get('stream')),
+        'messages': len(messages),
+        'prompt_chars': sum(len(str(message.get('content', ''))) for message in messages if isinstance(message, dict)),
+        'max_tokens': body.get('max_tokens'),
+    }
+
+
+class TrafficRecorder:
+    """后台写入的流量录制器"""
+
+    def __init__(self, path: str = "traffic/traffic.jsonl", include_bodies: bool = False,
+                 max_bytes: int = 50 * 1024 * 1024, backup_count: int = 5, queue_size: int = 10000):
+        """
+        Args:
+            path: 录制文件路径（按大小滚动）
+            include_bodies: 是否录制完整请求体（可能包含敏感对话内容）
+            max_bytes: 单个文件的最大字节数
+            backup_count: 保留的历史文件数
+            queue_size: 写入队列长度，写入跟不上时丢弃新记录而不是阻塞请求
+        """
+        self.path = path
+        self.include_bodies = include_bodies
+        self.recorded = 0
+        self.dropped = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._queue: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8'
+        )
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self._listener = logging.handlers.QueueListener(self._queue, handler)
+        self._listener.start()
+        logger.info(f"流量录制已启用，写入 {path}")
+
+    def record(self, entry: Dict[str, Any]):
+        """提交一条记录（非阻塞）"""
+        line = json.dumps(entry, ensure_ascii=False, separators=(',', ':'))
+        record = logging.makeLogRecord({'msg': line, 'levelno': logging.INFO, 'levelname': 'INFO'})
+        try:
+            self._queue.put_nowait(record)
+            self.recorded += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """停止后台写入线程（会先写完队列中的记录）"""
+        self._listener.stop()
+        for handler in self._listener.handlers:
+            handler.close()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'path': self.path,
+            'include_bodies': self.include_bodies,
+            'recorded': self.recorded,
+            'dropped': self.dropped,
+            'queued': self._queue.qsize(),
+        }
+
+
+class TrafficRecorderMiddleware:
+    """录制指定路径请求的ASGI中间件"""
+
+    def __init__(self, app, recorder: TrafficRecorder, paths: Iterable[str] = ('/v1/chat/completions',)):
+        self.app = app
+        self.recorder = recorder
+        self.paths = tuple(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].startswith(self.paths):
+            await self.app(scope, receive, send)
+            return
+
+        # 启用了请求追踪中间件时沿用其追踪记录
+        trace = get_trace() or start_trace(scope['path'])
+        body_chunks = []
+        state = {'status': 0, 'first_byte_ms': None, 'bytes_out': 0}
+
+        async def receive_wrapper():
+            message = await receive()
+            if message['type'] == 'http.request':
+                body_chunks.append(message.get('body', b''))
+            return message
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                state['status'] = message['status']
+            elif message['type'] == 'http.response.body':
+                if state['first_byte_ms'] is None:
+                    state['first_byte_ms'] = trace.elapsed_ms()
+                state['bytes_out'] += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            self._record(trace, b''.join(body_chunks), state)
+
+    def _record(self, trace, raw_body: bytes, state: Dict[str, Any]):
+        try:
+            body = json.loads(raw_body) if raw_body else None
+        except ValueError:
+            body = None
+
+        entry = trace.to_dict()
+        entry.update(
+            status=state['status'],
+            latency_ms=trace.elapsed_ms(),
+            first_byte_ms=state['first_byte_ms'],
+            bytes_out=state['bytes_out'],
+            request=summarize_body(body),
+        )
+        if self.recorder.include_bodies and body is not None:
+            entry['body'] = body
+        self.recorder.record(entry)
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+共享上游客户端模块
+所有上游请求复用同一个 httpx.AsyncClient（连接池），协商压缩的响应编码，
+并可选地对较大的请求体进行gzip压缩；统计线上传输字节与解压后字节。
+启动时预先建立若干连接并定期保活，缓存DNS解析结果，避免突发请求时
+每路并发都要重新解析域名和握手
+"""
+
+import gzip
+import json
+import time
+import socket
+import asyncio
+import logging
+import ipaddress
+from typing import Dict, Any, Optional, Tuple
+
+import httpx
+
+try:
+    import brotli  # noqa: F401  httpx 检测到该包时才能解码 br
+    ACCEPT_ENCODING = "gzip, br"
+except ImportError:
+    ACCEPT_ENCODING = "gzip"
+
+logger = logging.getLogger(__name__)
+
+# 进程内共享的TLS上下文，CA证书只加载一次
+_ssl_context = None
+
+
+def shared_ssl_context():
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = httpx.create_ssl_context()
+    return _ssl_context
+
+
+def _is_ip_address(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+
+class DNSCache:
+    """带TTL的DNS解析缓存，同一域名的并发解析只进行一次"""
+
+    def __init__(self, ttl: float = 300):
+        """
+        Args:
+            ttl: 解析结果的缓存时间（秒），为0时不缓存
+        """
+        self.ttl = ttl
+        self._entries: Dict[str, Tuple[str, float]] = {}
+        self._pending: Dict[str, asyncio.Future] = {}
+        self.stats = {'hits': 0, 'misses': 0, 'failures': 0}
+
+    async def resolve(self, host: str, port: int) -> Optional[str]:
+        """
+        返回域名对应的IP地址；无需缓存或解析失败时返回None，由连接层自行解析
+        """
+        if self.ttl <= 0 or not host or host == 'localhost' or _is_ip_address(host):
+            return None
+
+        entry = self._entries.get(host)
+        if entry and entry[1] > time.monotonic():
+            self.stats['hits'] += 1
+            return entry[0]
+
+        if host in self._pending:
+            return await asyncio.shield(self._pending[host])
+
+        self.stats['misses'] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[host] = future
+        address = None
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+            address = infos[0][4][0]
+            self._entries[host] = (address, time.monotonic() + self.ttl)
+        except OSError as e:
+            self.stats['failures'] += 1
+            if entry:
+                # 解析失败时继续使用过期的结果，好过整批请求失败
+                logger.warning(f"解析 {host} 失败，继续使用缓存的地址 {entry[0]}: {e}")
+                address = entry[0]
+            else:
+                logger.warning(f"解析 {host} 失败: {e}")
+        finally:
+            del self._pending[host]
+            future.set_result(address)
+        return address
+
+    def get_stats(self) -> Dict[str, Any]:
+        return dict(self.stats, ttl=self.ttl, entries={host: entry[0] for host, entry in self._entries.items()})
+
+
+class _CachedDNSTransport(httpx.AsyncBaseTransport):
+    """先查DNS缓存再连接的传输层（TLS的SNI和证书校验仍使用原域名）"""
+
+    def __init__(self, dns_cache: DNSCache, **kwargs):
+        self.dns_cache = dns_cache
+        self.transport = httpx.AsyncHTTPTransport(**kwargs)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        url = request.url
+        port = url.port or (443 if url.scheme == 'https' else 80)
+        address = await self.dns_cache.resolve(url.host, port)
+        if address is None:
+            return await self.transport.handle_async_request(request)
+        # Host 请求头在构造请求时已按原域名设置
+        request.url = url.copy_with(host=address)
+        request.extensions = dict(request.extensions, sni_hostname=url.host)
+        try:
+            return await self.transport.handle_async_request(request)
+        finally:
+            request.url = url
+
+    def pool_stats(self) -> Dict[str, int]:
+        connections = self.transport._pool.connections
+        return {
+            'connections': len(connections),
+            'idle_connections': sum(1 for connection in connections if connection.is_idle()),
+        }
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class UpstreamClient:
+    """共享的上游HTTP客户端"""
+
+    def __init__(self, gzip_requests: bool = False, gzip_min_bytes: int = 16384,
+                 warm_connections: int = 0, keepalive_interval: float = 45,
+                 keepalive_expiry: float = 120, dns_cache_ttl: float = 300):
+        """
+        Args:
+            gzip_requests: 是否对上游请求体进行gzip压缩
+            gzip_min_bytes: 请求体达到该字节数才压缩
+            warm_connections: 启动时预先建立并保活的连接数，0为不预热
+            keepalive_interval: 保活请求的间隔（秒）
+            keepalive_expiry: 空闲连接保留的时间（秒），应大于保活间隔
+            dns_cache_ttl: DNS解析结果的缓存时间（秒）
+        """
+        self.gzip_requests = gzip_requests
+        self.gzip_min_bytes = gzip_min_bytes
+        self.warm_connections = warm_connections
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_expiry = keepalive_expiry
+        self.dns_cache = DNSCache(dns_cache_ttl)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._transport: Optional[_CachedDNSTransport] = None
+        self._warm_task: Optional[asyncio.Task] = None
+        self.warm_stats = {'rounds': 0, 'requests': 0, 'failures': 0, 'last_round_ms': None}
+
+        self.stats = {
+            'requests': 0,
+            'gzipped_requests': 0,
+            'request_bytes': 0,
+            'request_wire_bytes': 0,
+            'responses': 0,
+            'response_bytes': 0,
+            'response_wire_bytes': 0,
+        }
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """首次使用时创建客户端（必须在事件循环中创建）"""
+        if self._client is None or self._client.is_closed:
+            # 所有连接共用同一个TLS上下文；Python的异步连接无法手动传入TLS会话，
+            # 因此握手开销主要靠保活的长连接避免
+            self._transport = _CachedDNSTransport(
+                self.dns_cache,
+                verify=shared_ssl_context(),
+                limits=httpx.Limits(max_connections=None, max_keepalive_connections=64,
+                                    keepalive_expiry=self.keepalive_expiry)
+            )
+            self._client = httpx.AsyncClient(
+                headers={"Accept-Encoding": ACCEPT_ENCODING},
+                transport=self._transport
+            )
+        return self._client
+
+    async def warm(self, url: str) -> int:
+        """
+        并发发送轻量请求，使连接池中至少有 warm_connections 个已握手的连接
+
+        Returns:
+            成功完成的请求数
+        """
+        begin = time.perf_counter()
+
+        async def ping():
+            try:
+                # 只为建立和保持连接，不带密钥，响应状态码无关紧要
+                response = await self.client.get(url, timeout=15)
+                await response.aclose()
+                return True
+            except httpx.HTTPError as e:
+                logger.debug(f"预热请求失败: {e}")
+                return False
+
+        results = await asyncio.gather(*(ping() for _ in range(self.warm_connections)))
+        succeeded = sum(results)
+        self.warm_stats['rounds'] += 1
+        self.warm_stats['requests'] += len(results)
+        self.warm_stats['failures'] += len(results) - succeeded
+        self.warm_stats['last_round_ms'] = round((time.perf_counter() - begin) * 1000, 1)
+        return succeeded
+
+    async def _warm_loop(self, url: str):
+        succeeded = await self.warm(url)
+        logger.info(f"已预热 {succeeded}/{self.warm_connections} 个上游连接，耗时 {self.warm_stats['last_round_ms']}ms")
+        while True:
+            await asyncio.sleep(self.keepalive_interval)
+            await self.warm(url)
+
+    def start_warming(self, url: str):
+        """启动预热和定期保活任务（需在事件循环中调用）"""
+        if self.warm_connections <= 0 or self._warm_task is not None:
+            return
+        self._warm_task = asyncio.create_task(self._warm_loop(url))
+
+    def encode_body(self, data: Dict[str, Any], headers: Dict[str, str]) -> Tuple[bytes, Dict[str, str]]:
+        """
+        把请求数据编码为JSON字节，超过阈值时gzip压缩
+
+        Returns:
+            (请求体字节, 补充了 Content-Type / Content-Encoding 的请求头)
+        """
+        body = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        headers = dict(headers, **{"Content-Type": "application/json"})
+        self.stats['requests'] += 1
+        self.stats['request_bytes'] += len(body)
+        if self.gzip_requests and len(body) >= self.gzip_min_bytes:
+            body = gzip.compress(body, compresslevel=5)
+            headers["Content-Encoding"] = "gzip"
+            self.stats['gzipped_requests'] += 1
+        self.stats['request_wire_bytes'] += len(body)
+        return body, headers
+
+    def record_response(self, response: httpx.Response, decoded_bytes: Optional[int] = None):
+        """
+        记录一个已读取完毕的响应的传输字节数
+
+        Args:
+            response: 上游响应
+            decoded_bytes: 流式读取时由调用方累计的解码后字节数
+        """
+        if decoded_bytes is None:
+            decoded_bytes = len(response.content)
+        self.stats['responses'] += 1
+        self.stats['response_bytes'] += decoded_bytes
+        self.stats['response_wire_bytes'] += response.num_bytes_downloaded
+
+    async def aclose(self):
+        if self._warm_task is not None:
+            self._warm_task.cancel()
+            self._warm_task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取上游传输统计（含压缩节省的字节数）"""
+        return dict(
+            self.stats,
+            accept_encoding=ACCEPT_ENCODING,
+            gzip_requests=self.gzip_requests,
+            request_bytes_saved=self.stats['request_bytes'] - self.stats['request_wire_bytes'],
+            response_bytes_saved=self.stats['response_bytes'] - self.stats['response_wire_bytes'],
+        )
+
+    def get_connection_stats(self) -> Dict[str, Any]:
+        """获取连接池、预热和DNS缓存统计"""
+        return {
+            'pool': self._transport.pool_stats() if self._transport is not None else {},
+            'warm_connections': self.warm_connections,
+            'warm': dict(self.warm_stats),
+            'dns': self.dns_cache.get_stats(),
+        }